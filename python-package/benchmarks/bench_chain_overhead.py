@@ -0,0 +1,71 @@
+"""
+Microbenchmark of the per-request overhead of the chat pipeline without any
+LLM or OpaquePrompts latency, comparing chains built on every request (the
+previous behaviour of the server) with chains taken from the ChainRegistry.
+
+It reports the cost of getting the runnables alone, and of a full request
+through the intermediate-output chain with a fake LLM. Run from the
+python-package directory with:
+
+    PYTHONPATH=src:benchmarks python benchmarks/bench_chain_overhead.py
+"""
+import argparse
+import asyncio
+import time
+from typing import Any, Awaitable, Callable
+
+from fakes import FakeLLM, install_fake_opaqueprompts
+from langchain.prompts import PromptTemplate
+from opchatserver.chains import ChainRegistry
+from opchatserver.intermediate_outputs import (
+    aget_response,
+    get_intermediate_output_chain,
+)
+from opchatserver.memory import build_memory
+from opchatserver.prompt_template import OPAQUEPROMPTS_TEMPLATE
+
+HISTORY = ["Hi, I am PERSON_1", "Hello PERSON_1"] * 3
+
+
+async def measure(
+    name: str, iterations: int, handle: Callable[[], Awaitable[Any]]
+) -> float:
+    for _ in range(10):
+        await handle()
+    start = time.perf_counter()
+    for _ in range(iterations):
+        await handle()
+    per_request = (time.perf_counter() - start) / iterations
+    print(f"{name:<40} {per_request * 1e6:>10.0f} us/request")
+    return per_request
+
+
+async def main(iterations: int) -> None:
+    install_fake_opaqueprompts()
+    registry = ChainRegistry(lambda model_name: FakeLLM())
+
+    async def build() -> Any:
+        prompt = PromptTemplate.from_template(OPAQUEPROMPTS_TEMPLATE)
+        return get_intermediate_output_chain(prompt, FakeLLM())
+
+    async def lookup() -> Any:
+        chains = registry.get("fake", OPAQUEPROMPTS_TEMPLATE)
+        return chains.intermediate_output_chain
+
+    for name, get_chain in [
+        ("rebuilt per request", build),
+        ("chain registry", lookup),
+    ]:
+
+        async def request() -> Any:
+            pg_chain = await get_chain()
+            return await aget_response(pg_chain, build_memory(HISTORY), "Hi")
+
+        await measure(f"{name}: chain only", iterations, get_chain)
+        await measure(f"{name}: full request", iterations, request)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--iterations", type=int, default=500)
+    asyncio.run(main(parser.parse_args().iterations))
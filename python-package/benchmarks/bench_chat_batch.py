@@ -0,0 +1,69 @@
+"""
+Benchmark of /chat/batch against sequential calls to /chat over a single
+client connection, with fake upstreams that simulate the latency of the
+OpaquePrompts service and of the LLM.
+
+A batch pays for one sanitize call and runs CHAT_BATCH_MAX_CONCURRENCY llm
+calls at a time, so its throughput should be several times the one of
+sequential calls. Run from the python-package directory with:
+
+    AUTH0_DOMAIN=x AUTH0_API_AUDIENCE=y PYTHONPATH=src:benchmarks \\
+        python benchmarks/bench_chat_batch.py
+"""
+import argparse
+import asyncio
+import time
+
+import httpx
+from fakes import FakeLLM, install_fake_auth, install_fake_opaqueprompts
+from opchatserver import server
+
+HEADERS = {"Authorization": "Bearer bench"}
+BODY = {"history": ["Hi", "Hello"], "prompt": "How are you?"}
+
+
+async def sequential(client: httpx.AsyncClient, requests: int) -> float:
+    """Send `requests` chats one after the other, and return the RPS"""
+    start = time.perf_counter()
+    for _ in range(requests):
+        response = await client.post("/chat", json=BODY, headers=HEADERS)
+        response.raise_for_status()
+    return requests / (time.perf_counter() - start)
+
+
+async def batch(client: httpx.AsyncClient, requests: int) -> float:
+    """Send `requests` chats in a single batch, and return the RPS"""
+    start = time.perf_counter()
+    response = await client.post(
+        "/chat/batch", json={"requests": [BODY] * requests}, headers=HEADERS
+    )
+    response.raise_for_status()
+    assert all(
+        item["statusCode"] == 200 for item in response.json()["responses"]
+    )
+    return requests / (time.perf_counter() - start)
+
+
+async def main(args: argparse.Namespace) -> None:
+    install_fake_auth()
+    install_fake_opaqueprompts(latency=args.sanitize_latency)
+    llm = FakeLLM(latency=args.llm_latency)
+    server._create_llm = lambda model_name: llm
+
+    async with server.app.router.lifespan_context(server.app):
+        transport = httpx.ASGITransport(app=server.app)
+        async with httpx.AsyncClient(
+            transport=transport, base_url="http://bench", timeout=None
+        ) as client:
+            print(f"{'mode':>12} {'requests/sec':>14}")
+            for name, run in [("sequential", sequential), ("batch", batch)]:
+                rps = await run(client, args.requests)
+                print(f"{name:>12} {rps:>14.1f}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--requests", type=int, default=32)
+    parser.add_argument("--llm-latency", type=float, default=0.2)
+    parser.add_argument("--sanitize-latency", type=float, default=0.05)
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,71 @@
+"""
+Load test of /chat which reports the throughput for an increasing number of
+concurrent requests, with fake upstreams that simulate the latency of the
+OpaquePrompts service and of the LLM.
+
+Because the blocking calls are off the event loop, the throughput should
+scale with the number of in-flight requests (up to the size of the executor,
+see CHAT_EXECUTOR_MAX_WORKERS) instead of staying flat. Run from the
+python-package directory with:
+
+    AUTH0_DOMAIN=x AUTH0_API_AUDIENCE=y PYTHONPATH=src:benchmarks \\
+        python benchmarks/bench_chat_concurrency.py
+"""
+import argparse
+import asyncio
+import time
+
+import httpx
+from fakes import FakeLLM, install_fake_auth, install_fake_opaqueprompts
+from opchatserver import server
+
+
+async def run_level(
+    client: httpx.AsyncClient, concurrency: int, requests: int
+) -> float:
+    """Send `requests` chats, `concurrency` at a time, and return the RPS"""
+    semaphore = asyncio.Semaphore(concurrency)
+    body = {"history": ["Hi", "Hello"], "prompt": "How are you?"}
+
+    async def send() -> None:
+        async with semaphore:
+            response = await client.post(
+                "/chat",
+                json=body,
+                headers={"Authorization": "Bearer bench"},
+            )
+            response.raise_for_status()
+
+    start = time.perf_counter()
+    await asyncio.gather(*[send() for _ in range(requests)])
+    return requests / (time.perf_counter() - start)
+
+
+async def main(args: argparse.Namespace) -> None:
+    install_fake_auth()
+    install_fake_opaqueprompts(latency=args.sanitize_latency)
+    llm = FakeLLM(latency=args.llm_latency)
+    server._create_llm = lambda model_name: llm
+
+    async with server.app.router.lifespan_context(server.app):
+        transport = httpx.ASGITransport(app=server.app)
+        async with httpx.AsyncClient(
+            transport=transport, base_url="http://bench", timeout=None
+        ) as client:
+            print(f"{'concurrency':>12} {'requests/sec':>14}")
+            for concurrency in args.concurrency:
+                rps = await run_level(
+                    client, concurrency, max(args.requests, concurrency)
+                )
+                print(f"{concurrency:>12} {rps:>14.1f}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        "--concurrency", type=int, nargs="+", default=[1, 2, 4, 8, 16, 32]
+    )
+    parser.add_argument("--requests", type=int, default=64)
+    parser.add_argument("--llm-latency", type=float, default=0.2)
+    parser.add_argument("--sanitize-latency", type=float, default=0.05)
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,103 @@
+"""
+Benchmark of the coalescing of identical chats (see `coalescing.py`). It
+sends bursts of chats in which each distinct chat is repeated, like
+retries and double submits, with fake upstreams that simulate the latency
+of the OpaquePrompts service and of the LLM, and reports the mean latency
+and the upstream calls with coalescing enabled and disabled.
+
+Run from the python-package directory with:
+
+    AUTH0_DOMAIN=x AUTH0_API_AUDIENCE=y PYTHONPATH=src:benchmarks \\
+        python benchmarks/bench_coalescing.py
+"""
+import argparse
+import asyncio
+import os
+import statistics
+import time
+from typing import Any, Dict, List
+
+import httpx
+from fakes import FakeLLM, install_fake_auth, install_fake_opaqueprompts
+from opchatserver import server
+from prometheus_client import REGISTRY
+
+
+async def run(
+    llm: FakeLLM, bodies: List[Dict[str, Any]], enabled: bool
+) -> Dict[str, float]:
+    """Post the chats concurrently and return their mean latency"""
+    os.environ["CHAT_COALESCING_ENABLED"] = "true" if enabled else "false"
+    llm.calls = 0
+    followers = (
+        REGISTRY.get_sample_value(
+            "chat_coalesced_requests_total", {"role": "follower"}
+        )
+        or 0.0
+    )
+    latencies: List[float] = []
+
+    async def send(client: httpx.AsyncClient, body: Dict[str, Any]) -> None:
+        start = time.perf_counter()
+        response = await client.post(
+            "/chat", json=body, headers={"Authorization": "Bearer bench"}
+        )
+        response.raise_for_status()
+        latencies.append(time.perf_counter() - start)
+
+    async with server.app.router.lifespan_context(server.app):
+        transport = httpx.ASGITransport(app=server.app)
+        async with httpx.AsyncClient(
+            transport=transport, base_url="http://bench", timeout=None
+        ) as client:
+            await server.app.state.warm_up.load_pipeline()
+            await asyncio.gather(*(send(client, body) for body in bodies))
+    return {
+        "mean": statistics.mean(latencies),
+        "llm_calls": llm.calls,
+        "coalesced": (
+            REGISTRY.get_sample_value(
+                "chat_coalesced_requests_total", {"role": "follower"}
+            )
+            or 0.0
+        )
+        - followers,
+    }
+
+
+async def main(args: argparse.Namespace) -> None:
+    install_fake_auth()
+    install_fake_opaqueprompts(latency=args.sanitize_latency)
+    llm = FakeLLM(latency=args.llm_latency)
+    server._create_llm = lambda model_name: llm
+    # Every chat has the same user, whose chats in flight are bounded
+    os.environ["ADMISSION_MAX_IN_FLIGHT_PER_SUBJECT"] = "64"
+
+    print(
+        f"{'copies':>8}{'coalescing':>12}{'mean':>10}"
+        f"{'llm calls':>11}{'coalesced':>11}"
+    )
+    for copies in args.copies:
+        bodies = [
+            {"history": ["Hi", "Hello"], "prompt": f"How are you? #{i}"}
+            for i in range(args.distinct)
+            for _ in range(copies)
+        ]
+        for enabled in [False, True]:
+            result = await run(llm, bodies, enabled)
+            print(
+                f"{copies:>8}{'on' if enabled else 'off':>12}"
+                f"{result['mean'] * 1e3:>7.0f} ms"
+                f"{result['llm_calls']:>11.0f}{result['coalesced']:>11.0f}"
+            )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawTextHelpFormatter
+    )
+    parser.add_argument("--distinct", type=int, default=8)
+    parser.add_argument("--copies", type=int, nargs="+", default=[1, 2, 4])
+    parser.add_argument("--llm-latency", type=float, default=0.2)
+    parser.add_argument("--sanitize-latency", type=float, default=0.05)
+    asyncio.run(main(parser.parse_args()))
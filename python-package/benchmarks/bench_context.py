@@ -0,0 +1,137 @@
+"""
+Microbenchmark of the memory allocated per chat by the chain with
+intermediate outputs, comparing the previous data flow, in which each stage
+passed its results on in new dicts and the response was built from the
+dict of outputs, with the per-chat `ChatContext` carried through the
+stages. Fake OpaquePrompts functions and a fake LLM, which answers with a
+response as long as the prompt, take no time, so only the server is
+measured.
+
+It reports the peak memory allocated during a chat, as measured by
+tracemalloc, and the time per chat, for large prompts and histories. Run
+from the python-package directory with:
+
+    PYTHONPATH=src:benchmarks python benchmarks/bench_context.py
+"""
+import argparse
+import asyncio
+import time
+import tracemalloc
+from typing import Any, Awaitable, Callable, Dict, List
+
+from fakes import FakeLLM, install_fake_opaqueprompts
+from langchain.prompts import PromptTemplate
+from opchatserver.executor import run_in_executor
+from opchatserver.intermediate_outputs import (
+    IntermediateOutputChain,
+    _asanitize,
+    aget_response,
+)
+from opchatserver.memory import build_memory
+from opchatserver.models import ChatResponse
+from opchatserver.prompt_template import OPAQUEPROMPTS_TEMPLATE
+from opchatserver.sanitization_cache import desanitize
+
+MESSAGE = "Could you tell me more about the second option you mentioned? "
+
+
+async def previous_aget_response(
+    pg_chain: IntermediateOutputChain, history: List[str], input: str
+) -> ChatResponse:
+    """The data flow of `aget_response` before the rework"""
+    memory = build_memory(history)
+    sanitized = await _asanitize(
+        {"prompt": input, "history": memory.buffer_as_messages}
+    )
+    raw_response = await pg_chain.completion.ainvoke(
+        sanitized["sanitized_input"]
+    )
+    outputs = {
+        "raw_response": raw_response,
+        "secure_context": sanitized["secure_context"],
+    }
+    desanitized_response = await run_in_executor(
+        lambda: desanitize(outputs["raw_response"], outputs["secure_context"])
+    )
+    return ChatResponse(
+        **{
+            "sanitizedPrompt": sanitized["sanitized_input"]["prompt"],
+            "rawResponse": raw_response,
+            "desanitizedResponse": desanitized_response,
+            "preScreen": sanitized.get("pre_screen"),
+        }
+    )
+
+
+async def context_aget_response(
+    pg_chain: IntermediateOutputChain, history: List[str], input: str
+) -> ChatResponse:
+    return await aget_response(pg_chain, build_memory(history), input)
+
+
+async def measure(
+    get_response: Callable[..., Awaitable[ChatResponse]],
+    pg_chain: IntermediateOutputChain,
+    history: List[str],
+    input: str,
+    iterations: int,
+) -> Dict[str, float]:
+    """Return the median peak memory and the mean time of a chat"""
+    await get_response(pg_chain, history, input)
+    peaks: List[int] = []
+    tracemalloc.start()
+    for _ in range(iterations):
+        baseline = tracemalloc.get_traced_memory()[0]
+        tracemalloc.reset_peak()
+        await get_response(pg_chain, history, input)
+        peaks.append(tracemalloc.get_traced_memory()[1] - baseline)
+    tracemalloc.stop()
+    start = time.perf_counter()
+    for _ in range(iterations):
+        await get_response(pg_chain, history, input)
+    return {
+        "peak": sorted(peaks)[len(peaks) // 2],
+        "time": (time.perf_counter() - start) / iterations,
+    }
+
+
+async def main(args: argparse.Namespace) -> None:
+    install_fake_opaqueprompts()
+    prompt = PromptTemplate.from_template(OPAQUEPROMPTS_TEMPLATE)
+
+    print(
+        f"{'turns':>6}{'prompt':>10}{'implementation':>16}"
+        f"{'peak':>12}{'time':>12}"
+    )
+    for turns in args.turns:
+        for prompt_length in args.prompt_lengths:
+            input = (MESSAGE * (prompt_length // len(MESSAGE) + 1))[
+                :prompt_length
+            ]
+            history: List[str] = [MESSAGE * 8] * (2 * turns)
+            pg_chain = IntermediateOutputChain(prompt, FakeLLM(response=input))
+            results: Dict[str, Any] = {}
+            for name, get_response in [
+                ("previous", previous_aget_response),
+                ("context", context_aget_response),
+            ]:
+                results[name] = await measure(
+                    get_response, pg_chain, history, input, args.iterations
+                )
+                print(
+                    f"{turns:>6}{prompt_length:>10}{name:>16}"
+                    f"{results[name]['peak'] / 1024:>9.1f} KiB"
+                    f"{results[name]['time'] * 1e3:>9.2f} ms"
+                )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawTextHelpFormatter
+    )
+    parser.add_argument("--iterations", type=int, default=50)
+    parser.add_argument("--turns", type=int, nargs="+", default=[10, 100])
+    parser.add_argument(
+        "--prompt-lengths", type=int, nargs="+", default=[1000, 30000]
+    )
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,109 @@
+"""
+Microbenchmark of the flattening and joining of the history around the
+sanitize call (`intermediate_outputs._sanitize`), with a sanitizer that
+returns its input, comparing the previous implementation with the current
+one over histories of increasing length.
+
+It reports the time per call, and the peak memory allocated during a call
+as measured by tracemalloc. The previous implementation modified its input,
+so its callers copied it first, which is included. Run from the
+python-package directory with:
+
+    PYTHONPATH=src:benchmarks python benchmarks/bench_history.py
+"""
+import argparse
+import time
+import tracemalloc
+from typing import Any, Callable, Dict, List
+
+import langchain.utilities.opaqueprompts as op
+from fakes import install_fake_opaqueprompts
+from langchain.schema import AIMessage, BaseMessage, HumanMessage
+from opchatserver.intermediate_outputs import _sanitize
+
+MESSAGE = "Could you tell me more about the second option you mentioned? "
+
+
+def previous_sanitize(unsanitized_input: Dict[str, Any]) -> Dict[str, Any]:
+    """The implementation of `_sanitize` before the rework"""
+    unsanitized_input.pop("conversation_key", None)
+    history = unsanitized_input.pop("history")
+    split_history = [message.content for message in history]
+    for i, chat_message in enumerate(split_history):
+        prefix = "Human"
+        if i % 2 == 1:
+            prefix = "Ai"
+        unsanitized_input[f"{prefix} {i//2 + 1}"] = chat_message
+    turns = len(split_history) // 2
+    sanitized_response = op.sanitize(unsanitized_input)
+    sanitized_input = sanitized_response["sanitized_input"]
+    assert isinstance(sanitized_input, dict)
+    history_str = ""
+    for i in range(1, turns + 1):
+        human_message = sanitized_input.pop(f"Human {i}")
+        ai_message = sanitized_input.pop(f"Ai {i}")
+        history_str += f"Human: {human_message}AI: {ai_message}"
+    sanitized_input["history"] = history_str
+    return sanitized_response
+
+
+def make_history(turns: int) -> List[BaseMessage]:
+    history: List[BaseMessage] = []
+    for i in range(turns):
+        history.append(HumanMessage(content=f"{i}: {MESSAGE * 4}"))
+        history.append(AIMessage(content=f"{i}: {MESSAGE * 8}"))
+    return history
+
+
+def measure(
+    sanitize: Callable[[Dict[str, Any]], Dict[str, Any]],
+    unsanitized_input: Dict[str, Any],
+    iterations: int,
+) -> Dict[str, float]:
+    start = time.perf_counter()
+    for _ in range(iterations):
+        sanitize(dict(unsanitized_input))
+    per_call = (time.perf_counter() - start) / iterations
+
+    tracemalloc.start()
+    sanitize(dict(unsanitized_input))
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {"time": per_call, "peak": peak}
+
+
+def main(turn_counts: List[int], iterations: int) -> None:
+    install_fake_opaqueprompts()
+    implementations = {"previous": previous_sanitize, "current": _sanitize}
+    print(
+        f"{'turns':>6}"
+        + "".join(f"{name + ' time':>16}" for name in implementations)
+        + "".join(f"{name + ' peak':>16}" for name in implementations)
+    )
+    for turns in turn_counts:
+        unsanitized_input = {
+            "prompt": "And the third one?",
+            "history": make_history(turns),
+            "conversation_key": "bench:conversation",
+        }
+        results = [
+            measure(sanitize, unsanitized_input, iterations)
+            for sanitize in implementations.values()
+        ]
+        print(
+            f"{turns:>6}"
+            + "".join(f"{r['time'] * 1e6:>13.1f} us" for r in results)
+            + "".join(f"{r['peak'] / 1024:>13.1f} KB" for r in results)
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawTextHelpFormatter
+    )
+    parser.add_argument(
+        "--turns", type=int, nargs="+", default=[10, 50, 100, 500, 1000]
+    )
+    parser.add_argument("--iterations", type=int, default=200)
+    args = parser.parse_args()
+    main(args.turns, args.iterations)
@@ -0,0 +1,368 @@
+"""
+Load test of the chat endpoints over HTTP, against local stand-ins for
+Auth0, OpaquePrompts and OpenAI (see `stand_ins.py`).
+
+The server runs in a uvicorn subprocess, as in production, and each
+scenario reports the throughput and the p50/p95/p99 latencies of its runs:
+
+- history: /chat with histories of increasing length,
+- intermediate: /chat with and without intermediate outputs, and
+  /chat/stream, whose time to first byte is also reported,
+- concurrency: /chat with an increasing number of concurrent requests.
+
+The results are written to a JSON file, and compared with the results of
+a previous run given with --baseline, to track regressions between
+commits. Run from the python-package directory with:
+
+    PYTHONPATH=src:benchmarks python benchmarks/bench_load.py \\
+        --output load.json [--baseline previous.json]
+"""
+import argparse
+import asyncio
+import json
+import os
+import socket
+import statistics
+import subprocess
+import sys
+import time
+from dataclasses import asdict, dataclass
+from datetime import datetime, timezone
+from typing import Any, Dict, List, Optional, Tuple
+
+import httpx
+from stand_ins import NAMES, Latencies, StandIns
+
+DOMAIN = "bench-domain.local"
+AUDIENCE = "https://bench-audience.local"
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+@dataclass
+class Run:
+    """One run of a scenario"""
+
+    scenario: str
+    endpoint: str
+    history_turns: int
+    with_intermediate_outputs: bool
+    concurrency: int
+
+
+SCENARIOS: Dict[str, List[Run]] = {
+    "history": [
+        Run("history", "/chat", turns, True, 8) for turns in (0, 2, 5, 20)
+    ],
+    "intermediate": [
+        Run("intermediate", "/chat", 2, True, 8),
+        Run("intermediate", "/chat", 2, False, 8),
+        Run("intermediate", "/chat/stream", 2, True, 8),
+        Run("intermediate", "/chat/stream", 2, False, 8),
+    ],
+    "concurrency": [
+        Run("concurrency", "/chat", 2, True, concurrency)
+        for concurrency in (1, 4, 16, 64)
+    ],
+}
+
+
+def make_body(run: Run, user: int) -> Dict[str, Any]:
+    name = NAMES[user % len(NAMES)]
+    history = []
+    for turn in range(run.history_turns):
+        history += [
+            f"My name is {name}, this is message {turn}.",
+            f"Nice to meet you {name}, this is answer {turn}.",
+        ]
+    return {
+        "history": history,
+        "prompt": f"Hi, I am {name}. What is my name?",
+        "with_intermediate_outputs": run.with_intermediate_outputs,
+    }
+
+
+async def send(
+    client: httpx.AsyncClient,
+    endpoint: str,
+    body: Dict[str, Any],
+    token: str,
+) -> Tuple[float, Optional[float], bool]:
+    """
+    Send a chat request and read its whole response.
+
+    Returns
+    -------
+    (float, float or None, bool)
+        The latency, the time to the first event of a stream, and whether
+        the request succeeded.
+    """
+    headers = {"Authorization": f"Bearer {token}"}
+    start = time.perf_counter()
+    first_byte = None
+    chunk = ""
+    async with client.stream(
+        "POST", endpoint, json=body, headers=headers
+    ) as response:
+        async for chunk in response.aiter_text():
+            if first_byte is None and chunk:
+                first_byte = time.perf_counter() - start
+        succeeded = response.status_code == 200
+        if endpoint == "/chat/stream":
+            # Errors of a stream are sent as its last event
+            succeeded = succeeded and "event: error" not in chunk
+    return time.perf_counter() - start, first_byte, succeeded
+
+
+def percentiles(values: List[float]) -> Dict[str, float]:
+    """The mean and the p50/p95/p99 of latencies, in milliseconds"""
+    if len(values) < 2:
+        values = values * 2 or [0.0, 0.0]
+    cuts = statistics.quantiles(values, n=100, method="inclusive")
+    return {
+        "mean": round(statistics.fmean(values) * 1000, 2),
+        "p50": round(cuts[49] * 1000, 2),
+        "p95": round(cuts[94] * 1000, 2),
+        "p99": round(cuts[98] * 1000, 2),
+    }
+
+
+async def run_load(
+    client: httpx.AsyncClient,
+    run: Run,
+    tokens: List[str],
+    requests: int,
+) -> Dict[str, Any]:
+    """Send `requests` chats of a run, and summarize their latencies"""
+    semaphore = asyncio.Semaphore(run.concurrency)
+    results: List[Tuple[float, Optional[float], bool]] = []
+
+    async def one(i: int) -> None:
+        async with semaphore:
+            user = i % len(tokens)
+            results.append(
+                await send(
+                    client, run.endpoint, make_body(run, user), tokens[user]
+                )
+            )
+
+    # Warm up the connections, the JWKS and the caches of the server
+    await asyncio.gather(*[one(i) for i in range(run.concurrency)])
+    results.clear()
+
+    start = time.perf_counter()
+    await asyncio.gather(*[one(i) for i in range(requests)])
+    elapsed = time.perf_counter() - start
+
+    latencies = [latency for latency, _, ok in results if ok]
+    first_bytes = [ttfb for _, ttfb, ok in results if ok and ttfb]
+    summary: Dict[str, Any] = asdict(run)
+    summary.update(
+        {
+            "requests": requests,
+            "errors": sum(1 for *_, ok in results if not ok),
+            "rps": round(len(latencies) / elapsed, 2),
+            "latency_ms": percentiles(latencies),
+        }
+    )
+    if run.endpoint == "/chat/stream":
+        summary["first_byte_ms"] = percentiles(first_bytes)
+    return summary
+
+
+def run_key(result: Dict[str, Any]) -> Tuple[Any, ...]:
+    return tuple(result[field] for field in Run.__dataclass_fields__)
+
+
+def print_results(
+    results: List[Dict[str, Any]], baseline: Optional[Dict[str, Any]]
+) -> None:
+    previous = {
+        run_key(result): result
+        for result in (baseline or {}).get("results", [])
+    }
+    print(
+        f"{'scenario':<13}{'endpoint':<14}{'hist':>5}{'inter':>6}{'conc':>5}"
+        f"{'rps':>9}{'p50':>9}{'p95':>9}{'p99':>9}{'err':>5}"
+        + (f"{'rps vs base':>13}" if baseline else "")
+    )
+    for result in results:
+        latency = result["latency_ms"]
+        line = (
+            f"{result['scenario']:<13}{result['endpoint']:<14}"
+            f"{result['history_turns']:>5}"
+            f"{'yes' if result['with_intermediate_outputs'] else 'no':>6}"
+            f"{result['concurrency']:>5}{result['rps']:>9.1f}"
+            f"{latency['p50']:>9.1f}{latency['p95']:>9.1f}"
+            f"{latency['p99']:>9.1f}{result['errors']:>5}"
+        )
+        before = previous.get(run_key(result))
+        if before and before["rps"]:
+            change = (result["rps"] - before["rps"]) / before["rps"]
+            line += f"{change:>+13.1%}"
+        print(line)
+
+
+def git_commit() -> Optional[str]:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "HEAD"],
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def launch_server(
+    stand_ins: StandIns, model: str, workers: int = 1
+) -> Tuple[subprocess.Popen, str]:
+    """Start the server in a uvicorn subprocess, without waiting for it"""
+    port = free_port()
+    env = dict(os.environ)
+    env.update(
+        {
+            "AUTH0_DOMAIN": DOMAIN,
+            "AUTH0_API_AUDIENCE": AUDIENCE,
+            "BENCH_JWKS_URL": stand_ins.jwks_url,
+            "BENCH_OPAQUEPROMPTS_URL": stand_ins.opaqueprompts_url,
+            "OPAQUEPROMPTS_API_KEY": "bench",
+            "OPENAI_API_BASE": stand_ins.openai_url,
+            "OPENAI_API_KEY": "bench",
+            "OPENAI_MODEL": model,
+            "PYTHONPATH": os.pathsep.join(
+                [
+                    os.path.join(BENCHMARKS_DIR, "..", "src"),
+                    BENCHMARKS_DIR,
+                    env.get("PYTHONPATH", ""),
+                ]
+            ),
+        }
+    )
+    process = subprocess.Popen(
+        [
+            sys.executable,
+            "-m",
+            "uvicorn",
+            "load_app:app",
+            "--port",
+            str(port),
+            "--workers",
+            str(workers),
+            "--log-level",
+            "warning",
+        ],
+        env=env,
+    )
+    return process, f"http://127.0.0.1:{port}"
+
+
+def start_server(
+    stand_ins: StandIns, args: argparse.Namespace
+) -> Tuple[subprocess.Popen, str]:
+    """Start the server in a uvicorn subprocess, and wait until it is ready"""
+    process, url = launch_server(stand_ins, args.model, args.workers)
+    deadline = time.monotonic() + 60
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError("the server exited on startup")
+        try:
+            # With several workers, this only checks one of them
+            if httpx.get(f"{url}/ready", timeout=1).status_code == 200:
+                return process, url
+        except httpx.TransportError:
+            pass
+        time.sleep(0.2)
+    process.terminate()
+    raise RuntimeError("the server was not ready in 60 seconds")
+
+
+async def main(args: argparse.Namespace) -> None:
+    latencies = Latencies(
+        jwks=args.jwks_latency,
+        sanitize=args.sanitize_latency,
+        desanitize=args.desanitize_latency,
+        llm=args.llm_latency,
+        llm_token=args.llm_token_latency,
+    )
+    stand_ins = StandIns(
+        latencies, DOMAIN, AUDIENCE, response_words=args.response_words
+    )
+    tokens = [stand_ins.make_token(f"bench|{i}") for i in range(args.users)]
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+
+    process, url = start_server(stand_ins, args)
+    results = []
+    try:
+        limits = httpx.Limits(
+            max_connections=None, max_keepalive_connections=None
+        )
+        async with httpx.AsyncClient(
+            base_url=url, timeout=None, limits=limits
+        ) as client:
+            for scenario in args.scenarios:
+                for run in SCENARIOS[scenario]:
+                    results.append(
+                        await run_load(
+                            client,
+                            run,
+                            tokens,
+                            max(args.requests, 4 * run.concurrency),
+                        )
+                    )
+    finally:
+        process.terminate()
+        process.wait()
+
+    print_results(results, baseline)
+    report = {
+        "commit": git_commit(),
+        "timestamp": datetime.now(timezone.utc).isoformat(),
+        "config": vars(args),
+        "results": results,
+    }
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"results written to {args.output}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawTextHelpFormatter
+    )
+    parser.add_argument(
+        "--scenarios",
+        nargs="+",
+        choices=list(SCENARIOS),
+        default=list(SCENARIOS),
+    )
+    parser.add_argument("--requests", type=int, default=64)
+    parser.add_argument(
+        "--users",
+        type=int,
+        default=16,
+        help="number of distinct users, whose requests are admitted "
+        "separately",
+    )
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument("--model", default="gpt-3.5-turbo")
+    parser.add_argument("--response-words", type=int, default=32)
+    parser.add_argument("--jwks-latency", type=float, default=0.02)
+    parser.add_argument("--sanitize-latency", type=float, default=0.05)
+    parser.add_argument("--desanitize-latency", type=float, default=0.02)
+    parser.add_argument("--llm-latency", type=float, default=0.2)
+    parser.add_argument("--llm-token-latency", type=float, default=0.005)
+    parser.add_argument("--output", default="load-results.json")
+    parser.add_argument(
+        "--baseline", help="results of a previous run to compare with"
+    )
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,131 @@
+"""
+Benchmark of the micro-batching of the OpaquePrompts calls (see
+`microbatch.py`). It sends bursts of concurrent chats of one user, with a
+fake OpaquePrompts service which handles one call at a time and charges a
+fixed overhead per call plus a cost per text, and reports the throughput,
+the mean latency and the sanitize calls for several batch sizes and
+windows.
+
+Run from the python-package directory with:
+
+    AUTH0_DOMAIN=x AUTH0_API_AUDIENCE=y PYTHONPATH=src:benchmarks \\
+        python benchmarks/bench_microbatch.py
+"""
+import argparse
+import asyncio
+import json
+import os
+import statistics
+import threading
+import time
+from typing import Dict, List, Tuple, Union
+
+import httpx
+from fakes import FakeLLM, install_fake_auth
+from langchain.utilities import opaqueprompts as op
+from opchatserver import server
+
+
+class OverheadOpaquePrompts:
+    """
+    A fake OpaquePrompts service which handles one call at a time, and
+    takes `overhead` seconds per call plus `per_text` seconds per text
+    """
+
+    def __init__(self, overhead: float, per_text: float):
+        self.overhead = overhead
+        self.per_text = per_text
+        self.sanitize_calls = 0
+        self._lock = threading.Lock()
+
+    def sanitize(
+        self, input: Union[str, Dict[str, str]]
+    ) -> Dict[str, Union[str, Dict[str, str]]]:
+        with self._lock:
+            self.sanitize_calls += 1
+            texts = 1 if isinstance(input, str) else len(input)
+            time.sleep(self.overhead + self.per_text * texts)
+        return {"sanitized_input": input, "secure_context": json.dumps({})}
+
+    def desanitize(self, sanitized_text: str, secure_context: bytes) -> str:
+        with self._lock:
+            time.sleep(self.overhead + self.per_text)
+        return sanitized_text
+
+
+async def run(
+    service: OverheadOpaquePrompts, chats: int, max_size: int, window: float
+) -> Dict[str, float]:
+    """Post the chats concurrently and return their throughput and latency"""
+    for stage in ["SANITIZE", "DESANITIZE"]:
+        os.environ[f"{stage}_BATCH_MAX_SIZE"] = str(max_size)
+        os.environ[f"{stage}_BATCH_WINDOW"] = str(window)
+    service.sanitize_calls = 0
+    latencies: List[float] = []
+
+    async def send(client: httpx.AsyncClient, i: int) -> None:
+        start = time.perf_counter()
+        response = await client.post(
+            "/chat",
+            json={"history": ["Hi", "Hello"], "prompt": f"How are you? #{i}"},
+            headers={"Authorization": "Bearer bench"},
+        )
+        response.raise_for_status()
+        latencies.append(time.perf_counter() - start)
+
+    async with server.app.router.lifespan_context(server.app):
+        transport = httpx.ASGITransport(app=server.app)
+        async with httpx.AsyncClient(
+            transport=transport, base_url="http://bench", timeout=None
+        ) as client:
+            await server.app.state.warm_up.load_pipeline()
+            start = time.perf_counter()
+            await asyncio.gather(*(send(client, i) for i in range(chats)))
+            elapsed = time.perf_counter() - start
+    return {
+        "throughput": chats / elapsed,
+        "mean": statistics.mean(latencies),
+        "sanitize_calls": service.sanitize_calls,
+    }
+
+
+async def main(args: argparse.Namespace) -> None:
+    install_fake_auth()
+    service = OverheadOpaquePrompts(args.overhead, args.per_text)
+    op.sanitize = service.sanitize
+    op.desanitize = service.desanitize
+    server._create_llm = lambda model_name: FakeLLM(latency=args.llm_latency)
+    # Every chat has the same user, whose chats in flight are bounded
+    os.environ["ADMISSION_MAX_IN_FLIGHT_PER_SUBJECT"] = str(args.chats)
+
+    configs: List[Tuple[int, float]] = [(1, 0.0)] + [
+        (max_size, window)
+        for max_size in args.max_sizes
+        for window in args.windows
+    ]
+    print(
+        f"{'max size':>9}{'window':>10}{'chats/s':>10}{'mean':>10}"
+        f"{'sanitize calls':>16}"
+    )
+    for max_size, window in configs:
+        result = await run(service, args.chats, max_size, window)
+        print(
+            f"{max_size:>9}{window * 1e3:>7.0f} ms"
+            f"{result['throughput']:>10.1f}{result['mean'] * 1e3:>7.0f} ms"
+            f"{result['sanitize_calls']:>16.0f}"
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawTextHelpFormatter
+    )
+    parser.add_argument("--chats", type=int, default=64)
+    parser.add_argument("--max-sizes", type=int, nargs="+", default=[8, 32])
+    parser.add_argument(
+        "--windows", type=float, nargs="+", default=[0.002, 0.01]
+    )
+    parser.add_argument("--overhead", type=float, default=0.02)
+    parser.add_argument("--per-text", type=float, default=0.001)
+    parser.add_argument("--llm-latency", type=float, default=0.05)
+    asyncio.run(main(parser.parse_args()))
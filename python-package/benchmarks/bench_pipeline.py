@@ -0,0 +1,86 @@
+"""
+Benchmark of the critical path of /chat, with fake upstreams that simulate
+the latency of the token verification, e.g. when the signing keys are
+fetched or the token is not cached yet, of the OpaquePrompts service and of
+the LLM. It reports the median latency of sequential chats, with the token
+verified in `--auth-latency` seconds or from the cache, and with
+CHAT_SPECULATIVE_SANITIZE disabled and enabled.
+
+Run from the python-package directory with:
+
+    AUTH0_DOMAIN=x AUTH0_API_AUDIENCE=y PYTHONPATH=src:benchmarks \\
+        python benchmarks/bench_pipeline.py
+"""
+import argparse
+import asyncio
+import os
+import statistics
+import time
+from typing import Any, List
+
+import httpx
+from fakes import FakeLLM, install_fake_auth, install_fake_opaqueprompts
+from opchatserver import server
+from opchatserver.authorization import VerifyToken
+
+BODY = {
+    "history": ["Hi, I am Bob", "Hello PERSON_1, how can I help?"],
+    "prompt": "What is my name?",
+}
+
+
+async def run(
+    client: httpx.AsyncClient, requests: int, auth_latency: float
+) -> float:
+    """Post the chats one at a time and return their median latency"""
+
+    def verify(self: VerifyToken, required_scopes: Any = None) -> Any:
+        time.sleep(auth_latency)
+        return {"sub": "bench|1"}
+
+    VerifyToken.verify = verify  # type: ignore
+    latencies: List[float] = []
+    for _ in range(requests):
+        start = time.perf_counter()
+        response = await client.post(
+            "/chat", json=BODY, headers={"Authorization": "Bearer bench"}
+        )
+        response.raise_for_status()
+        latencies.append(time.perf_counter() - start)
+    return statistics.median(latencies)
+
+
+async def main(args: argparse.Namespace) -> None:
+    install_fake_auth()
+    install_fake_opaqueprompts(latency=args.sanitize_latency)
+    server._create_llm = lambda model_name: FakeLLM(latency=args.llm_latency)
+
+    print(f"{'token':<10}{'speculative':>12}{'median':>12}")
+    for speculative in ["false", "true"]:
+        os.environ["CHAT_SPECULATIVE_SANITIZE"] = speculative
+        async with server.app.router.lifespan_context(server.app):
+            transport = httpx.ASGITransport(app=server.app)
+            async with httpx.AsyncClient(
+                transport=transport, base_url="http://bench", timeout=None
+            ) as client:
+                await server.app.state.warm_up.load_pipeline()
+                for token, latency in [
+                    ("cached", 0.0),
+                    ("verified", args.auth_latency),
+                ]:
+                    median = await run(client, args.requests, latency)
+                    print(
+                        f"{token:<10}{speculative:>12}"
+                        f"{median * 1e3:>9.1f} ms"
+                    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawTextHelpFormatter
+    )
+    parser.add_argument("--requests", type=int, default=30)
+    parser.add_argument("--auth-latency", type=float, default=0.05)
+    parser.add_argument("--sanitize-latency", type=float, default=0.05)
+    parser.add_argument("--llm-latency", type=float, default=0.2)
+    asyncio.run(main(parser.parse_args()))
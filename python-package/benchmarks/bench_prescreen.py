@@ -0,0 +1,155 @@
+"""
+Benchmark of the local pre-screen (see `prescreen.py`), which reports:
+
+- the time taken to screen inputs of increasing size, per mode,
+- the share of a sample of prompts that each mode finds clean,
+- the latency of /chat per mode, for clean prompts and prompts with names,
+  with fake upstreams that simulate the latency of the OpaquePrompts
+  service and of the LLM, and the latency saved per request compared with
+  the pre-screen turned off.
+
+Run from the python-package directory with:
+
+    AUTH0_DOMAIN=x AUTH0_API_AUDIENCE=y PYTHONPATH=src:benchmarks \\
+        python benchmarks/bench_prescreen.py
+"""
+import argparse
+import asyncio
+import os
+import statistics
+import time
+from typing import Dict, List
+
+import httpx
+from fakes import FakeLLM, install_fake_auth, install_fake_opaqueprompts
+from opchatserver import server
+from opchatserver.prescreen import get_prescreen
+
+MODES = {
+    "off": {"PRESCREEN_MODE": "off"},
+    "conservative": {"PRESCREEN_MODE": "conservative"},
+    # e.g. a deployment answering programming questions
+    "tunable": {
+        "PRESCREEN_MODE": "tunable",
+        "PRESCREEN_ENTITIES": "EMAIL_ADDRESS,URL,IP_ADDRESS,US_SSN,"
+        "CREDIT_CARD,IBAN,PHONE_NUMBER,PROPER_NOUN",
+        "PRESCREEN_ALLOWED_WORDS": "Python,JavaScript,SQL,Docker,Linux,API",
+    },
+}
+
+SAMPLE_PROMPTS = [
+    "hello",
+    "how are you today?",
+    "tell me a joke about cats",
+    "What is the capital of France?",
+    "How do I reverse a list in Python?",
+    "Write a SQL query that counts the rows of a table.",
+    "explain the difference between threads and processes",
+    "My name is Alice, what is my name?",
+    "Email bob@example.com about the meeting on 12/03/2024",
+    "Can you summarize this: the quarterly results were 12% up.",
+    "Why does my Docker build fail with exit code 137?",
+    "thanks, that helps!",
+]
+
+
+def use_mode(mode: str) -> None:
+    for name in ("PRESCREEN_ENTITIES", "PRESCREEN_ALLOWED_WORDS"):
+        os.environ.pop(name, None)
+    os.environ.update(MODES[mode])
+
+
+def bench_screen(sizes: List[int], iterations: int) -> None:
+    print(f"{'screen, chars':<16}" + "".join(f"{m:>16}" for m in MODES))
+    for size in sizes:
+        text = ("please explain how this works " * size)[:size]
+        line = f"{size:<16}"
+        for mode in MODES:
+            use_mode(mode)
+            prescreen = get_prescreen()
+            if prescreen is None:
+                line += f"{'-':>16}"
+                continue
+            start = time.perf_counter()
+            for _ in range(iterations):
+                prescreen.is_clean([text])
+            per_call = (time.perf_counter() - start) / iterations
+            line += f"{per_call * 1e6:>13.1f} us"
+        print(line)
+
+
+def bench_clean_share() -> None:
+    print(f"\n{'clean prompts':<16}" + "".join(f"{m:>16}" for m in MODES))
+    line = f"{len(SAMPLE_PROMPTS):<16}"
+    for mode in MODES:
+        use_mode(mode)
+        prescreen = get_prescreen()
+        clean = (
+            sum(prescreen.is_clean([prompt]) for prompt in SAMPLE_PROMPTS)
+            if prescreen is not None
+            else 0
+        )
+        line += f"{clean / len(SAMPLE_PROMPTS):>16.0%}"
+    print(line)
+
+
+async def chat_latency(
+    client: httpx.AsyncClient, prompt: str, requests: int
+) -> float:
+    """The median latency of sequential chats with a prompt, in seconds"""
+    body = {"history": ["hi", "hello, how can I help?"], "prompt": prompt}
+    latencies = []
+    for _ in range(requests):
+        start = time.perf_counter()
+        response = await client.post(
+            "/chat", json=body, headers={"Authorization": "Bearer bench"}
+        )
+        response.raise_for_status()
+        latencies.append(time.perf_counter() - start)
+    return statistics.median(latencies)
+
+
+async def bench_chat(args: argparse.Namespace) -> None:
+    install_fake_auth()
+    install_fake_opaqueprompts(latency=args.sanitize_latency)
+    llm = FakeLLM(latency=args.llm_latency, response="Sure!")
+    server._create_llm = lambda model_name: llm
+
+    prompts = {"clean": "how are you today?", "names": "Hi, I am Alice."}
+    print(f"\n{'/chat, median':<16}{'prompt':>10}{'latency':>12}{'saved':>12}")
+    async with server.app.router.lifespan_context(server.app):
+        transport = httpx.ASGITransport(app=server.app)
+        async with httpx.AsyncClient(
+            transport=transport, base_url="http://bench", timeout=None
+        ) as client:
+            baseline: Dict[str, float] = {}
+            for mode in MODES:
+                use_mode(mode)
+                for kind, prompt in prompts.items():
+                    latency = await chat_latency(client, prompt, args.requests)
+                    baseline.setdefault(kind, latency)
+                    saved = baseline[kind] - latency
+                    print(
+                        f"{mode:<16}{kind:>10}{latency * 1000:>9.1f} ms"
+                        f"{saved * 1000:>9.1f} ms"
+                    )
+
+
+def main(args: argparse.Namespace) -> None:
+    bench_screen(args.sizes, args.iterations)
+    bench_clean_share()
+    asyncio.run(bench_chat(args))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawTextHelpFormatter
+    )
+    parser.add_argument(
+        "--sizes", type=int, nargs="+", default=[64, 1024, 16384]
+    )
+    parser.add_argument("--iterations", type=int, default=1000)
+    parser.add_argument("--requests", type=int, default=20)
+    parser.add_argument("--llm-latency", type=float, default=0.2)
+    parser.add_argument("--sanitize-latency", type=float, default=0.05)
+    main(parser.parse_args())
@@ -0,0 +1,205 @@
+"""
+Benchmark of the routing of the chats to the LLM backends (see
+`backends.py`), with local fake backends. It reports the latency of /chat:
+
+- for a mix of short and long prompts, when every chat goes to a slow
+  "large" backend, and when a route sends the short prompts to a fast
+  "small" backend,
+- under concurrent load, when every chat goes to one replica of a backend
+  whose latency grows once it has more than `--capacity` calls in flight,
+  and when a route spreads the chats over two replicas by their recent
+  latency.
+
+Run from the python-package directory with:
+
+    AUTH0_DOMAIN=x AUTH0_API_AUDIENCE=y PYTHONPATH=src:benchmarks \\
+        python benchmarks/bench_routing.py
+"""
+import argparse
+import asyncio
+import json
+import os
+import statistics
+import tempfile
+import time
+from collections import Counter
+from typing import Any, Dict, List, Optional
+
+import httpx
+from fakes import install_fake_auth, install_fake_opaqueprompts
+from langchain.callbacks.manager import AsyncCallbackManagerForLLMRun
+from opchatserver import server
+from opchatserver.llms import FakeLLM
+
+SHORT_BODY = {"history": ["Hi", "Hello"], "prompt": "How are you?"}
+LONG_BODY = {
+    "history": ["Hi", "Hello"],
+    "prompt": "Summarize this text. " + "It was a dark night. " * 200,
+}
+
+# The calls in flight of each saturating backend
+_in_flight: Dict[str, int] = {}
+
+
+class SaturatingLLM(FakeLLM):
+    """
+    A fake LLM whose latency grows with the calls in flight beyond its
+    capacity, like a backend whose requests are queued.
+    """
+
+    name: str = "saturating"
+    capacity: int = 4
+
+    async def _acall(
+        self,
+        prompt: str,
+        stop: Optional[List[str]] = None,
+        run_manager: Optional[AsyncCallbackManagerForLLMRun] = None,
+        **kwargs: Any,
+    ) -> str:
+        in_flight = _in_flight[self.name] = _in_flight.get(self.name, 0) + 1
+        try:
+            await asyncio.sleep(
+                self.latency * max(1.0, in_flight / self.capacity)
+            )
+        finally:
+            _in_flight[self.name] -= 1
+        return self._respond(prompt)
+
+
+def create_saturating_llm(name: str, params: Dict[str, Any]) -> FakeLLM:
+    """The factory of the "bench_routing:create_saturating_llm" type"""
+    return SaturatingLLM(name=name, **params)
+
+
+async def run(
+    config: Dict[str, Any],
+    bodies: List[Dict[str, Any]],
+    concurrency: int,
+) -> Dict[str, Any]:
+    """
+    Post the chats with the backends of `config`, `concurrency` at a time,
+    and return their latencies and the backends which completed them.
+    """
+    path = os.path.join(tempfile.mkdtemp(), "backends.json")
+    with open(path, "w") as file:
+        json.dump(config, file)
+    os.environ["LLM_BACKENDS_CONFIG"] = path
+
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies: List[float] = []
+    models: Counter = Counter()
+
+    async def send(client: httpx.AsyncClient, body: Dict[str, Any]) -> None:
+        async with semaphore:
+            start = time.perf_counter()
+            response = await client.post(
+                "/chat", json=body, headers={"Authorization": "Bearer bench"}
+            )
+            response.raise_for_status()
+            latencies.append(time.perf_counter() - start)
+            models[response.json()["model"]] += 1
+
+    async with server.app.router.lifespan_context(server.app):
+        transport = httpx.ASGITransport(app=server.app)
+        async with httpx.AsyncClient(
+            transport=transport, base_url="http://bench", timeout=None
+        ) as client:
+            # Measure the chats once the chat pipeline is loaded
+            await server.app.state.warm_up.load_pipeline()
+            await asyncio.gather(*(send(client, body) for body in bodies))
+    latencies.sort()
+    return {
+        "mean": statistics.mean(latencies),
+        "p95": latencies[int(len(latencies) * 0.95)],
+        "models": dict(models),
+    }
+
+
+def report(name: str, result: Dict[str, Any]) -> None:
+    models = ", ".join(
+        f"{k}: {v}" for k, v in sorted(result["models"].items())
+    )
+    print(
+        f"  {name:<24}{result['mean'] * 1e3:>9.0f} ms"
+        f"{result['p95'] * 1e3:>9.0f} ms   {models}"
+    )
+
+
+async def main(args: argparse.Namespace) -> None:
+    install_fake_auth()
+    install_fake_opaqueprompts()
+    # Every chat has the same user, whose chats in flight are bounded
+    os.environ["ADMISSION_MAX_IN_FLIGHT_PER_SUBJECT"] = str(
+        max(args.concurrency, 10)
+    )
+
+    backends = {
+        "large": {"type": "fake", "params": {"latency": args.large_latency}},
+        "small": {"type": "fake", "params": {"latency": args.small_latency}},
+    }
+    # One long prompt for every four short ones
+    bodies = [LONG_BODY if i % 5 == 0 else SHORT_BODY for i in range(100)]
+    print(f"{'mixed prompts':<26}{'mean':>12}{'p95':>12}")
+    report(
+        "large only",
+        await run({"backends": backends, "default": "large"}, bodies, 10),
+    )
+    report(
+        "short prompts to small",
+        await run(
+            {
+                "backends": backends,
+                "default": "large",
+                "routes": [
+                    {
+                        "backends": ["small"],
+                        "max_prompt_tokens": args.max_prompt_tokens,
+                    }
+                ],
+            },
+            bodies,
+            10,
+        ),
+    )
+
+    replica = {
+        "type": "bench_routing:create_saturating_llm",
+        "params": {"latency": args.small_latency, "capacity": args.capacity},
+    }
+    replicas = {"replica-a": replica, "replica-b": replica}
+    bodies = [SHORT_BODY] * args.requests
+    print(f"\n{'saturated backend':<26}{'mean':>12}{'p95':>12}")
+    report(
+        "one replica",
+        await run(
+            {"backends": replicas, "default": "replica-a"},
+            bodies,
+            args.concurrency,
+        ),
+    )
+    report(
+        "by recent latency",
+        await run(
+            {
+                "backends": replicas,
+                "default": "replica-a",
+                "routes": [{"backends": ["replica-a", "replica-b"]}],
+            },
+            bodies,
+            args.concurrency,
+        ),
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawTextHelpFormatter
+    )
+    parser.add_argument("--large-latency", type=float, default=1.0)
+    parser.add_argument("--small-latency", type=float, default=0.2)
+    parser.add_argument("--max-prompt-tokens", type=int, default=200)
+    parser.add_argument("--capacity", type=int, default=4)
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--requests", type=int, default=200)
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,128 @@
+"""
+Microbenchmark of the serialization of the chat requests and responses,
+with large histories and responses, comparing the default path of FastAPI
+(validating the returned model again, converting it to JSON-compatible
+Python objects, then `json.dumps`) with FastJSONResponse, and the previous
+str Server-Sent Events with the bytes produced by `format_sse`.
+
+Run from the python-package directory with:
+
+    PYTHONPATH=src:benchmarks python benchmarks/bench_serialization.py
+"""
+import argparse
+import json
+import time
+from typing import Any, Callable
+
+from fastapi.responses import JSONResponse
+from fastapi.routing import serialize_response
+from fastapi.utils import create_response_field
+from opchatserver.models import (
+    ChatBatchItem,
+    ChatBatchResponse,
+    ChatRequest,
+    ChatResponse,
+)
+from opchatserver.responses import FastJSONResponse
+from opchatserver.streaming import format_sse
+
+
+def measure(name: str, iterations: int, run: Callable[[], Any]) -> float:
+    for _ in range(min(iterations, 10)):
+        run()
+    start = time.perf_counter()
+    for _ in range(iterations):
+        run()
+    per_call = (time.perf_counter() - start) / iterations
+    print(f"{name:<52} {per_call * 1e6:>10.1f} us")
+    return per_call
+
+
+def compare(
+    name: str,
+    iterations: int,
+    before: Callable[[], Any],
+    after: Callable[[], Any],
+) -> None:
+    slow = measure(f"{name}: FastAPI default", iterations, before)
+    fast = measure(f"{name}: FastJSONResponse", iterations, after)
+    print(f"{'':<52} {slow / fast:>10.1f}x")
+
+
+def fastapi_default(field: Any, content: Any) -> bytes:
+    """Serialize a returned model as FastAPI does with a response_model"""
+    # The coroutine does not await anything for async endpoints, so it is
+    # driven directly rather than paying for an event loop
+    coroutine = serialize_response(field=field, response_content=content)
+    try:
+        coroutine.send(None)
+    except StopIteration as result:
+        return JSONResponse(result.value).body
+    raise RuntimeError("serialize_response awaited")
+
+
+def main(args: argparse.Namespace) -> None:
+    message = "My name is Alice and I live in Paris. " * (
+        args.message_length // 38
+    )
+    for messages in args.history:
+        body = json.dumps(
+            {"history": [message] * messages, "prompt": message}
+        ).encode()
+        measure(
+            f"parse + validate request, {messages} messages",
+            args.iterations,
+            lambda: ChatRequest.model_validate(json.loads(body)),
+        )
+
+    chat_field = create_response_field("chat", ChatResponse)
+    response = ChatResponse(
+        desanitizedResponse=message,
+        sanitizedPrompt=message,
+        rawResponse=message,
+        preScreen=None,
+    )
+    compare(
+        "ChatResponse",
+        args.iterations,
+        lambda: fastapi_default(chat_field, response),
+        lambda: FastJSONResponse(response).body,
+    )
+
+    batch_field = create_response_field("batch", ChatBatchResponse)
+    batch = ChatBatchResponse(
+        responses=[
+            ChatBatchItem(statusCode=200, response=response)
+            for _ in range(args.batch_size)
+        ]
+    )
+    compare(
+        f"ChatBatchResponse, {args.batch_size} items",
+        max(1, args.iterations // 10),
+        lambda: fastapi_default(batch_field, batch),
+        lambda: FastJSONResponse(batch).body,
+    )
+
+    token = {"text": "Hello PERSON_1, "}
+    slow = measure(
+        "token event: str, encoded by the response",
+        args.iterations * 10,
+        lambda: f"event: token\ndata: {json.dumps(token)}\n\n".encode(),
+    )
+    fast = measure(
+        "token event: bytes",
+        args.iterations * 10,
+        lambda: format_sse("token", token),
+    )
+    print(f"{'':<52} {slow / fast:>10.1f}x")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--iterations", type=int, default=1000)
+    parser.add_argument(
+        "--history", type=int, nargs="+", default=[10, 50, 200]
+    )
+    parser.add_argument("--message-length", type=int, default=4096)
+    parser.add_argument("--batch-size", type=int, default=100)
+    main(parser.parse_args())
@@ -0,0 +1,161 @@
+"""
+Startup benchmark of the chat server, which reports the median over fresh
+processes of:
+
+- import: the time to import `opchatserver.server`, and the modules it
+  imports that take the longest,
+- listen: the time from starting uvicorn until it accepts connections,
+- ready: the time until /ready answers 200, i.e. the pipeline is loaded and
+  the JWKS are prefetched,
+- first chat: the time until a first /chat, sent as soon as the server
+  listens, is answered.
+
+The upstream services are the stand-ins of `stand_ins.py`. Run from the
+python-package directory with:
+
+    PYTHONPATH=src:benchmarks python benchmarks/bench_startup.py
+"""
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import time
+from typing import Dict, List, Optional, Tuple
+
+import httpx
+from bench_load import AUDIENCE, BENCHMARKS_DIR, DOMAIN, launch_server
+from stand_ins import Latencies, StandIns
+
+
+def measure_import() -> Tuple[float, Dict[str, float]]:
+    """
+    Import the server in a fresh interpreter.
+
+    Returns
+    -------
+    (float, Dict[str, float])
+        The import time of the server, and the cumulative import times of
+        the modules it imports directly, in seconds.
+    """
+    env = dict(os.environ)
+    env.update(
+        {
+            "AUTH0_DOMAIN": DOMAIN,
+            "AUTH0_API_AUDIENCE": AUDIENCE,
+            "PYTHONPATH": os.path.join(BENCHMARKS_DIR, "..", "src"),
+        }
+    )
+    result = subprocess.run(
+        [
+            sys.executable,
+            "-X",
+            "importtime",
+            "-c",
+            "import opchatserver.server",
+        ],
+        capture_output=True,
+        text=True,
+        env=env,
+        check=True,
+    )
+    total = 0.0
+    packages: Dict[str, float] = {}
+    for line in result.stderr.splitlines():
+        # "import time: self [us] | cumulative | imported package"
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line[len("import time:") :].split("|")
+        # The name is indented by two spaces per level of nesting
+        depth = (len(name) - len(name.lstrip()) - 1) // 2
+        if name.strip() == "opchatserver.server":
+            total = int(cumulative) / 1e6
+        elif depth == 1:
+            packages[name.strip()] = int(cumulative) / 1e6
+    return total, packages
+
+
+def measure_startup(
+    stand_ins: StandIns, model: str
+) -> Tuple[float, float, Optional[float]]:
+    """
+    Start the server, and chat with it as soon as it accepts connections.
+
+    Returns
+    -------
+    (float, float, float or None)
+        The times to listen, to be ready and to answer the first chat, in
+        seconds.
+    """
+    token = stand_ins.make_token("bench|startup")
+    start = time.perf_counter()
+    process, url = launch_server(stand_ins, model)
+    listen = ready = first_chat = None
+    try:
+        with httpx.Client(base_url=url, timeout=60) as client:
+            while ready is None and time.perf_counter() - start < 60:
+                if process.poll() is not None:
+                    raise RuntimeError("the server exited on startup")
+                try:
+                    response = client.get("/ready")
+                except httpx.TransportError:
+                    time.sleep(0.005)
+                    continue
+                if listen is None:
+                    listen = time.perf_counter() - start
+                    chat = client.post(
+                        "/chat",
+                        json={"history": [], "prompt": "Hi, I am Alice."},
+                        headers={"Authorization": f"Bearer {token}"},
+                    )
+                    if chat.status_code == 200:
+                        first_chat = time.perf_counter() - start
+                    continue
+                if response.status_code == 200:
+                    ready = time.perf_counter() - start
+                else:
+                    time.sleep(0.005)
+    finally:
+        process.terminate()
+        process.wait()
+    if listen is None or ready is None:
+        raise RuntimeError("the server was not ready in 60 seconds")
+    return listen, ready, first_chat
+
+
+def median(values: List[float]) -> str:
+    return f"{statistics.median(values) * 1000:>9.0f} ms"
+
+
+def main(args: argparse.Namespace) -> None:
+    imports = [measure_import() for _ in range(args.runs)]
+    print(f"{'import':<30}{median([total for total, _ in imports])}")
+    slowest = sorted(
+        imports[0][1].items(), key=lambda item: item[1], reverse=True
+    )
+    for name, seconds in slowest[: args.top]:
+        print(f"  {name:<28}{seconds * 1000:>9.0f} ms")
+
+    stand_ins = StandIns(Latencies(llm=0.05), DOMAIN, AUDIENCE)
+    startups = [
+        measure_startup(stand_ins, args.model) for _ in range(args.runs)
+    ]
+    print(f"{'listen':<30}{median([s[0] for s in startups])}")
+    print(f"{'ready':<30}{median([s[1] for s in startups])}")
+    first_chats = [s[2] for s in startups if s[2] is not None]
+    if first_chats:
+        print(f"{'first chat':<30}{median(first_chats)}")
+    if len(first_chats) < len(startups):
+        print(f"{len(startups) - len(first_chats)} first chats failed")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawTextHelpFormatter
+    )
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument(
+        "--top", type=int, default=8, help="number of slowest imports shown"
+    )
+    parser.add_argument("--model", default="gpt-3.5-turbo")
+    main(parser.parse_args())
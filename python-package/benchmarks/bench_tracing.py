@@ -0,0 +1,132 @@
+"""
+Benchmark of the overhead of the request tracing (see `tracing.py`). It
+reports:
+
+- the cost of the tracing of one request alone: its trace and root span,
+  and the spans of its six stages, when the request is not recorded (the
+  default), recorded for its timings, or recorded and exported, compared
+  with the stages measured without any trace. The export itself runs on a
+  background thread, but shares the interpreter with the requests,
+- the median latency of sequential /chat requests, with fake upstreams
+  without latency so that the overhead is not hidden by the upstream calls,
+  with tracing disabled, with the timings of each chat requested, and with
+  every trace exported to a file. The scenarios are interleaved, so that
+  they are equally affected by noise.
+
+Run from the python-package directory with:
+
+    AUTH0_DOMAIN=x AUTH0_API_AUDIENCE=y PYTHONPATH=src:benchmarks \\
+        python benchmarks/bench_tracing.py
+"""
+import argparse
+import asyncio
+import os
+import statistics
+import tempfile
+import time
+from typing import Dict, List, Optional
+
+import httpx
+from fakes import FakeLLM, install_fake_auth, install_fake_opaqueprompts
+from opchatserver import server
+from opchatserver.metrics import track_stage
+from opchatserver.tracing import Span, SpanExporter, Trace, _current_span
+
+STAGES = ["auth", "memory", "admission", "sanitize", "llm", "desanitize"]
+
+BODY = {"history": ["hi", "hello, how can I help?"], "prompt": "Hi, I'm Bob"}
+
+
+def bench_primitives(iterations: int) -> None:
+    exporter = SpanExporter(lambda data: None)
+
+    def request(mode: Optional[str]) -> None:
+        token = None
+        if mode is not None:
+            trace = Trace("request", "0" * 32, sampled=mode == "exported")
+            trace.recording = mode != "not recorded"
+            token = _current_span.set(Span(trace, None, "POST /chat"))
+        for stage in STAGES:
+            with track_stage(stage):
+                pass
+        if token is not None:
+            _current_span.reset(token)
+            if trace.sampled:
+                exporter.export(trace)
+
+    baseline = None
+    print(f"{'tracing of a request':<28}")
+    for name in [None, "not recorded", "recorded", "exported"]:
+        start = time.perf_counter()
+        for _ in range(iterations):
+            request(name)
+        per_request = (time.perf_counter() - start) / iterations
+        baseline = baseline or per_request
+        print(
+            f"  {name or 'no trace':<26}{per_request * 1e6:>10.1f} us/request"
+            f"{(per_request - baseline) * 1e6:>+10.1f} us"
+        )
+    exporter.close()
+
+
+async def bench_chat(requests: int) -> None:
+    install_fake_auth()
+    install_fake_opaqueprompts()
+    llm = FakeLLM(response="Sure!")
+    server._create_llm = lambda model_name: llm
+
+    trace_file = os.path.join(tempfile.mkdtemp(), "traces.jsonl")
+    scenarios = [
+        ("disabled", {"TRACING_EXPORTER": "none"}, BODY),
+        (
+            "disabled, with timings",
+            {"TRACING_EXPORTER": "none"},
+            {**BODY, "with_timings": True},
+        ),
+        (
+            "exported to a file",
+            {"TRACING_EXPORTER": "file", "TRACING_FILE": trace_file},
+            BODY,
+        ),
+    ]
+    headers = {"Authorization": "Bearer bench"}
+    latencies: Dict[str, List[float]] = {name: [] for name, _, _ in scenarios}
+    async with server.app.router.lifespan_context(server.app):
+        transport = httpx.ASGITransport(app=server.app)
+        async with httpx.AsyncClient(
+            transport=transport, base_url="http://bench", timeout=None
+        ) as client:
+            for round in range(requests + 10):
+                for name, env, body in scenarios:
+                    os.environ.update(env)
+                    start = time.perf_counter()
+                    response = await client.post(
+                        "/chat", json=body, headers=headers
+                    )
+                    response.raise_for_status()
+                    # The first rounds warm up the server
+                    if round >= 10:
+                        latencies[name].append(time.perf_counter() - start)
+    print(f"\n{'/chat, median':<28}")
+    baseline = None
+    for name, _, _ in scenarios:
+        latency = statistics.median(latencies[name])
+        baseline = baseline or latency
+        print(
+            f"  {name:<26}{latency * 1e6:>10.0f} us/request"
+            f"{(latency - baseline) * 1e6:>+10.0f} us"
+        )
+
+
+def main(args: argparse.Namespace) -> None:
+    bench_primitives(args.iterations)
+    asyncio.run(bench_chat(args.requests))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawTextHelpFormatter
+    )
+    parser.add_argument("--iterations", type=int, default=100000)
+    parser.add_argument("--requests", type=int, default=300)
+    main(parser.parse_args())
@@ -0,0 +1,125 @@
+"""
+Benchmark of token verifications per second, comparing a new PyJWKClient
+per verification (the previous behaviour of VerifyToken) with the shared
+JWKS key store and verified token cache.
+
+A local HTTP server stands in for the Auth0 JWKS endpoint. Run from the
+python-package directory with:
+
+    python benchmarks/bench_verify_token.py --iterations 200
+"""
+import argparse
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Callable, Dict
+
+import jwt
+from cryptography.hazmat.primitives.asymmetric import rsa
+from opchatserver import authorization
+from opchatserver.authorization import JWKSKeyStore, VerifyToken
+
+DOMAIN = "bench-domain.local"
+AUDIENCE = "https://bench-audience.local"
+
+
+def start_jwks_server(jwks: Dict[str, Any], latency: float) -> str:
+    """
+    Start a local JWKS endpoint on a daemon thread and return its URL.
+    """
+    body = json.dumps(jwks).encode()
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self) -> None:
+            time.sleep(latency)
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args: Any) -> None:
+            pass
+
+    httpd = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    return f"http://127.0.0.1:{httpd.server_port}/.well-known/jwks.json"
+
+
+def measure(name: str, iterations: int, verify: Callable[[], Any]) -> float:
+    start = time.perf_counter()
+    for _ in range(iterations):
+        verify()
+    rate = iterations / (time.perf_counter() - start)
+    print(f"{name:<40} {rate:>12.1f} verifications/sec")
+    return rate
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--iterations", type=int, default=200)
+    parser.add_argument(
+        "--jwks-latency",
+        type=float,
+        default=0.02,
+        help="simulated latency of the JWKS endpoint in seconds",
+    )
+    args = parser.parse_args()
+
+    private_key = rsa.generate_private_key(
+        public_exponent=65537, key_size=2048
+    )
+    jwk = json.loads(
+        jwt.algorithms.RSAAlgorithm.to_jwk(private_key.public_key())
+    )
+    jwk.update({"kid": "bench-key", "use": "sig", "alg": "RS256"})
+    jwks_url = start_jwks_server({"keys": [jwk]}, args.jwks_latency)
+    token = jwt.encode(
+        {
+            "sub": "bench|1",
+            "aud": AUDIENCE,
+            "iss": f"https://{DOMAIN}/",
+            "exp": int(time.time() + 3600),
+            "scope": "use:opaque-prompts-chat-bot",
+        },
+        private_key,
+        algorithm="RS256",
+        headers={"kid": "bench-key"},
+    )
+
+    def verify_uncached() -> None:
+        signing_key = jwt.PyJWKClient(jwks_url).get_signing_key_from_jwt(token)
+        jwt.decode(
+            token,
+            signing_key.key,
+            algorithms=["RS256"],
+            audience=AUDIENCE,
+            issuer=f"https://{DOMAIN}/",
+        )
+
+    authorization._key_stores[DOMAIN] = JWKSKeyStore(jwks_url)
+    VerifyToken.domain = DOMAIN
+    VerifyToken.audience = AUDIENCE
+
+    def verify_key_store_only() -> None:
+        authorization._verified_tokens.clear()
+        VerifyToken(token).verify()
+
+    def verify_cached() -> None:
+        VerifyToken(token).verify()
+
+    before = measure(
+        "new PyJWKClient per request", args.iterations, verify_uncached
+    )
+    measure("shared key store", args.iterations, verify_key_store_only)
+    after = measure(
+        "shared key store + verified token cache",
+        args.iterations,
+        verify_cached,
+    )
+    print(f"speedup: {after / before:.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,50 @@
+"""
+In-process fakes of the upstream services of the chat server, shared by the
+benchmarks. They only simulate latency, so the benchmarks measure the
+overhead of the server itself.
+"""
+import json
+import time
+from typing import Dict, Optional, Union
+
+import langchain.utilities.opaqueprompts as op
+from opchatserver import llms
+from opchatserver.authorization import JWKSKeyStore, VerifyToken
+
+
+class FakeLLM(llms.FakeLLM):
+    """
+    The fake LLM of the server, which answers with a fixed response by
+    default
+    """
+
+    response: Optional[str] = "Hello PERSON_1, how can I help?"
+
+
+def install_fake_opaqueprompts(latency: float = 0.0) -> None:
+    """
+    Replace the OpaquePrompts sanitize and desanitize functions with fakes
+    which block for `latency` seconds, like a remote call would.
+    """
+
+    def sanitize(
+        input: Union[str, Dict[str, str]]
+    ) -> Dict[str, Union[str, Dict[str, str]]]:
+        time.sleep(latency)
+        return {"sanitized_input": input, "secure_context": json.dumps({})}
+
+    def desanitize(sanitized_text: str, secure_context: bytes) -> str:
+        time.sleep(latency)
+        return sanitized_text
+
+    op.sanitize = sanitize
+    op.desanitize = desanitize
+
+
+def install_fake_auth() -> None:
+    """Accept every bearer token without contacting Auth0"""
+    VerifyToken.verify = lambda self, required_scopes=None: {  # type: ignore
+        "sub": "bench|1"
+    }
+    # Prefetched by the warm-up of the server
+    JWKSKeyStore.refresh = lambda self: None  # type: ignore
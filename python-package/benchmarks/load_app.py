@@ -0,0 +1,72 @@
+"""
+The chat server as run by the load tests, with its upstream calls going to
+the stand-ins of `stand_ins.py`:
+
+- the JWKS of AUTH0_DOMAIN are fetched from BENCH_JWKS_URL,
+- an `opaqueprompts` client module calling BENCH_OPAQUEPROMPTS_URL is
+  installed, since the real client only talks to the hosted service,
+- the OpenAI client uses OPENAI_API_BASE, which the load tests point to the
+  OpenAI stand-in.
+
+Run it with uvicorn from the python-package directory:
+
+    PYTHONPATH=src:benchmarks uvicorn load_app:app
+"""
+import os
+import sys
+import types
+from dataclasses import dataclass
+from typing import Any, List
+
+import requests
+from opchatserver import authorization
+from opchatserver.authorization import JWKSKeyStore
+
+
+@dataclass
+class SanitizeResponse:
+    sanitized_texts: List[str]
+    secure_context: Any
+
+
+@dataclass
+class DesanitizeResponse:
+    desanitized_text: str
+
+
+def _install_opaqueprompts_client(url: str) -> None:
+    session = requests.Session()
+
+    def sanitize(texts: List[str]) -> SanitizeResponse:
+        response = session.post(f"{url}/sanitize", json={"texts": texts})
+        response.raise_for_status()
+        return SanitizeResponse(**response.json())
+
+    def desanitize(sanitized_text: str, secure_context: Any) -> Any:
+        response = session.post(
+            f"{url}/desanitize",
+            json={
+                "sanitized_text": sanitized_text,
+                "secure_context": secure_context,
+            },
+        )
+        response.raise_for_status()
+        return DesanitizeResponse(**response.json())
+
+    client = types.ModuleType("opaqueprompts")
+    client.__package__ = "opaqueprompts"
+    client.sanitize = sanitize  # type: ignore
+    client.desanitize = desanitize  # type: ignore
+    client.SanitizeResponse = SanitizeResponse  # type: ignore
+    client.DesanitizeResponse = DesanitizeResponse  # type: ignore
+    sys.modules["opaqueprompts"] = client
+
+
+_install_opaqueprompts_client(os.environ["BENCH_OPAQUEPROMPTS_URL"])
+authorization._key_stores[os.environ["AUTH0_DOMAIN"]] = JWKSKeyStore(
+    os.environ["BENCH_JWKS_URL"]
+)
+
+from opchatserver.server import app  # noqa: E402
+
+__all__ = ["app"]
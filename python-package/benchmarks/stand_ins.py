@@ -0,0 +1,280 @@
+"""
+Local HTTP stand-ins for the upstream services of the chat server, used by
+the load tests so that requests take the same network paths as in
+production:
+
+- an Auth0 JWKS endpoint, whose key signs the bearer tokens of the tests,
+- the OpaquePrompts sanitize and desanitize API, which replaces the names
+  in `NAMES` with placeholders,
+- an OpenAI-compatible completions API, which answers both
+  /v1/completions and /v1/chat/completions, streamed or not.
+
+Each stand-in runs on a daemon thread of the current process and waits for
+its configured latency before answering.
+"""
+import json
+import re
+import threading
+import time
+import uuid
+from dataclasses import dataclass
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Dict, List, Tuple, Type
+
+import jwt
+from cryptography.hazmat.primitives.asymmetric import rsa
+
+# Names the stand-in sanitizer treats as PII
+NAMES = ["Alice", "Bob", "Carol", "Dave"]
+
+SCOPE = "use:opaque-prompts-chat-bot"
+
+
+@dataclass
+class Latencies:
+    """The simulated latencies of the stand-ins, in seconds"""
+
+    jwks: float = 0.02
+    sanitize: float = 0.05
+    desanitize: float = 0.02
+    # Until the first token of the completion
+    llm: float = 0.2
+    # Between two tokens of a streamed completion
+    llm_token: float = 0.005
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    latencies: Latencies
+
+    def log_message(self, *args: Any) -> None:
+        pass
+
+    def read_json(self) -> Any:
+        length = int(self.headers.get("Content-Length", "0"))
+        return json.loads(self.rfile.read(length) or b"{}")
+
+    def send_json(self, data: Any) -> None:
+        body = json.dumps(data).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class _JWKSHandler(_Handler):
+    jwks: Dict[str, Any]
+
+    def do_GET(self) -> None:
+        time.sleep(self.latencies.jwks)
+        self.send_json(self.jwks)
+
+
+class _OpaquePromptsHandler(_Handler):
+    def do_POST(self) -> None:
+        request = self.read_json()
+        if self.path.endswith("/sanitize"):
+            time.sleep(self.latencies.sanitize)
+            texts, secure_context = sanitize(request["texts"])
+            self.send_json(
+                {"sanitized_texts": texts, "secure_context": secure_context}
+            )
+        else:
+            time.sleep(self.latencies.desanitize)
+            text = request["sanitized_text"]
+            for placeholder, name in json.loads(
+                request["secure_context"]
+            ).items():
+                text = text.replace(placeholder, name)
+            self.send_json({"desanitized_text": text})
+
+
+class _OpenAIHandler(_Handler):
+    response_words: int
+
+    def do_POST(self) -> None:
+        request = self.read_json()
+        chat = self.path.endswith("/chat/completions")
+        if chat:
+            prompt = "\n".join(m["content"] for m in request["messages"])
+        else:
+            prompt = request["prompt"]
+            prompt = prompt[0] if isinstance(prompt, list) else prompt
+        tokens = self.completion_tokens(prompt)
+        time.sleep(self.latencies.llm)
+        if request.get("stream"):
+            self.stream(request["model"], tokens, chat)
+            return
+        text = "".join(tokens)
+        choice: Dict[str, Any] = {"index": 0, "finish_reason": "stop"}
+        if chat:
+            choice["message"] = {"role": "assistant", "content": text}
+        else:
+            choice.update({"text": text, "logprobs": None})
+        self.send_json(
+            {
+                "id": f"cmpl-{uuid.uuid4().hex}",
+                "object": "chat.completion" if chat else "text_completion",
+                "created": int(time.time()),
+                "model": request["model"],
+                "choices": [choice],
+                "usage": {
+                    "prompt_tokens": len(prompt) // 4,
+                    "completion_tokens": len(tokens),
+                    "total_tokens": len(prompt) // 4 + len(tokens),
+                },
+            }
+        )
+
+    def completion_tokens(self, prompt: str) -> List[str]:
+        """
+        Answer with the placeholders of the prompt, so that the response
+        has to be desanitized, padded to `response_words` words
+        """
+        placeholders = sorted(set(re.findall(r"PERSON_\d+", prompt)))
+        words = ["Hello"] + placeholders + ["how", "can", "I", "help?"]
+        words += ["More"] * max(0, self.response_words - len(words))
+        return [f" {word}" if i else word for i, word in enumerate(words)]
+
+    def stream(self, model: str, tokens: List[str], chat: bool) -> None:
+        # The connection is closed at the end of the stream rather than
+        # sending a chunked body
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Connection", "close")
+        self.end_headers()
+        self.close_connection = True
+        for i, token in enumerate(tokens + [""]):
+            if i:
+                time.sleep(self.latencies.llm_token)
+            last = i == len(tokens)
+            choice: Dict[str, Any] = {
+                "index": 0,
+                "finish_reason": "stop" if last else None,
+            }
+            if chat:
+                choice["delta"] = {} if last else {"content": token}
+            else:
+                choice.update({"text": token, "logprobs": None})
+            chunk = {
+                "id": "cmpl-stream",
+                "object": "chat.completion.chunk"
+                if chat
+                else "text_completion",
+                "created": int(time.time()),
+                "model": model,
+                "choices": [choice],
+            }
+            self.wfile.write(f"data: {json.dumps(chunk)}\n\n".encode())
+            self.wfile.flush()
+        self.wfile.write(b"data: [DONE]\n\n")
+        self.wfile.flush()
+
+
+def sanitize(texts: List[str]) -> Tuple[List[str], str]:
+    """
+    Replace the names in `NAMES` with placeholders, sharing them across the
+    texts, and return the sanitized texts with their secure context.
+    """
+    secure_context: Dict[str, str] = {}
+    sanitized = []
+    for text in texts:
+        for i, name in enumerate(NAMES):
+            if name in text:
+                placeholder = f"PERSON_{i + 1}"
+                secure_context[placeholder] = name
+                text = text.replace(name, placeholder)
+        sanitized.append(text)
+    return sanitized, json.dumps(secure_context)
+
+
+def _serve(handler: Type[_Handler], **attributes: Any) -> str:
+    """
+    Helper function which serves a handler on a daemon thread and returns
+    its base URL.
+    """
+    handler_class = type(handler.__name__, (handler,), attributes)
+    httpd = ThreadingHTTPServer(("127.0.0.1", 0), handler_class)
+    httpd.daemon_threads = True
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    return f"http://127.0.0.1:{httpd.server_port}"
+
+
+class StandIns:
+    """
+    Starts the stand-ins, and signs the bearer tokens their JWKS endpoint
+    validates.
+    """
+
+    def __init__(
+        self,
+        latencies: Latencies,
+        domain: str,
+        audience: str,
+        response_words: int = 32,
+    ):
+        """
+        Parameters
+        ----------
+        latencies : Latencies
+            The simulated latencies of the stand-ins.
+        domain : str
+            The Auth0 domain of the tokens, which must match AUTH0_DOMAIN.
+        audience : str
+            The audience of the tokens, which must match AUTH0_API_AUDIENCE.
+        response_words : int, optional
+            The number of words of each completion, by default 32.
+        """
+        self.domain = domain
+        self.audience = audience
+        self._private_key = rsa.generate_private_key(
+            public_exponent=65537, key_size=2048
+        )
+        jwk = json.loads(
+            jwt.algorithms.RSAAlgorithm.to_jwk(self._private_key.public_key())
+        )
+        jwk.update({"kid": "bench-key", "use": "sig", "alg": "RS256"})
+
+        self.jwks_url = (
+            _serve(_JWKSHandler, latencies=latencies, jwks={"keys": [jwk]})
+            + "/.well-known/jwks.json"
+        )
+        self.opaqueprompts_url = _serve(
+            _OpaquePromptsHandler, latencies=latencies
+        )
+        self.openai_url = (
+            _serve(
+                _OpenAIHandler,
+                latencies=latencies,
+                response_words=response_words,
+            )
+            + "/v1"
+        )
+
+    def make_token(self, subject: str) -> str:
+        """
+        Sign a bearer token of a subject, valid for an hour.
+
+        Parameters
+        ----------
+        subject : str
+            The `sub` claim of the token.
+
+        Returns
+        -------
+        str
+            The token.
+        """
+        return jwt.encode(
+            {
+                "sub": subject,
+                "aud": self.audience,
+                "iss": f"https://{self.domain}/",
+                "exp": int(time.time() + 3600),
+                "scope": SCOPE,
+            },
+            self._private_key,
+            algorithm="RS256",
+            headers={"kid": "bench-key"},
+        )
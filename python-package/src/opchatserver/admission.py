@@ -0,0 +1,271 @@
+"""
+This module contains the admission controller of the chat endpoints, which
+bounds the number of chats handled at once by a worker, overall and per
+user, so that a traffic spike queues or is shed instead of overloading the
+OpenAI and OpaquePrompts APIs.
+
+Requests over the limits wait in a bounded FIFO queue. A request is shed
+with a 503 response when the queue is full, or when it has waited longer
+than its deadline, so that queued requests keep a predictable latency.
+"""
+import asyncio
+import math
+import os
+import time
+from collections import deque
+from contextlib import asynccontextmanager
+from dataclasses import dataclass, field
+from typing import AsyncIterator, Deque, Dict, List
+
+from prometheus_client import Counter, Gauge, Histogram
+
+admission_in_flight = Gauge(
+    "admission_in_flight",
+    "Chat requests admitted and not yet finished",
+    multiprocess_mode="livesum",
+)
+admission_queue_depth = Gauge(
+    "admission_queue_depth",
+    "Chat requests waiting to be admitted",
+    multiprocess_mode="livesum",
+)
+admission_wait = Histogram(
+    "admission_wait_seconds",
+    "Time chat requests waited to be admitted",
+)
+admission_rejected = Counter(
+    "admission_rejected_total",
+    "Chat requests shed by the admission controller",
+    ["reason"],
+)
+
+
+class AdmissionRejected(Exception):
+    """
+    Raised when a request is not admitted.
+
+    Attributes
+    ----------
+    reason : str
+        Why the request was rejected, "queue_full" or "timeout".
+    retry_after : int
+        The number of seconds after which the client may retry.
+    """
+
+    def __init__(self, reason: str, retry_after: int):
+        super().__init__(f"the server is overloaded ({reason})")
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+@dataclass
+class _Waiter:
+    subject: str
+    future: "asyncio.Future[None]" = field(repr=False)
+
+
+class AdmissionController:
+    """
+    Admits requests while fewer than `max_in_flight` requests, and fewer
+    than `max_in_flight_per_subject` requests of the same subject, are in
+    flight. It must be used from a single event loop.
+    """
+
+    def __init__(
+        self,
+        max_in_flight: int = 64,
+        max_in_flight_per_subject: int = 8,
+        max_queue: int = 256,
+        max_wait: float = 5,
+    ):
+        """
+        Parameters
+        ----------
+        max_in_flight : int, optional
+            The maximum number of requests in flight, by default 64.
+        max_in_flight_per_subject : int, optional
+            The maximum number of requests of one subject in flight, by
+            default 8.
+        max_queue : int, optional
+            The maximum number of requests waiting to be admitted, by default
+            256.
+        max_wait : float, optional
+            The number of seconds a request may wait to be admitted before
+            it is shed, by default 5.
+        """
+        self.max_in_flight = max_in_flight
+        self.max_in_flight_per_subject = max_in_flight_per_subject
+        self.max_queue = max_queue
+        self.max_wait = max_wait
+        self.in_flight = 0
+        self._in_flight_per_subject: Dict[str, int] = {}
+        self._queue: Deque[_Waiter] = deque()
+
+    @property
+    def queue_depth(self) -> int:
+        """The number of requests waiting to be admitted."""
+        return len(self._queue)
+
+    async def acquire(self, subject: str) -> None:
+        """
+        Wait until a request of `subject` is admitted. Every successful call
+        must be followed by a call to `release`.
+
+        Parameters
+        ----------
+        subject : str
+            The subject of the request, e.g. the `sub` of its token.
+
+        Raises
+        ------
+        AdmissionRejected
+            If the queue is full, or the request waited longer than
+            `max_wait` seconds.
+        """
+        if not self._queue and self._can_admit(subject):
+            self._admit(subject)
+            admission_wait.observe(0)
+            return
+        if len(self._queue) >= self.max_queue:
+            admission_rejected.labels(reason="queue_full").inc()
+            raise AdmissionRejected("queue_full", self._retry_after())
+
+        waiter = _Waiter(subject, asyncio.get_running_loop().create_future())
+        self._queue.append(waiter)
+        admission_queue_depth.inc()
+        # The request may be admitted right away if the queued requests are
+        # waiting for their own subject
+        self._wake()
+        start = time.perf_counter()
+        try:
+            await asyncio.wait_for(
+                asyncio.shield(waiter.future), timeout=self.max_wait
+            )
+        except asyncio.TimeoutError:
+            if not waiter.future.done():
+                admission_rejected.labels(reason="timeout").inc()
+                raise AdmissionRejected("timeout", self._retry_after())
+        except asyncio.CancelledError:
+            # The request was admitted just as it was cancelled
+            if waiter.future.done() and not waiter.future.cancelled():
+                self.release(subject)
+            raise
+        finally:
+            if not waiter.future.done():
+                waiter.future.cancel()
+                self._queue.remove(waiter)
+                admission_queue_depth.dec()
+            admission_wait.observe(time.perf_counter() - start)
+
+    def try_acquire(self, subject: str) -> bool:
+        """
+        Admit a request of `subject` only if it can be admitted right away,
+        without waiting. Every successful call must be followed by a call to
+        `release`.
+
+        Parameters
+        ----------
+        subject : str
+            The subject of the request.
+
+        Returns
+        -------
+        bool
+            Whether the request was admitted.
+        """
+        if self._queue or not self._can_admit(subject):
+            return False
+        self._admit(subject)
+        return True
+
+    def release(self, subject: str) -> None:
+        """
+        Mark a request admitted by `acquire` as finished, and admit the
+        requests waiting for it.
+
+        Parameters
+        ----------
+        subject : str
+            The subject passed to `acquire`.
+        """
+        self.in_flight -= 1
+        admission_in_flight.dec()
+        count = self._in_flight_per_subject[subject] - 1
+        if count:
+            self._in_flight_per_subject[subject] = count
+        else:
+            del self._in_flight_per_subject[subject]
+        self._wake()
+
+    @asynccontextmanager
+    async def admit(self, subject: str) -> AsyncIterator[None]:
+        """
+        Hold an admission for the duration of a block, see `acquire`.
+
+        Parameters
+        ----------
+        subject : str
+            The subject of the request.
+        """
+        await self.acquire(subject)
+        try:
+            yield
+        finally:
+            self.release(subject)
+
+    def _can_admit(self, subject: str) -> bool:
+        return (
+            self.in_flight < self.max_in_flight
+            and self._in_flight_per_subject.get(subject, 0)
+            < self.max_in_flight_per_subject
+        )
+
+    def _admit(self, subject: str) -> None:
+        self.in_flight += 1
+        admission_in_flight.inc()
+        self._in_flight_per_subject[subject] = (
+            self._in_flight_per_subject.get(subject, 0) + 1
+        )
+
+    def _wake(self) -> None:
+        """
+        Helper function which admits the waiting requests in order, skipping
+        those of subjects at their limit so that they do not hold up the
+        requests of other subjects.
+        """
+        skipped: List[_Waiter] = []
+        while self._queue and self.in_flight < self.max_in_flight:
+            waiter = self._queue.popleft()
+            if not self._can_admit(waiter.subject):
+                skipped.append(waiter)
+                continue
+            admission_queue_depth.dec()
+            self._admit(waiter.subject)
+            waiter.future.set_result(None)
+        self._queue.extendleft(reversed(skipped))
+
+    def _retry_after(self) -> int:
+        """
+        Helper function which estimates when a rejected request may be
+        retried, from the time the queued requests may still wait.
+        """
+        return max(1, math.ceil(self.max_wait))
+
+
+def create_admission_controller() -> AdmissionController:
+    """
+    Create the admission controller configured from the environment.
+
+    Returns
+    -------
+    AdmissionController
+        The admission controller.
+    """
+    return AdmissionController(
+        max_in_flight=int(os.environ.get("ADMISSION_MAX_IN_FLIGHT", "64")),
+        max_in_flight_per_subject=int(
+            os.environ.get("ADMISSION_MAX_IN_FLIGHT_PER_SUBJECT", "8")
+        ),
+        max_queue=int(os.environ.get("ADMISSION_MAX_QUEUE", "256")),
+        max_wait=float(os.environ.get("ADMISSION_MAX_WAIT", "5")),
+    )
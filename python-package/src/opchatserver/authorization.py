@@ -3,12 +3,212 @@ This module handles authentication logic for the OpaquePrompts chat server.
 This logic is independent of the langchain integration, and is not needed
 for other servers using the OpaquePrompts langchain integration.
 """
+import hashlib
+import logging
 import os
+import threading
+import time
 from http import HTTPStatus
-from typing import Dict, List, Optional
+from typing import Any, Dict, List, Optional
 
 import jwt
 from fastapi import HTTPException
+from opchatserver.cache import TTLCache
+from opchatserver.tracing import trace_span
+
+logger = logging.getLogger(__name__)
+
+
+class JWKSKeyStore:
+    """
+    Process-wide store of the signing keys published at a JWKS endpoint.
+
+    Keys are fetched once and reused until they are older than `ttl`. When
+    they get within `refresh_margin` seconds of expiring, they are refreshed
+    by a background thread while the current keys keep being served. A token
+    signed with an unknown key id triggers a synchronous refetch, at most
+    once every `min_refetch_interval` seconds, which handles key rotation.
+    """
+
+    def __init__(
+        self,
+        jwks_url: str,
+        ttl: float = 600,
+        refresh_margin: float = 60,
+        min_refetch_interval: float = 10,
+        timeout: int = 30,
+    ):
+        """
+        Parameters
+        ----------
+        jwks_url : str
+            The URL of the JWKS document.
+        ttl : float, optional
+            The number of seconds the fetched keys are used for, by default
+            600.
+        refresh_margin : float, optional
+            The number of seconds before `ttl` elapses at which a background
+            refresh is started, by default 60.
+        min_refetch_interval : float, optional
+            The minimum number of seconds between two fetches caused by
+            unknown key ids, by default 10.
+        timeout : int, optional
+            The timeout of a fetch in seconds, by default 30.
+        """
+        self.jwks_url = jwks_url
+        self.ttl = ttl
+        self.refresh_margin = min(refresh_margin, ttl)
+        self.min_refetch_interval = min_refetch_interval
+        self._client = jwt.PyJWKClient(
+            jwks_url, cache_jwk_set=False, timeout=timeout
+        )
+        self._keys: Dict[str, jwt.PyJWK] = {}
+        self._fetched_at: Optional[float] = None
+        self._lock = threading.Lock()
+        self._refreshing = False
+
+    def refresh(self) -> None:
+        """
+        Fetch the JWKS document and replace the stored keys with its
+        signing keys.
+        """
+        with trace_span("jwks"):
+            keys = {
+                str(key.key_id): key
+                for key in self._client.get_signing_keys(refresh=True)
+            }
+        with self._lock:
+            self._keys = keys
+            self._fetched_at = time.monotonic()
+
+    def get_signing_key(self, kid: Optional[str]) -> jwt.PyJWK:
+        """
+        Get the signing key with the given key id.
+
+        Parameters
+        ----------
+        kid : str, optional
+            The key id found in the header of a token.
+
+        Returns
+        -------
+        jwt.PyJWK
+            The matching signing key.
+        """
+        with self._lock:
+            age = (
+                None
+                if self._fetched_at is None
+                else time.monotonic() - self._fetched_at
+            )
+            key = self._keys.get(kid) if kid else None
+
+        refreshed = age is None or age >= self.ttl
+        if refreshed:
+            self.refresh()
+            with self._lock:
+                key = self._keys.get(kid) if kid else None
+        elif age is not None and age >= self.ttl - self.refresh_margin:
+            self._start_background_refresh()
+
+        # The key may have been rotated since the last fetch, unless the keys
+        # were just fetched
+        if (
+            key is None
+            and not refreshed
+            and age is not None
+            and age >= self.min_refetch_interval
+        ):
+            self.refresh()
+            with self._lock:
+                key = self._keys.get(kid) if kid else None
+
+        if key is None:
+            raise jwt.PyJWKClientError(
+                f'Unable to find a signing key that matches: "{kid}"'
+            )
+        return key
+
+    def get_signing_key_from_jwt(self, token: str) -> jwt.PyJWK:
+        """
+        Get the signing key matching the key id in the header of `token`.
+
+        Parameters
+        ----------
+        token : str
+            An encoded JWT.
+
+        Returns
+        -------
+        jwt.PyJWK
+            The matching signing key.
+        """
+        header = jwt.get_unverified_header(token)
+        return self.get_signing_key(header.get("kid"))
+
+    def _start_background_refresh(self) -> None:
+        """
+        Refresh the keys on a daemon thread, unless a refresh is already
+        running.
+        """
+        with self._lock:
+            if self._refreshing:
+                return
+            self._refreshing = True
+        threading.Thread(
+            target=self._background_refresh,
+            name="jwks-refresh",
+            daemon=True,
+        ).start()
+
+    def _background_refresh(self) -> None:
+        try:
+            self.refresh()
+        except Exception as error:
+            # The current keys stay in use until they expire
+            logger.warning(f"Failed to refresh JWKS: {error}")
+        finally:
+            with self._lock:
+                self._refreshing = False
+
+
+# One key store per Auth0 domain, shared by every request of the process
+_key_stores: Dict[str, JWKSKeyStore] = {}
+_key_stores_lock = threading.Lock()
+
+
+def get_jwks_key_store(domain: Optional[str]) -> JWKSKeyStore:
+    """
+    Get the process-wide key store for the JWKS of an Auth0 domain,
+    creating it on first use.
+
+    Parameters
+    ----------
+    domain : str, optional
+        The Auth0 domain.
+
+    Returns
+    -------
+    JWKSKeyStore
+        The key store of the domain.
+    """
+    with _key_stores_lock:
+        key_store = _key_stores.get(str(domain))
+        if key_store is None:
+            key_store = JWKSKeyStore(
+                f"https://{domain}/.well-known/jwks.json",
+                ttl=float(os.environ.get("AUTH0_JWKS_CACHE_TTL", "600")),
+            )
+            _key_stores[str(domain)] = key_store
+        return key_store
+
+
+# Payloads of tokens whose signature and claims have already been verified,
+# keyed by a hash of the token, its audience and its issuer
+_verified_tokens: TTLCache[Dict[str, Any]] = TTLCache(
+    maxsize=int(os.environ.get("AUTH0_VERIFIED_TOKEN_CACHE_SIZE", "1024")),
+    ttl=float(os.environ.get("AUTH0_VERIFIED_TOKEN_CACHE_TTL", "300")),
+)
 
 
 class VerifyToken:
@@ -32,12 +232,13 @@ class VerifyToken:
         """
         self.token = token
 
-        # This gets the JWKS from a given URL and does processing so you can
-        # use any of the keys available
-        jwks_url = f"https://{self.domain}/.well-known/jwks.json"
-        self.jwks_client = jwt.PyJWKClient(jwks_url)
+        # This gets the JWKS of the domain from a process-wide key store, so
+        # that the keys are not fetched again for every token
+        self.jwks_client = get_jwks_key_store(self.domain)
 
-    def verify(self, required_scopes: Optional[List[str]] = None) -> None:
+    def verify(
+        self, required_scopes: Optional[List[str]] = None
+    ) -> Dict[str, Any]:
         """
         Validates that the token associated with this instance is of
         the correct form and contains the neccessary signatures to access
@@ -49,6 +250,45 @@ class VerifyToken:
         required_scopes : list of strings, optional
             A list of scopes that must be present in the token for validation
             to pass
+
+        Returns
+        -------
+        Dict[str, Any]
+            The payload of the verified token.
+        """
+        issuer = f"https://{self.domain}/"
+        cache_key = (
+            hashlib.sha256(self.token.encode()).hexdigest(),
+            self.audience,
+            issuer,
+        )
+        payload = _verified_tokens.get(cache_key)
+        if payload is None:
+            payload = self._decode(issuer)
+            # A cached payload must not outlive the token itself
+            expires_in = (
+                payload["exp"] - time.time() if "exp" in payload else None
+            )
+            _verified_tokens.set(cache_key, payload, ttl=expires_in)
+
+        # Check for required scopes
+        self._verify_scopes(payload, required_scopes)
+        return payload
+
+    def _decode(self, issuer: str) -> Dict[str, Any]:
+        """
+        Helper function which checks the signature and the claims of the
+        token associated with this instance.
+
+        Parameters
+        ----------
+        issuer : str
+            The expected issuer of the token.
+
+        Returns
+        -------
+        Dict[str, Any]
+            The payload of the token.
         """
         try:
             self.signing_key = self.jwks_client.get_signing_key_from_jwt(
@@ -59,19 +299,17 @@ class VerifyToken:
                 self.signing_key,
                 algorithms=self.algorithms,
                 audience=self.audience,
-                issuer=f"https://{self.domain}/",
+                issuer=issuer,
             )
         except Exception as error:
             raise HTTPException(
                 status_code=HTTPStatus.UNAUTHORIZED, detail=str(error)
             )
-
-        # Check for required scopes
-        self._verify_scopes(payload, required_scopes)
+        return payload
 
     def _verify_scopes(
         self,
-        token_payload: Dict[str, str],
+        token_payload: Dict[str, Any],
         required_scopes: Optional[List[str]],
     ) -> None:
         """
@@ -80,7 +318,7 @@ class VerifyToken:
 
         Parameters
         ----------
-        token_payload : Dict[str, str]
+        token_payload : Dict[str, Any]
             The extracted payload of an authorization jwt token
         required_scopes : list of strings, optional
             A list of scopes that must be present in the token for validation
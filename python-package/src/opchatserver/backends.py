@@ -0,0 +1,431 @@
+"""
+This module contains the registry of the LLM backends of the chat server,
+and the routing of each chat to one of them.
+
+Without configuration, there is one backend: the OpenAI model named by the
+OPENAI_MODEL environment variable. LLM_BACKENDS_CONFIG can name a JSON file
+which maps backend names to LLM factories, and lists routing rules:
+
+    {
+        "backends": {
+            "gpt-3.5-turbo": {"type": "openai"},
+            "gpt-4": {"type": "openai", "params": {"temperature": 0}},
+            "local": {"type": "fake", "params": {"latency": 0.1}}
+        },
+        "default": "gpt-4",
+        "routes": [
+            {"backends": ["gpt-4"], "scopes": ["tier:premium"]},
+            {
+                "backends": ["gpt-3.5-turbo", "local"],
+                "max_prompt_tokens": 500,
+                "max_latency": 2.0
+            }
+        ]
+    }
+
+The type of a backend is "openai", "fake", or the "module:function" path
+of a function which takes the name of the backend and its params and
+returns the LLM. The name of a backend is the model name passed to OpenAI,
+unless its params set "model_name", and `model` names the model whose
+tokenizer and context window are used for its history, by default the
+model name.
+
+The routes are tried in order, and the first one which matches the chat
+selects its backend; a chat which matches none goes to the default backend.
+A route matches when:
+- the prompt and history of the chat have at most `max_prompt_tokens` and
+  at least `min_prompt_tokens` tokens,
+- the access token of the user has one of its `scopes`, from its "scope"
+  claim or its "permissions",
+- one of its backends has a current latency, the median of its llm calls of
+  the last minute, of at most `max_latency` seconds.
+Of the backends of a matching route, the one with the lowest current
+latency, weighted by its calls in flight, is selected, so that load moves
+away from a saturated backend without all of it moving to the next one.
+
+LangChain is only imported when the LLM of a backend is created.
+"""
+import importlib
+import json
+import os
+import threading
+import time
+from collections import deque
+from dataclasses import dataclass, field
+from typing import (
+    TYPE_CHECKING,
+    Any,
+    Callable,
+    Deque,
+    Dict,
+    FrozenSet,
+    Iterable,
+    List,
+    Optional,
+    Tuple,
+)
+
+from opchatserver.memory import count_tokens
+from prometheus_client import Counter
+
+if TYPE_CHECKING:
+    from langchain.llms.base import BaseLLM
+
+backend_selections = Counter(
+    "llm_backend_selections_total",
+    "Chats routed to each LLM backend, by the route which selected it",
+    ["backend", "route"],
+)
+
+
+@dataclass(frozen=True)
+class Backend:
+    """
+    An LLM backend.
+
+    Attributes
+    ----------
+    name : str
+        The name of the backend, which is reported as the model of the
+        chats it completes.
+    type : str
+        The factory of its LLM, see `LLM_FACTORIES`.
+    params : dict
+        The parameters of its LLM.
+    model : str
+        The model whose tokenizer and context window are used for the
+        history of its chats.
+    """
+
+    name: str
+    type: str = "openai"
+    params: Dict[str, Any] = field(default_factory=dict)
+    model: str = ""
+
+    def __post_init__(self) -> None:
+        if not self.model:
+            object.__setattr__(
+                self, "model", self.params.get("model_name", self.name)
+            )
+
+
+@dataclass(frozen=True)
+class Route:
+    """
+    A routing rule, see the documentation of the module.
+    """
+
+    backends: Tuple[str, ...]
+    max_prompt_tokens: Optional[int] = None
+    min_prompt_tokens: Optional[int] = None
+    scopes: FrozenSet[str] = frozenset()
+    max_latency: Optional[float] = None
+
+    @property
+    def counts_tokens(self) -> bool:
+        return (
+            self.max_prompt_tokens is not None
+            or self.min_prompt_tokens is not None
+        )
+
+
+class RecentLatency:
+    """
+    Tracks the median latency of the calls of the last `window` seconds,
+    and the calls in flight.
+    """
+
+    def __init__(self, window: float = 60.0, max_samples: int = 1000):
+        """
+        Parameters
+        ----------
+        window : float, optional
+            The number of seconds the latency of a call is kept, by default
+            60.
+        max_samples : int, optional
+            The maximum number of calls kept, by default 1000.
+        """
+        self.window = window
+        self.in_flight = 0
+        self._samples: Deque[Tuple[float, float]] = deque(maxlen=max_samples)
+        self._lock = threading.Lock()
+
+    def start(self) -> None:
+        """Record the start of a call."""
+        with self._lock:
+            self.in_flight += 1
+
+    def record(self, latency: float) -> None:
+        """Record the end of a call and its latency, in seconds."""
+        with self._lock:
+            self.in_flight = max(0, self.in_flight - 1)
+        self._samples.append((time.monotonic(), latency))
+
+    def value(self) -> Optional[float]:
+        """
+        Get the median latency of the recent calls.
+
+        Returns
+        -------
+        float, optional
+            The median latency in seconds, or None if there was no call in
+            the window.
+        """
+        since = time.monotonic() - self.window
+        latencies = sorted(
+            latency for at, latency in list(self._samples) if at >= since
+        )
+        if not latencies:
+            return None
+        return latencies[len(latencies) // 2]
+
+
+def _create_openai_llm(name: str, params: Dict[str, Any]) -> "BaseLLM":
+    from langchain.llms import OpenAI
+
+    return OpenAI(**{"model_name": name, **params})
+
+
+def _create_fake_llm(name: str, params: Dict[str, Any]) -> "BaseLLM":
+    from opchatserver.llms import FakeLLM
+
+    return FakeLLM(**params)
+
+
+# The factories of the LLMs of each backend type, which take the name of the
+# backend and its params
+LLM_FACTORIES: Dict[str, Callable[[str, Dict[str, Any]], "BaseLLM"]] = {
+    "openai": _create_openai_llm,
+    "fake": _create_fake_llm,
+}
+
+
+class BackendRegistry:
+    """
+    The LLM backends of the server, and the routes which select the backend
+    of each chat.
+    """
+
+    def __init__(
+        self,
+        backends: Iterable[Backend],
+        default: str,
+        routes: Iterable[Route] = (),
+    ):
+        """
+        Parameters
+        ----------
+        backends : iterable of Backend
+            The backends.
+        default : str
+            The name of the backend of the chats which match no route.
+        routes : iterable of Route, optional
+            The routes, tried in order.
+
+        Raises
+        ------
+        ValueError
+            If a route or the default refers to an unknown backend, or a
+            backend has an unknown type.
+        """
+        self.backends = {backend.name: backend for backend in backends}
+        self.routes = list(routes)
+        for backend in self.backends.values():
+            if backend.type not in LLM_FACTORIES and ":" not in backend.type:
+                raise ValueError(
+                    f"unknown type of backend {backend.name}: {backend.type}"
+                )
+        names = {default}.union(*(route.backends for route in self.routes))
+        unknown = names - set(self.backends)
+        if unknown:
+            raise ValueError(f"unknown backends: {sorted(unknown)}")
+        if any(not route.backends for route in self.routes):
+            raise ValueError("every route needs at least one backend")
+        self.default = self.backends[default]
+        self._latencies = {name: RecentLatency() for name in self.backends}
+        self._counts_tokens = any(route.counts_tokens for route in self.routes)
+        # Whether the selection depends on the access token of the user
+        self.uses_scopes = any(route.scopes for route in self.routes)
+
+    def create_llm(self, name: str) -> "BaseLLM":
+        """
+        Create the LLM of a backend, which reports the latency of its calls
+        to the registry.
+
+        Parameters
+        ----------
+        name : str
+            The name of the backend.
+
+        Returns
+        -------
+        BaseLLM
+            The LLM.
+        """
+        from opchatserver.llms import LatencyCallback
+
+        backend = self.backends[name]
+        factory = LLM_FACTORIES.get(backend.type)
+        if factory is None:
+            module, function = backend.type.split(":", 1)
+            factory = getattr(importlib.import_module(module), function)
+        llm = factory(backend.name, dict(backend.params))
+        latency = self._latencies[name]
+        llm.callbacks = [
+            *(llm.callbacks or []),  # type: ignore[misc]
+            LatencyCallback(latency.start, latency.record),
+        ]
+        return llm
+
+    def latency(self, name: str) -> Optional[float]:
+        """
+        Get the current latency of a backend.
+
+        Parameters
+        ----------
+        name : str
+            The name of the backend.
+
+        Returns
+        -------
+        float, optional
+            The median latency of its llm calls of the last minute, in
+            seconds, or None if it had no call.
+        """
+        return self._latencies[name].value()
+
+    def select(
+        self, prompt: str, history: List[str], token_payload: Dict[str, Any]
+    ) -> Backend:
+        """
+        Select the backend of a chat.
+
+        Parameters
+        ----------
+        prompt : str
+            The prompt of the chat.
+        history : list of str
+            The history of the chat.
+        token_payload : dict
+            The payload of the verified access token of the user.
+
+        Returns
+        -------
+        Backend
+            The backend of the first matching route, or the default one.
+        """
+        if not self.routes:
+            return self.default
+        prompt_tokens = 0
+        if self._counts_tokens:
+            model = self.default.model
+            prompt_tokens = count_tokens(prompt, model) + sum(
+                count_tokens(message, model) for message in history
+            )
+        scopes = _get_scopes(token_payload)
+        for i, route in enumerate(self.routes):
+            if (
+                route.max_prompt_tokens is not None
+                and prompt_tokens > route.max_prompt_tokens
+            ) or (
+                route.min_prompt_tokens is not None
+                and prompt_tokens < route.min_prompt_tokens
+            ):
+                continue
+            if route.scopes and not route.scopes & scopes:
+                continue
+            backend = self._fastest(route)
+            if backend is not None:
+                backend_selections.labels(backend.name, str(i)).inc()
+                return backend
+        backend_selections.labels(self.default.name, "default").inc()
+        return self.default
+
+    def _fastest(self, route: Route) -> Optional[Backend]:
+        """
+        Helper function which selects the backend of a route with the
+        lowest current latency times its calls in flight plus one, a backend
+        without recent calls counting as the fastest, or None if they are
+        all slower than the `max_latency` of the route.
+        """
+        if len(route.backends) == 1 and route.max_latency is None:
+            return self.backends[route.backends[0]]
+        best: Optional[Tuple[float, int, str]] = None
+        for name in route.backends:
+            latency = self.latency(name)
+            if route.max_latency is not None and (latency or 0.0) > (
+                route.max_latency
+            ):
+                continue
+            in_flight = self._latencies[name].in_flight
+            cost = (latency or 0.0) * (in_flight + 1)
+            if best is None or (cost, in_flight) < best[:2]:
+                best = (cost, in_flight, name)
+        return self.backends[best[2]] if best is not None else None
+
+
+def _get_scopes(token_payload: Dict[str, Any]) -> FrozenSet[str]:
+    """
+    Helper function which gets the scopes and permissions of an access
+    token.
+    """
+    scopes = str(token_payload.get("scope", "")).split()
+    permissions = token_payload.get("permissions") or []
+    return frozenset([*scopes, *permissions])
+
+
+def load_backend_registry(config: Dict[str, Any]) -> BackendRegistry:
+    """
+    Create a backend registry from its configuration, see the documentation
+    of the module.
+
+    Parameters
+    ----------
+    config : dict
+        The configuration.
+
+    Returns
+    -------
+    BackendRegistry
+        The registry.
+    """
+    backends = [
+        Backend(
+            name=name,
+            type=backend.get("type", "openai"),
+            params=dict(backend.get("params", {})),
+            model=backend.get("model", ""),
+        )
+        for name, backend in config["backends"].items()
+    ]
+    routes = [
+        Route(
+            backends=tuple(route["backends"]),
+            max_prompt_tokens=route.get("max_prompt_tokens"),
+            min_prompt_tokens=route.get("min_prompt_tokens"),
+            scopes=frozenset(route.get("scopes", [])),
+            max_latency=route.get("max_latency"),
+        )
+        for route in config.get("routes", [])
+    ]
+    default = config.get("default", backends[0].name if backends else "")
+    return BackendRegistry(backends, default, routes)
+
+
+def create_backend_registry() -> BackendRegistry:
+    """
+    Create the backend registry configured by the file named by the
+    LLM_BACKENDS_CONFIG environment variable, or the single OpenAI backend
+    of OPENAI_MODEL if it is not set.
+
+    Returns
+    -------
+    BackendRegistry
+        The registry.
+    """
+    path = os.environ.get("LLM_BACKENDS_CONFIG")
+    if not path:
+        model = os.environ.get("OPENAI_MODEL", "gpt-3.5-turbo")
+        return BackendRegistry([Backend(model)], model)
+    with open(path) as file:
+        return load_backend_registry(json.load(file))
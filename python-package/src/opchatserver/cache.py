@@ -0,0 +1,132 @@
+"""
+This module contains a small thread-safe LRU cache with per-entry expiry
+that is shared by the caches of the chat server.
+"""
+import threading
+import time
+from collections import OrderedDict
+from typing import Callable, Generic, Hashable, Optional, Tuple, TypeVar
+
+V = TypeVar("V")
+
+
+class TTLCache(Generic[V]):
+    """
+    A bounded least-recently-used cache whose entries expire after a
+    time-to-live. Each entry may also carry its own, earlier, expiry time.
+
+    All operations are guarded by a lock, so a single instance can be shared
+    between the threads of the server's executor.
+    """
+
+    def __init__(
+        self,
+        maxsize: int,
+        ttl: float,
+        timer: Callable[[], float] = time.monotonic,
+    ):
+        """
+        Parameters
+        ----------
+        maxsize : int
+            The maximum number of entries held by the cache. When it is
+            exceeded, the least recently used entry is evicted.
+        ttl : float
+            The number of seconds after which an entry expires.
+        timer : callable, optional
+            The clock used to compute expiry times, by default
+            `time.monotonic`.
+        """
+        if maxsize <= 0:
+            raise ValueError("maxsize must be greater than 0")
+        if ttl <= 0:
+            raise ValueError("ttl must be greater than 0")
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._timer = timer
+        self._lock = threading.Lock()
+        self._entries: "OrderedDict[Hashable, Tuple[float, V]]" = OrderedDict()
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._entries)
+
+    def get(self, key: Hashable) -> Optional[V]:
+        """
+        Get the value stored for `key`, or None if there is no entry or the
+        entry has expired. A successful lookup marks the entry as the most
+        recently used one.
+
+        Parameters
+        ----------
+        key : Hashable
+            The key of the entry.
+
+        Returns
+        -------
+        V, optional
+            The cached value, if any.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            expires_at, value = entry
+            if expires_at <= self._timer():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def set(
+        self, key: Hashable, value: V, ttl: Optional[float] = None
+    ) -> None:
+        """
+        Store `value` under `key`, evicting the least recently used entry if
+        the cache is full.
+
+        Parameters
+        ----------
+        key : Hashable
+            The key of the entry.
+        value : V
+            The value to store.
+        ttl : float, optional
+            A time-to-live for this entry. It is capped by the time-to-live
+            of the cache. Entries with a non-positive `ttl` are not stored.
+        """
+        if ttl is None or ttl > self.ttl:
+            ttl = self.ttl
+        if ttl <= 0:
+            return
+        with self._lock:
+            self._entries[key] = (self._timer() + ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def pop(self, key: Hashable) -> Optional[V]:
+        """
+        Remove the entry stored under `key` and return its value, or None if
+        there is no live entry.
+
+        Parameters
+        ----------
+        key : Hashable
+            The key of the entry.
+
+        Returns
+        -------
+        V, optional
+            The removed value, if any.
+        """
+        with self._lock:
+            entry = self._entries.pop(key, None)
+        if entry is None or entry[0] <= self._timer():
+            return None
+        return entry[1]
+
+    def clear(self) -> None:
+        """Remove all the entries of the cache."""
+        with self._lock:
+            self._entries.clear()
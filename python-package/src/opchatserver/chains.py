@@ -0,0 +1,145 @@
+"""
+This module contains the registry of the LangChain runnables used by the
+chat server. The runnables only depend on the model and the prompt template,
+so they are built once and reused by every request, with the per-request
+data passed through their inputs.
+
+LangChain is only imported when the first runnables are built, so that
+importing the server stays fast.
+"""
+import threading
+from functools import cached_property
+from typing import TYPE_CHECKING, Any, Callable, Dict, Tuple
+
+if TYPE_CHECKING:
+    from langchain.llms.base import BaseLLM
+    from langchain.schema import BasePromptTemplate
+    from langchain.schema.runnable import Runnable
+    from opchatserver.intermediate_outputs import IntermediateOutputChain
+
+
+class ChatChains:
+    """
+    The runnables serving the chats for one model and prompt template.
+
+    Attributes
+    ----------
+    prompt : BasePromptTemplate
+        The prompt template.
+    llm : BaseLLM
+        The llm completing the prompts.
+    completion_chain : Runnable
+        Completes already sanitized inputs and returns the raw response,
+        using the response cache when it is enabled.
+    uncached_completion_chain : Runnable
+        Completes the inputs which the local pre-screen finds clean, which
+        are not sanitized, without the response cache.
+    intermediate_output_chain : IntermediateOutputChain
+        The chain returned by `get_intermediate_output_chain`, which also
+        completes the inputs which are already sanitized, e.g. in batches.
+    """
+
+    def __init__(self, prompt: "BasePromptTemplate", llm: "BaseLLM"):
+        """
+        Parameters
+        ----------
+        prompt : BasePromptTemplate
+            The prompt template.
+        llm : BaseLLM
+            The llm completing the prompts.
+        """
+        from opchatserver.completion import LLMCompletion
+        from opchatserver.intermediate_outputs import (
+            get_intermediate_output_chain,
+        )
+
+        self.prompt = prompt
+        self.llm = llm
+        self.completion_chain: "Runnable" = LLMCompletion(prompt, llm)
+        self.uncached_completion_chain: "Runnable" = LLMCompletion(
+            prompt, llm, cacheable=False
+        )
+        self.intermediate_output_chain: "IntermediateOutputChain" = (
+            get_intermediate_output_chain(prompt, llm)
+        )
+
+    @cached_property
+    def opaqueprompts_chain(self) -> "Runnable":
+        """
+        The chain of the typical OpaquePrompts LangChain integration, which
+        wraps the llm with `OpaquePrompts`. It is built on first use, since
+        `OpaquePrompts` checks for its API key when it is created. When the
+        local pre-screen finds an input clean, it is completed by the llm
+        directly instead, without the response cache.
+        """
+        from langchain.llms.opaqueprompts import OpaquePrompts
+        from langchain.schema.output_parser import StrOutputParser
+        from langchain.schema.runnable import RunnableBranch
+
+        return RunnableBranch(
+            (_is_clean, self.uncached_completion_chain),
+            self.prompt | OpaquePrompts(base_llm=self.llm) | StrOutputParser(),
+        )
+
+
+def _is_clean(input: Dict[str, Any]) -> bool:
+    """
+    Helper function which checks whether the local pre-screen, if it is
+    enabled, finds no sensitive data in the prompt and history of an input.
+    """
+    from opchatserver.prescreen import get_prescreen
+
+    prescreen = get_prescreen()
+    return prescreen is not None and prescreen.is_clean(
+        [input["prompt"], input["history"]]
+    )
+
+
+class ChainRegistry:
+    """
+    Builds the `ChatChains` of each model and prompt template combination
+    once, and returns the same instance for every later request.
+    """
+
+    def __init__(self, llm_factory: Callable[[str], "BaseLLM"]):
+        """
+        Parameters
+        ----------
+        llm_factory : callable
+            Creates the llm of a model, given the model name.
+        """
+        self._llm_factory = llm_factory
+        self._chains: Dict[Tuple[str, str], ChatChains] = {}
+        self._lock = threading.Lock()
+
+    def get(self, model_name: str, template: str) -> ChatChains:
+        """
+        Get the runnables of a model and a prompt template, building them on
+        first use.
+
+        Parameters
+        ----------
+        model_name : str
+            The name of the model.
+        template : str
+            The prompt template.
+
+        Returns
+        -------
+        ChatChains
+            The runnables of the model and prompt template.
+        """
+        key = (model_name, template)
+        chains = self._chains.get(key)
+        if chains is None:
+            from langchain.prompts import PromptTemplate
+
+            with self._lock:
+                chains = self._chains.get(key)
+                if chains is None:
+                    chains = ChatChains(
+                        PromptTemplate.from_template(template),
+                        self._llm_factory(model_name),
+                    )
+                    self._chains[key] = chains
+        return chains
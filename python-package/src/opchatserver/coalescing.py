@@ -0,0 +1,152 @@
+"""
+This module contains the coalescing of concurrent duplicate chats: while a
+chat is being completed, the identical chats of the same user, e.g. retries
+and double submits, wait for its response instead of sanitizing and
+completing their prompt again.
+"""
+import asyncio
+import hashlib
+import os
+from typing import Awaitable, Callable, Dict, Generic, Optional, TypeVar
+
+from opchatserver.tracing import trace_span
+from prometheus_client import Counter, Gauge
+
+T = TypeVar("T")
+
+coalesced_requests = Counter(
+    "chat_coalesced_requests_total",
+    "Chats which ran the chat pipeline (leader) or waited for the response "
+    "of an identical chat in flight (follower)",
+    ["role"],
+)
+coalescing_in_flight = Gauge(
+    "chat_coalescing_in_flight",
+    "Distinct chats in flight which identical chats can wait for",
+    multiprocess_mode="livesum",
+)
+
+
+class _Flight(Generic[T]):
+    """The shared execution of a key, and the number of its callers."""
+
+    __slots__ = ("task", "waiters")
+
+    def __init__(self, task: "asyncio.Task[T]"):
+        self.task = task
+        self.waiters = 0
+
+
+class SingleFlight(Generic[T]):
+    """
+    Runs at most one execution of a function per key at a time, sharing its
+    result, or its exception, with the callers of the same key.
+
+    The function runs in a task of its own, so that a caller which is
+    cancelled, e.g. because its client disconnected, does not cancel the
+    others. The task is only cancelled when all of its callers are.
+    """
+
+    def __init__(self) -> None:
+        self._flights: Dict[str, _Flight[T]] = {}
+
+    def __len__(self) -> int:
+        return len(self._flights)
+
+    async def run(self, key: str, function: Callable[[], Awaitable[T]]) -> T:
+        """
+        Run `function`, or wait for the execution in flight for `key`.
+
+        Parameters
+        ----------
+        key : str
+            Identifies the executions which are interchangeable.
+        function : callable
+            Returns the awaitable to run if no execution is in flight for
+            `key`.
+
+        Returns
+        -------
+        T
+            The result of the execution, shared by all of its callers.
+        """
+        flight = self._flights.get(key)
+        if flight is None:
+            coalesced_requests.labels("leader").inc()
+            # The task inherits the context, and so the trace, of the caller
+            flight = self._flights[key] = _Flight(
+                asyncio.ensure_future(function())
+            )
+            coalescing_in_flight.inc()
+            flight.task.add_done_callback(lambda _: self._land(key, flight))
+            return await self._wait(flight)
+        coalesced_requests.labels("follower").inc()
+        with trace_span("coalesced"):
+            return await self._wait(flight)
+
+    async def _wait(self, flight: _Flight[T]) -> T:
+        """
+        Helper function which waits for the result of an execution, and
+        cancels it if all of its callers are cancelled.
+        """
+        flight.waiters += 1
+        try:
+            return await asyncio.shield(flight.task)
+        except asyncio.CancelledError:
+            if not flight.task.done() and flight.waiters == 1:
+                flight.task.cancel()
+            raise
+        finally:
+            flight.waiters -= 1
+
+    def _land(self, key: str, flight: _Flight[T]) -> None:
+        """
+        Helper function which forgets the execution of `key` once it is
+        done, so that later calls run the function again.
+        """
+        if self._flights.get(key) is flight:
+            del self._flights[key]
+            coalescing_in_flight.dec()
+        if not flight.task.cancelled():
+            # Retrieve the exception, if any, in case all the callers left
+            flight.task.exception()
+
+
+def coalescing_key(subject: str, model: str, body: str) -> str:
+    """
+    Get the key of a chat, which identical chats of the same user share.
+
+    Parameters
+    ----------
+    subject : str
+        The verified subject of the access token of the user.
+    model : str
+        The name of the backend which completes the chat.
+    body : str
+        The request body, serialized deterministically.
+
+    Returns
+    -------
+    str
+        The key.
+    """
+    digest = hashlib.blake2b(digest_size=16)
+    for part in (subject, model, body):
+        digest.update(part.encode())
+        digest.update(b"\0")
+    return digest.hexdigest()
+
+
+def create_single_flight() -> Optional[SingleFlight]:
+    """
+    Create the coalescing of the chats, unless it is disabled by the
+    CHAT_COALESCING_ENABLED environment variable.
+
+    Returns
+    -------
+    SingleFlight, optional
+        The coalescing of the chats, or None if it is disabled.
+    """
+    if os.environ.get("CHAT_COALESCING_ENABLED", "true").lower() != "true":
+        return None
+    return SingleFlight()
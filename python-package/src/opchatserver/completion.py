@@ -0,0 +1,121 @@
+"""
+This module contains the runnable which completes the sanitized inputs of
+the chat with the llm. It is the "llm" stage of the chat pipeline: its
+asynchronous calls go through the resilience policy of the stage, and it
+serves the responses of the response cache when it is enabled.
+
+Only sanitized prompts may be cached: the inputs which the local pre-screen
+finds clean are sent to the llm as they are, so they are completed by an
+`LLMCompletion` which does not use the cache.
+"""
+from typing import Any, AsyncIterator, Dict, Optional, Tuple
+
+from langchain.llms.base import BaseLLM
+from langchain.schema import BasePromptTemplate
+from langchain.schema.output_parser import StrOutputParser
+from langchain.schema.prompt import PromptValue
+from langchain.schema.runnable import Runnable, RunnableConfig
+from opchatserver.metrics import track_stage, track_stream
+from opchatserver.resilience import get_stage_policy
+from opchatserver.response_cache import ResponseCache, get_response_cache
+
+
+class LLMCompletion(Runnable[Dict[str, Any], str]):
+    """
+    Applies the prompt template to sanitized inputs and returns the raw
+    response of the llm, as `prompt | llm | StrOutputParser()` would.
+    """
+
+    def __init__(
+        self, prompt: BasePromptTemplate, llm: BaseLLM, cacheable: bool = True
+    ):
+        """
+        Parameters
+        ----------
+        prompt : BasePromptTemplate
+            The prompt template.
+        llm : BaseLLM
+            The llm completing the prompts.
+        cacheable : bool, optional
+            Whether the responses may be taken from and stored in the
+            response cache, by default True. It must be False for inputs
+            which are not sanitized.
+        """
+        self.prompt = prompt
+        self.llm = llm
+        self.cacheable = cacheable
+        self._llm_chain = llm | StrOutputParser()
+        # Identifies the model and its parameters, like the llm cache of
+        # LangChain does
+        self._llm_string = str(sorted(llm.dict().items()))
+
+    def invoke(
+        self, input: Dict[str, Any], config: Optional[RunnableConfig] = None
+    ) -> str:
+        prompt_value = self.prompt.invoke(input, config)
+        cache, key, response = self._lookup(prompt_value)
+        if response is not None:
+            return response
+        with track_stage("llm"):
+            response = self._llm_chain.invoke(prompt_value, config)
+        if cache is not None:
+            cache.set(key, response)
+        return response
+
+    async def ainvoke(
+        self,
+        input: Dict[str, Any],
+        config: Optional[RunnableConfig] = None,
+        **kwargs: Any,
+    ) -> str:
+        prompt_value = await self.prompt.ainvoke(input, config)
+        cache, key, response = self._lookup(prompt_value)
+        if response is not None:
+            return response
+        with track_stage("llm"):
+            response = await get_stage_policy("llm").call(
+                lambda: self._llm_chain.ainvoke(prompt_value, config)
+            )
+        if cache is not None:
+            cache.set(key, response)
+        return response
+
+    async def astream(
+        self,
+        input: Dict[str, Any],
+        config: Optional[RunnableConfig] = None,
+        **kwargs: Any,
+    ) -> AsyncIterator[str]:
+        prompt_value = await self.prompt.ainvoke(input, config)
+        cache, key, response = self._lookup(prompt_value)
+        if response is not None:
+            yield response
+            return
+        chunks = []
+        stream = get_stage_policy("llm").stream(
+            lambda: self._llm_chain.astream(prompt_value, config)
+        )
+        async for chunk in track_stream("llm", stream):
+            chunks.append(chunk)
+            yield chunk
+        # Only complete responses are cached
+        if cache is not None:
+            cache.set(key, "".join(chunks))
+
+    def _lookup(
+        self, prompt_value: PromptValue
+    ) -> Tuple[Optional[ResponseCache], str, Optional[str]]:
+        """
+        Helper function which looks up the response to a prompt in the
+        response cache, if it is enabled and the completion is cacheable.
+
+        Returns
+        -------
+        (ResponseCache or None, str, str or None)
+            The cache, the key of the prompt, and the cached response.
+        """
+        cache = get_response_cache() if self.cacheable else None
+        if cache is None:
+            return None, "", None
+        key = cache.key(self._llm_string, prompt_value.to_string())
+        return cache, key, cache.get(key)
@@ -0,0 +1,198 @@
+"""
+This module drains a worker of the chat server before it stops: once the
+worker is draining, /ready answers 503 so that load balancers stop sending
+it traffic, new chats are rejected with 503, and the shutdown of the worker
+waits for the chats in flight, up to a deadline, before the resources they
+use (the upstream connection pools, the executor) are released.
+
+uvicorn stops accepting connections as soon as it receives SIGTERM, and
+waits for the open ones for up to `--timeout-graceful-shutdown` seconds. If
+SHUTDOWN_DRAIN_DELAY is set, the worker instead starts draining on SIGTERM
+and keeps accepting connections, e.g. for health checks, until its chats
+in flight are done, for up to that many seconds, before handing the signal
+over to uvicorn. This gives load balancers the time to notice that it is
+not ready anymore.
+"""
+import asyncio
+import logging
+import os
+import signal
+import threading
+from contextlib import contextmanager
+from typing import Any, Iterator, Optional, Set
+
+from opchatserver.metrics import CHAT_ENDPOINTS
+from prometheus_client import Gauge
+from starlette.responses import JSONResponse
+
+logger = logging.getLogger(__name__)
+
+chats_in_flight = Gauge(
+    "server_chats_in_flight",
+    "Chats being handled by the worker, which its shutdown waits for",
+    multiprocess_mode="livesum",
+)
+draining_workers = Gauge(
+    "server_draining",
+    "1 if the worker is draining before it stops, 0 otherwise",
+    multiprocess_mode="max",
+)
+
+
+class Drain:
+    """
+    Tracks the chats in flight of a worker, and whether it is draining.
+    """
+
+    def __init__(self) -> None:
+        self.draining = False
+        self.in_flight = 0
+        # Set whenever no chat is in flight
+        self._idle = asyncio.Event()
+        self._idle.set()
+
+    def start(self) -> None:
+        """Start draining: new chats are rejected from now on."""
+        if not self.draining:
+            logger.info("Draining %d chat(s) in flight", self.in_flight)
+            self.draining = True
+            draining_workers.set(1)
+
+    @contextmanager
+    def track(self) -> Iterator[None]:
+        """Count a chat as in flight until the block exits."""
+        self.in_flight += 1
+        chats_in_flight.inc()
+        self._idle.clear()
+        try:
+            yield
+        finally:
+            self.in_flight -= 1
+            chats_in_flight.dec()
+            if self.in_flight == 0:
+                self._idle.set()
+
+    async def wait(self, timeout: float) -> bool:
+        """
+        Wait until no chat is in flight.
+
+        Parameters
+        ----------
+        timeout : float
+            The maximum number of seconds to wait.
+
+        Returns
+        -------
+        bool
+            True if no chat is in flight, False if some still are after
+            `timeout` seconds.
+        """
+        try:
+            await asyncio.wait_for(self._idle.wait(), timeout)
+        except asyncio.TimeoutError:
+            logger.warning(
+                "%d chat(s) still in flight after draining for %.1f seconds",
+                self.in_flight,
+                timeout,
+            )
+            return False
+        return True
+
+
+class DrainMiddleware:
+    """
+    ASGI middleware which counts the chat requests in flight until their
+    response has been sent, including the body of streaming responses, and
+    rejects new ones with 503 while the worker is draining.
+    """
+
+    def __init__(self, app: Any):
+        self.app = app
+
+    async def __call__(self, scope: Any, receive: Any, send: Any) -> None:
+        drain: Optional[Drain] = getattr(scope["app"].state, "drain", None)
+        if (
+            scope["type"] != "http"
+            or scope.get("path") not in CHAT_ENDPOINTS
+            or drain is None
+        ):
+            await self.app(scope, receive, send)
+            return
+        if drain.draining:
+            response = JSONResponse(
+                {"detail": "The server is shutting down"},
+                status_code=503,
+                headers={"Retry-After": "1", "Connection": "close"},
+            )
+            await response(scope, receive, send)
+            return
+        with drain.track():
+            await self.app(scope, receive, send)
+
+
+def get_drain_timeout() -> float:
+    """
+    Get the maximum number of seconds the shutdown of a worker waits for its
+    chats in flight, from the SHUTDOWN_DRAIN_TIMEOUT environment variable.
+
+    Returns
+    -------
+    float
+        The timeout, 30 seconds by default.
+    """
+    return float(os.environ.get("SHUTDOWN_DRAIN_TIMEOUT", "30"))
+
+
+def install_drain_signal_handler(drain: Drain) -> bool:
+    """
+    Start draining the worker on SIGTERM, and hand the signal over to uvicorn
+    once no chat is in flight, or after SHUTDOWN_DRAIN_DELAY seconds, by
+    raising SIGINT, which uvicorn handles the same way. It is only installed
+    if SHUTDOWN_DRAIN_DELAY is set, from the main thread.
+
+    Parameters
+    ----------
+    drain : Drain
+        The drain of the worker.
+
+    Returns
+    -------
+    bool
+        Whether the handler was installed.
+    """
+    delay = float(os.environ.get("SHUTDOWN_DRAIN_DELAY", "0"))
+    if delay <= 0 or threading.current_thread() is not threading.main_thread():
+        return False
+    loop = asyncio.get_running_loop()
+    handed_over = False
+    # Holds the drain task, which the event loop only references weakly
+    tasks: Set["asyncio.Task[None]"] = set()
+
+    def hand_over() -> None:
+        nonlocal handed_over
+        # uvicorn stops right away, without the lifespan shutdown, on a
+        # second SIGINT
+        if not handed_over:
+            handed_over = True
+            signal.raise_signal(signal.SIGINT)
+
+    async def drain_then_hand_over() -> None:
+        drain.start()
+        await drain.wait(delay)
+        hand_over()
+
+    def on_sigterm() -> None:
+        if drain.draining:
+            # A second SIGTERM does not wait for the chats in flight
+            hand_over()
+            return
+        task = loop.create_task(drain_then_hand_over())
+        tasks.add(task)
+        task.add_done_callback(tasks.discard)
+
+    try:
+        loop.add_signal_handler(signal.SIGTERM, on_sigterm)
+    except NotImplementedError:  # pragma: no cover
+        # Windows
+        return False
+    return True
@@ -0,0 +1,96 @@
+"""
+This module owns the bounded thread pool used to run blocking work, such as
+calls to the OpaquePrompts service, without blocking the server's event loop.
+"""
+import asyncio
+import contextvars
+import functools
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Optional, TypeVar
+
+T = TypeVar("T")
+
+_executor: Optional[ThreadPoolExecutor] = None
+_executor_lock = threading.Lock()
+
+
+def _get_max_workers() -> int:
+    """
+    Get the maximum number of threads of the executor.
+
+    Returns
+    -------
+    int
+        The maximum number of threads of the executor.
+    """
+    return int(os.environ.get("CHAT_EXECUTOR_MAX_WORKERS", "32"))
+
+
+def get_executor() -> ThreadPoolExecutor:
+    """
+    Get the process-wide executor, creating it on first use.
+
+    Returns
+    -------
+    ThreadPoolExecutor
+        The executor used to run blocking work.
+    """
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(
+                max_workers=_get_max_workers(),
+                thread_name_prefix="opchatserver",
+            )
+        return _executor
+
+
+def install_default_executor() -> None:
+    """
+    Make the process-wide executor the default executor of the running event
+    loop, so that blocking work offloaded by LangChain with
+    `run_in_executor(None, ...)` is bounded by the same pool.
+    """
+    asyncio.get_running_loop().set_default_executor(get_executor())
+
+
+def shutdown_executor() -> None:
+    """
+    Shut down the process-wide executor, waiting for pending work. A new
+    executor is created if it is needed again.
+    """
+    global _executor
+    with _executor_lock:
+        executor, _executor = _executor, None
+    if executor is not None:
+        executor.shutdown(wait=True)
+
+
+async def run_in_executor(
+    func: Callable[..., T], *args: Any, **kwargs: Any
+) -> T:
+    """
+    Run a blocking function on the process-wide executor, in a copy of the
+    current context, so that it sees the trace of its request.
+
+    Parameters
+    ----------
+    func : callable
+        The blocking function to run.
+    *args : Any
+        The positional arguments of `func`.
+    **kwargs : Any
+        The keyword arguments of `func`.
+
+    Returns
+    -------
+    T
+        The return value of `func`.
+    """
+    context = contextvars.copy_context()
+    return await asyncio.get_running_loop().run_in_executor(
+        get_executor(),
+        functools.partial(context.run, func, *args, **kwargs),
+    )
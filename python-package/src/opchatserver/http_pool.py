@@ -0,0 +1,338 @@
+"""
+This module owns the connection pools shared by all the calls the server
+makes to the OpenAI and OpaquePrompts APIs, so that connections are kept
+alive and reused rather than opened for every request.
+
+The OpenAI client (openai<1.0) uses `requests` for synchronous calls and
+`aiohttp` for asynchronous ones, and opens a new `aiohttp` session for every
+asynchronous call unless one is provided through `openai.aiosession`. The
+OpaquePrompts client uses a module-level `requests` session whose pool is
+smaller than the executor of the server. Neither library supports HTTP/2,
+so the pools use persistent HTTP/1.1 connections.
+"""
+import logging
+import os
+from typing import Any, Dict, Optional, Tuple, Union
+
+import aiohttp
+import openai
+import requests
+from prometheus_client import Gauge
+from requests.adapters import HTTPAdapter
+
+logger = logging.getLogger(__name__)
+
+pool_connections = Gauge(
+    "upstream_pool_connections",
+    "Connections of the upstream connection pools",
+    ["pool", "state"],
+    multiprocess_mode="livesum",
+)
+
+
+class TimeoutHTTPAdapter(HTTPAdapter):
+    """
+    An HTTPAdapter which applies a default timeout to requests sent without
+    one.
+    """
+
+    def __init__(
+        self, timeout: Tuple[float, float], *args: Any, **kwargs: Any
+    ):
+        """
+        Parameters
+        ----------
+        timeout : (float, float)
+            The default connect and read timeouts, in seconds.
+        *args : Any
+            The positional arguments of `HTTPAdapter`.
+        **kwargs : Any
+            The keyword arguments of `HTTPAdapter`.
+        """
+        self.timeout = timeout
+        super().__init__(*args, **kwargs)
+
+    def send(
+        self,
+        request: requests.PreparedRequest,
+        timeout: Union[None, float, Tuple[float, float]] = None,
+        **kwargs: Any,
+    ) -> requests.Response:
+        return super().send(
+            request,
+            timeout=self.timeout if timeout is None else timeout,
+            **kwargs,
+        )
+
+
+class UpstreamPools:
+    """
+    The `requests` and `aiohttp` sessions used for all upstream calls of one
+    worker, with bounded pools of keep-alive connections.
+    """
+
+    def __init__(
+        self,
+        max_connections: int = 100,
+        max_connections_per_host: int = 32,
+        keepalive_timeout: float = 30,
+        connect_timeout: float = 10,
+        read_timeout: float = 120,
+    ):
+        """
+        Parameters
+        ----------
+        max_connections : int, optional
+            The maximum number of connections of the asynchronous pool, by
+            default 100.
+        max_connections_per_host : int, optional
+            The maximum number of connections to a single upstream host, for
+            both the synchronous and the asynchronous pools, by default 32.
+        keepalive_timeout : float, optional
+            The number of seconds an idle connection is kept open, by default
+            30.
+        connect_timeout : float, optional
+            The timeout to establish a connection, in seconds, by default 10.
+        read_timeout : float, optional
+            The timeout to read from a connection, in seconds, by default 120.
+        """
+        self.max_connections = max_connections
+        self.max_connections_per_host = max_connections_per_host
+        self.keepalive_timeout = keepalive_timeout
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.requests_session: Optional[requests.Session] = None
+        self.aiohttp_session: Optional[aiohttp.ClientSession] = None
+        self.opaqueprompts_session: Optional[requests.Session] = None
+
+    async def start(self) -> None:
+        """
+        Create the sessions and install them in the OpenAI and OpaquePrompts
+        clients. Must be called from the event loop of the server.
+        """
+        self.requests_session = requests.Session()
+        self.requests_session.mount(
+            "https://",
+            TimeoutHTTPAdapter(
+                (self.connect_timeout, self.read_timeout),
+                pool_connections=4,
+                pool_maxsize=self.max_connections_per_host,
+                max_retries=openai.api_requestor.MAX_CONNECTION_RETRIES,
+            ),
+        )
+        openai.requestssession = self.requests_session
+
+        self.aiohttp_session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(
+                limit=self.max_connections,
+                limit_per_host=self.max_connections_per_host,
+                keepalive_timeout=self.keepalive_timeout,
+            ),
+            timeout=aiohttp.ClientTimeout(
+                total=None,
+                sock_connect=self.connect_timeout,
+                sock_read=self.read_timeout,
+            ),
+        )
+        self.opaqueprompts_session = self._install_opaqueprompts_session()
+
+    async def close(self) -> None:
+        """Close the sessions and uninstall them from the clients."""
+        if openai.requestssession is self.requests_session:
+            openai.requestssession = None
+        if self.requests_session is not None:
+            self.requests_session.close()
+            self.requests_session = None
+        if self.aiohttp_session is not None:
+            await self.aiohttp_session.close()
+            self.aiohttp_session = None
+        if self.opaqueprompts_session is not None:
+            self.opaqueprompts_session.close()
+            self.opaqueprompts_session = None
+
+    def usage(self) -> Dict[str, Dict[str, int]]:
+        """
+        Get the number of connections of each pool, by state.
+
+        Returns
+        -------
+        dict
+            For each pool, the number of connections that are "in_use" and
+            "idle", and the connection "limit". The counts of the `aiohttp`
+            pool are read from the internals of its connector, and left out
+            if this version of `aiohttp` does not have them.
+        """
+        usage: Dict[str, Dict[str, int]] = {}
+        if self.aiohttp_session is not None:
+            connector: Any = self.aiohttp_session.connector
+            usage["aiohttp"] = {"limit": connector.limit}
+            acquired = getattr(connector, "_acquired", None)
+            if acquired is not None:
+                usage["aiohttp"]["in_use"] = len(acquired)
+            conns = getattr(connector, "_conns", None)
+            if conns is not None:
+                usage["aiohttp"]["idle"] = sum(
+                    len(pool) for pool in conns.values()
+                )
+        for name, session in [
+            ("requests", self.requests_session),
+            ("opaqueprompts", self.opaqueprompts_session),
+        ]:
+            if session is not None:
+                usage[name] = _requests_usage(session)
+        return usage
+
+    def record_usage(self) -> None:
+        """Export the usage of the pools as Prometheus gauges."""
+        for pool, states in self.usage().items():
+            for state, value in states.items():
+                pool_connections.labels(pool=pool, state=state).set(value)
+
+    def _install_opaqueprompts_session(self) -> Optional[requests.Session]:
+        """
+        Replace the module-level session of the OpaquePrompts client with one
+        whose pool matches the pools of this instance. This relies on the
+        internals of the client, so if they are not found, the client keeps
+        its own session.
+
+        Returns
+        -------
+        requests.Session, optional
+            The installed session, or None if the OpaquePrompts client is not
+            installed or not supported.
+        """
+        try:
+            from opaqueprompts import opaqueprompts_service
+        except ImportError:
+            logger.warning(
+                "opaqueprompts is not installed, its connections are not "
+                "pooled by the server"
+            )
+            return None
+
+        try:
+            adapter = opaqueprompts_service.HTTPAAdapter(
+                opaqueprompts_service._get_default_validators()
+            )
+            session_lock = opaqueprompts_service._session_lock
+        except AttributeError as e:
+            logger.warning(
+                "This version of opaqueprompts is not supported (%s), its "
+                "connections are not pooled by the server",
+                e,
+            )
+            return None
+        if isinstance(adapter, HTTPAdapter):
+            adapter.init_poolmanager(
+                connections=4, maxsize=self.max_connections_per_host
+            )
+        session = requests.Session()
+        session.mount("httpa://", adapter)
+        session.mount(
+            "http://",
+            HTTPAdapter(pool_maxsize=self.max_connections_per_host),
+        )
+        with session_lock:
+            opaqueprompts_service._session = session
+        return session
+
+
+def _requests_usage(session: requests.Session) -> Dict[str, int]:
+    """
+    Helper function which counts the connections of the pools of a
+    `requests` session.
+    """
+    usage = {"in_use": 0, "idle": 0, "limit": 0}
+    for adapter in session.adapters.values():
+        if not isinstance(adapter, HTTPAdapter):
+            continue
+        for key in adapter.poolmanager.pools.keys():
+            pool = adapter.poolmanager.pools[key]
+            # Free slots of the pool are filled with None
+            idle = sum(1 for conn in list(pool.pool.queue) if conn is not None)
+            usage["idle"] += idle
+            usage["in_use"] += pool.pool.maxsize - pool.pool.qsize()
+            usage["limit"] += pool.pool.maxsize
+    return usage
+
+
+_pools: Optional[UpstreamPools] = None
+
+
+def get_upstream_pools() -> Optional[UpstreamPools]:
+    """
+    Get the pools of this worker.
+
+    Returns
+    -------
+    UpstreamPools, optional
+        The pools, or None if they have not been started.
+    """
+    return _pools
+
+
+async def start_upstream_pools() -> UpstreamPools:
+    """
+    Create and start the pools of this worker, configured from the
+    environment.
+
+    Returns
+    -------
+    UpstreamPools
+        The started pools.
+    """
+    global _pools
+    pools = UpstreamPools(
+        max_connections=int(os.environ.get("UPSTREAM_MAX_CONNECTIONS", "100")),
+        max_connections_per_host=int(
+            os.environ.get("UPSTREAM_MAX_CONNECTIONS_PER_HOST", "32")
+        ),
+        keepalive_timeout=float(
+            os.environ.get("UPSTREAM_KEEPALIVE_TIMEOUT", "30")
+        ),
+        connect_timeout=float(
+            os.environ.get("UPSTREAM_CONNECT_TIMEOUT", "10")
+        ),
+        read_timeout=float(os.environ.get("UPSTREAM_READ_TIMEOUT", "120")),
+    )
+    await pools.start()
+    _pools = pools
+    return pools
+
+
+async def close_upstream_pools() -> None:
+    """Close the pools of this worker, if they were started."""
+    global _pools
+    pools, _pools = _pools, None
+    if pools is not None:
+        await pools.close()
+
+
+class UpstreamPoolsMiddleware:
+    """
+    ASGI middleware which makes the asynchronous OpenAI calls of a request
+    use the shared `aiohttp` session, and records the usage of the pools
+    after the request.
+
+    `openai.aiosession` is a context variable, so it has to be set in the
+    context of each request rather than once at startup.
+    """
+
+    def __init__(self, app: Any):
+        self.app = app
+
+    async def __call__(self, scope: Any, receive: Any, send: Any) -> None:
+        pools = _pools
+        if (
+            scope["type"] != "http"
+            or pools is None
+            or pools.aiohttp_session is None
+        ):
+            await self.app(scope, receive, send)
+            return
+        token = openai.aiosession.set(pools.aiohttp_session)
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            openai.aiosession.reset(token)
+            pools.record_usage()
@@ -1,23 +1,211 @@
-from typing import Any, Dict
+import asyncio
+import threading
+from itertools import islice
+from typing import Any, Dict, List, Optional, Tuple
 
 import langchain.utilities.opaqueprompts as op
-from langchain.llms.base import LLM
+from langchain.llms.base import LLM, BaseLLM
 from langchain.memory import ConversationBufferWindowMemory
-from langchain.prompts import ChatPromptTemplate
-from langchain.schema import BasePromptTemplate
-from langchain.schema.output_parser import StrOutputParser
-from langchain.schema.runnable import RunnableMap, RunnableSequence
+from langchain.schema import BasePromptTemplate, SystemMessage
+from langchain.schema.runnable import Runnable, RunnableConfig
+from opchatserver.completion import LLMCompletion
+from opchatserver.executor import run_in_executor
+from opchatserver.metrics import track_stage
+from opchatserver.microbatch import get_batcher
 from opchatserver.models import ChatResponse
+from opchatserver.prescreen import CLEAN_SECURE_CONTEXT, get_prescreen
+from opchatserver.resilience import get_stage_policy
+from opchatserver.sanitization_cache import (
+    SecureContext,
+    desanitize,
+    get_sanitization_cache,
+)
+
+# Separates the texts desanitized in one call, see `_desanitize_batch`
+_BATCH_SEPARATOR = "\n\n<<opchatserver batch separator>>\n\n"
+
+
+class ChatContext:
+    """
+    The state of one chat, carried through the stages of the chain with
+    intermediate outputs. Each stage reads the results it needs from the
+    context and records its own on it, so that the sanitized input, the
+    secure context and the responses are passed by reference from the
+    sanitize call to the response, rather than copied into the dicts of
+    each stage.
+    """
+
+    __slots__ = (
+        "input",
+        "sanitized_input",
+        "secure_context",
+        "shares_secure_context",
+        "pre_screen",
+        "raw_response",
+        "desanitized_response",
+    )
+
+    def __init__(self, input: Dict[str, Any]):
+        """
+        Parameters
+        ----------
+        input : dict
+            the input of the chain, with the "prompt" and "history" keys,
+            or the output of `asanitize` as "inputs_after_sanitize"
+        """
+        self.input = input
+        self.sanitized_input: Optional[Dict[str, str]] = None
+        self.secure_context: Optional[SecureContext] = None
+        self.shares_secure_context = False
+        self.pre_screen: Optional[str] = None
+        self.raw_response: Optional[str] = None
+        self.desanitized_response: Optional[str] = None
+        sanitized = input.get("inputs_after_sanitize")
+        if sanitized is not None:
+            self.set_sanitized(sanitized)
+
+    def set_sanitized(self, sanitized_response: Dict[str, Any]) -> None:
+        """
+        Record the response of the sanitize stage, in the format returned by
+        `_sanitize`.
+        """
+        self.sanitized_input = sanitized_response["sanitized_input"]
+        self.secure_context = sanitized_response["secure_context"]
+        self.shares_secure_context = sanitized_response.get(
+            "shares_secure_context", False
+        )
+        self.pre_screen = sanitized_response.get("pre_screen")
+
+    def outputs(self) -> Dict[str, Any]:
+        """
+        Get the intermediate outputs of the chat, as returned by the chain.
+        """
+        assert self.sanitized_input is not None
+        return {
+            "sanitizedPrompt": self.sanitized_input["prompt"],
+            "rawResponse": self.raw_response,
+            "desanitizedResponse": self.desanitized_response,
+            "preScreen": self.pre_screen,
+        }
+
+    def response(self, with_intermediate_outputs: bool = True) -> ChatResponse:
+        """
+        Get the response to the chat, with or without its intermediate
+        outputs.
+        """
+        desanitized_response = self.desanitized_response
+        assert desanitized_response is not None
+        if not with_intermediate_outputs:
+            return ChatResponse(desanitizedResponse=desanitized_response)
+        assert self.sanitized_input is not None
+        return ChatResponse(
+            sanitizedPrompt=self.sanitized_input["prompt"],
+            rawResponse=self.raw_response,
+            desanitizedResponse=desanitized_response,
+            preScreen=self.pre_screen,
+        )
+
+
+class IntermediateOutputChain(Runnable[Dict[str, Any], Dict[str, Any]]):
+    """
+    The chat pipeline with intermediate outputs, as the graph of its stages:
+    sanitize, then llm, then desanitize. Each stage only waits for the
+    results it needs: the sanitized prompt, the secure context and the
+    decision of the pre-screen are read from the output of the sanitize
+    stage, rather than computed by branches running alongside the llm.
+
+    An input which already contains its sanitized form, as returned by
+    `asanitize`, in "inputs_after_sanitize" skips the sanitize stage.
+    """
+
+    def __init__(self, prompt: BasePromptTemplate, llm: BaseLLM):
+        """
+        Parameters
+        ----------
+        prompt : BasePromptTemplate
+            the prompt template used by the chain
+        llm : BaseLLM
+            the llm used by the chain
+        """
+        self.completion = LLMCompletion(prompt, llm)
+        # Completes the inputs which the pre-screen finds clean, which are
+        # not sanitized and so must not be cached
+        self.uncached_completion = LLMCompletion(prompt, llm, cacheable=False)
+
+    def invoke(
+        self, input: Dict[str, Any], config: Optional[RunnableConfig] = None
+    ) -> Dict[str, Any]:
+        return self.run(ChatContext(input), config).outputs()
+
+    async def ainvoke(
+        self,
+        input: Dict[str, Any],
+        config: Optional[RunnableConfig] = None,
+        **kwargs: Any,
+    ) -> Dict[str, Any]:
+        return (await self.arun(ChatContext(input), config)).outputs()
+
+    def run(
+        self, context: ChatContext, config: Optional[RunnableConfig] = None
+    ) -> ChatContext:
+        """
+        Run the stages of the chain on the context of a chat.
+
+        Parameters
+        ----------
+        context : ChatContext
+            the context of the chat, on which the results of the stages are
+            recorded
+        config : RunnableConfig, optional
+            the config of the llm call
+
+        Returns
+        -------
+        ChatContext
+            the context of the chat, with its desanitized response.
+        """
+        if context.sanitized_input is None:
+            context.set_sanitized(_screen_and_sanitize(context.input))
+        assert context.sanitized_input is not None
+        context.raw_response = self._completion(context).invoke(
+            context.sanitized_input, config
+        )
+        context.desanitized_response = _desanitize(context)
+        return context
+
+    async def arun(
+        self, context: ChatContext, config: Optional[RunnableConfig] = None
+    ) -> ChatContext:
+        """
+        Run the stages of the chain on the context of a chat, without
+        blocking the event loop. See `run`.
+        """
+        if context.sanitized_input is None:
+            context.set_sanitized(await _asanitize(context.input))
+        assert context.sanitized_input is not None
+        context.raw_response = await self._completion(context).ainvoke(
+            context.sanitized_input, config
+        )
+        context.desanitized_response = await _adesanitize(context)
+        return context
+
+    def _completion(self, context: ChatContext) -> LLMCompletion:
+        """
+        Helper function which gets the completion of the sanitized input of
+        a chat, which only uses the response cache if it was sanitized.
+        """
+        if context.secure_context is CLEAN_SECURE_CONTEXT:
+            return self.uncached_completion
+        return self.completion
 
 
 def get_intermediate_output_chain(
-    prompt: ChatPromptTemplate, llm: LLM
-) -> RunnableSequence:
+    prompt: BasePromptTemplate, llm: BaseLLM
+) -> IntermediateOutputChain:
     """
-    Build and return a chain that can give intermediate outputs, using
-    the LangChain expression language. It uses sanitize() and desanitize()
-    from the OpaquePrompts functions to avoid leaking senitive information
-    to the llm.
+    Build and return a chain that can give intermediate outputs. It uses
+    sanitize() and desanitize() from the OpaquePrompts functions to avoid
+    leaking senitive information to the llm.
 
     This is used by the chat server to get intermediate outputs, which is
     not a general use case of OpaquePrompts.
@@ -25,64 +213,26 @@ def get_intermediate_output_chain(
 
     Parameters
     ----------
-    prompt : ChatPromptTemplate
+    prompt : BasePromptTemplate
         the prompt template used by the chain
-    llm : LLM
+    llm : BaseLLM
         the llm used by the chain
 
     Returns
     -------
-    RunnableSequence
+    IntermediateOutputChain
         the chain that can give intermediate outputs including
-        `sanitizedPrompt`, `rawResponse`, and `desanitizedResponse`.
+        `sanitizedPrompt`, `rawResponse`, `desanitizedResponse` and
+        `preScreen`.
 
         `sanitizedPrompt` is the prompt after sanitization.
         `rawResponse` is the raw response from the llm.
         `desanitizedResponse` is the response after desanitization.
+        `preScreen` is the decision of the local pre-screen, "clean" if the
+        input was not sent to OpaquePrompts, "flagged" if it was, or None if
+        the pre-screen is disabled.
     """
-    pg_chain: RunnableSequence = (
-        RunnableMap(
-            {
-                # sanitize the input
-                "inputs_after_sanitize": (_sanitize),
-            }
-        )
-        | RunnableMap(
-            {
-                # get the sanitized prompt
-                "sanitized_prompt": (
-                    lambda x: x["inputs_after_sanitize"]["sanitized_input"][
-                        "prompt"
-                    ]
-                ),
-                # pass the sanitized input to the llm and get the raw response
-                "raw_response": (
-                    lambda x: x["inputs_after_sanitize"]["sanitized_input"]
-                )
-                | prompt
-                | llm
-                | StrOutputParser(),
-                # pass through the secure context from the sanitized input
-                "secure_context": (
-                    lambda x: x["inputs_after_sanitize"]["secure_context"]
-                ),
-            }
-        )
-        | RunnableMap(
-            {
-                "sanitizedPrompt": (lambda x: x["sanitized_prompt"]),
-                "rawResponse": (lambda x: x["raw_response"]),
-                # desanitize the response
-                "desanitizedResponse": (
-                    lambda x: op.desanitize(
-                        x["raw_response"],
-                        x["secure_context"],
-                    )
-                ),
-            }
-        )
-    )
-    return pg_chain
+    return IntermediateOutputChain(prompt, llm)
 
 
 def get_response(
@@ -92,7 +242,8 @@ def get_response(
     llm: LLM,
 ) -> ChatResponse:
     """
-    Get chat response with intermediate outputs
+    Get chat response with intermediate outputs. This runs `aget_response`
+    in a new event loop, so it must not be called from a running one.
 
     Parameters
     ----------
@@ -116,16 +267,301 @@ def get_response(
         `desanitizedResponse` is the response after desanitization.
     """
     pg_chain = get_intermediate_output_chain(prompt, llm=llm)
-    return ChatResponse(
-        **pg_chain.invoke(
-            {
-                "prompt": input,
-                "history": memory.buffer_as_messages,
-            }
+    return asyncio.run(aget_response(pg_chain, memory, input))
+
+
+async def aget_response(
+    pg_chain: IntermediateOutputChain,
+    memory: ConversationBufferWindowMemory,
+    input: str,
+    conversation_key: Optional[str] = None,
+    inputs_after_sanitize: Optional[Dict[str, Any]] = None,
+    subject: Optional[str] = None,
+) -> ChatResponse:
+    """
+    Get chat response with intermediate outputs without blocking the event
+    loop. The LLM is called natively asynchronously, while the calls to the
+    OpaquePrompts service run on the executor of the server.
+
+    Parameters
+    ----------
+    pg_chain : IntermediateOutputChain
+        the chain returned by `get_intermediate_output_chain`, which can be
+        reused across requests
+    memory : ConversationBufferWindowMemory
+        memory that stores the conversation history
+    input : str
+        the user input message
+    conversation_key : str, optional
+        identifies the conversation, so that its turns can be taken from the
+        sanitization cache when it is enabled
+    inputs_after_sanitize : dict, optional
+        the input already sanitized by `asanitize`, if any
+    subject : str, optional
+        the verified user of the chat, whose concurrent inputs can be
+        sanitized in one call when SANITIZE_BATCH_MAX_SIZE is set
+
+    Returns
+    -------
+    ChatResponse
+        the chat response with intermediate outputs, see `get_response`.
+    """
+    context = ChatContext(
+        {
+            "prompt": input,
+            "history": memory.buffer_as_messages,
+            "conversation_key": conversation_key,
+            "inputs_after_sanitize": inputs_after_sanitize,
+            "subject": subject,
+        }
+    )
+    return (await pg_chain.arun(context)).response()
+
+
+async def asanitize(
+    memory: ConversationBufferWindowMemory,
+    input: str,
+    conversation_key: Optional[str] = None,
+) -> Dict[str, Any]:
+    """
+    Sanitize the input of a chat ahead of `aget_response`, on the executor
+    of the server, e.g. while the access token of the user is verified.
+
+    Parameters
+    ----------
+    memory : ConversationBufferWindowMemory
+        memory that stores the conversation history
+    input : str
+        the user input message
+    conversation_key : str, optional
+        identifies the conversation in the sanitization cache
+
+    Returns
+    -------
+    dict
+        the sanitized input and its secure context, which can be passed to
+        `aget_response` as `inputs_after_sanitize`.
+    """
+    return await _asanitize(
+        {
+            "prompt": input,
+            "history": memory.buffer_as_messages,
+            "conversation_key": conversation_key,
+        }
+    )
+
+
+def _screen_and_sanitize(unsanitized_input: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Helper function which sanitizes an input with `_sanitize`, unless the
+    local pre-screen finds it clean.
+    """
+    decision = _prescreen(unsanitized_input)
+    if decision == "clean":
+        return _skip_sanitize(unsanitized_input)
+    return _with_decision(_sanitize(unsanitized_input), decision)
+
+
+async def _asanitize(unsanitized_input: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Run `_sanitize` on the executor of the server, unless the local
+    pre-screen finds the input clean.
+    """
+    decision = _prescreen(unsanitized_input)
+    if decision == "clean":
+        return _skip_sanitize(unsanitized_input)
+    subject = unsanitized_input.get("subject")
+    batcher = get_batcher("sanitize", _asanitize_inputs)
+    with track_stage("sanitize"):
+        if (
+            batcher is None
+            or subject is None
+            # The turns seen before are taken from the cache instead
+            or _uses_sanitization_cache(unsanitized_input)
+        ):
+            sanitized_response = await get_stage_policy("sanitize").call(
+                lambda: run_in_executor(_sanitize, unsanitized_input)
+            )
+        else:
+            # Only the inputs of the same user share a secure context
+            sanitized_response = await batcher.submit(
+                subject, unsanitized_input
+            )
+    return _with_decision(sanitized_response, decision)
+
+
+def _uses_sanitization_cache(unsanitized_input: Dict[str, Any]) -> bool:
+    """
+    Helper function which checks whether `_sanitize` takes the turns of an
+    input from the sanitization cache.
+    """
+    return (
+        unsanitized_input.get("conversation_key") is not None
+        and unsanitized_input.get("history") is not None
+        and get_sanitization_cache() is not None
+    )
+
+
+async def _asanitize_inputs(
+    unsanitized_inputs: List[Dict[str, Any]]
+) -> List[Dict[str, Any]]:
+    """
+    Helper function which sanitizes the inputs batched by the sanitize
+    batcher in one call, on the executor of the server.
+    """
+    if len(unsanitized_inputs) == 1:
+        return [
+            await get_stage_policy("sanitize").call(
+                lambda: run_in_executor(_sanitize, unsanitized_inputs[0])
+            )
+        ]
+    return await get_stage_policy("sanitize").call(
+        lambda: run_in_executor(_sanitize_batch, unsanitized_inputs)
+    )
+
+
+def _prescreen(unsanitized_input: Dict[str, Any]) -> Optional[str]:
+    """
+    Helper function which screens the texts of an input locally, if the
+    pre-screen is enabled.
+
+    Returns
+    -------
+    str, optional
+        "clean" if the input does not need to be sanitized, "flagged" if it
+        does, or None if the pre-screen is disabled.
+    """
+    prescreen = get_prescreen()
+    if prescreen is None:
+        return None
+    texts = [
+        value
+        for key, value in unsanitized_input.items()
+        if key not in _NOT_SANITIZED and isinstance(value, str)
+    ]
+    texts += [
+        message.content for message in unsanitized_input.get("history", [])
+    ]
+    return "clean" if prescreen.is_clean(texts) else "flagged"
+
+
+def _skip_sanitize(unsanitized_input: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Helper function which returns a clean input as its own sanitized form,
+    in the format returned by `_sanitize`, without calling op.sanitize(). Its
+    secure context has no placeholders, so it is not desanitized either.
+    """
+    sanitized_input, turns = _flatten_history(unsanitized_input)
+    if turns is not None:
+        _join_history(sanitized_input, turns)
+    return {
+        "sanitized_input": sanitized_input,
+        "secure_context": CLEAN_SECURE_CONTEXT,
+        "pre_screen": "clean",
+    }
+
+
+def _with_decision(
+    sanitized_response: Dict[str, Any], decision: Optional[str]
+) -> Dict[str, Any]:
+    """
+    Helper function which records the decision of the pre-screen, if it is
+    enabled, in the response of a sanitize call.
+    """
+    if decision is not None:
+        sanitized_response["pre_screen"] = decision
+    return sanitized_response
+
+
+def _desanitize(context: ChatContext) -> str:
+    """
+    Helper function which desanitizes the raw response of the llm with the
+    secure context returned by the sanitization.
+
+    Parameters
+    ----------
+    context : ChatContext
+        The context of the chat, after the llm stage.
+
+    Returns
+    -------
+    str
+        The desanitized response.
+    """
+    assert context.raw_response is not None
+    assert context.secure_context is not None
+    if context.secure_context is CLEAN_SECURE_CONTEXT:
+        # The input was not sanitized, so there is nothing to desanitize
+        return context.raw_response
+    return desanitize(context.raw_response, context.secure_context)
+
+
+async def _adesanitize(context: ChatContext) -> str:
+    """
+    Run `_desanitize` on the executor of the server.
+    """
+    raw_response = context.raw_response
+    secure_context = context.secure_context
+    assert raw_response is not None and secure_context is not None
+    if secure_context is CLEAN_SECURE_CONTEXT:
+        # The input was not sanitized, so there is nothing to desanitize
+        return raw_response
+    batcher = get_batcher("desanitize", _adesanitize_texts)
+    with track_stage("desanitize"):
+        if (
+            batcher is None
+            # Only the responses to the inputs of a batched sanitize call
+            # share their secure context, so the others are not kept
+            # waiting for partners
+            or not context.shares_secure_context
+            or not isinstance(secure_context, str)
+        ):
+            return await get_stage_policy("desanitize").call(
+                lambda: run_in_executor(_desanitize, context)
+            )
+        return await batcher.submit(
+            secure_context, (raw_response, secure_context)
         )
+
+
+async def _adesanitize_texts(texts: List[Tuple[str, str]]) -> List[str]:
+    """
+    Helper function which desanitizes the texts batched by the desanitize
+    batcher, which share their secure context, on the executor of the
+    server.
+    """
+    return await get_stage_policy("desanitize").call(
+        lambda: run_in_executor(_desanitize_batch, texts)
     )
 
 
+def _desanitize_batch(texts: List[Tuple[str, str]]) -> List[str]:
+    """
+    Helper function which desanitizes texts with the same secure context in
+    a single call to op.desanitize(), by joining them with a separator. If
+    the separator does not split the result back into as many texts, e.g.
+    because a text contains it, the texts are desanitized one by one.
+
+    Parameters
+    ----------
+    texts : list
+        The sanitized texts, each with their secure context.
+
+    Returns
+    -------
+    list
+        The desanitized texts, in order.
+    """
+    secure_context = texts[0][1]
+    if len(texts) > 1:
+        desanitized = desanitize(
+            _BATCH_SEPARATOR.join(text for text, _ in texts), secure_context
+        ).split(_BATCH_SEPARATOR)
+        if len(desanitized) == len(texts):
+            return desanitized
+    return [desanitize(text, secure_context) for text, _ in texts]
+
+
 def _sanitize(unsanitized_input: Dict[str, Any]) -> Dict[str, Any]:
     """
     Helper function which splits up the history part of the prompt prior to
@@ -141,7 +577,9 @@ def _sanitize(unsanitized_input: Dict[str, Any]) -> Dict[str, Any]:
         contain the "history" key, it will just be passed directly to
         op.sanitize. If the history key is contained in the dictionary then
         it should contain a list of alternating HumanMessage and AIMessage
-        objects and even length.
+        objects and even length. An optional "conversation_key" identifies
+        the conversation in the sanitization cache. The input is not
+        modified.
 
     Returns
     -------
@@ -155,26 +593,192 @@ def _sanitize(unsanitized_input: Dict[str, Any]) -> Dict[str, Any]:
 
         The `secure_context` needs to be passed to the `desanitize` function.
     """
-    if "history" not in unsanitized_input:
-        return op.sanitize(unsanitized_input)
-    # Convert history from an array of chat messages to a dictionary
-    history = unsanitized_input.pop("history")
-    split_history = [message.content for message in history]
-    if len(split_history) % 2 != 0:
-        raise Exception("History must be an even length string")
-    for i, chat_message in enumerate(split_history):
-        prefix = "Human"
-        if i % 2 == 1:
-            prefix = "Ai"
-        unsanitized_input[f"{prefix} {i//2 + 1}"] = chat_message
-    sanitized_response = op.sanitize(unsanitized_input)
-    # Reconstruct original history str with the sanitized messages
+    conversation_key = unsanitized_input.get("conversation_key")
+    texts, turns = _flatten_history(unsanitized_input)
+    if turns is None:
+        return op.sanitize(texts)
+    sanitized_response: Dict[str, Any]
+    cache = get_sanitization_cache()
+    if cache is not None and conversation_key is not None:
+        # Only the turns that were not seen before are sent to the sanitizer
+        sanitized, secure_context = cache.sanitize(conversation_key, texts)
+        sanitized_response = {
+            "sanitized_input": sanitized,
+            "secure_context": secure_context,
+        }
+    else:
+        sanitized_response = op.sanitize(texts)
     sanitized_input = sanitized_response["sanitized_input"]
-
-    history_str = ""
-    for i in range(1, len(split_history) // 2 + 1):
-        human_message = sanitized_input.pop(f"Human {i}")
-        ai_message = sanitized_input.pop(f"Ai {i}")
-        history_str += f"Human: {human_message}AI: {ai_message}"
-    sanitized_input["history"] = history_str
+    # A dict of texts is sanitized into a dict of texts
+    assert isinstance(sanitized_input, dict)
+    _join_history(sanitized_input, turns)
     return sanitized_response
+
+
+def _sanitize_batch(
+    unsanitized_inputs: List[Dict[str, Any]]
+) -> List[Dict[str, Any]]:
+    """
+    Helper function which sanitizes several inputs, each containing the
+    "history" key, in a single call to op.sanitize(). The inputs share the
+    secure context of the call, so they must belong to the same user.
+
+    Parameters
+    ----------
+    unsanitized_inputs : list
+        The unsanitized inputs, as passed to `_sanitize`.
+
+    Returns
+    -------
+    list
+        The sanitized inputs and their secure context, in the format
+        returned by `_sanitize`, with "shares_secure_context" set to True
+        if there are several inputs.
+    """
+    combined: Dict[str, str] = {}
+    turns: List[Optional[int]] = []
+    for i, unsanitized_input in enumerate(unsanitized_inputs):
+        texts, input_turns = _flatten_history(unsanitized_input)
+        turns.append(input_turns)
+        for key, value in texts.items():
+            combined[f"{i} {key}"] = value
+    sanitized_response = op.sanitize(combined)
+    sanitized_combined = sanitized_response["sanitized_input"]
+    # A dict of texts is sanitized into a dict of texts
+    assert isinstance(sanitized_combined, dict)
+
+    sanitized_inputs: List[Dict[str, str]] = [{} for _ in unsanitized_inputs]
+    for key, value in sanitized_combined.items():
+        index, input_key = key.split(" ", 1)
+        sanitized_inputs[int(index)][input_key] = value
+    for sanitized_input, input_turns in zip(sanitized_inputs, turns):
+        # Like `_sanitize`, the inputs without a history do not get one
+        if input_turns is not None:
+            _join_history(sanitized_input, input_turns)
+    return [
+        {
+            "sanitized_input": sanitized_input,
+            "secure_context": sanitized_response["secure_context"],
+            "shares_secure_context": len(sanitized_inputs) > 1,
+        }
+        for sanitized_input in sanitized_inputs
+    ]
+
+
+async def asanitize_batch(
+    unsanitized_inputs: List[Dict[str, Any]]
+) -> List[Dict[str, Any]]:
+    """
+    Sanitize several inputs of the same user in a single call to the
+    OpaquePrompts service, on the executor of the server.
+
+    Parameters
+    ----------
+    unsanitized_inputs : list
+        The unsanitized inputs, each containing the "prompt" and "history"
+        keys like the inputs of `get_intermediate_output_chain`.
+
+    Returns
+    -------
+    list
+        For each input, its sanitized form and the secure context needed to
+        desanitize it, which can be passed to the chain returned by
+        `get_intermediate_output_chain` as "inputs_after_sanitize". The inputs
+        that the local pre-screen finds clean are not sent to the service.
+    """
+    decisions = [_prescreen(input) for input in unsanitized_inputs]
+    sanitized_responses = [
+        _skip_sanitize(input) if decision == "clean" else {}
+        for input, decision in zip(unsanitized_inputs, decisions)
+    ]
+    flagged = [
+        i for i, decision in enumerate(decisions) if decision != "clean"
+    ]
+    if flagged:
+        with track_stage("sanitize"):
+            sanitized = await get_stage_policy("sanitize").call(
+                lambda: run_in_executor(
+                    _sanitize_batch, [unsanitized_inputs[i] for i in flagged]
+                )
+            )
+        for i, sanitized_response in zip(flagged, sanitized):
+            sanitized_responses[i] = _with_decision(
+                sanitized_response, decisions[i]
+            )
+    return sanitized_responses
+
+
+# The keys of the messages of each turn of a flattened history, e.g.
+# ("Human 1", "Ai 1"), built once and shared by all the inputs. The list
+# only grows, under the lock.
+_turn_keys: List[Tuple[str, str]] = []
+_turn_keys_lock = threading.Lock()
+
+# The keys of an input which are not sent to the sanitizer as they are
+_NOT_SANITIZED = frozenset(
+    ["history", "conversation_key", "inputs_after_sanitize", "subject"]
+)
+
+
+def _flatten_history(
+    unsanitized_input: Dict[str, Any]
+) -> Tuple[Dict[str, str], Optional[int]]:
+    """
+    Helper function which gets the texts of an input to sanitize, in which
+    its history is replaced by one key per message, so that the messages
+    are sanitized individually. A summary of truncated turns at the start
+    of the history gets its own key. The input is not modified.
+
+    Returns
+    -------
+    (dict, int or None)
+        The texts to sanitize, and the number of turns of the history, or
+        None if the input has no history.
+    """
+    texts = {
+        key: value
+        for key, value in unsanitized_input.items()
+        if key not in _NOT_SANITIZED
+    }
+    history = unsanitized_input.get("history")
+    if history is None:
+        return texts, None
+    messages = iter(history)
+    length = len(history)
+    # The summary of the truncated turns, if any, comes first
+    if history and isinstance(history[0], SystemMessage):
+        texts["Summary"] = next(messages).content
+        length -= 1
+    if length % 2 != 0:
+        raise Exception("History must be an even length string")
+    turns = length // 2
+    if len(_turn_keys) < turns:
+        with _turn_keys_lock:
+            _turn_keys.extend(
+                (f"Human {i}", f"Ai {i}")
+                for i in range(len(_turn_keys) + 1, turns + 1)
+            )
+    for human_key, ai_key in islice(_turn_keys, turns):
+        texts[human_key] = next(messages).content
+        texts[ai_key] = next(messages).content
+    return texts, turns
+
+
+def _join_history(sanitized_input: Dict[str, str], turns: int) -> None:
+    """
+    Helper function which reverses `_flatten_history` on the sanitized
+    input, combining the sanitized messages into the history string.
+    """
+    # The history string is joined once, in linear time
+    parts: List[str] = []
+    summary = sanitized_input.pop("Summary", None)
+    if summary is not None:
+        parts += ("System: ", summary, "\n")
+    for human_key, ai_key in islice(_turn_keys, turns):
+        parts += (
+            "Human: ",
+            sanitized_input.pop(human_key),
+            "AI: ",
+            sanitized_input.pop(ai_key),
+        )
+    sanitized_input["history"] = "".join(parts)
@@ -0,0 +1,136 @@
+"""
+This module contains the LangChain parts of the LLM backends of the chat
+server, see `backends.py`: the local fake LLM of the "fake" backend type,
+and the callback handler which records the latency of the calls to a
+backend.
+"""
+import asyncio
+import time
+from typing import Any, AsyncIterator, Callable, Dict, List, Optional
+from uuid import UUID
+
+from langchain.callbacks.base import BaseCallbackHandler
+from langchain.callbacks.manager import (
+    AsyncCallbackManagerForLLMRun,
+    CallbackManagerForLLMRun,
+)
+from langchain.llms.base import LLM
+from langchain.schema.output import GenerationChunk
+
+
+class FakeLLM(LLM):
+    """
+    A local LLM for tests and benchmarks, which answers after a simulated
+    latency of `latency` seconds plus `latency_per_char` seconds per
+    character of the prompt, without blocking the event loop on the
+    asynchronous path. It answers with `response`, or echoes the last line
+    of the prompt if `response` is not set, and streams its answer in chunks
+    of `chunk_size` characters, or as a whole if it is not set. `calls`
+    counts its answers.
+    """
+
+    response: Optional[str] = None
+    latency: float = 0.0
+    latency_per_char: float = 0.0
+    chunk_size: Optional[int] = None
+    calls: int = 0
+
+    @property
+    def _llm_type(self) -> str:
+        return "fake"
+
+    def _call(
+        self,
+        prompt: str,
+        stop: Optional[List[str]] = None,
+        run_manager: Optional[CallbackManagerForLLMRun] = None,
+        **kwargs: Any,
+    ) -> str:
+        time.sleep(self._latency(prompt))
+        return self._respond(prompt)
+
+    async def _acall(
+        self,
+        prompt: str,
+        stop: Optional[List[str]] = None,
+        run_manager: Optional[AsyncCallbackManagerForLLMRun] = None,
+        **kwargs: Any,
+    ) -> str:
+        await asyncio.sleep(self._latency(prompt))
+        return self._respond(prompt)
+
+    async def _astream(
+        self,
+        prompt: str,
+        stop: Optional[List[str]] = None,
+        run_manager: Optional[AsyncCallbackManagerForLLMRun] = None,
+        **kwargs: Any,
+    ) -> AsyncIterator[GenerationChunk]:
+        await asyncio.sleep(self._latency(prompt))
+        response = self._respond(prompt)
+        if self.chunk_size is None:
+            yield GenerationChunk(text=response)
+            return
+        for i in range(0, len(response), self.chunk_size):
+            await asyncio.sleep(0)
+            yield GenerationChunk(text=response[i : i + self.chunk_size])
+
+    def _latency(self, prompt: str) -> float:
+        return self.latency + self.latency_per_char * len(prompt)
+
+    def _respond(self, prompt: str) -> str:
+        self.calls += 1
+        if self.response is not None:
+            return self.response
+        return prompt.strip().rsplit("\n", 1)[-1]
+
+
+class LatencyCallback(BaseCallbackHandler):
+    """
+    Reports the start of each call to an LLM to `start`, and its duration,
+    including failed calls and whole streams, to `record`.
+    """
+
+    # Called in the thread of the llm call rather than on the executor
+    run_inline = True
+
+    def __init__(
+        self, start: Callable[[], None], record: Callable[[float], None]
+    ):
+        """
+        Parameters
+        ----------
+        start : callable
+            Called when a call starts.
+        record : callable
+            Called with the duration of each call, in seconds, when it ends.
+        """
+        self.start = start
+        self.record = record
+        self._starts: Dict[UUID, float] = {}
+
+    def on_llm_start(
+        self,
+        serialized: Dict[str, Any],
+        prompts: List[str],
+        *,
+        run_id: UUID,
+        **kwargs: Any,
+    ) -> None:
+        self._starts[run_id] = time.perf_counter()
+        self.start()
+
+    def on_llm_end(
+        self, response: Any, *, run_id: UUID, **kwargs: Any
+    ) -> None:
+        self._finish(run_id)
+
+    def on_llm_error(
+        self, error: BaseException, *, run_id: UUID, **kwargs: Any
+    ) -> None:
+        self._finish(run_id)
+
+    def _finish(self, run_id: UUID) -> None:
+        start = self._starts.pop(run_id, None)
+        if start is not None:
+            self.record(time.perf_counter() - start)
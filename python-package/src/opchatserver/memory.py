@@ -1,25 +1,324 @@
-from typing import List
+"""
+This module builds the memory of a conversation from its history. The most
+recent turns are kept within a budget of tokens, so that long messages do
+not inflate the sanitized prompt and the llm call, while short
+conversations keep more of their context.
 
-from langchain.memory import ConversationBufferWindowMemory
+Tokens are counted with tiktoken when it is installed, and estimated from
+the length of the messages otherwise.
+"""
+import hashlib
+import math
+import os
+import re
+from dataclasses import dataclass
+from functools import lru_cache
+from typing import TYPE_CHECKING, Any, Callable, List, Optional, Tuple
+
+from opchatserver.cache import TTLCache
+
+if TYPE_CHECKING:
+    from langchain.memory import ConversationBufferWindowMemory
+
+try:
+    import tiktoken
+except ImportError:  # pragma: no cover
+    tiktoken = None
+
+# The context window of the supported models, matched by prefix
+MODEL_CONTEXT_WINDOWS = {
+    "gpt-3.5-turbo-16k": 16385,
+    "gpt-3.5-turbo-1106": 16385,
+    "gpt-3.5-turbo": 4096,
+    "gpt-4-32k": 32768,
+    "gpt-4-1106": 128000,
+    "gpt-4": 8192,
+    "text-davinci": 4097,
+}
+DEFAULT_CONTEXT_WINDOW = 4096
+
+# The tokens added to each message by its role, e.g. "Human: "
+MESSAGE_OVERHEAD = 4
+
+# The average number of characters of a token, when tiktoken is missing
+CHARS_PER_TOKEN = 4
+
+_token_counts: TTLCache[int] = TTLCache(maxsize=16384, ttl=3600)
+
+
+def get_context_window(model: str) -> int:
+    """
+    Get the number of tokens of the context window of a model.
+
+    Parameters
+    ----------
+    model : str
+        The name of the OpenAI model.
+
+    Returns
+    -------
+    int
+        The size of the context window, or DEFAULT_CONTEXT_WINDOW if the
+        model is unknown.
+    """
+    for prefix in sorted(MODEL_CONTEXT_WINDOWS, key=len, reverse=True):
+        if model.startswith(prefix):
+            return MODEL_CONTEXT_WINDOWS[prefix]
+    return DEFAULT_CONTEXT_WINDOW
+
+
+@lru_cache(maxsize=None)
+def _get_encoding(model: str) -> Any:
+    """
+    Helper function which gets the tiktoken encoding of a model, or None if
+    tiktoken is not installed.
+    """
+    if tiktoken is None:
+        return None
+    try:
+        return tiktoken.encoding_for_model(model)
+    except KeyError:
+        return tiktoken.get_encoding("cl100k_base")
+
+
+def count_tokens(text: str, model: str) -> int:
+    """
+    Count the tokens of a message. The counts are cached, keyed by a hash of
+    the message so that the cache does not hold the messages themselves.
+
+    Parameters
+    ----------
+    text : str
+        The message.
+    model : str
+        The name of the OpenAI model whose tokenizer is used.
+
+    Returns
+    -------
+    int
+        The number of tokens of the message, including its role.
+    """
+    key = hashlib.blake2b(f"{model}\0{text}".encode(), digest_size=16).digest()
+    count = _token_counts.get(key)
+    if count is None:
+        count = _count_tokens(text, model) + MESSAGE_OVERHEAD
+        _token_counts.set(key, count)
+    return count
+
+
+def _count_tokens(text: str, model: str) -> int:
+    encoding = _get_encoding(model)
+    if encoding is None:
+        return math.ceil(len(text) / CHARS_PER_TOKEN)
+    return len(encoding.encode(text, disallowed_special=()))
+
+
+def _keep_last_tokens(text: str, max_tokens: int, model: str) -> str:
+    """
+    Helper function which truncates the start of a text to its last
+    `max_tokens` tokens.
+    """
+    if max_tokens <= 0:
+        return ""
+    encoding = _get_encoding(model)
+    if encoding is None:
+        return text[-max_tokens * CHARS_PER_TOKEN :]
+    tokens = encoding.encode(text, disallowed_special=())
+    return encoding.decode(tokens[-max_tokens:])
+
+
+def summarize_turns(messages: List[str]) -> str:
+    """
+    Summarize the truncated turns of a conversation, from the first sentence
+    of each message of the user. It runs locally, so that unsanitized
+    messages are not sent to the llm, and the summary is sanitized with the
+    rest of the history.
+
+    Parameters
+    ----------
+    messages : List[str]
+        The truncated messages, alternating between the user and the llm.
+
+    Returns
+    -------
+    str
+        The summary.
+    """
+    sentences = [
+        re.split(r"(?<=[.!?])\s", message.strip(), maxsplit=1)[0]
+        for message in messages[0::2]
+    ]
+    return "Earlier, the user said: " + " / ".join(sentences)
 
 
 def build_memory(
-    history: List[str], k: int = 5
-) -> ConversationBufferWindowMemory:
+    history: List[str],
+    k: int = 5,
+    max_tokens: Optional[int] = None,
+    model: str = "gpt-3.5-turbo",
+    summarize: Optional[Callable[[List[str]], str]] = None,
+) -> "ConversationBufferWindowMemory":
     """Build memory from history.
 
+    The most recent turns are kept, up to `k` turns and `max_tokens` tokens.
+    Older turns are dropped, or summarized by `summarize` into a system
+    message at the start of the memory.
+
     Parameters
     ----------
     history : List[str]
         List of strings representing the conversation history.
     k : int, optional
-        Number of turns of history to use, by default 5
+        Maximum number of turns of history to use, by default 5
+    max_tokens : int, optional
+        Maximum number of tokens of the history, by default None for no
+        limit. When `summarize` is set, a quarter of it is used by the
+        summary.
+    model : str, optional
+        The OpenAI model whose tokenizer counts the tokens, by default
+        "gpt-3.5-turbo"
+    summarize : callable, optional
+        Summarizes the messages of the dropped turns, by default None to
+        drop them without a summary
     """
-    memory = ConversationBufferWindowMemory(k=k)
-    start_index = max(0, len(history) - 2 * k)
-    for i in range(start_index, len(history) - 1, 2):
+    # Imported here, so that importing the server does not load LangChain
+    from langchain.memory import ConversationBufferWindowMemory
+    from langchain.schema import SystemMessage
+
+    turns = [
+        (history[i], history[i + 1]) for i in range(0, len(history) - 1, 2)
+    ]
+    summary_tokens = 0
+    if summarize is not None and max_tokens is not None:
+        summary_tokens = max_tokens // 4
+    kept = _count_kept_turns(
+        turns,
+        k,
+        max_tokens - summary_tokens if max_tokens is not None else None,
+        model,
+    )
+    dropped = turns[: len(turns) - kept]
+
+    summary = None
+    if summarize is not None and dropped:
+        summary = summarize([message for turn in dropped for message in turn])
+        if max_tokens is not None:
+            summary = _keep_last_tokens(
+                summary, summary_tokens - MESSAGE_OVERHEAD, model
+            )
+
+    # The window covers the summary, which counts as a message
+    memory = ConversationBufferWindowMemory(k=kept + (1 if summary else 0))
+    if summary:
+        memory.chat_memory.add_message(SystemMessage(content=summary))
+    for human_message, ai_message in turns[len(turns) - kept :]:
         memory.save_context(
-            {"input": history[i]},
-            {"output": history[i + 1]},
+            {"input": human_message},
+            {"output": ai_message},
         )
     return memory
+
+
+def _count_kept_turns(
+    turns: List[Tuple[str, str]],
+    k: int,
+    max_tokens: Optional[int],
+    model: str,
+) -> int:
+    """
+    Helper function which counts the most recent turns that fit in `k`
+    turns and `max_tokens` tokens.
+    """
+    kept = 0
+    used = 0
+    for human_message, ai_message in reversed(turns):
+        if kept == k:
+            break
+        if max_tokens is not None:
+            used += count_tokens(human_message, model)
+            used += count_tokens(ai_message, model)
+            if used > max_tokens:
+                break
+        kept += 1
+    return kept
+
+
+@dataclass(frozen=True)
+class HistoryWindow:
+    """
+    The limits of the history used to complete a prompt, see `build_memory`.
+    """
+
+    max_turns: int
+    max_tokens: Optional[int]
+    model: str
+    summarize: Optional[Callable[[List[str]], str]] = None
+
+    def build_memory(
+        self, history: List[str]
+    ) -> "ConversationBufferWindowMemory":
+        """
+        Build the memory of a conversation within the limits of the window.
+
+        Parameters
+        ----------
+        history : List[str]
+            List of strings representing the conversation history.
+
+        Returns
+        -------
+        ConversationBufferWindowMemory
+            The memory of the conversation.
+        """
+        return build_memory(
+            history,
+            k=self.max_turns,
+            max_tokens=self.max_tokens,
+            model=self.model,
+            summarize=self.summarize,
+        )
+
+
+def get_history_max_turns() -> int:
+    """
+    Get the maximum number of turns of the history sent with a prompt, from
+    the HISTORY_MAX_TURNS environment variable.
+
+    Returns
+    -------
+    int
+        The number of turns, 20 by default.
+    """
+    return int(os.environ.get("HISTORY_MAX_TURNS", "20"))
+
+
+def create_history_window(model: str) -> HistoryWindow:
+    """
+    Create the history window of a model, configured from the environment.
+    By default, the history may use a quarter of the context window of the
+    model.
+
+    Parameters
+    ----------
+    model : str
+        The name of the OpenAI model.
+
+    Returns
+    -------
+    HistoryWindow
+        The history window.
+    """
+    max_tokens = int(
+        os.environ.get(
+            "HISTORY_MAX_TOKENS", str(get_context_window(model) // 4)
+        )
+    )
+    summary = os.environ.get("HISTORY_SUMMARY", "none").lower()
+    if summary not in ("none", "extractive"):
+        raise ValueError(f"unknown HISTORY_SUMMARY: {summary}")
+    return HistoryWindow(
+        max_turns=get_history_max_turns(),
+        max_tokens=max_tokens if max_tokens > 0 else None,
+        model=model,
+        summarize=summarize_turns if summary == "extractive" else None,
+    )
@@ -0,0 +1,184 @@
+"""
+This module contains the Prometheus metrics of the chat server: the latency
+of the chat requests, and the latency, concurrency and errors of each stage
+of the chat pipeline. Each stage is also a span of the trace of its request,
+see `tracing.py`.
+
+When the server runs with several worker processes, set the
+PROMETHEUS_MULTIPROC_DIR environment variable to an empty directory shared
+by the workers, so that /metrics aggregates the metrics of all of them
+rather than reporting those of the worker that happens to answer.
+"""
+import os
+import time
+from contextlib import contextmanager
+from typing import Any, AsyncIterator, Iterator, Optional, TypeVar
+
+from opchatserver.tracing import end_span, start_span
+from prometheus_client import (
+    CollectorRegistry,
+    Counter,
+    Gauge,
+    Histogram,
+    make_asgi_app,
+    multiprocess,
+)
+
+T = TypeVar("T")
+
+# The endpoints whose requests are measured, so that the label of the
+# request metrics cannot grow without bound
+CHAT_ENDPOINTS = frozenset(["/chat", "/chat/stream", "/chat/batch"])
+
+request_duration = Histogram(
+    "http_request_duration_seconds",
+    "Total latency of a chat HTTP request, including a streamed body",
+    ["endpoint"],
+)
+requests_in_flight = Gauge(
+    "http_requests_in_flight",
+    "Chat HTTP requests being handled",
+    ["endpoint"],
+    multiprocess_mode="livesum",
+)
+responses = Counter(
+    "http_responses_total",
+    "Chat HTTP responses, by status code",
+    ["endpoint", "status"],
+)
+
+stage_duration = Histogram(
+    "chat_stage_duration_seconds",
+    "Latency of a stage of the chat pipeline",
+    ["stage"],
+)
+stage_in_flight = Gauge(
+    "chat_stage_in_flight",
+    "Calls to a stage of the chat pipeline in progress",
+    ["stage"],
+    multiprocess_mode="livesum",
+)
+stage_errors = Counter(
+    "chat_stage_errors_total",
+    "Errors raised by a stage of the chat pipeline, by exception type",
+    ["stage", "error"],
+)
+
+
+@contextmanager
+def track_stage(stage: str) -> Iterator[None]:
+    """
+    Measure the latency, concurrency and errors of a stage of the chat
+    pipeline, and record it as a span of the request if it is traced. It
+    can be used in both synchronous and asynchronous code.
+
+    Parameters
+    ----------
+    stage : str
+        The name of the stage, e.g. "sanitize".
+    """
+    in_flight = stage_in_flight.labels(stage=stage)
+    in_flight.inc()
+    span = start_span(stage)
+    error: Optional[BaseException] = None
+    start = time.perf_counter()
+    try:
+        yield
+    except Exception as e:
+        error = e
+        stage_errors.labels(stage=stage, error=type(e).__name__).inc()
+        raise
+    finally:
+        stage_duration.labels(stage=stage).observe(time.perf_counter() - start)
+        in_flight.dec()
+        if span is not None:
+            end_span(span, error)
+
+
+async def track_stream(
+    stage: str, stream: AsyncIterator[T]
+) -> AsyncIterator[T]:
+    """
+    Measure a stage of the chat pipeline which produces a stream, from its
+    start until its last item.
+
+    Parameters
+    ----------
+    stage : str
+        The name of the stage, e.g. "llm".
+    stream : AsyncIterator
+        The stream produced by the stage.
+
+    Returns
+    -------
+    AsyncIterator
+        The items of `stream`.
+    """
+    with track_stage(stage):
+        async for item in stream:
+            yield item
+
+
+def make_metrics_app() -> Any:
+    """
+    Create the ASGI application serving the metrics, which aggregates the
+    metrics of all the workers if PROMETHEUS_MULTIPROC_DIR is set.
+
+    Returns
+    -------
+    ASGI application
+        The application to mount on /metrics.
+    """
+    if os.environ.get("PROMETHEUS_MULTIPROC_DIR"):
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        return make_asgi_app(registry=registry)
+    return make_asgi_app()
+
+
+def mark_worker_stopped() -> None:
+    """
+    Remove the live gauges of this worker from the aggregated metrics, when
+    it stops. Does nothing unless PROMETHEUS_MULTIPROC_DIR is set.
+    """
+    if os.environ.get("PROMETHEUS_MULTIPROC_DIR"):
+        multiprocess.mark_process_dead(os.getpid())
+
+
+class RequestMetricsMiddleware:
+    """
+    ASGI middleware which measures the chat requests until their response
+    has been sent, including the body of streaming responses.
+    """
+
+    def __init__(self, app: Any):
+        self.app = app
+
+    async def __call__(self, scope: Any, receive: Any, send: Any) -> None:
+        endpoint = scope.get("path")
+        if scope["type"] != "http" or endpoint not in CHAT_ENDPOINTS:
+            await self.app(scope, receive, send)
+            return
+
+        status: Optional[int] = None
+
+        async def send_and_record_status(message: Any) -> None:
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        in_flight = requests_in_flight.labels(endpoint=endpoint)
+        in_flight.inc()
+        start = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_and_record_status)
+        finally:
+            request_duration.labels(endpoint=endpoint).observe(
+                time.perf_counter() - start
+            )
+            in_flight.dec()
+            responses.labels(
+                endpoint=endpoint,
+                status=str(status) if status is not None else "none",
+            ).inc()
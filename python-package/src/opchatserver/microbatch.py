@@ -0,0 +1,197 @@
+"""
+This module contains the micro-batching of the calls to the OpaquePrompts
+service: the sanitize (and separately desanitize) calls of a user which
+arrive within a few milliseconds of each other are sent as one call, whose
+results are routed back to each caller.
+
+The inputs of a sanitize call share its secure context, which maps every
+placeholder of the call to its original value. The calls of different
+users are never batched together, so that the response to a user can only
+be desanitized with the values of their own inputs.
+"""
+import asyncio
+import os
+import threading
+from typing import (
+    Awaitable,
+    Callable,
+    Dict,
+    Generic,
+    Hashable,
+    List,
+    Optional,
+    Set,
+    Tuple,
+    TypeVar,
+)
+
+from prometheus_client import Histogram
+
+In = TypeVar("In")
+Out = TypeVar("Out")
+
+batch_sizes = Histogram(
+    "opaqueprompts_batch_size",
+    "Number of inputs of the batched calls to the OpaquePrompts service",
+    ["stage"],
+    buckets=(1, 2, 4, 8, 16, 32, 64),
+)
+
+
+class _Batch(Generic[In, Out]):
+    """The inputs collected for one call, and the futures of their callers."""
+
+    __slots__ = ("loop", "items", "futures", "timer")
+
+    def __init__(self, loop: asyncio.AbstractEventLoop):
+        self.loop = loop
+        self.items: List[In] = []
+        self.futures: List["asyncio.Future[Out]"] = []
+        self.timer: Optional[asyncio.TimerHandle] = None
+
+
+class MicroBatcher(Generic[In, Out]):
+    """
+    Collects the inputs submitted with the same key, and runs them as one
+    batch once `max_size` inputs are collected, or `window` seconds after
+    the first one, whichever comes first.
+    """
+
+    def __init__(
+        self,
+        stage: str,
+        run_batch: Callable[[List[In]], Awaitable[List[Out]]],
+        max_size: int,
+        window: float,
+    ):
+        """
+        Parameters
+        ----------
+        stage : str
+            The name of the stage, which labels the metrics.
+        run_batch : callable
+            Returns the result of each input of a batch, in order.
+        max_size : int
+            The maximum number of inputs of a batch.
+        window : float
+            The maximum number of seconds an input waits for other inputs.
+        """
+        if max_size < 1:
+            raise ValueError("max_size must be at least 1")
+        self.stage = stage
+        self.run_batch = run_batch
+        self.max_size = max_size
+        self.window = window
+        self._pending: Dict[Hashable, _Batch[In, Out]] = {}
+        # Holds the running batches, which the event loop only references
+        # weakly
+        self._running: Set["asyncio.Task[None]"] = set()
+
+    async def submit(self, key: Hashable, item: In) -> Out:
+        """
+        Submit an input, and wait for its result.
+
+        Parameters
+        ----------
+        key : Hashable
+            Only the inputs with the same key are batched together.
+        item : In
+            The input.
+
+        Returns
+        -------
+        Out
+            The result of the input.
+        """
+        loop = asyncio.get_running_loop()
+        batch = self._pending.get(key)
+        if batch is None or batch.loop is not loop:
+            batch = self._pending[key] = _Batch(loop)
+            batch.timer = loop.call_later(self.window, self._flush, key, batch)
+        future: "asyncio.Future[Out]" = loop.create_future()
+        batch.items.append(item)
+        batch.futures.append(future)
+        if len(batch.items) >= self.max_size:
+            self._flush(key, batch)
+        return await future
+
+    def _flush(self, key: Hashable, batch: _Batch[In, Out]) -> None:
+        """
+        Helper function which starts running a batch, unless it is already.
+        """
+        if self._pending.get(key) is not batch:
+            return
+        del self._pending[key]
+        if batch.timer is not None:
+            batch.timer.cancel()
+        task = asyncio.ensure_future(self._run(batch))
+        self._running.add(task)
+        task.add_done_callback(self._running.discard)
+
+    async def _run(self, batch: _Batch[In, Out]) -> None:
+        """
+        Helper function which runs a batch and sets the result, or the
+        error, of each of its callers which is still waiting.
+        """
+        batch_sizes.labels(self.stage).observe(len(batch.items))
+        # Given to the callers still waiting if the batch does not complete,
+        # e.g. because it is cancelled
+        error: Exception = RuntimeError(
+            f"The {self.stage} batch did not complete"
+        )
+        try:
+            results = await self.run_batch(batch.items)
+            if len(results) != len(batch.items):
+                raise RuntimeError(
+                    f"The {self.stage} batch returned {len(results)} "
+                    f"results for {len(batch.items)} inputs"
+                )
+            for future, result in zip(batch.futures, results):
+                if not future.done():
+                    future.set_result(result)
+        except Exception as e:
+            error = e
+        finally:
+            for future in batch.futures:
+                if not future.done():
+                    future.set_exception(error)
+
+
+_batchers: Dict[Tuple[str, int, float], MicroBatcher] = {}
+_batchers_lock = threading.Lock()
+
+
+def get_batcher(
+    stage: str, run_batch: Callable[[List[In]], Awaitable[List[Out]]]
+) -> Optional[MicroBatcher[In, Out]]:
+    """
+    Get the batcher of a stage, configured by the environment variables
+    prefixed by the name of the stage, e.g. SANITIZE_BATCH_MAX_SIZE and
+    SANITIZE_BATCH_WINDOW.
+
+    Parameters
+    ----------
+    stage : str
+        "sanitize" or "desanitize".
+    run_batch : callable
+        Runs the batches of the stage, see `MicroBatcher`.
+
+    Returns
+    -------
+    MicroBatcher, optional
+        The batcher, or None if the calls of the stage are not batched.
+    """
+    prefix = stage.upper()
+    max_size = int(os.environ.get(f"{prefix}_BATCH_MAX_SIZE", "1"))
+    if max_size <= 1:
+        return None
+    window = float(os.environ.get(f"{prefix}_BATCH_WINDOW", "0.005"))
+    key = (stage, max_size, window)
+    batcher = _batchers.get(key)
+    if batcher is None:
+        with _batchers_lock:
+            batcher = _batchers.get(key)
+            if batcher is None:
+                batcher = MicroBatcher(stage, run_batch, max_size, window)
+                _batchers[key] = batcher
+    return batcher
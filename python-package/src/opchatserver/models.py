@@ -1,15 +1,54 @@
-from typing import List, Optional
+import os
+from typing import Dict, List, Optional
 
 from pydantic import BaseModel, Field
+from typing_extensions import Annotated
+
+# Bounds on the size of a chat request, so that validating, sanitizing and
+# completing it stays cheap. Larger requests are rejected with 422.
+MAX_HISTORY_MESSAGES = int(os.environ.get("CHAT_MAX_HISTORY_MESSAGES", "200"))
+MAX_MESSAGE_LENGTH = int(os.environ.get("CHAT_MAX_MESSAGE_LENGTH", "32768"))
+
+Message = Annotated[str, Field(max_length=MAX_MESSAGE_LENGTH)]
 
 
 class ChatRequest(BaseModel):
-    history: Optional[List[str]]
-    prompt: str
+    history: Optional[List[Message]] = Field(
+        None, max_length=MAX_HISTORY_MESSAGES
+    )
+    prompt: Message
     with_intermediate_outputs: bool = True
+    # Identifies a conversation whose history is kept by the server, in
+    # which case `history` must be omitted
+    conversation_id: Optional[str] = Field(None, min_length=1, max_length=128)
+    # Return the time taken by each stage with the intermediate outputs
+    with_timings: bool = False
 
 
 class ChatResponse(BaseModel):
     desanitized_response: str = Field(..., alias="desanitizedResponse")
     sanitized_prompt: Optional[str] = Field(None, alias="sanitizedPrompt")
     raw_response: Optional[str] = Field(None, alias="rawResponse")
+    # "clean" if the local pre-screen found no sensitive data, so the prompt
+    # was not sanitized, "flagged" if it did, or None if it is disabled
+    pre_screen: Optional[str] = Field(None, alias="preScreen")
+    # The name of the LLM backend which completed the prompt
+    model: Optional[str] = None
+    # The milliseconds spent in each stage of the chat, if requested with
+    # `with_timings`
+    timings: Optional[Dict[str, float]] = None
+
+
+class ChatBatchRequest(BaseModel):
+    requests: List[ChatRequest] = Field(..., min_length=1)
+
+
+class ChatBatchItem(BaseModel):
+    # The HTTP status code the request would have had on its own
+    status_code: int = Field(..., alias="statusCode")
+    response: Optional[ChatResponse] = None
+    detail: Optional[str] = None
+
+
+class ChatBatchResponse(BaseModel):
+    responses: List[ChatBatchItem]
@@ -0,0 +1,26 @@
+"""
+This module describes the placeholders that OpaquePrompts substitutes for
+sensitive data in sanitized text.
+"""
+import re
+from typing import FrozenSet
+
+# Sanitized items have the format "TYPE_ID", e.g. "PERSON_999"
+PLACEHOLDER_PATTERN = re.compile(r"[A-Z][A-Z_]*_\d+")
+
+
+def find_placeholders(text: str) -> FrozenSet[str]:
+    """
+    Find the placeholders in a sanitized text.
+
+    Parameters
+    ----------
+    text : str
+        The sanitized text.
+
+    Returns
+    -------
+    frozenset of str
+        The placeholders found in `text`.
+    """
+    return frozenset(PLACEHOLDER_PATTERN.findall(text))
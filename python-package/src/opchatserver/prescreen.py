@@ -0,0 +1,277 @@
+"""
+This module contains an optional local pre-screen of the chat inputs, which
+runs before the OpaquePrompts sanitizer. The texts of an input are scanned
+with a single compiled regular expression for common types of sensitive
+data; when none is found, the input is "clean" and is sent to the llm
+without the remote sanitize and desanitize calls. The screen costs tens of
+microseconds for a typical prompt, against the round trips to the
+service that it saves.
+
+A regular expression cannot recognize every name, e.g. a name written in
+lower case, so skipping the sanitizer trades some privacy for latency and
+the pre-screen is disabled by default. Two modes are available:
+
+- conservative: every type of `ENTITY_PATTERNS`, including any digit, any
+  non-ASCII character, and any capitalized word that is not a common English
+  word. Only short, plain inputs such as "hello, how are you?" are clean.
+- tunable: the types listed in PRESCREEN_ENTITIES, and the capitalized words
+  of PRESCREEN_ALLOWED_WORDS are allowed in addition to the common ones,
+  e.g. to let questions about code or products through.
+"""
+import os
+import re
+import threading
+import time
+from typing import Dict, FrozenSet, Iterable, Optional, Pattern, Tuple
+
+from opchatserver.sanitization_cache import CompositeSecureContext
+from prometheus_client import Counter, Histogram
+
+# The secure context of an input that was not sent to the sanitizer. It has
+# no placeholders, so desanitizing with it leaves the text unchanged.
+CLEAN_SECURE_CONTEXT = CompositeSecureContext(parts=())
+
+# The types of sensitive data, matched in this order. Each pattern starts
+# at one of the trigger characters of its type, so that a text is only
+# matched where a trigger is found. The patterns must not contain capturing
+# groups.
+ENTITY_PATTERNS: Dict[str, str] = {
+    "EMAIL_ADDRESS": r"(?<=[\w.+-])@[\w-]+(?:\.[\w-]+)+",
+    "URL": r"(?<=[a-zA-Z])://\S",
+    "IP_ADDRESS": r"(?<![\w.])\d{1,3}(?:\.\d{1,3}){3}(?![\w.]*\d)",
+    "US_SSN": r"(?<!\w)\d{3}-\d{2}-\d{4}(?!\w)",
+    "CREDIT_CARD": r"(?<!\w)(?:\d[ -]?){12,18}\d(?!\w)",
+    "IBAN": (
+        r"(?<=\b[A-Z]{2})\d{2}(?: ?[A-Z0-9]{4}){2,7}(?: ?[A-Z0-9]{1,4})?\b"
+    ),
+    "PHONE_NUMBER": r"(?<!\w)\d[\d ().-]{6,}\d(?!\w)",
+    "DATE": r"(?<!\w)\d{1,4}[/.-]\d{1,2}[/.-]\d{1,4}(?!\w)",
+    "NUMBER": r"\d",
+    "NON_ASCII": r"[^\x00-\x7f]",
+    # Capitalized words, which are checked against the allowed words
+    "PROPER_NOUN": r"[A-Z][\w'-]*",
+}
+
+# The characters at which the patterns of each type start, as the contents
+# of a character class
+ENTITY_TRIGGERS: Dict[str, str] = {
+    "EMAIL_ADDRESS": "@",
+    "URL": ":",
+    "IP_ADDRESS": r"\d",
+    "US_SSN": r"\d",
+    "CREDIT_CARD": r"\d",
+    "IBAN": r"\d",
+    "PHONE_NUMBER": r"\d",
+    "DATE": r"\d",
+    "NUMBER": r"\d",
+    "NON_ASCII": r"\x80-\U0010ffff",
+}
+
+# Capitalized words that are not names, allowed by PROPER_NOUN, including
+# the roles of the history string. Common words which are also first names,
+# e.g. "Will" or "May", are left out.
+COMMON_WORDS = frozenset(
+    """
+    a about after again all also am an and any are as at be because been
+    before but by can could did do does don't for from get give go good
+    great had has have he hello help hey hi how i i'd i'll i'm i've if in
+    is it it's just know let let's like make me more my no not now of ok
+    okay on one or other our please she should so some sorry sure tell
+    thank thanks that that's the their them then there these they this
+    those to use very was we well were what what's when where which who why
+    with would write yes you your explain describe show list summarize
+    translate compare find earlier human ai system
+    """.split()
+)
+
+prescreen_decisions = Counter(
+    "prescreen_decisions_total",
+    "Inputs checked by the local pre-screen, by decision and by the type "
+    "of the first sensitive data found",
+    ["decision", "entity"],
+)
+prescreen_duration = Histogram(
+    "prescreen_duration_seconds",
+    "Time taken by the local pre-screen of an input",
+    buckets=(0.00001, 0.00005, 0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05),
+)
+
+
+class PreScreen:
+    """
+    Finds sensitive data in texts. The patterns of the screened types are
+    alternated in a single regular expression, which is only tried where
+    the text contains one of their trigger characters, e.g. a digit or "@",
+    and the capitalized words are looked up in the allowed words.
+    """
+
+    def __init__(
+        self,
+        entities: Iterable[str],
+        allowed_words: Iterable[str] = COMMON_WORDS,
+        max_chars: int = 65536,
+    ):
+        """
+        Parameters
+        ----------
+        entities : iterable of str
+            The types of `ENTITY_PATTERNS` to look for.
+        allowed_words : iterable of str, optional
+            The capitalized words that PROPER_NOUN does not match, in any
+            case, by default COMMON_WORDS.
+        max_chars : int, optional
+            Inputs longer than this are not screened, and are sent to the
+            sanitizer, which bounds the time spent on the event loop. By
+            default 65536.
+        """
+        entities = [entity.strip().upper() for entity in entities]
+        unknown = set(entities) - set(ENTITY_PATTERNS)
+        if unknown:
+            raise ValueError(f"unknown pre-screen entities: {sorted(unknown)}")
+        if not entities:
+            raise ValueError("the pre-screen needs at least one entity")
+        self.entities = tuple(
+            entity for entity in ENTITY_PATTERNS if entity in entities
+        )
+        self.allowed_words: FrozenSet[str] = frozenset(
+            word.lower() for word in allowed_words
+        )
+        self.max_chars = max_chars
+
+        triggered = [
+            entity for entity in self.entities if entity in ENTITY_TRIGGERS
+        ]
+        self._pattern: Optional[Pattern[str]] = None
+        self._triggers: Optional[Pattern[str]] = None
+        if triggered:
+            self._pattern = re.compile(
+                "|".join(
+                    f"(?P<{entity}>{ENTITY_PATTERNS[entity]})"
+                    for entity in triggered
+                )
+            )
+            triggers = dict.fromkeys(ENTITY_TRIGGERS[e] for e in triggered)
+            self._triggers = re.compile(f"[{''.join(triggers)}]")
+        self._capitalized = (
+            re.compile(ENTITY_PATTERNS["PROPER_NOUN"])
+            if "PROPER_NOUN" in self.entities
+            else None
+        )
+
+    def find_entity(self, text: str) -> Optional[str]:
+        """
+        Find sensitive data in a text.
+
+        Parameters
+        ----------
+        text : str
+            The text to screen.
+
+        Returns
+        -------
+        str, optional
+            The type of the first sensitive data found, PROPER_NOUN coming
+            last, or None if the text is clean.
+        """
+        if self._pattern is not None and self._triggers is not None:
+            position = 0
+            while True:
+                trigger = self._triggers.search(text, position)
+                if trigger is None:
+                    break
+                match = self._pattern.match(text, trigger.start())
+                if match is not None:
+                    return match.lastgroup
+                position = trigger.end()
+        if self._capitalized is not None:
+            for word in self._capitalized.findall(text):
+                if word.lower() not in self.allowed_words:
+                    return "PROPER_NOUN"
+        return None
+
+    def is_clean(self, texts: Iterable[str]) -> bool:
+        """
+        Screen the texts of an input, recording the decision in the metrics.
+
+        Parameters
+        ----------
+        texts : iterable of str
+            The texts of the input, e.g. its prompt and history.
+
+        Returns
+        -------
+        bool
+            Whether no sensitive data was found, in which case the input
+            does not need to be sanitized.
+        """
+        start = time.perf_counter()
+        entity = None
+        length = 0
+        for text in texts:
+            length += len(text)
+            if length > self.max_chars:
+                entity = "TOO_LONG"
+                break
+            entity = self.find_entity(text)
+            if entity is not None:
+                break
+        prescreen_duration.observe(time.perf_counter() - start)
+        if entity is None:
+            prescreen_decisions.labels("clean", "").inc()
+            return True
+        prescreen_decisions.labels("flagged", entity).inc()
+        return False
+
+
+_prescreens: Dict[Tuple[str, str, str, str], PreScreen] = {}
+_prescreens_lock = threading.Lock()
+
+
+def get_prescreen() -> Optional[PreScreen]:
+    """
+    Get the pre-screen configured by the PRESCREEN_MODE environment
+    variable: "off" (the default), "conservative" or "tunable".
+
+    Returns
+    -------
+    PreScreen, optional
+        The pre-screen, or None if it is disabled.
+    """
+    mode = os.environ.get("PRESCREEN_MODE", "off").lower()
+    if mode == "off":
+        return None
+    key = (
+        mode,
+        os.environ.get("PRESCREEN_ENTITIES", ",".join(ENTITY_PATTERNS)),
+        os.environ.get("PRESCREEN_ALLOWED_WORDS", ""),
+        os.environ.get("PRESCREEN_MAX_CHARS", "65536"),
+    )
+    prescreen = _prescreens.get(key)
+    if prescreen is None:
+        with _prescreens_lock:
+            prescreen = _prescreens.get(key)
+            if prescreen is None:
+                prescreen = _create_prescreen(*key)
+                _prescreens[key] = prescreen
+    return prescreen
+
+
+def _create_prescreen(
+    mode: str, entities: str, allowed_words: str, max_chars: str
+) -> PreScreen:
+    """
+    Helper function which creates the pre-screen of a mode from the values
+    of the environment variables.
+    """
+    if mode == "conservative":
+        return PreScreen(ENTITY_PATTERNS, max_chars=int(max_chars))
+    if mode == "tunable":
+        return PreScreen(
+            [entity for entity in entities.split(",") if entity.strip()],
+            COMMON_WORDS
+            | frozenset(
+                word.strip() for word in allowed_words.split(",") if word
+            ),
+            max_chars=int(max_chars),
+        )
+    raise ValueError(f"unknown PRESCREEN_MODE: {mode}")
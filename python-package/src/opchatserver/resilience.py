@@ -0,0 +1,577 @@
+"""
+This module contains the resilience layer of the calls the chat pipeline
+makes to its upstream services, for each of its "sanitize", "llm" and
+"desanitize" stages:
+
+- a timeout per call, so that a slow dependency does not use up the whole
+  latency budget of a request,
+- jittered retries of the idempotent sanitize and desanitize calls, when
+  they fail transiently,
+- optional hedging of the llm calls, which sends a second request when the
+  first one is slower than the usual (p95) latency and keeps the first
+  response,
+- a circuit breaker, which fails fast while a dependency keeps failing.
+
+Only transient errors, i.e. timeouts, connection errors and 5xx or 429
+responses, are retried and counted by the circuit breaker. Other errors,
+such as the rejection of an invalid input, are raised right away, so that
+the bad requests of one user do not open the circuit for everyone.
+
+Calls made on the executor cannot be interrupted, so a call that times out
+keeps its thread until it returns, but the request does not wait for it.
+"""
+import asyncio
+import functools
+import math
+import os
+import random
+import threading
+import time
+from collections import deque
+from typing import (
+    AsyncIterator,
+    Awaitable,
+    Callable,
+    Deque,
+    Dict,
+    List,
+    Optional,
+    Tuple,
+    Type,
+    TypeVar,
+)
+
+from prometheus_client import Counter, Gauge
+
+T = TypeVar("T")
+
+STAGES = ("sanitize", "llm", "desanitize")
+
+upstream_retries = Counter(
+    "upstream_retries_total", "Retried upstream calls", ["stage"]
+)
+upstream_timeouts = Counter(
+    "upstream_timeouts_total", "Upstream calls which timed out", ["stage"]
+)
+upstream_hedges = Counter(
+    "upstream_hedges_total",
+    "Hedged upstream calls, by the request which answered first",
+    ["stage", "winner"],
+)
+circuit_state = Gauge(
+    "upstream_circuit_state",
+    "State of the circuit breaker of an upstream stage: 0 closed, 1 open, "
+    "2 half-open",
+    ["stage"],
+    multiprocess_mode="max",
+)
+
+
+class UpstreamError(Exception):
+    """
+    Base class of the errors raised by the resilience layer.
+
+    Attributes
+    ----------
+    stage : str
+        The stage of the failed call.
+    """
+
+    def __init__(self, stage: str, message: str):
+        super().__init__(message)
+        self.stage = stage
+
+
+class UpstreamTimeoutError(UpstreamError):
+    """Raised when an upstream call takes longer than its timeout."""
+
+
+class CircuitOpenError(UpstreamError):
+    """
+    Raised without calling the upstream service while its circuit is open.
+
+    Attributes
+    ----------
+    retry_after : int
+        The number of seconds until the circuit lets a call through.
+    """
+
+    def __init__(self, stage: str, retry_after: int):
+        super().__init__(stage, f"{stage} is unavailable")
+        self.retry_after = retry_after
+
+
+def is_transient(error: BaseException) -> bool:
+    """
+    Check whether a failed upstream call may succeed if it is made again.
+
+    Parameters
+    ----------
+    error : BaseException
+        The error raised by the call.
+
+    Returns
+    -------
+    bool
+        True if the call timed out, could not reach the service, or was
+        answered with a 5xx or 429 status, False otherwise.
+    """
+    if isinstance(
+        error, (TimeoutError, ConnectionError, UpstreamTimeoutError)
+    ):
+        return True
+    status = _get_status(error)
+    if status is not None:
+        return status == 429 or status >= 500
+    return isinstance(error, _connection_errors())
+
+
+def _get_status(error: BaseException) -> Optional[int]:
+    """
+    Helper function which gets the HTTP status of the response an error was
+    raised for, as set by requests, aiohttp or openai, if any.
+    """
+    for name in ("status_code", "status", "http_status"):
+        status = getattr(error, name, None)
+        if isinstance(status, int):
+            return status
+    status = getattr(getattr(error, "response", None), "status_code", None)
+    return status if isinstance(status, int) else None
+
+
+@functools.lru_cache(maxsize=None)
+def _connection_errors() -> Tuple[Type[BaseException], ...]:
+    """
+    Helper function which gets the connection and timeout errors of the
+    HTTP clients of the upstream services which are installed.
+    """
+    errors: List[Type[BaseException]] = []
+    try:
+        import requests
+
+        errors += [requests.ConnectionError, requests.Timeout]
+    except ImportError:
+        pass
+    try:
+        import aiohttp
+
+        errors.append(aiohttp.ClientConnectionError)
+    except ImportError:
+        pass
+    try:
+        import openai.error
+
+        errors += [openai.error.APIConnectionError, openai.error.Timeout]
+    except ImportError:
+        pass
+    return tuple(errors)
+
+
+class CircuitBreaker:
+    """
+    Opens after `failure_threshold` consecutive failures, and then rejects
+    calls for `reset_timeout` seconds. After that, a single trial call is let
+    through: the circuit closes if it succeeds and opens again if it fails.
+    """
+
+    CLOSED = 0
+    OPEN = 1
+    HALF_OPEN = 2
+
+    def __init__(
+        self,
+        stage: str,
+        failure_threshold: int = 5,
+        reset_timeout: float = 30,
+        timer: Callable[[], float] = time.monotonic,
+    ):
+        """
+        Parameters
+        ----------
+        stage : str
+            The stage protected by the circuit breaker.
+        failure_threshold : int, optional
+            The number of consecutive failures which open the circuit, by
+            default 5.
+        reset_timeout : float, optional
+            The number of seconds the circuit stays open, by default 30.
+        timer : callable, optional
+            The clock of the circuit breaker, by default `time.monotonic`.
+        """
+        self.stage = stage
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._timer = timer
+        self._lock = threading.Lock()
+        self._failures = 0
+        self._opened_at = 0.0
+        self._trial_in_flight = False
+        self._set_state(self.CLOSED)
+
+    @property
+    def state(self) -> int:
+        """The state of the circuit, CLOSED, OPEN or HALF_OPEN."""
+        return self._state
+
+    def before_call(self) -> None:
+        """
+        Check that a call may be made.
+
+        Raises
+        ------
+        CircuitOpenError
+            If the circuit is open, or a trial call is already in flight.
+        """
+        with self._lock:
+            if self._state == self.CLOSED:
+                return
+            remaining = self._opened_at + self.reset_timeout - self._timer()
+            if self._state == self.OPEN and remaining <= 0:
+                self._set_state(self.HALF_OPEN)
+            if self._state == self.HALF_OPEN and not self._trial_in_flight:
+                self._trial_in_flight = True
+                return
+            raise CircuitOpenError(self.stage, max(1, math.ceil(remaining)))
+
+    def record_success(self) -> None:
+        """Record a successful call, closing the circuit."""
+        with self._lock:
+            self._failures = 0
+            self._trial_in_flight = False
+            self._set_state(self.CLOSED)
+
+    def record_failure(self) -> None:
+        """Record a failed call, opening the circuit if needed."""
+        with self._lock:
+            self._failures += 1
+            self._trial_in_flight = False
+            if (
+                self._state == self.HALF_OPEN
+                or self._failures >= self.failure_threshold
+            ):
+                self._opened_at = self._timer()
+                self._set_state(self.OPEN)
+
+    def record_abandoned(self) -> None:
+        """
+        Record a call whose outcome is unknown because it was cancelled, so
+        that another trial call may be made.
+        """
+        with self._lock:
+            self._trial_in_flight = False
+
+    def _set_state(self, state: int) -> None:
+        self._state = state
+        circuit_state.labels(stage=self.stage).set(state)
+
+
+class LatencyTracker:
+    """Tracks a percentile of the latency of the recent calls of a stage."""
+
+    def __init__(self, percentile: float = 0.95, window: int = 1000):
+        """
+        Parameters
+        ----------
+        percentile : float, optional
+            The percentile to track, by default 0.95.
+        window : int, optional
+            The number of recent calls used, by default 1000.
+        """
+        self.percentile = percentile
+        self._latencies: Deque[float] = deque(maxlen=window)
+
+    def record(self, latency: float) -> None:
+        """Record the latency of a call, in seconds."""
+        self._latencies.append(latency)
+
+    def value(self, min_samples: int = 20) -> Optional[float]:
+        """
+        Get the percentile of the recorded latencies.
+
+        Parameters
+        ----------
+        min_samples : int, optional
+            The number of calls needed for a meaningful value, by default 20.
+
+        Returns
+        -------
+        float, optional
+            The percentile, or None if too few calls were recorded.
+        """
+        if len(self._latencies) < min_samples:
+            return None
+        latencies = sorted(self._latencies)
+        return latencies[int(self.percentile * (len(latencies) - 1))]
+
+
+class StagePolicy:
+    """
+    The timeout, retries, hedging and circuit breaker of the upstream calls
+    of one stage.
+    """
+
+    def __init__(
+        self,
+        stage: str,
+        timeout: Optional[float] = None,
+        retries: int = 0,
+        retry_base_delay: float = 0.1,
+        retry_max_delay: float = 2,
+        hedge: bool = False,
+        hedge_after: Optional[float] = None,
+        breaker: Optional[CircuitBreaker] = None,
+    ):
+        """
+        Parameters
+        ----------
+        stage : str
+            The name of the stage.
+        timeout : float, optional
+            The timeout of a call, in seconds, by default None for no
+            timeout.
+        retries : int, optional
+            The number of times a failed call is retried, by default 0. Only
+            idempotent calls should be retried.
+        retry_base_delay : float, optional
+            The base of the exponential backoff between retries, in seconds,
+            by default 0.1.
+        retry_max_delay : float, optional
+            The maximum backoff between retries, in seconds, by default 2.
+        hedge : bool, optional
+            Whether to send a second request when a call is slower than
+            `hedge_after`, by default False.
+        hedge_after : float, optional
+            The delay after which a call is hedged, in seconds, by default
+            None for the p95 latency of the recent calls.
+        breaker : CircuitBreaker, optional
+            The circuit breaker of the stage, by default None.
+        """
+        self.stage = stage
+        self.timeout = timeout
+        self.retries = retries
+        self.retry_base_delay = retry_base_delay
+        self.retry_max_delay = retry_max_delay
+        self.hedge = hedge
+        self.hedge_after = hedge_after
+        self.breaker = breaker
+        self.latency = LatencyTracker()
+
+    async def call(self, make_call: Callable[[], Awaitable[T]]) -> T:
+        """
+        Make an upstream call, applying the policy.
+
+        Parameters
+        ----------
+        make_call : callable
+            Starts the call and returns its awaitable. It is called again
+            for each retry or hedged request. Only the calls which fail
+            transiently, see `is_transient`, are retried.
+
+        Returns
+        -------
+        T
+            The result of the call.
+
+        Raises
+        ------
+        UpstreamTimeoutError
+            If the last attempt timed out.
+        CircuitOpenError
+            If the circuit of the stage is open.
+        """
+        attempt = 0
+        while True:
+            if self.breaker is not None:
+                self.breaker.before_call()
+            try:
+                result = await self._attempt(make_call)
+            except Exception as e:
+                if not is_transient(e):
+                    # The upstream service is not at fault, and the call
+                    # would fail again
+                    if self.breaker is not None:
+                        self.breaker.record_abandoned()
+                    raise
+                if self.breaker is not None:
+                    self.breaker.record_failure()
+                if attempt >= self.retries:
+                    raise
+            except BaseException:
+                if self.breaker is not None:
+                    self.breaker.record_abandoned()
+                raise
+            else:
+                if self.breaker is not None:
+                    self.breaker.record_success()
+                return result
+            attempt += 1
+            upstream_retries.labels(stage=self.stage).inc()
+            # Full jitter, so that retries of concurrent requests spread out
+            await asyncio.sleep(
+                random.uniform(
+                    0,
+                    min(
+                        self.retry_max_delay,
+                        self.retry_base_delay * 2 ** (attempt - 1),
+                    ),
+                )
+            )
+
+    async def stream(
+        self, make_stream: Callable[[], AsyncIterator[T]]
+    ) -> AsyncIterator[T]:
+        """
+        Stream the items of an upstream call, applying the circuit breaker
+        of the policy, and its timeout to the wait for each item. Streams are
+        neither retried nor hedged, since their first items may already
+        have been used.
+
+        Parameters
+        ----------
+        make_stream : callable
+            Starts the call and returns its stream.
+
+        Returns
+        -------
+        AsyncIterator
+            The items of the stream.
+        """
+        if self.breaker is not None:
+            self.breaker.before_call()
+        try:
+            stream = make_stream()
+            while True:
+                try:
+                    item = await asyncio.wait_for(
+                        stream.__anext__(), timeout=self.timeout
+                    )
+                except StopAsyncIteration:
+                    break
+                except asyncio.TimeoutError:
+                    upstream_timeouts.labels(stage=self.stage).inc()
+                    raise UpstreamTimeoutError(
+                        self.stage,
+                        f"{self.stage} sent nothing for {self.timeout}s",
+                    )
+                yield item
+        except Exception as e:
+            if self.breaker is not None:
+                if is_transient(e):
+                    self.breaker.record_failure()
+                else:
+                    self.breaker.record_abandoned()
+            raise
+        except BaseException:
+            if self.breaker is not None:
+                self.breaker.record_abandoned()
+            raise
+        if self.breaker is not None:
+            self.breaker.record_success()
+
+    async def _attempt(self, make_call: Callable[[], Awaitable[T]]) -> T:
+        """
+        Helper function which makes one attempt of a call, hedged if needed,
+        within the timeout.
+        """
+        start = time.perf_counter()
+        try:
+            result = await asyncio.wait_for(
+                self._hedged(make_call), timeout=self.timeout
+            )
+        except asyncio.TimeoutError:
+            upstream_timeouts.labels(stage=self.stage).inc()
+            raise UpstreamTimeoutError(
+                self.stage, f"{self.stage} timed out after {self.timeout}s"
+            )
+        self.latency.record(time.perf_counter() - start)
+        return result
+
+    async def _hedged(self, make_call: Callable[[], Awaitable[T]]) -> T:
+        """
+        Helper function which makes a call and, if it is slower than the
+        hedging delay, a second one, returning the first result.
+        """
+        hedge_after = self.hedge_after
+        if hedge_after is None and self.hedge:
+            hedge_after = self.latency.value()
+        if not self.hedge or hedge_after is None:
+            return await make_call()
+
+        first = asyncio.ensure_future(make_call())
+        done, _ = await asyncio.wait([first], timeout=hedge_after)
+        if done:
+            return first.result()
+        second = asyncio.ensure_future(make_call())
+        tasks = {first: "first", second: "hedge"}
+        try:
+            pending = set(tasks)
+            while True:
+                done, pending = await asyncio.wait(
+                    pending, return_when=asyncio.FIRST_COMPLETED
+                )
+                succeeded = [t for t in done if t.exception() is None]
+                if succeeded or not pending:
+                    task = (succeeded or list(done))[0]
+                    upstream_hedges.labels(
+                        stage=self.stage, winner=tasks[task]
+                    ).inc()
+                    return task.result()
+        finally:
+            for task in tasks:
+                task.cancel()
+
+
+_policies: Dict[str, StagePolicy] = {}
+_policies_lock = threading.Lock()
+
+
+def get_stage_policy(stage: str) -> StagePolicy:
+    """
+    Get the policy of a stage, configured from the environment.
+
+    Parameters
+    ----------
+    stage : str
+        One of "sanitize", "llm" and "desanitize".
+
+    Returns
+    -------
+    StagePolicy
+        The policy of the stage.
+    """
+    with _policies_lock:
+        policy = _policies.get(stage)
+        if policy is None:
+            policy = _policies[stage] = _create_stage_policy(stage)
+        return policy
+
+
+def _create_stage_policy(stage: str) -> StagePolicy:
+    """
+    Helper function which creates the policy of a stage from the
+    environment variables prefixed by the name of the stage, e.g.
+    SANITIZE_TIMEOUT.
+    """
+    prefix = stage.upper()
+    default_timeout = "60" if stage == "llm" else "10"
+    # Only sanitize and desanitize calls are idempotent
+    default_retries = "0" if stage == "llm" else "2"
+    timeout = float(os.environ.get(f"{prefix}_TIMEOUT", default_timeout))
+    hedge_after = os.environ.get(f"{prefix}_HEDGE_AFTER")
+    return StagePolicy(
+        stage,
+        timeout=timeout if timeout > 0 else None,
+        retries=int(os.environ.get(f"{prefix}_RETRIES", default_retries)),
+        retry_base_delay=float(
+            os.environ.get("UPSTREAM_RETRY_BASE_DELAY", "0.1")
+        ),
+        hedge=os.environ.get(f"{prefix}_HEDGE", "false").lower() == "true",
+        hedge_after=float(hedge_after) if hedge_after else None,
+        breaker=CircuitBreaker(
+            stage,
+            failure_threshold=int(
+                os.environ.get("CIRCUIT_FAILURE_THRESHOLD", "5")
+            ),
+            reset_timeout=float(os.environ.get("CIRCUIT_RESET_TIMEOUT", "30")),
+        ),
+    )
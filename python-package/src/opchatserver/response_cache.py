@@ -0,0 +1,117 @@
+"""
+This module contains an optional cache of the raw responses of the llm,
+keyed by the model and the sanitized prompt sent to it.
+
+Requests which are sanitized into the same prompt, such as frequently asked
+questions or retries, are then answered without calling the llm, and only
+the desanitization runs with the secure context of the current request.
+Only sanitized prompts and responses are stored, so the cache holds no PII.
+"""
+import hashlib
+import os
+import threading
+from typing import Optional
+
+from opchatserver.cache import TTLCache
+from prometheus_client import Counter
+
+response_cache_requests = Counter(
+    "response_cache_requests_total",
+    "Lookups of llm responses in the response cache",
+    ["result"],
+)
+
+
+class ResponseCache:
+    """
+    A bounded cache of llm responses which expire after a time-to-live.
+    """
+
+    def __init__(self, maxsize: int = 4096, ttl: float = 3600):
+        """
+        Parameters
+        ----------
+        maxsize : int, optional
+            The maximum number of responses in the cache, by default 4096.
+        ttl : float, optional
+            The number of seconds a response is kept, by default 3600.
+        """
+        self._responses: TTLCache[str] = TTLCache(maxsize=maxsize, ttl=ttl)
+
+    @staticmethod
+    def key(llm_string: str, prompt: str) -> str:
+        """
+        Get the key of the response of an llm to a prompt.
+
+        Parameters
+        ----------
+        llm_string : str
+            Identifies the llm, including its model and parameters.
+        prompt : str
+            The sanitized prompt, after the prompt template was applied.
+
+        Returns
+        -------
+        str
+            The key of the response.
+        """
+        return hashlib.sha256(f"{llm_string}\0{prompt}".encode()).hexdigest()
+
+    def get(self, key: str) -> Optional[str]:
+        """
+        Get a cached response.
+
+        Parameters
+        ----------
+        key : str
+            The key returned by `key`.
+
+        Returns
+        -------
+        str, optional
+            The raw response of the llm, or None if it is not cached.
+        """
+        response = self._responses.get(key)
+        response_cache_requests.labels(
+            result="miss" if response is None else "hit"
+        ).inc()
+        return response
+
+    def set(self, key: str, response: str) -> None:
+        """
+        Cache a response.
+
+        Parameters
+        ----------
+        key : str
+            The key returned by `key`.
+        response : str
+            The raw response of the llm.
+        """
+        self._responses.set(key, response)
+
+
+_cache: Optional[ResponseCache] = None
+_cache_lock = threading.Lock()
+
+
+def get_response_cache() -> Optional[ResponseCache]:
+    """
+    Get the process-wide response cache, if it is enabled with the
+    RESPONSE_CACHE_ENABLED environment variable.
+
+    Returns
+    -------
+    ResponseCache, optional
+        The cache, or None if it is disabled.
+    """
+    global _cache
+    if os.environ.get("RESPONSE_CACHE_ENABLED", "false").lower() != "true":
+        return None
+    with _cache_lock:
+        if _cache is None:
+            _cache = ResponseCache(
+                maxsize=int(os.environ.get("RESPONSE_CACHE_SIZE", "4096")),
+                ttl=float(os.environ.get("RESPONSE_CACHE_TTL", "3600")),
+            )
+        return _cache
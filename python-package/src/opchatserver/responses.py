@@ -0,0 +1,51 @@
+"""
+This module contains the JSON response class of the chat endpoints. It
+serializes pydantic models straight to bytes with pydantic-core, and other
+content with orjson, instead of the validation and `jsonable_encoder` pass
+FastAPI otherwise makes over the models returned by the endpoints.
+"""
+import json
+from typing import Any
+
+from fastapi.responses import JSONResponse
+from pydantic import BaseModel
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover
+    orjson = None  # type: ignore[assignment]
+
+
+def dumps(content: Any) -> bytes:
+    """
+    Serialize content to JSON bytes. Models are serialized by alias, as
+    FastAPI would.
+
+    Parameters
+    ----------
+    content : Any
+        A pydantic model, or JSON-serializable content.
+
+    Returns
+    -------
+    bytes
+        The JSON document, encoded in UTF-8.
+    """
+    if isinstance(content, BaseModel):
+        return content.__pydantic_serializer__.to_json(content, by_alias=True)
+    if orjson is not None:
+        return orjson.dumps(content)
+    return json.dumps(  # type: ignore[unreachable]
+        content, ensure_ascii=False, separators=(",", ":")
+    ).encode()
+
+
+class FastJSONResponse(JSONResponse):
+    """
+    A JSON response whose content is serialized with `dumps`. Endpoints
+    return it directly, with their model as `response_model` for the
+    OpenAPI schema, so that FastAPI does not serialize the model itself.
+    """
+
+    def render(self, content: Any) -> bytes:
+        return dumps(content)
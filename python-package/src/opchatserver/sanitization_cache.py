@@ -0,0 +1,286 @@
+"""
+This module contains an optional per-conversation cache of sanitized texts,
+so that the turns of a conversation are sent to the OpaquePrompts sanitizer
+once rather than on every new turn.
+
+Texts sanitized by different calls to `op.sanitize` have different secure
+contexts. A response is therefore desanitized with the secure context of
+each call whose placeholders it contains, which assumes that desanitization
+leaves the placeholders of other contexts untouched. Entities are only
+linked within a call, so the same person mentioned in a cached turn and in a
+new prompt gets two placeholders; this is why the cache is opt-in. If a new
+call returns a placeholder that is already used by a cached turn, the whole
+input is sanitized again in a single call instead.
+"""
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import (
+    Any,
+    Dict,
+    FrozenSet,
+    List,
+    NamedTuple,
+    Optional,
+    Tuple,
+    Union,
+)
+
+import langchain.utilities.opaqueprompts as op
+from opchatserver.cache import TTLCache
+from opchatserver.placeholders import find_placeholders
+from prometheus_client import Counter
+
+sanitize_cache_texts = Counter(
+    "sanitize_cache_texts_total",
+    "Texts looked up in the sanitization cache",
+    ["result"],
+)
+
+
+@dataclass(frozen=True)
+class CompositeSecureContext:
+    """
+    The secure contexts of the sanitize calls that produced the texts of one
+    input, each with the placeholders it can desanitize.
+    """
+
+    parts: Tuple[Tuple[str, FrozenSet[str]], ...]
+
+
+SecureContext = Union[str, CompositeSecureContext]
+
+
+def desanitize(sanitized_text: str, secure_context: SecureContext) -> str:
+    """
+    Desanitize a text with a secure context returned by `op.sanitize` or by
+    `SanitizationCache.sanitize`.
+
+    Parameters
+    ----------
+    sanitized_text : str
+        The sanitized text, e.g. the response of the llm.
+    secure_context : str or CompositeSecureContext
+        The secure context of the sanitized input.
+
+    Returns
+    -------
+    str
+        The desanitized text.
+    """
+    if not isinstance(secure_context, CompositeSecureContext):
+        return op.desanitize(
+            sanitized_text, secure_context  # type: ignore[arg-type]
+        )
+    for context, placeholders in secure_context.parts:
+        if any(placeholder in sanitized_text for placeholder in placeholders):
+            sanitized_text = op.desanitize(
+                sanitized_text, context  # type: ignore[arg-type]
+            )
+    return sanitized_text
+
+
+class _SanitizedText(NamedTuple):
+    sanitized: str
+    context_id: int
+    placeholders: FrozenSet[str]
+
+
+class _Conversation:
+    """The sanitized texts of a conversation and their secure contexts"""
+
+    def __init__(self) -> None:
+        self.lock = threading.Lock()
+        self.contexts: Dict[int, str] = {}
+        self.texts: "OrderedDict[str, _SanitizedText]" = OrderedDict()
+        self.next_context_id = 0
+
+    def add_context(self, context: str) -> int:
+        context_id = self.next_context_id
+        self.next_context_id += 1
+        self.contexts[context_id] = context
+        return context_id
+
+    def evict(self, max_texts: int) -> None:
+        while len(self.texts) > max_texts:
+            self.texts.popitem(last=False)
+        used = {text.context_id for text in self.texts.values()}
+        for context_id in list(self.contexts):
+            if context_id not in used:
+                del self.contexts[context_id]
+
+
+class SanitizationCache:
+    """
+    Caches the sanitized form of the texts of each conversation, keyed by a
+    hash of their content, with the secure contexts needed to desanitize
+    them. Memory is bounded by the number of conversations and of texts per
+    conversation, and conversations expire after a time-to-live.
+    """
+
+    def __init__(
+        self,
+        max_conversations: int = 1024,
+        max_texts_per_conversation: int = 64,
+        ttl: float = 1800,
+    ):
+        """
+        Parameters
+        ----------
+        max_conversations : int, optional
+            The maximum number of conversations in the cache, by default
+            1024.
+        max_texts_per_conversation : int, optional
+            The maximum number of texts kept per conversation, by default 64.
+        ttl : float, optional
+            The number of seconds a conversation is kept after its last
+            turn, by default 1800.
+        """
+        self.max_texts_per_conversation = max_texts_per_conversation
+        self._conversations: TTLCache[_Conversation] = TTLCache(
+            maxsize=max_conversations, ttl=ttl
+        )
+        self._lock = threading.Lock()
+
+    def sanitize(
+        self, conversation_key: str, texts: Dict[str, str]
+    ) -> Tuple[Dict[str, str], SecureContext]:
+        """
+        Sanitize the values of `texts`, only sending to `op.sanitize` those
+        which have not been sanitized before in the conversation.
+
+        Parameters
+        ----------
+        conversation_key : str
+            Identifies the conversation of the texts.
+        texts : dict
+            The texts to sanitize.
+
+        Returns
+        -------
+        (dict, str or CompositeSecureContext)
+            The sanitized texts, with the same keys as `texts`, and the
+            secure context needed to desanitize them.
+        """
+        conversation = self._get_conversation(conversation_key)
+        with conversation.lock:
+            hashes = {key: _hash(text) for key, text in texts.items()}
+            cached = {
+                key: conversation.texts[digest]
+                for key, digest in hashes.items()
+                if digest in conversation.texts
+            }
+            missing = {
+                key: text for key, text in texts.items() if key not in cached
+            }
+            sanitize_cache_texts.labels(result="hit").inc(len(cached))
+            sanitize_cache_texts.labels(result="miss").inc(len(missing))
+
+            results = dict(cached)
+            if missing:
+                new = self._sanitize_missing(conversation, missing)
+                cached_placeholders = frozenset().union(
+                    *(text.placeholders for text in cached.values())
+                )
+                new_placeholders = frozenset().union(
+                    *(text.placeholders for text in new.values())
+                )
+                if cached_placeholders & new_placeholders:
+                    # Placeholders would be ambiguous, so sanitize the whole
+                    # input in a single call
+                    conversation.texts.clear()
+                    results = self._sanitize_missing(conversation, texts)
+                else:
+                    results.update(new)
+                for key, text in results.items():
+                    conversation.texts[hashes[key]] = text
+            for digest in hashes.values():
+                conversation.texts.move_to_end(digest)
+            conversation.evict(
+                max(self.max_texts_per_conversation, len(texts))
+            )
+            return (
+                {key: text.sanitized for key, text in results.items()},
+                _secure_context(conversation, list(results.values())),
+            )
+
+    def _get_conversation(self, conversation_key: str) -> _Conversation:
+        with self._lock:
+            conversation = self._conversations.get(conversation_key)
+            if conversation is None:
+                conversation = _Conversation()
+            # Refresh the time-to-live of the conversation
+            self._conversations.set(conversation_key, conversation)
+            return conversation
+
+    def _sanitize_missing(
+        self, conversation: _Conversation, texts: Dict[str, str]
+    ) -> Dict[str, _SanitizedText]:
+        response: Dict[str, Any] = op.sanitize(texts)
+        context_id = conversation.add_context(response["secure_context"])
+        return {
+            key: _SanitizedText(
+                sanitized, context_id, find_placeholders(sanitized)
+            )
+            for key, sanitized in response["sanitized_input"].items()
+        }
+
+
+def _hash(text: str) -> str:
+    return hashlib.sha256(text.encode()).hexdigest()
+
+
+def _secure_context(
+    conversation: _Conversation, texts: List[_SanitizedText]
+) -> SecureContext:
+    """
+    Helper function which builds the secure context of sanitized texts,
+    which is a plain secure context if they come from a single call.
+    """
+    placeholders: Dict[int, FrozenSet[str]] = {}
+    for text in texts:
+        placeholders[text.context_id] = (
+            placeholders.get(text.context_id, frozenset()) | text.placeholders
+        )
+    if len(placeholders) == 1:
+        (context_id,) = placeholders
+        return conversation.contexts[context_id]
+    return CompositeSecureContext(
+        tuple(
+            (conversation.contexts[context_id], context_placeholders)
+            for context_id, context_placeholders in placeholders.items()
+        )
+    )
+
+
+_cache: Optional[SanitizationCache] = None
+_cache_lock = threading.Lock()
+
+
+def get_sanitization_cache() -> Optional[SanitizationCache]:
+    """
+    Get the process-wide sanitization cache, if it is enabled with the
+    SANITIZE_CACHE_ENABLED environment variable.
+
+    Returns
+    -------
+    SanitizationCache, optional
+        The cache, or None if it is disabled.
+    """
+    global _cache
+    if os.environ.get("SANITIZE_CACHE_ENABLED", "false").lower() != "true":
+        return None
+    with _cache_lock:
+        if _cache is None:
+            _cache = SanitizationCache(
+                max_conversations=int(
+                    os.environ.get("SANITIZE_CACHE_MAX_CONVERSATIONS", "1024")
+                ),
+                max_texts_per_conversation=int(
+                    os.environ.get("SANITIZE_CACHE_MAX_TEXTS", "64")
+                ),
+                ttl=float(os.environ.get("SANITIZE_CACHE_TTL", "1800")),
+            )
+        return _cache
@@ -1,37 +1,162 @@
+import asyncio
+import hashlib
 import logging
 import os
-import time
+from contextlib import asynccontextmanager
 from http import HTTPStatus
-from typing import Any, List
+from typing import (
+    TYPE_CHECKING,
+    Any,
+    AsyncIterator,
+    Awaitable,
+    Dict,
+    List,
+    Optional,
+    Tuple,
+    TypeVar,
+)
 
-from fastapi import Depends, FastAPI, HTTPException
+from fastapi import Depends, FastAPI, HTTPException, Request
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import StreamingResponse
 from fastapi.security import HTTPBearer
-from langchain import LLMChain, PromptTemplate
-from langchain.llms import OpenAI
-from langchain.llms.opaqueprompts import OpaquePrompts
-from opchatserver.authorization import VerifyToken
-from opchatserver.intermediate_outputs import get_response
-from opchatserver.memory import build_memory
-from opchatserver.models import ChatRequest, ChatResponse
+from opchatserver.admission import (
+    AdmissionController,
+    AdmissionRejected,
+    create_admission_controller,
+)
+from opchatserver.authorization import VerifyToken, get_jwks_key_store
+from opchatserver.backends import (
+    Backend,
+    BackendRegistry,
+    create_backend_registry,
+)
+from opchatserver.chains import ChainRegistry, ChatChains
+from opchatserver.coalescing import (
+    SingleFlight,
+    coalescing_key,
+    create_single_flight,
+)
+from opchatserver.draining import (
+    Drain,
+    DrainMiddleware,
+    get_drain_timeout,
+    install_drain_signal_handler,
+)
+from opchatserver.executor import (
+    install_default_executor,
+    run_in_executor,
+    shutdown_executor,
+)
+from opchatserver.http_pool import (
+    UpstreamPoolsMiddleware,
+    close_upstream_pools,
+    start_upstream_pools,
+)
+from opchatserver.memory import HistoryWindow, create_history_window
+from opchatserver.metrics import (
+    RequestMetricsMiddleware,
+    make_metrics_app,
+    mark_worker_stopped,
+    track_stage,
+)
+from opchatserver.models import (
+    ChatBatchItem,
+    ChatBatchRequest,
+    ChatBatchResponse,
+    ChatRequest,
+    ChatResponse,
+)
 from opchatserver.prompt_template import OPAQUEPROMPTS_TEMPLATE
-from prometheus_client import Histogram, make_asgi_app
+from opchatserver.resilience import (
+    CircuitOpenError,
+    UpstreamError,
+    UpstreamTimeoutError,
+)
+from opchatserver.responses import FastJSONResponse
+from opchatserver.sessions import SessionStore, create_session_store
+from opchatserver.tracing import (
+    TracingMiddleware,
+    close_span_exporters,
+    current_trace,
+    trace_span,
+)
+from opchatserver.warmup import WarmUp
+from starlette.background import BackgroundTask
+
+# The modules of the chat pipeline import LangChain, which is slow, so they
+# are imported when the pipeline is loaded rather than with the server, see
+# `_load_pipeline`
+if TYPE_CHECKING:
+    from langchain.llms.base import BaseLLM
+    from langchain.memory import ConversationBufferWindowMemory
 
 logger = logging.getLogger(__name__)
 
-app = FastAPI()
-token_auth_scheme = HTTPBearer()
+T = TypeVar("T")
 
-# Define Prometheus histogram to track latency
-h = Histogram(
-    "http_request_duration_seconds", "Total latency of a /chat HTTP request"
-)
 
-# Add prometheus ASGI middleware to route /metrics requests
-# IMPORTANT: this is not multiprocess safe. If you wish to run
-# gunicorn with multiprocessing enabled, see instructions at
-# https://github.com/prometheus/client_python#fastapi--gunicorn
-metrics_app = make_asgi_app()
+@asynccontextmanager
+async def lifespan(app: FastAPI) -> AsyncIterator[None]:
+    """
+    Set up the resources shared by all requests when the server starts, and
+    release them when it stops.
+
+    Parameters
+    ----------
+    app : FastAPI
+        The application being started.
+    """
+    # Bound the threads used for blocking work, including the work that
+    # LangChain offloads to the default executor of the event loop
+    install_default_executor()
+    # Keep connections to the OpenAI and OpaquePrompts APIs alive across
+    # requests
+    await start_upstream_pools()
+    # The LLM backends, and the routes which select the backend of a chat
+    app.state.backends = create_backend_registry()
+    # Build the LangChain runnables once per backend and prompt template,
+    # rather than on every request
+    app.state.chain_registry = ChainRegistry(_create_llm)
+    # Keep the history of the conversations identified by a conversation_id
+    app.state.session_store = create_session_store()
+    # The token budget of the history of each model, created on first use
+    app.state.history_windows = {}
+    # Bound the chats handled at once, overall and per user
+    app.state.admission_controller = create_admission_controller()
+    # Identical chats of a user in flight at the same time share a response
+    app.state.single_flight = create_single_flight()
+    # Load the chat pipeline and prefetch the JWKS in the background, so
+    # that the server accepts connections, e.g. health checks, right away
+    app.state.warm_up = WarmUp(
+        load_pipeline=lambda: _load_pipeline(app),
+        prefetch_jwks=lambda: get_jwks_key_store(VerifyToken.domain).refresh(),
+    )
+    app.state.warm_up.start()
+    # Track the chats in flight, which the worker waits for before it stops
+    app.state.drain = Drain()
+    install_drain_signal_handler(app.state.drain)
+    yield
+    # Reject new chats, and let the ones in flight finish with the
+    # resources they use
+    app.state.drain.start()
+    await app.state.drain.wait(get_drain_timeout())
+    await app.state.warm_up.stop()
+    if app.state.session_store is not None:
+        app.state.session_store.close()
+    await close_upstream_pools()
+    shutdown_executor()
+    close_span_exporters()
+    mark_worker_stopped()
+
+
+app = FastAPI(lifespan=lifespan)
+token_auth_scheme = HTTPBearer()
+
+# Add prometheus ASGI middleware to route /metrics requests. It aggregates
+# the metrics of all the workers when PROMETHEUS_MULTIPROC_DIR is set, see
+# https://github.com/prometheus/client_python#multiprocess-mode-eg-gunicorn
+metrics_app = make_metrics_app()
 app.mount("/metrics", metrics_app)
 
 
@@ -47,16 +172,100 @@ def _get_origns() -> List[str]:
     return os.environ.get("ORIGINS", "http://localhost:3000").split(",")
 
 
-def _get_openai_model() -> str:
+def _get_batch_max_size() -> int:
     """
-    Get the OpenAI model that is used by the server.
+    Get the maximum number of requests in a batch.
 
     Returns
     -------
-    str
-        The OpenAI model that is used by the server.
+    int
+        The maximum number of requests in a batch.
+    """
+    return int(os.environ.get("CHAT_BATCH_MAX_SIZE", "100"))
+
+
+def _get_speculative_sanitize() -> bool:
+    """
+    Get whether the input of a chat is sanitized while the access token of
+    the user is verified, rather than once the chat is admitted.
+
+    Returns
+    -------
+    bool
+        Whether sanitize runs speculatively.
+    """
+    return os.environ.get("CHAT_SPECULATIVE_SANITIZE", "false").lower() == (
+        "true"
+    )
+
+
+def _get_batch_max_concurrency() -> int:
+    """
+    Get the maximum number of concurrent llm calls of a batch.
+
+    Returns
+    -------
+    int
+        The maximum number of concurrent llm calls of a batch.
+    """
+    return int(os.environ.get("CHAT_BATCH_MAX_CONCURRENCY", "8"))
+
+
+def _create_llm(model_name: str) -> "BaseLLM":
+    """
+    Create the LLM of a backend.
+
+    Parameters
+    ----------
+    model_name : str
+        The name of the backend.
+
+    Returns
+    -------
+    BaseLLM
+        The LLM that completes the prompts of the backend.
+    """
+    backends: BackendRegistry = app.state.backends
+    return backends.create_llm(model_name)
+
+
+def _load_pipeline(app: FastAPI) -> None:
+    """
+    Import the modules of the chat pipeline and build the runnables of the
+    configured backends and prompt template. This is slow and blocking, so it
+    runs on the executor, see `WarmUp`.
+
+    Parameters
+    ----------
+    app : FastAPI
+        The application whose pipeline is loaded.
+    """
+    import opchatserver.intermediate_outputs  # noqa: F401
+    import opchatserver.streaming  # noqa: F401
+
+    registry: ChainRegistry = app.state.chain_registry
+    backends: BackendRegistry = app.state.backends
+    for name in backends.backends:
+        registry.get(name, OPAQUEPROMPTS_TEMPLATE)
+
+
+async def _get_chain_registry(request: Request) -> ChainRegistry:
+    """
+    Get the registry of the LangChain runnables built when the server
+    started, waiting for the chat pipeline to be loaded.
+
+    Parameters
+    ----------
+    request : Request
+        The request being served.
+
+    Returns
+    -------
+    ChainRegistry
+        The runnables of each backend and prompt template.
     """
-    return os.environ.get("OPENAI_MODEL", "gpt-3.5-turbo")
+    await request.app.state.warm_up.load_pipeline()
+    return request.app.state.chain_registry
 
 
 app.add_middleware(
@@ -66,76 +275,660 @@ app.add_middleware(
     allow_methods=["*"],
     allow_headers=["*"],
 )
+app.add_middleware(UpstreamPoolsMiddleware)
+# Rejects new chats while the worker drains, see `draining.py`
+app.add_middleware(DrainMiddleware)
+# Gives each chat request a request ID and a trace, see `tracing.py`
+app.add_middleware(TracingMiddleware)
+# Added last, so that it measures the whole handling of the requests
+app.add_middleware(RequestMetricsMiddleware)
+
+
+def _get_single_flight(request: Request) -> Optional[SingleFlight]:
+    """
+    Get the coalescing of the identical chats in flight.
+
+    Parameters
+    ----------
+    request : Request
+        The incoming request.
+
+    Returns
+    -------
+    SingleFlight, optional
+        The coalescing of the chats, or None if it is disabled.
+    """
+    return request.app.state.single_flight
+
+
+def _get_session_store(request: Request) -> Optional[SessionStore]:
+    """
+    Get the store of the conversation sessions.
+
+    Parameters
+    ----------
+    request : Request
+        The incoming request.
+
+    Returns
+    -------
+    SessionStore, optional
+        The session store, or None if sessions are disabled.
+    """
+    return request.app.state.session_store
+
+
+def _get_history_window(request: Request, model: str) -> HistoryWindow:
+    """
+    Get the limits of the history used to complete a prompt with a model.
+
+    Parameters
+    ----------
+    request : Request
+        The incoming request.
+    model : str
+        The name of the model, see `Backend.model`.
+
+    Returns
+    -------
+    HistoryWindow
+        The history window of the model.
+    """
+    history_windows: Dict[
+        str, HistoryWindow
+    ] = request.app.state.history_windows
+    if model not in history_windows:
+        history_windows[model] = create_history_window(model)
+    return history_windows[model]
+
+
+def _route(
+    request: Request,
+    chain_registry: ChainRegistry,
+    prompt: str,
+    history: List[str],
+    token_payload: Dict[str, Any],
+) -> Tuple[Backend, ChatChains, "ConversationBufferWindowMemory"]:
+    """
+    Select the LLM backend of a chat, and build the memory of its history
+    within the history window of the backend.
+
+    Parameters
+    ----------
+    request : Request
+        The incoming request.
+    chain_registry : ChainRegistry
+        The runnables of each backend.
+    prompt : str
+        The prompt to be completed.
+    history : List[str]
+        The history of the conversation.
+    token_payload : Dict[str, Any]
+        The payload of the verified token of the request.
+
+    Returns
+    -------
+    (Backend, ChatChains, ConversationBufferWindowMemory)
+        The backend, its runnables and the memory of the conversation.
+    """
+    backends: BackendRegistry = request.app.state.backends
+    backend = backends.select(prompt, history, token_payload)
+    chains = chain_registry.get(backend.name, OPAQUEPROMPTS_TEMPLATE)
+    memory = _get_history_window(request, backend.model).build_memory(history)
+    return backend, chains, memory
+
+
+async def _prepare_chat(
+    request: Request,
+    chain_registry: ChainRegistry,
+    chat_request: ChatRequest,
+    session_store: Optional[SessionStore],
+    auth: "asyncio.Future[Dict[str, Any]]",
+) -> Tuple[Backend, ChatChains, "ConversationBufferWindowMemory"]:
+    """
+    Load the history of a chat, select its backend and build its memory,
+    only waiting for the verification of the access token of the user when
+    they depend on it: for a conversation kept by the server, or routes
+    which depend on the scopes of the user.
+
+    Parameters
+    ----------
+    request : Request
+        The incoming request.
+    chain_registry : ChainRegistry
+        The runnables of each backend.
+    chat_request : ChatRequest
+        The request body.
+    session_store : SessionStore, optional
+        The store of the conversations identified by a conversation_id.
+    auth : asyncio.Future
+        The verification of the access token, which returns its payload.
+
+    Returns
+    -------
+    (Backend, ChatChains, ConversationBufferWindowMemory)
+        The backend, its runnables and the memory of the conversation.
+    """
+    backends: BackendRegistry = request.app.state.backends
+    token_payload: Dict[str, Any] = {}
+    if chat_request.conversation_id is not None or backends.uses_scopes:
+        token_payload = await auth
+    with track_stage("memory"):
+        history = await _load_history(
+            chat_request, token_payload, session_store
+        )
+        return _route(
+            request,
+            chain_registry,
+            chat_request.prompt,
+            history,
+            token_payload,
+        )
+
+
+async def _during_auth(
+    auth: "asyncio.Future[Dict[str, Any]]", stage: Awaitable[T]
+) -> Tuple[Dict[str, Any], T]:
+    """
+    Run a stage of a chat while the access token of the user is verified.
+    The stage is cancelled if the token is rejected, and its own errors are
+    only raised once the token is verified, so that a request which is not
+    authorized always gets the error of its token.
+
+    Parameters
+    ----------
+    auth : asyncio.Future
+        The verification of the access token, which returns its payload.
+    stage : Awaitable
+        The stage.
+
+    Returns
+    -------
+    (Dict[str, Any], T)
+        The payload of the verified token and the result of the stage.
+    """
+    task = asyncio.ensure_future(stage)
+    pending: List["asyncio.Future[Any]"] = [auth, task]
+    try:
+        await asyncio.wait(pending, return_when=asyncio.FIRST_EXCEPTION)
+        token_payload = await auth
+        return token_payload, await task
+    finally:
+        if task.done() and not task.cancelled():
+            # Retrieve its error, if any, when the token was rejected
+            task.exception()
+        task.cancel()
+
+
+def _get_admission_controller(request: Request) -> AdmissionController:
+    """
+    Get the admission controller of the chat endpoints.
+
+    Parameters
+    ----------
+    request : Request
+        The incoming request.
+
+    Returns
+    -------
+    AdmissionController
+        The admission controller.
+    """
+    return request.app.state.admission_controller
+
+
+async def _acquire_admission(
+    admission_controller: AdmissionController, token_payload: Dict[str, Any]
+) -> str:
+    """
+    Wait until the request of a user is admitted. The admission must then be
+    released with the returned subject.
+
+    Parameters
+    ----------
+    admission_controller : AdmissionController
+        The admission controller.
+    token_payload : Dict[str, Any]
+        The payload of the verified token of the request.
+
+    Returns
+    -------
+    str
+        The subject of the request.
+    """
+    subject = str(token_payload.get("sub", ""))
+    try:
+        with trace_span("admission"):
+            await admission_controller.acquire(subject)
+    except AdmissionRejected as e:
+        raise HTTPException(
+            status_code=HTTPStatus.SERVICE_UNAVAILABLE,
+            detail=str(e),
+            headers={"Retry-After": str(e.retry_after)},
+        )
+    return subject
+
+
+def _get_speculative_subject(bearer_token: Any) -> str:
+    """
+    Get the subject under which the speculative sanitize call of a chat is
+    admitted. The call is made before the token is verified, so its subject
+    is derived from the token itself: the chats sent with the same token
+    share the per-subject limit, and the calls of forged tokens are still
+    bounded by the global limit.
+
+    Parameters
+    ----------
+    bearer_token : Any
+        The bearer token of the request.
+
+    Returns
+    -------
+    str
+        The subject of the speculative call.
+    """
+    credentials = str(getattr(bearer_token, "credentials", ""))
+    digest = hashlib.sha256(credentials.encode()).hexdigest()
+    return f"speculative:{digest[:32]}"
+
+
+@asynccontextmanager
+async def _admission(
+    admission_controller: AdmissionController, token_payload: Dict[str, Any]
+) -> AsyncIterator[None]:
+    """
+    Hold the admission of the request of a user for the duration of a block.
+
+    Parameters
+    ----------
+    admission_controller : AdmissionController
+        The admission controller.
+    token_payload : Dict[str, Any]
+        The payload of the verified token of the request.
+    """
+    subject = await _acquire_admission(admission_controller, token_payload)
+    try:
+        yield
+    finally:
+        admission_controller.release(subject)
+
+
+def _upstream_http_exception(error: UpstreamError) -> HTTPException:
+    """
+    Get the HTTP error of a failed upstream call: 504 if it timed out, and
+    503 with a Retry-After header if its circuit is open.
+
+    Parameters
+    ----------
+    error : UpstreamError
+        The error raised by the resilience layer.
+
+    Returns
+    -------
+    HTTPException
+        The HTTP error.
+    """
+    if isinstance(error, CircuitOpenError):
+        return HTTPException(
+            status_code=HTTPStatus.SERVICE_UNAVAILABLE,
+            detail=str(error),
+            headers={"Retry-After": str(error.retry_after)},
+        )
+    if isinstance(error, UpstreamTimeoutError):
+        return HTTPException(
+            status_code=HTTPStatus.GATEWAY_TIMEOUT, detail=str(error)
+        )
+    return HTTPException(status_code=HTTPStatus.BAD_GATEWAY, detail=str(error))
+
+
+async def _verify_token(bearer_token: Any) -> Dict[str, Any]:
+    """
+    Verify the bearer token of a request.
+
+    Parameters
+    ----------
+    bearer_token : Any
+        The bearer token, which is used to verify the user's identity.
+
+    Returns
+    -------
+    Dict[str, Any]
+        The payload of the verified token.
+    """
+    # This may fetch the JWKS, so it runs on the executor rather than on the
+    # event loop.
+    with track_stage("auth"):
+        return await run_in_executor(
+            VerifyToken(bearer_token.credentials).verify,
+            required_scopes=["use:opaque-prompts-chat-bot"],
+        )
+
+
+def _validate_history(chat_request: ChatRequest) -> None:
+    """
+    Validate the history of a chat request.
+
+    Parameters
+    ----------
+    chat_request : ChatRequest
+        The request body.
+    """
+    # `history` must be a list with an even number of strings,
+    # because each pair of strings represents
+    # a turn in the conversation. An example of a valid history is:
+    # `[HUMAN_MESSAGE1, BOT_RESPONSE1, HUMAN_MESSAGE2, BOT_RESPONSE2]`.
+    if (
+        not isinstance(chat_request.history, list)
+        or len(chat_request.history) % 2 != 0
+    ):
+        raise HTTPException(
+            status_code=400,
+            detail="history must be a list with an even number of strings",
+        )
+
+
+def _get_session_key(
+    token_payload: Dict[str, Any], conversation_id: str
+) -> str:
+    """
+    Get the key of a session in the session store. Sessions belong to the
+    user that created them, so the same conversation_id sent by another user
+    refers to another session.
+
+    Parameters
+    ----------
+    token_payload : Dict[str, Any]
+        The payload of the verified token of the request.
+    conversation_id : str
+        The conversation_id of the request.
+
+    Returns
+    -------
+    str
+        The key of the session.
+    """
+    return f"{token_payload.get('sub')}\0{conversation_id}"
+
+
+async def _load_history(
+    chat_request: ChatRequest,
+    token_payload: Dict[str, Any],
+    session_store: Optional[SessionStore],
+) -> List[str]:
+    """
+    Get the history of the conversation of a request, either from the
+    request itself or from its session.
+
+    Parameters
+    ----------
+    chat_request : ChatRequest
+        The request body.
+    token_payload : Dict[str, Any]
+        The payload of the verified token of the request.
+    session_store : SessionStore, optional
+        The store of the sessions, or None if sessions are disabled.
+
+    Returns
+    -------
+    List[str]
+        The history of the conversation.
+    """
+    if chat_request.conversation_id is None:
+        _validate_history(chat_request)
+        return chat_request.history  # type: ignore[return-value]
+    if session_store is None:
+        raise HTTPException(
+            status_code=400,
+            detail="conversation_id is not supported by this server",
+        )
+    if chat_request.history:
+        raise HTTPException(
+            status_code=400,
+            detail="history must be omitted when conversation_id is set",
+        )
+    return await session_store.aget(
+        _get_session_key(token_payload, chat_request.conversation_id)
+    )
+
+
+async def _save_turn(
+    chat_request: ChatRequest,
+    token_payload: Dict[str, Any],
+    session_store: Optional[SessionStore],
+    response: str,
+) -> None:
+    """
+    Add a turn to the session of a request, if it has one.
+
+    Parameters
+    ----------
+    chat_request : ChatRequest
+        The request body.
+    token_payload : Dict[str, Any]
+        The payload of the verified token of the request.
+    session_store : SessionStore, optional
+        The store of the sessions, or None if sessions are disabled.
+    response : str
+        The desanitized response to the prompt of the request.
+    """
+    if chat_request.conversation_id is None or session_store is None:
+        return
+    await session_store.aappend(
+        _get_session_key(token_payload, chat_request.conversation_id),
+        chat_request.prompt,
+        response,
+    )
+
+
+def _get_conversation_key(
+    token_payload: Dict[str, Any], chat_request: ChatRequest
+) -> str:
+    """
+    Identify the conversation of a request by its user and either its
+    conversation_id or its first message, which stays the same as the
+    conversation goes on.
+
+    Parameters
+    ----------
+    token_payload : Dict[str, Any]
+        The payload of the verified token of the request.
+    chat_request : ChatRequest
+        The request body.
+
+    Returns
+    -------
+    str
+        The key of the conversation.
+    """
+    if chat_request.conversation_id is not None:
+        conversation = f"id:{chat_request.conversation_id}"
+    else:
+        history = chat_request.history or []
+        first_message = history[0] if history else chat_request.prompt
+        conversation = f"message:{first_message}"
+    return hashlib.sha256(
+        f"{token_payload.get('sub')}\0{conversation}".encode()
+    ).hexdigest()
+
+
+@app.get("/ready")
+async def ready(request: Request) -> FastJSONResponse:
+    """
+    Readiness endpoint for load balancers and orchestrators. The worker is
+    ready once it has loaded the chat pipeline and prefetched the JWKS, and
+    until it starts draining before it stops.
+
+    Parameters
+    ----------
+    request : Request
+        The incoming request.
+
+    Returns
+    -------
+    FastJSONResponse
+        200 if the worker is ready and 503 otherwise, with the state of each
+        step of the warm-up and whether the worker is draining.
+    """
+    warm_up: WarmUp = request.app.state.warm_up
+    drain: Drain = request.app.state.drain
+    is_ready = warm_up.ready and not drain.draining
+    return FastJSONResponse(
+        {
+            "ready": is_ready,
+            "steps": warm_up.done,
+            "draining": drain.draining,
+        },
+        status_code=(
+            HTTPStatus.OK if is_ready else HTTPStatus.SERVICE_UNAVAILABLE
+        ),
+    )
 
 
-@app.post("/chat")
+@app.post("/chat", response_model=ChatResponse)
 async def chat(
+    request: Request,
     chat_request: ChatRequest,
     bearer_token: Any = Depends(token_auth_scheme),
-) -> ChatResponse:
+    chain_registry: ChainRegistry = Depends(_get_chain_registry),
+    session_store: Optional[SessionStore] = Depends(_get_session_store),
+    admission_controller: AdmissionController = Depends(
+        _get_admission_controller
+    ),
+    single_flight: Optional[SingleFlight] = Depends(_get_single_flight),
+) -> FastJSONResponse:
     """
     Secure chat endpoint that uses OpaquePrompts to protect the user's privacy.
+    While a chat is in flight, the identical chats of the same user wait for
+    its response rather than running the chat pipeline again.
 
     Parameters
     ----------
+    request : Request
+        The incoming request.
     chat_request : ChatRequest
         The request body, which contains the history of the conversation
         and the prompt to be completed.
     bearer_token : Any, optional
         The bearer token, which is used to verify the user's identity.
+    chain_registry : ChainRegistry, optional
+        The LangChain runnables of each backend and prompt template.
+    session_store : SessionStore, optional
+        The store of the conversations identified by a conversation_id.
+    admission_controller : AdmissionController, optional
+        Bounds the chats handled at once.
+    single_flight : SingleFlight, optional
+        Coalesces the identical chats in flight, unless it is disabled.
 
     Returns
     -------
-    ChatResponse
-        The response body, which contains the bot's response to the prompt.
-        If `with_intermediate_outputs` is `True`, then the response body
-        also contains the intermediate outputs from OpaquePrompts and LLM.
+    FastJSONResponse
+        The ChatResponse body, which contains the bot's response to the
+        prompt. If `with_intermediate_outputs` is `True`, then the response
+        body also contains the intermediate outputs from OpaquePrompts and
+        LLM, and the time taken by each stage if `with_timings` is `True`.
     """
-    start = time.time()
+    trace = (
+        current_trace()
+        if chat_request.with_intermediate_outputs and chat_request.with_timings
+        else None
+    )
+    if trace is not None:
+        # The stages are recorded from now on, even if the request is not
+        # sampled
+        trace.recording = True
+    # The stages of the chat start as soon as their inputs are ready: the
+    # token is verified while the memory is built and, if enabled, while
+    # the input is sanitized
+    auth = asyncio.ensure_future(_verify_token(bearer_token))
     try:
-        # Verify bearer_token
-        VerifyToken(bearer_token.credentials).verify(
-            required_scopes=["use:opaque-prompts-chat-bot"]
-        )
 
-        # `history` must be a list with an even number of strings,
-        # because each pair of strings represents
-        # a turn in the conversation. An example of a valid history is:
-        # `[HUMAN_MESSAGE1, BOT_RESPONSE1, HUMAN_MESSAGE2, BOT_RESPONSE2]`.
-        if (
-            not isinstance(chat_request.history, list)
-            or len(chat_request.history) % 2 != 0
-        ):
-            raise HTTPException(
-                status_code=400,
-                detail="history must be a list with an even number of strings",
-            )
-        prompt = PromptTemplate.from_template(OPAQUEPROMPTS_TEMPLATE)
-        memory = build_memory(chat_request.history)
-
-        if chat_request.with_intermediate_outputs:
-            return get_response(
-                prompt=prompt,
-                memory=memory,
-                input=chat_request.prompt,
-                llm=OpenAI(model_name=_get_openai_model()),
+        async def prepare() -> Tuple[
+            Backend,
+            ChatChains,
+            "ConversationBufferWindowMemory",
+            Optional[Dict[str, Any]],
+        ]:
+            backend, chains, memory = await _prepare_chat(
+                request, chain_registry, chat_request, session_store, auth
             )
+            sanitized = None
+            if (
+                chat_request.with_intermediate_outputs
+                and _get_speculative_sanitize()
+            ):
+                # Loaded by `_get_chain_registry`
+                from opchatserver.intermediate_outputs import asanitize
 
-        # This is the typical case for the OpaquePrompts LangChain integration.
-        # We can get security from OpaquePrompts by simply wrapping the LLM,
-        # e.g. `llm=OpenAI()` -> `llm=OpaquePrompts(base_llm=OpenAI())`.
-        #
-        # More about the LangChain integration can be found here:
-        # https://python.langchain.com/docs/integrations/llms/opaqueprompts
-        chain = LLMChain(
-            prompt=prompt,
-            llm=OpaquePrompts(base_llm=OpenAI(model_name=_get_openai_model())),
-            memory=memory,
-        )
-        return ChatResponse(desanitizedResponse=chain.run(chat_request.prompt))
+                # The speculative call only runs if it can be admitted right
+                # away, and holds its admission while it runs. Otherwise,
+                # the input is sanitized once the chat is admitted.
+                subject = _get_speculative_subject(bearer_token)
+                if admission_controller.try_acquire(subject):
+                    try:
+                        # The conversation key is only known once the token
+                        # is verified, so the sanitization cache is not used
+                        sanitized = await asanitize(
+                            memory, chat_request.prompt
+                        )
+                    finally:
+                        admission_controller.release(subject)
+            return backend, chains, memory, sanitized
+
+        token_payload, (
+            backend,
+            chains,
+            memory,
+            sanitized,
+        ) = await _during_auth(auth, prepare())
+
+        async def complete() -> ChatResponse:
+            async with _admission(admission_controller, token_payload):
+                if chat_request.with_intermediate_outputs:
+                    # Loaded by `_get_chain_registry`
+                    from opchatserver.intermediate_outputs import aget_response
+
+                    response = await aget_response(
+                        pg_chain=chains.intermediate_output_chain,
+                        memory=memory,
+                        input=chat_request.prompt,
+                        conversation_key=_get_conversation_key(
+                            token_payload, chat_request
+                        ),
+                        inputs_after_sanitize=sanitized,
+                        subject=str(token_payload.get("sub", "")),
+                    )
+                else:
+                    response = await _get_opaqueprompts_response(
+                        chains, memory, chat_request.prompt
+                    )
+                await _save_turn(
+                    chat_request,
+                    token_payload,
+                    session_store,
+                    response.desanitized_response,
+                )
+            response.model = backend.name
+            return response
+
+        if single_flight is None:
+            response = await complete()
+        else:
+            key = coalescing_key(
+                str(token_payload.get("sub", "")),
+                backend.name,
+                chat_request.model_dump_json(),
+            )
+            response = await single_flight.run(key, complete)
+        if trace is not None:
+            # The response may be shared with identical chats
+            response = response.model_copy(update={"timings": trace.timings()})
+        return FastJSONResponse(response)
     except HTTPException as e:
         logger.exception(e)
         raise e
+    except UpstreamError as e:
+        logger.exception(e)
+        raise _upstream_http_exception(e)
     except Exception as e:
         logger.exception(e)
         raise HTTPException(
@@ -143,7 +936,280 @@ async def chat(
             detail=str(e),
         )
     finally:
-        h.observe(start - time.time())
+        auth.cancel()
+
+
+async def _get_opaqueprompts_response(
+    chains: ChatChains, memory: "ConversationBufferWindowMemory", prompt: str
+) -> ChatResponse:
+    """
+    Get the response to a prompt without intermediate outputs.
+
+    Parameters
+    ----------
+    chains : ChatChains
+        The LangChain runnables of the backend of the chat.
+    memory : ConversationBufferWindowMemory
+        The memory of the conversation.
+    prompt : str
+        The prompt to be completed.
+
+    Returns
+    -------
+    ChatResponse
+        The desanitized response to the prompt.
+    """
+    # This is the typical case for the OpaquePrompts LangChain integration.
+    # We can get security from OpaquePrompts by simply wrapping the LLM,
+    # e.g. `llm=OpenAI()` -> `llm=OpaquePrompts(base_llm=OpenAI())`.
+    #
+    # More about the LangChain integration can be found here:
+    # https://python.langchain.com/docs/integrations/llms/opaqueprompts
+    #
+    # The chain is shared across requests, so the conversation history
+    # is passed as an input rather than through a memory in the chain.
+    with track_stage("opaqueprompts"):
+        return ChatResponse(
+            desanitizedResponse=await chains.opaqueprompts_chain.ainvoke(
+                {"prompt": prompt, "history": memory.buffer}
+            )
+        )
+
+
+@app.post("/chat/stream")
+async def chat_stream(
+    request: Request,
+    chat_request: ChatRequest,
+    bearer_token: Any = Depends(token_auth_scheme),
+    chain_registry: ChainRegistry = Depends(_get_chain_registry),
+    session_store: Optional[SessionStore] = Depends(_get_session_store),
+    admission_controller: AdmissionController = Depends(
+        _get_admission_controller
+    ),
+) -> StreamingResponse:
+    """
+    Secure chat endpoint that streams the response as Server-Sent Events,
+    desanitizing it as the LLM generates it.
+
+    Parameters
+    ----------
+    request : Request
+        The incoming request.
+    chat_request : ChatRequest
+        The request body, which contains the history of the conversation
+        and the prompt to be completed.
+    bearer_token : Any, optional
+        The bearer token, which is used to verify the user's identity.
+    chain_registry : ChainRegistry, optional
+        The LangChain runnables of each backend and prompt template.
+    session_store : SessionStore, optional
+        The store of the conversations identified by a conversation_id.
+    admission_controller : AdmissionController, optional
+        Bounds the chats handled at once. The admission of the request is
+        held until its stream ends.
+
+    Returns
+    -------
+    StreamingResponse
+        A text/event-stream response, whose X-Model header names the backend
+        which completes the prompt. `token` events carry the desanitized
+        response as it is generated. If `with_intermediate_outputs` is
+        `True`, the stream also contains a `sanitizedPrompt` event before
+        the tokens and a `rawResponse` event after them. The stream ends
+        with a `done` event, or an `error` event if the generation failed.
+    """
+    # The token is verified while the memory is built
+    auth = asyncio.ensure_future(_verify_token(bearer_token))
+    try:
+        token_payload, (backend, chains, memory) = await _during_auth(
+            auth,
+            _prepare_chat(
+                request, chain_registry, chat_request, session_store, auth
+            ),
+        )
+        subject = await _acquire_admission(admission_controller, token_payload)
+    except HTTPException as e:
+        logger.exception(e)
+        raise e
+    finally:
+        auth.cancel()
+
+    async def save_turn(response: str) -> None:
+        await _save_turn(chat_request, token_payload, session_store, response)
+
+    # Loaded by `_get_chain_registry`
+    from opchatserver.streaming import astream_response
+
+    events = astream_response(
+        completion_chain=chains.completion_chain,
+        uncached_completion_chain=chains.uncached_completion_chain,
+        memory=memory,
+        input=chat_request.prompt,
+        with_intermediate_outputs=chat_request.with_intermediate_outputs,
+        conversation_key=_get_conversation_key(token_payload, chat_request),
+        on_complete=save_turn,
+    )
+    return StreamingResponse(
+        events,
+        media_type="text/event-stream",
+        # Ask proxies not to buffer the stream
+        headers={
+            "Cache-Control": "no-cache",
+            "X-Accel-Buffering": "no",
+            "X-Model": backend.name,
+        },
+        # Runs once the stream has ended, even if the client disconnected
+        background=BackgroundTask(admission_controller.release, subject),
+    )
+
+
+@app.post("/chat/batch", response_model=ChatBatchResponse)
+async def chat_batch(
+    request: Request,
+    batch_request: ChatBatchRequest,
+    bearer_token: Any = Depends(token_auth_scheme),
+    chain_registry: ChainRegistry = Depends(_get_chain_registry),
+    session_store: Optional[SessionStore] = Depends(_get_session_store),
+    admission_controller: AdmissionController = Depends(
+        _get_admission_controller
+    ),
+) -> FastJSONResponse:
+    """
+    Secure chat endpoint that completes several prompts of the same user in
+    one request. The prompts are sanitized in a single call to OpaquePrompts,
+    and completed concurrently.
+
+    Parameters
+    ----------
+    request : Request
+        The incoming request.
+    batch_request : ChatBatchRequest
+        The request body, which contains the chat requests, each with the
+        same fields as the body of `/chat`.
+    bearer_token : Any, optional
+        The bearer token, which is used to verify the user's identity.
+    chain_registry : ChainRegistry, optional
+        The LangChain runnables of each backend and prompt template.
+    session_store : SessionStore, optional
+        The store of the conversations identified by a conversation_id.
+    admission_controller : AdmissionController, optional
+        Bounds the chats handled at once. A batch is admitted as one chat,
+        whose llm calls are bounded by CHAT_BATCH_MAX_CONCURRENCY.
+
+    Returns
+    -------
+    FastJSONResponse
+        The ChatBatchResponse body, which contains a result for each chat
+        request, in order. Each result has the status code the request would
+        have had on its own, and either the response that `/chat` would
+        have returned or the detail of the error.
+    """
+    try:
+        token_payload = await _verify_token(bearer_token)
+        max_size = _get_batch_max_size()
+        if len(batch_request.requests) > max_size:
+            raise HTTPException(
+                status_code=400,
+                detail=f"a batch may contain at most {max_size} requests",
+            )
+    except HTTPException as e:
+        logger.exception(e)
+        raise e
+
+    chat_requests = batch_request.requests
+    items: Dict[int, ChatBatchItem] = {}
+    inputs: Dict[int, Dict[str, Any]] = {}
+    routes: Dict[int, Tuple[Backend, ChatChains]] = {}
+    for i, chat_request in enumerate(chat_requests):
+        try:
+            with track_stage("memory"):
+                history = await _load_history(
+                    chat_request, token_payload, session_store
+                )
+                backend, chains, memory = _route(
+                    request,
+                    chain_registry,
+                    chat_request.prompt,
+                    history,
+                    token_payload,
+                )
+        except HTTPException as e:
+            items[i] = ChatBatchItem(statusCode=e.status_code, detail=e.detail)
+            continue
+        inputs[i] = {
+            "prompt": chat_request.prompt,
+            "history": memory.buffer_as_messages,
+        }
+        routes[i] = (backend, chains)
+
+    if inputs:
+        # Loaded by `_get_chain_registry`
+        from opchatserver.intermediate_outputs import (
+            ChatContext,
+            asanitize_batch,
+        )
+
+        # The requests may be routed to the chains of different backends,
+        # so their llm calls are bounded here rather than by the
+        # max_concurrency of `abatch` on a single chain
+        semaphore = asyncio.Semaphore(_get_batch_max_concurrency())
+
+        async def complete(
+            chains: ChatChains, sanitized_input: Dict[str, Any]
+        ) -> Any:
+            async with semaphore:
+                # The sanitize stage is skipped for inputs_after_sanitize
+                return await chains.intermediate_output_chain.arun(
+                    ChatContext({"inputs_after_sanitize": sanitized_input})
+                )
+
+        outputs: List[Any]
+        async with _admission(admission_controller, token_payload):
+            try:
+                # The requests belong to the same user, so they can share
+                # the secure context of a single sanitize call
+                sanitized_inputs = await asanitize_batch(list(inputs.values()))
+                # Each request is completed by the chains of its backend
+                outputs = await asyncio.gather(
+                    *(
+                        complete(routes[i][1], sanitized_input)
+                        for i, sanitized_input in zip(inputs, sanitized_inputs)
+                    ),
+                    return_exceptions=True,
+                )
+            except Exception as e:
+                logger.exception(e)
+                outputs = [e] * len(inputs)
+        for i, output in zip(inputs, outputs):
+            if isinstance(output, Exception):
+                logger.error("Batch request %d failed", i, exc_info=output)
+                items[i] = ChatBatchItem(
+                    statusCode=(
+                        _upstream_http_exception(output).status_code
+                        if isinstance(output, UpstreamError)
+                        else HTTPStatus.INTERNAL_SERVER_ERROR
+                    ),
+                    detail=str(output),
+                )
+                continue
+            response = output.response(
+                chat_requests[i].with_intermediate_outputs
+            )
+            response.model = routes[i][0].name
+            await _save_turn(
+                chat_requests[i],
+                token_payload,
+                session_store,
+                response.desanitized_response,
+            )
+            items[i] = ChatBatchItem(
+                statusCode=HTTPStatus.OK, response=response
+            )
+    return FastJSONResponse(
+        ChatBatchResponse(
+            responses=[items[i] for i in range(len(chat_requests))]
+        )
+    )
 
 
 # Validate required env vars
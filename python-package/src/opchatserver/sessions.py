@@ -0,0 +1,254 @@
+"""
+This module contains the stores of server-side conversation sessions, which
+let a client send a `conversation_id` and the new prompt rather than the
+whole history of the conversation on every turn.
+
+Only the last turns used by the memory of the chains are kept, so a session
+costs the same to load however long the conversation gets.
+"""
+import abc
+import os
+import sqlite3
+import threading
+import time
+from typing import List, Optional, Tuple
+
+from opchatserver.cache import TTLCache
+from opchatserver.executor import run_in_executor
+from opchatserver.memory import get_history_max_turns
+
+
+class SessionStore(abc.ABC):
+    """
+    The base class of the session stores. A session is the history of a
+    conversation, as a list of alternating human and AI messages.
+
+    The synchronous methods may block, so the asynchronous ones run them on
+    the executor unless a subclass knows better.
+    """
+
+    def __init__(self, max_turns: int = 20):
+        """
+        Parameters
+        ----------
+        max_turns : int, optional
+            The number of turns kept per session, by default 20, which is
+            the default maximum number of turns of the history window, see
+            `create_history_window`.
+        """
+        if max_turns <= 0:
+            raise ValueError("max_turns must be greater than 0")
+        self.max_turns = max_turns
+
+    @abc.abstractmethod
+    def get(self, session_key: str) -> List[str]:
+        """
+        Get the history of a session.
+
+        Parameters
+        ----------
+        session_key : str
+            Identifies the session.
+
+        Returns
+        -------
+        List[str]
+            The last turns of the session, or an empty list if the session
+            does not exist or has expired.
+        """
+
+    @abc.abstractmethod
+    def append(self, session_key: str, prompt: str, response: str) -> None:
+        """
+        Add a turn to a session, creating the session if needed.
+
+        Parameters
+        ----------
+        session_key : str
+            Identifies the session.
+        prompt : str
+            The prompt of the user.
+        response : str
+            The desanitized response to the prompt.
+        """
+
+    def close(self) -> None:
+        """Release the resources of the store."""
+
+    async def aget(self, session_key: str) -> List[str]:
+        """Asynchronous version of `get`."""
+        return await run_in_executor(self.get, session_key)
+
+    async def aappend(
+        self, session_key: str, prompt: str, response: str
+    ) -> None:
+        """Asynchronous version of `append`."""
+        await run_in_executor(self.append, session_key, prompt, response)
+
+
+class InMemorySessionStore(SessionStore):
+    """
+    Keeps the sessions in the memory of the worker, evicting the least
+    recently used ones. Sessions are lost when the worker restarts and are
+    not shared between workers.
+    """
+
+    def __init__(
+        self,
+        max_turns: int = 20,
+        max_sessions: int = 10000,
+        ttl: float = 86400,
+    ):
+        """
+        Parameters
+        ----------
+        max_turns : int, optional
+            The number of turns kept per session, by default 20.
+        max_sessions : int, optional
+            The maximum number of sessions, by default 10000.
+        ttl : float, optional
+            The number of seconds a session is kept after its last turn, by
+            default 86400.
+        """
+        super().__init__(max_turns)
+        # Histories are immutable, so they can be read without the lock
+        self._sessions: TTLCache[Tuple[str, ...]] = TTLCache(
+            maxsize=max_sessions, ttl=ttl
+        )
+        self._lock = threading.Lock()
+
+    def get(self, session_key: str) -> List[str]:
+        return list(self._sessions.get(session_key) or ())
+
+    def append(self, session_key: str, prompt: str, response: str) -> None:
+        with self._lock:
+            history = self._sessions.get(session_key) or ()
+            history = (history + (prompt, response))[-2 * self.max_turns :]
+            self._sessions.set(session_key, history)
+
+    async def aget(self, session_key: str) -> List[str]:
+        # Nothing blocks, so there is no need for the executor
+        return self.get(session_key)
+
+    async def aappend(
+        self, session_key: str, prompt: str, response: str
+    ) -> None:
+        self.append(session_key, prompt, response)
+
+
+class SQLiteSessionStore(SessionStore):
+    """
+    Keeps the sessions in a SQLite database, so that they survive restarts
+    and are shared by the workers of one machine.
+    """
+
+    def __init__(self, path: str, max_turns: int = 20, ttl: float = 86400):
+        """
+        Parameters
+        ----------
+        path : str
+            The path of the database file, created if it does not exist.
+        max_turns : int, optional
+            The number of turns kept per session, by default 20.
+        ttl : float, optional
+            The number of seconds a session is kept after its last turn, by
+            default 86400.
+        """
+        super().__init__(max_turns)
+        self.ttl = ttl
+        # The connection is shared by the threads of the executor, and
+        # guarded by the lock
+        self._connection = sqlite3.connect(
+            path, timeout=30, check_same_thread=False, isolation_level=None
+        )
+        self._lock = threading.Lock()
+        with self._lock:
+            self._connection.execute("PRAGMA journal_mode=WAL")
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS turns ("
+                " session_key TEXT NOT NULL,"
+                " turn INTEGER NOT NULL,"
+                " prompt TEXT NOT NULL,"
+                " response TEXT NOT NULL,"
+                " updated REAL NOT NULL,"
+                " PRIMARY KEY (session_key, turn))"
+            )
+            self._connection.execute(
+                "CREATE INDEX IF NOT EXISTS turns_updated ON turns (updated)"
+            )
+
+    def get(self, session_key: str) -> List[str]:
+        with self._lock:
+            rows = self._connection.execute(
+                "SELECT prompt, response FROM turns"
+                " WHERE session_key = ? AND updated > ?"
+                " ORDER BY turn DESC LIMIT ?",
+                (session_key, time.time() - self.ttl, self.max_turns),
+            ).fetchall()
+        return [message for row in reversed(rows) for message in row]
+
+    def append(self, session_key: str, prompt: str, response: str) -> None:
+        now = time.time()
+        with self._lock:
+            with self._connection:
+                self._connection.execute("BEGIN IMMEDIATE")
+                (turn,) = self._connection.execute(
+                    "SELECT COALESCE(MAX(turn), -1) + 1 FROM turns"
+                    " WHERE session_key = ?",
+                    (session_key,),
+                ).fetchone()
+                self._connection.execute(
+                    "INSERT INTO turns VALUES (?, ?, ?, ?, ?)",
+                    (session_key, turn, prompt, response, now),
+                )
+                self._connection.execute(
+                    "DELETE FROM turns WHERE session_key = ? AND turn <= ?",
+                    (session_key, turn - self.max_turns),
+                )
+                # Refresh the time-to-live of the whole session
+                self._connection.execute(
+                    "UPDATE turns SET updated = ? WHERE session_key = ?",
+                    (now, session_key),
+                )
+                self._connection.execute(
+                    "DELETE FROM turns WHERE updated <= ?", (now - self.ttl,)
+                )
+
+    def close(self) -> None:
+        with self._lock:
+            self._connection.close()
+
+
+def create_session_store() -> Optional[SessionStore]:
+    """
+    Create the session store configured with the SESSION_STORE environment
+    variable.
+
+    Returns
+    -------
+    SessionStore, optional
+        The store, or None if sessions are disabled.
+    """
+    kind = os.environ.get("SESSION_STORE", "memory").lower()
+    # Keep as many turns as the history window may use
+    max_turns = int(
+        os.environ.get("SESSION_MAX_TURNS", str(get_history_max_turns()))
+    )
+    ttl = float(os.environ.get("SESSION_TTL", "86400"))
+    if kind == "none":
+        return None
+    if kind == "memory":
+        return InMemorySessionStore(
+            max_turns=max_turns,
+            max_sessions=int(os.environ.get("SESSION_MAX_SESSIONS", "10000")),
+            ttl=ttl,
+        )
+    if kind == "sqlite":
+        return SQLiteSessionStore(
+            os.environ.get("SESSION_STORE_PATH", "sessions.db"),
+            max_turns=max_turns,
+            ttl=ttl,
+        )
+    raise ValueError(
+        f"SESSION_STORE must be one of none, memory or sqlite, not {kind}"
+    )
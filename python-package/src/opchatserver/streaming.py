@@ -0,0 +1,241 @@
+"""
+This module streams chat responses as Server-Sent Events. The response of
+the LLM is desanitized as it is generated, taking care of placeholders that
+are split across the chunks of the stream.
+"""
+import asyncio
+import logging
+import re
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, Optional
+
+from langchain.memory import ConversationBufferWindowMemory
+from langchain.schema.runnable import Runnable
+from opchatserver.executor import run_in_executor
+from opchatserver.intermediate_outputs import _asanitize
+from opchatserver.metrics import track_stage
+from opchatserver.placeholders import PLACEHOLDER_PATTERN
+from opchatserver.prescreen import CLEAN_SECURE_CONTEXT
+from opchatserver.resilience import get_stage_policy
+from opchatserver.responses import dumps
+from opchatserver.sanitization_cache import SecureContext, desanitize
+
+logger = logging.getLogger(__name__)
+
+# The end of a text which may be the start of a placeholder (see
+# `PLACEHOLDER_PATTERN`) that is completed by the next chunk. Other text,
+# e.g. lower-case words or text without spaces, is released right away.
+_PLACEHOLDER_PREFIX_PATTERN = re.compile(r"(?:[A-Z][A-Z_]*(?:_\d*)?)?\Z")
+
+
+class PlaceholderSafeBuffer:
+    """
+    Buffers the chunks of a sanitized stream so that only text which cannot
+    end in the middle of a placeholder is released for desanitization.
+    """
+
+    def __init__(self) -> None:
+        self._pending = ""
+
+    def push(self, chunk: str) -> str:
+        """
+        Add a chunk of the stream to the buffer.
+
+        Parameters
+        ----------
+        chunk : str
+            The next chunk of the sanitized stream.
+
+        Returns
+        -------
+        str
+            The buffered text up to the start of a possible placeholder at
+            its end, which is safe to desanitize. It may be empty.
+        """
+        text = self._pending + chunk
+        match = _PLACEHOLDER_PREFIX_PATTERN.search(text)
+        # The pattern matches the end of any text
+        assert match is not None
+        split = match.start()
+        self._pending = text[split:]
+        return text[:split]
+
+    def flush(self) -> str:
+        """
+        Release the rest of the buffer, at the end of the stream.
+
+        Returns
+        -------
+        str
+            The text that was held back.
+        """
+        text, self._pending = self._pending, ""
+        return text
+
+
+def format_sse(event: str, data: Dict[str, Any]) -> bytes:
+    """
+    Format a Server-Sent Event.
+
+    Parameters
+    ----------
+    event : str
+        The name of the event.
+    data : dict
+        The payload of the event, which is sent as JSON.
+
+    Returns
+    -------
+    bytes
+        The event in the text/event-stream format, encoded in UTF-8 so that
+        the response does not encode it again.
+    """
+    return b"event: %s\ndata: %s\n\n" % (event.encode(), dumps(data))
+
+
+async def astream_response(
+    completion_chain: Runnable,
+    uncached_completion_chain: Runnable,
+    memory: ConversationBufferWindowMemory,
+    input: str,
+    with_intermediate_outputs: bool = True,
+    conversation_key: Optional[str] = None,
+    on_complete: Optional[Callable[[str], Awaitable[None]]] = None,
+) -> AsyncIterator[bytes]:
+    """
+    Stream a chat response as Server-Sent Events.
+
+    The stream contains, in order:
+    - a `sanitizedPrompt` event, if `with_intermediate_outputs` is True,
+      with the decision of the local pre-screen when it is enabled,
+    - `token` events with the desanitized text generated by the llm,
+    - a `rawResponse` event, if `with_intermediate_outputs` is True,
+    - a `done` event, or an `error` event if the generation failed.
+
+    Parameters
+    ----------
+    completion_chain : Runnable
+        the chain which formats the sanitized input with the prompt template
+        and streams the response of the llm as strings
+    uncached_completion_chain : Runnable
+        the same chain without the response cache, which streams the
+        response to the inputs that the local pre-screen finds clean, since
+        they are not sanitized
+    memory : ConversationBufferWindowMemory
+        memory that stores the conversation history
+    input : str
+        the user input message
+    with_intermediate_outputs : bool, optional
+        whether to send the intermediate outputs, by default True
+    conversation_key : str, optional
+        identifies the conversation, so that its turns can be taken from the
+        sanitization cache when it is enabled
+    on_complete : callable, optional
+        awaited with the whole desanitized response once it has been
+        generated, before the `done` event
+
+    Returns
+    -------
+    AsyncIterator[bytes]
+        The events of the stream.
+    """
+    try:
+        sanitize_response = await _asanitize(
+            {
+                "prompt": input,
+                "history": memory.buffer_as_messages,
+                "conversation_key": conversation_key,
+            }
+        )
+        sanitized_input = sanitize_response["sanitized_input"]
+        secure_context = sanitize_response["secure_context"]
+        if with_intermediate_outputs:
+            event = {"text": sanitized_input["prompt"]}
+            if "pre_screen" in sanitize_response:
+                event["preScreen"] = sanitize_response["pre_screen"]
+            yield format_sse("sanitizedPrompt", event)
+
+        raw_chunks = []
+        desanitized_chunks = []
+        buffer = PlaceholderSafeBuffer()
+        if secure_context is CLEAN_SECURE_CONTEXT:
+            completion_chain = uncached_completion_chain
+        stream = completion_chain.astream(sanitized_input)
+        async for chunks in _coalesce(stream):
+            raw_chunks.append(chunks)
+            text = await _desanitize_segment(
+                buffer.push(chunks), secure_context
+            )
+            if text:
+                desanitized_chunks.append(text)
+                yield format_sse("token", {"text": text})
+        text = await _desanitize_segment(buffer.flush(), secure_context)
+        if text:
+            desanitized_chunks.append(text)
+            yield format_sse("token", {"text": text})
+        if on_complete is not None:
+            await on_complete("".join(desanitized_chunks))
+
+        if with_intermediate_outputs:
+            yield format_sse("rawResponse", {"text": "".join(raw_chunks)})
+        yield format_sse("done", {})
+    except Exception as e:
+        # The response has already started, so errors are reported in-band
+        logger.exception(e)
+        yield format_sse("error", {"detail": str(e)})
+
+
+async def _desanitize_segment(
+    segment: str, secure_context: SecureContext
+) -> str:
+    """
+    Helper function which desanitizes a segment of the stream. Segments
+    without any placeholder, or of an input that was not sanitized, are
+    returned as is, without calling the OpaquePrompts service.
+    """
+    if (
+        not segment
+        or secure_context is CLEAN_SECURE_CONTEXT
+        or not PLACEHOLDER_PATTERN.search(segment)
+    ):
+        return segment
+    with track_stage("desanitize"):
+        return await get_stage_policy("desanitize").call(
+            lambda: run_in_executor(desanitize, segment, secure_context)
+        )
+
+
+async def _coalesce(stream: AsyncIterator[str]) -> AsyncIterator[str]:
+    """
+    Helper function which reads `stream` in the background and yields, at
+    each step, all the chunks received since the previous step. While the
+    consumer waits on a desanitize call, chunks accumulate and are then
+    desanitized together.
+    """
+    queue: "asyncio.Queue[Optional[str]]" = asyncio.Queue()
+    error: Optional[BaseException] = None
+
+    async def produce() -> None:
+        nonlocal error
+        try:
+            async for chunk in stream:
+                queue.put_nowait(chunk)
+        except BaseException as e:
+            error = e
+        finally:
+            queue.put_nowait(None)
+
+    producer = asyncio.create_task(produce())
+    try:
+        done = False
+        while not done:
+            chunks = [await queue.get()]
+            while not queue.empty():
+                chunks.append(queue.get_nowait())
+            done = chunks[-1] is None
+            text = "".join(chunk for chunk in chunks if chunk is not None)
+            if text:
+                yield text
+        if error is not None:
+            raise error
+    finally:
+        producer.cancel()
@@ -0,0 +1,579 @@
+"""
+This module contains the request tracing of the chat server. Every chat
+request gets a request ID, returned in the X-Request-ID header, and a trace
+whose spans time the stages of the chat pipeline: auth (including the JWKS
+fetch), memory, admission, sanitize, llm and desanitize.
+
+Tracing is disabled by default. When TRACING_EXPORTER is set, the traces of
+the sampled requests are exported in the OTLP/JSON format of OpenTelemetry,
+on a background thread, either to a file or to the HTTP endpoint of a
+collector. The current span is kept in a context variable, so that the
+stages find their parent without it being passed around; while a request is
+not recorded, a stage only costs a lookup of that variable.
+"""
+import json
+import os
+import queue
+import random
+import re
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
+
+import requests
+from prometheus_client import Counter
+
+# The endpoints whose requests are traced
+TRACED_ENDPOINTS = frozenset(["/chat", "/chat/stream", "/chat/batch"])
+
+# The accepted X-Request-ID headers, so that a client cannot inject
+# arbitrary content in the traces
+REQUEST_ID_PATTERN = re.compile(r"[\w.:-]{1,128}")
+# https://www.w3.org/TR/trace-context/#traceparent-header
+TRACEPARENT_PATTERN = re.compile(
+    r"00-([0-9a-f]{32})-([0-9a-f]{16})-([0-9a-f]{2})"
+)
+
+# OTLP span kinds and status codes
+SPAN_KIND_INTERNAL = 1
+SPAN_KIND_SERVER = 2
+STATUS_CODE_ERROR = 2
+
+traces_exported = Counter(
+    "tracing_traces_total",
+    "Traces of requests handed to the exporter, by result",
+    ["result"],
+)
+
+
+class Trace:
+    """
+    The spans of one request.
+
+    Attributes
+    ----------
+    request_id : str
+        The ID of the request.
+    trace_id : str
+        The OpenTelemetry ID of the trace, as 32 hex digits.
+    recording : bool
+        Whether spans are recorded. Requests which are not sampled start
+        unrecorded, and can be recorded from then on, e.g. to return their
+        timings.
+    sampled : bool
+        Whether the trace is exported.
+    start : int
+        The time the request started, in nanoseconds since the epoch.
+    spans : list of Span
+        The finished spans, in the order they ended.
+    """
+
+    def __init__(
+        self, request_id: str, trace_id: str, sampled: bool = False
+    ) -> None:
+        self.request_id = request_id
+        self.trace_id = trace_id
+        self.sampled = sampled
+        self.recording = sampled
+        self.start = time.time_ns()
+        self.spans: List[Span] = []
+
+    def timings(self) -> Dict[str, float]:
+        """
+        Get the time spent in each stage of the request.
+
+        Returns
+        -------
+        dict
+            The total duration of the spans of each name, in milliseconds,
+            and the time since the start of the request as "total".
+        """
+        timings: Dict[str, float] = {}
+        # `spans` may be appended to by other threads
+        for span in list(self.spans):
+            if span.parent is not None:
+                duration = (span.end - span.start) / 1e6
+                timings[span.name] = timings.get(span.name, 0.0) + duration
+        timings["total"] = (time.time_ns() - self.start) / 1e6
+        return {name: round(ms, 3) for name, ms in timings.items()}
+
+
+class Span:
+    """
+    A timed operation of a request.
+    """
+
+    __slots__ = (
+        "trace",
+        "parent",
+        "name",
+        "span_id",
+        "kind",
+        "start",
+        "end",
+        "attributes",
+        "error",
+        "remote_parent_id",
+    )
+
+    def __init__(
+        self,
+        trace: Trace,
+        parent: Optional["Span"],
+        name: str,
+        kind: int = SPAN_KIND_INTERNAL,
+    ) -> None:
+        self.trace = trace
+        self.parent = parent
+        self.name = name
+        self.span_id = os.urandom(8).hex()
+        self.kind = kind
+        self.start = time.time_ns()
+        self.end = 0
+        self.attributes: Dict[str, Any] = {}
+        self.error: Optional[str] = None
+        # The ID of the span of the client, from its traceparent header
+        self.remote_parent_id: Optional[str] = None
+
+
+_current_span: ContextVar[Optional[Span]] = ContextVar(
+    "opchatserver_current_span", default=None
+)
+
+
+def current_trace() -> Optional[Trace]:
+    """
+    Get the trace of the request being handled.
+
+    Returns
+    -------
+    Trace, optional
+        The trace, or None outside of a traced request.
+    """
+    span = _current_span.get()
+    return span.trace if span is not None else None
+
+
+def start_span(name: str) -> Optional[Span]:
+    """
+    Start a span, as a child of the current span, and make it the current
+    span. It must be ended with `end_span`.
+
+    Parameters
+    ----------
+    name : str
+        The name of the span, e.g. "sanitize".
+
+    Returns
+    -------
+    Span, optional
+        The span, or None if the request is not recorded.
+    """
+    parent = _current_span.get()
+    if parent is None or not parent.trace.recording:
+        return None
+    span = Span(parent.trace, parent, name)
+    _current_span.set(span)
+    return span
+
+
+def end_span(span: Span, error: Optional[BaseException] = None) -> None:
+    """
+    End a span started with `start_span`, and make its parent the current
+    span again.
+
+    Parameters
+    ----------
+    span : Span
+        The span.
+    error : BaseException, optional
+        The error which ended the span, if any.
+    """
+    span.end = time.time_ns()
+    if error is not None:
+        span.error = type(error).__name__
+    span.trace.spans.append(span)
+    _current_span.set(span.parent)
+
+
+@contextmanager
+def trace_span(name: str) -> Iterator[Optional[Span]]:
+    """
+    Time a block as a span of the current request. It can be used in both
+    synchronous and asynchronous code.
+
+    Parameters
+    ----------
+    name : str
+        The name of the span, e.g. "jwks".
+    """
+    span = start_span(name)
+    if span is None:
+        yield None
+        return
+    try:
+        yield span
+    except BaseException as e:
+        end_span(span, e)
+        raise
+    end_span(span)
+
+
+def encode_traces(traces: List[Trace], service_name: str) -> bytes:
+    """
+    Encode traces as an OTLP/JSON ExportTraceServiceRequest.
+
+    Parameters
+    ----------
+    traces : list of Trace
+        The traces, whose spans have ended.
+    service_name : str
+        The service.name attribute of the resource of the spans.
+
+    Returns
+    -------
+    bytes
+        The JSON document.
+    """
+    spans = []
+    for trace in traces:
+        for span in trace.spans:
+            parent_id = (
+                span.parent.span_id
+                if span.parent is not None
+                else span.remote_parent_id
+            )
+            otlp_span: Dict[str, Any] = {
+                "traceId": trace.trace_id,
+                "spanId": span.span_id,
+                "name": span.name,
+                "kind": span.kind,
+                "startTimeUnixNano": str(span.start),
+                "endTimeUnixNano": str(span.end),
+                "attributes": [
+                    {"key": key, "value": _otlp_value(value)}
+                    for key, value in span.attributes.items()
+                ],
+            }
+            if parent_id is not None:
+                otlp_span["parentSpanId"] = parent_id
+            if span.error is not None:
+                otlp_span["status"] = {
+                    "code": STATUS_CODE_ERROR,
+                    "message": span.error,
+                }
+            spans.append(otlp_span)
+    return json.dumps(
+        {
+            "resourceSpans": [
+                {
+                    "resource": {
+                        "attributes": [
+                            {
+                                "key": "service.name",
+                                "value": {"stringValue": service_name},
+                            }
+                        ]
+                    },
+                    "scopeSpans": [
+                        {"scope": {"name": "opchatserver"}, "spans": spans}
+                    ],
+                }
+            ]
+        },
+        separators=(",", ":"),
+    ).encode()
+
+
+def _otlp_value(value: Any) -> Dict[str, Any]:
+    """
+    Helper function which encodes an attribute value as an OTLP AnyValue.
+    """
+    if isinstance(value, bool):
+        return {"boolValue": value}
+    if isinstance(value, int):
+        return {"intValue": str(value)}
+    if isinstance(value, float):
+        return {"doubleValue": value}
+    return {"stringValue": str(value)}
+
+
+class SpanExporter:
+    """
+    Exports the traces of the sampled requests in batches, on a background
+    thread, so that the requests never wait on the export. Traces are
+    dropped when the queue is full, e.g. if the collector is down.
+    """
+
+    def __init__(
+        self,
+        write: Callable[[bytes], None],
+        service_name: str = "opchatserver",
+        max_queue_size: int = 2048,
+        max_batch_size: int = 256,
+        interval: float = 1.0,
+    ):
+        """
+        Parameters
+        ----------
+        write : callable
+            Called on the background thread with each encoded batch.
+        service_name : str, optional
+            The service.name of the spans, by default "opchatserver".
+        max_queue_size : int, optional
+            The maximum number of traces waiting to be exported, by default
+            2048.
+        max_batch_size : int, optional
+            The maximum number of traces exported at once, by default 256.
+        interval : float, optional
+            The maximum number of seconds a trace waits for its batch to be
+            full, by default 1.
+        """
+        self.write = write
+        self.service_name = service_name
+        self.max_batch_size = max_batch_size
+        self.interval = interval
+        self._queue: "queue.Queue[Optional[Trace]]" = queue.Queue(
+            max_queue_size
+        )
+        self._thread = threading.Thread(
+            target=self._run, name="span-exporter", daemon=True
+        )
+        self._thread.start()
+
+    def export(self, trace: Trace) -> None:
+        """
+        Queue a finished trace for export.
+
+        Parameters
+        ----------
+        trace : Trace
+            The trace.
+        """
+        try:
+            self._queue.put_nowait(trace)
+        except queue.Full:
+            traces_exported.labels(result="dropped").inc()
+
+    def close(self, timeout: float = 5.0) -> None:
+        """
+        Export the queued traces and stop the background thread.
+
+        Parameters
+        ----------
+        timeout : float, optional
+            The maximum number of seconds to wait, by default 5.
+        """
+        try:
+            self._queue.put(None, timeout=timeout)
+        except queue.Full:
+            return
+        self._thread.join(timeout)
+
+    def _run(self) -> None:
+        closed = False
+        while not closed:
+            batch: List[Trace] = []
+            deadline = time.monotonic() + self.interval
+            while len(batch) < self.max_batch_size:
+                try:
+                    trace = self._queue.get(
+                        timeout=max(deadline - time.monotonic(), 0)
+                    )
+                except queue.Empty:
+                    break
+                if trace is None:
+                    closed = True
+                    break
+                batch.append(trace)
+            if batch:
+                self._write(batch)
+
+    def _write(self, batch: List[Trace]) -> None:
+        try:
+            self.write(encode_traces(batch, self.service_name))
+        except Exception:
+            traces_exported.labels(result="failed").inc(len(batch))
+        else:
+            traces_exported.labels(result="exported").inc(len(batch))
+
+
+def _file_writer(path: str) -> Callable[[bytes], None]:
+    """
+    Helper function which appends each batch to a file, one JSON document
+    per line, as read by the otlpjsonfile receiver of the collector.
+    """
+    lock = threading.Lock()
+
+    def write(data: bytes) -> None:
+        with lock, open(path, "ab") as file:
+            file.write(data + b"\n")
+
+    return write
+
+
+def _otlp_http_writer(endpoint: str) -> Callable[[bytes], None]:
+    """
+    Helper function which posts each batch to the OTLP/HTTP endpoint of a
+    collector.
+    """
+    session = requests.Session()
+
+    def write(data: bytes) -> None:
+        response = session.post(
+            endpoint,
+            data=data,
+            headers={"Content-Type": "application/json"},
+            timeout=10,
+        )
+        response.raise_for_status()
+
+    return write
+
+
+_exporters: Dict[Tuple[str, str, str], SpanExporter] = {}
+_exporters_lock = threading.Lock()
+
+
+def get_span_exporter() -> Optional[SpanExporter]:
+    """
+    Get the exporter configured by the TRACING_EXPORTER environment
+    variable: "none" (the default), "file" to append the traces to
+    TRACING_FILE, or "otlp" to post them to TRACING_OTLP_ENDPOINT.
+
+    Returns
+    -------
+    SpanExporter, optional
+        The exporter, or None if tracing is disabled.
+    """
+    kind = os.environ.get("TRACING_EXPORTER", "none").lower()
+    if kind == "none":
+        return None
+    if kind == "file":
+        target = os.environ.get("TRACING_FILE", "traces.jsonl")
+    elif kind == "otlp":
+        target = os.environ.get(
+            "TRACING_OTLP_ENDPOINT", "http://localhost:4318/v1/traces"
+        )
+    else:
+        raise ValueError(f"unknown TRACING_EXPORTER: {kind}")
+    service_name = os.environ.get("OTEL_SERVICE_NAME", "opchatserver")
+    key = (kind, target, service_name)
+    exporter = _exporters.get(key)
+    if exporter is None:
+        with _exporters_lock:
+            exporter = _exporters.get(key)
+            if exporter is None:
+                write = (
+                    _file_writer(target)
+                    if kind == "file"
+                    else _otlp_http_writer(target)
+                )
+                exporter = SpanExporter(write, service_name)
+                _exporters[key] = exporter
+    return exporter
+
+
+def close_span_exporters() -> None:
+    """
+    Export the queued traces and stop the exporters, when the server stops.
+    A new exporter is created if it is needed again.
+    """
+    with _exporters_lock:
+        exporters = list(_exporters.values())
+        _exporters.clear()
+    for exporter in exporters:
+        exporter.close()
+
+
+def _get_sample_ratio() -> float:
+    """
+    Get the share of the requests whose traces are exported.
+
+    Returns
+    -------
+    float
+        The TRACING_SAMPLE_RATIO, between 0 and 1, by default 1.
+    """
+    return float(os.environ.get("TRACING_SAMPLE_RATIO", "1"))
+
+
+class TracingMiddleware:
+    """
+    ASGI middleware which gives each chat request a request ID and a trace,
+    whose root span lasts until the response has been sent. The request ID
+    is taken from the X-Request-ID header of the request if it is valid,
+    and the trace continues the trace of the client if the request has a
+    traceparent header.
+    """
+
+    def __init__(self, app: Any):
+        self.app = app
+
+    async def __call__(self, scope: Any, receive: Any, send: Any) -> None:
+        path = scope.get("path")
+        if scope["type"] != "http" or path not in TRACED_ENDPOINTS:
+            await self.app(scope, receive, send)
+            return
+
+        request_id: Optional[str] = None
+        trace_id: Optional[str] = None
+        parent_id: Optional[str] = None
+        sampled = True
+        for name, value in scope["headers"]:
+            if name == b"x-request-id":
+                header = value.decode("latin-1")
+                if REQUEST_ID_PATTERN.fullmatch(header):
+                    request_id = header
+            elif name == b"traceparent":
+                match = TRACEPARENT_PATTERN.fullmatch(value.decode("latin-1"))
+                if match is not None:
+                    trace_id, parent_id, flags = match.groups()
+                    sampled = bool(int(flags, 16) & 1)
+        if trace_id is None:
+            trace_id = uuid.uuid4().hex
+        request_id = request_id or trace_id
+        request_id_header = (b"x-request-id", request_id.encode("latin-1"))
+
+        exporter = get_span_exporter()
+        sampled = (
+            exporter is not None
+            and sampled
+            and random.random() < _get_sample_ratio()
+        )
+        trace = Trace(request_id, trace_id, sampled)
+        root = Span(trace, None, f"{scope['method']} {path}", SPAN_KIND_SERVER)
+        root.remote_parent_id = parent_id
+        token = _current_span.set(root)
+        status: Optional[int] = None
+
+        async def send_with_request_id(message: Any) -> None:
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+                message["headers"] = [
+                    *message.get("headers", []),
+                    request_id_header,
+                ]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_request_id)
+        finally:
+            _current_span.reset(token)
+            if trace.sampled and exporter is not None:
+                root.attributes = {
+                    "http.method": scope["method"],
+                    "http.route": path,
+                    "request.id": request_id,
+                }
+                if status is not None:
+                    root.attributes["http.status_code"] = status
+                    if status >= 500:
+                        root.error = str(status)
+                root.end = time.time_ns()
+                trace.spans.append(root)
+                exporter.export(trace)
@@ -0,0 +1,143 @@
+"""
+This module warms up a worker of the chat server once it has started. The
+LangChain and OpaquePrompts modules of the chat pipeline are slow to import,
+so the server module does not import them; they are loaded on the executor
+in the background, while the server already accepts connections, and the
+JWKS of the Auth0 domain are prefetched so that the first requests do not
+wait for them.
+
+The worker reports itself ready, e.g. on /ready, once both are done.
+Requests that arrive earlier load the pipeline themselves, off the event
+loop.
+"""
+import asyncio
+import logging
+import threading
+import time
+from typing import Awaitable, Callable, Dict, Optional
+
+from opchatserver.executor import run_in_executor
+from prometheus_client import Gauge
+
+logger = logging.getLogger(__name__)
+
+STEPS = ("pipeline", "jwks")
+
+warmup_duration = Gauge(
+    "server_warmup_duration_seconds",
+    "Seconds taken by a warm-up step of the worker, since it started",
+    ["step"],
+    multiprocess_mode="max",
+)
+
+
+class WarmUp:
+    """
+    Loads the chat pipeline, then prefetches the JWKS, in a background task.
+    Each step is retried with exponential backoff until it succeeds or the
+    warm-up is stopped.
+    """
+
+    def __init__(
+        self,
+        load_pipeline: Callable[[], None],
+        prefetch_jwks: Callable[[], None],
+        retry_delay: float = 0.5,
+        max_retry_delay: float = 30,
+    ):
+        """
+        Parameters
+        ----------
+        load_pipeline : callable
+            Imports the modules of the chat pipeline and builds its
+            runnables. It runs on the executor, at most once successfully.
+        prefetch_jwks : callable
+            Fetches the JWKS of the Auth0 domain. It runs on the executor.
+        retry_delay : float, optional
+            The delay before retrying a failed step, in seconds, doubled on
+            every failure. By default 0.5.
+        max_retry_delay : float, optional
+            The maximum delay before retrying a failed step, in seconds, by
+            default 30.
+        """
+        self._load_pipeline = load_pipeline
+        self._prefetch_jwks = prefetch_jwks
+        self.retry_delay = retry_delay
+        self.max_retry_delay = max_retry_delay
+        self.done: Dict[str, bool] = {step: False for step in STEPS}
+        self._pipeline_lock = threading.Lock()
+        self._task: Optional["asyncio.Task[None]"] = None
+        self._started_at = time.monotonic()
+
+    @property
+    def ready(self) -> bool:
+        """Whether every step of the warm-up is done"""
+        return all(self.done.values())
+
+    def start(self) -> None:
+        """Start the warm-up in a background task of the running loop."""
+        self._started_at = time.monotonic()
+        self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self) -> None:
+        """Cancel the warm-up if it is still running."""
+        if self._task is None:
+            return
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+
+    async def load_pipeline(self) -> None:
+        """
+        Wait until the chat pipeline is loaded, loading it on the executor
+        if the warm-up has not done it yet. Errors of the load are raised.
+        """
+        if not self.done["pipeline"]:
+            await run_in_executor(self._load_pipeline_once)
+
+    def _load_pipeline_once(self) -> None:
+        # Requests arriving during the warm-up wait for the load in progress
+        with self._pipeline_lock:
+            if not self.done["pipeline"]:
+                self._load_pipeline()
+                self._mark_done("pipeline")
+
+    async def _prefetch_jwks_once(self) -> None:
+        await run_in_executor(self._prefetch_jwks)
+        self._mark_done("jwks")
+
+    async def _run(self) -> None:
+        await self._retry("pipeline", self.load_pipeline)
+        await self._retry("jwks", self._prefetch_jwks_once)
+        logger.info(
+            "Warm-up done in %.2f seconds",
+            time.monotonic() - self._started_at,
+        )
+
+    async def _retry(
+        self, step: str, attempt: Callable[[], Awaitable[None]]
+    ) -> None:
+        """
+        Helper function which runs a step of the warm-up until it succeeds.
+        """
+        delay = self.retry_delay
+        while True:
+            try:
+                await attempt()
+                return
+            except Exception as error:
+                logger.warning(
+                    "Warm-up step %s failed, retrying in %.1f seconds: %s",
+                    step,
+                    delay,
+                    error,
+                )
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, self.max_retry_delay)
+
+    def _mark_done(self, step: str) -> None:
+        self.done[step] = True
+        warmup_duration.labels(step).set(time.monotonic() - self._started_at)
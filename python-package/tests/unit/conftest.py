@@ -0,0 +1,152 @@
+"""
+Shared fixtures for the unit tests, including local fakes for the
+OpaquePrompts service and the LLM so that the chat pipeline can run without
+network access.
+"""
+import asyncio
+import json
+import os
+import re
+import time
+from typing import Any, Dict, List, Optional, Union
+
+import httpx
+import pytest
+from opchatserver import llms
+
+# The server validates these at import time
+os.environ.setdefault("AUTH0_DOMAIN", "test-domain.local")
+os.environ.setdefault("AUTH0_API_AUDIENCE", "https://test-audience.local")
+
+# Names the fake sanitizer treats as PII
+FAKE_PII = ["Alice", "Bob", "Carol"]
+
+AUTH_HEADERS = {"Authorization": "Bearer test-token"}
+
+
+class FakeOpaquePrompts:
+    """
+    A local stand-in for `langchain.utilities.opaqueprompts` which replaces
+    the names in `FAKE_PII` with placeholders, and blocks for `latency`
+    seconds on every call like the remote service would.
+    """
+
+    def __init__(self, latency: float = 0.0):
+        self.latency = latency
+        self.sanitize_calls: List[Union[str, Dict[str, str]]] = []
+        self.desanitize_calls: List[str] = []
+
+    def sanitize(
+        self, input: Union[str, Dict[str, str]]
+    ) -> Dict[str, Union[str, Dict[str, str]]]:
+        time.sleep(self.latency)
+        self.sanitize_calls.append(input)
+        secure_context: Dict[str, str] = {}
+
+        def replace(text: str) -> str:
+            for name in FAKE_PII:
+                if name in text:
+                    placeholder = f"PERSON_{FAKE_PII.index(name) + 1}"
+                    secure_context[placeholder] = name
+                    text = text.replace(name, placeholder)
+            return text
+
+        if isinstance(input, str):
+            sanitized_input: Union[str, Dict[str, str]] = replace(input)
+        else:
+            sanitized_input = {
+                key: replace(value) for key, value in input.items()
+            }
+        return {
+            "sanitized_input": sanitized_input,
+            "secure_context": json.dumps(secure_context),
+        }
+
+    def desanitize(self, sanitized_text: str, secure_context: str) -> str:
+        time.sleep(self.latency)
+        self.desanitize_calls.append(sanitized_text)
+        for placeholder, name in json.loads(secure_context).items():
+            sanitized_text = sanitized_text.replace(placeholder, name)
+        return sanitized_text
+
+
+class FakeLLM(llms.FakeLLM):
+    """
+    The fake LLM of the server, which echoes the prompt part of the
+    OpaquePrompts template and streams the response in chunks of 4
+    characters.
+    """
+
+    chunk_size: Optional[int] = 4
+
+    def _respond(self, prompt: str) -> str:
+        self.calls += 1
+        match = re.search(r"Prompt: ```(.*)```", prompt, re.DOTALL)
+        return f"Echo: {match.group(1) if match else prompt}"
+
+
+async def post_requests(
+    path: str, bodies: List[Dict[str, Any]]
+) -> List[httpx.Response]:
+    """Post the bodies concurrently to the server within its lifespan"""
+    from opchatserver import server
+
+    async with server.app.router.lifespan_context(server.app):
+        transport = httpx.ASGITransport(app=server.app)
+        async with httpx.AsyncClient(
+            transport=transport, base_url="http://test"
+        ) as client:
+            return await asyncio.gather(
+                *[
+                    client.post(path, json=body, headers=AUTH_HEADERS)
+                    for body in bodies
+                ]
+            )
+
+
+### Fixtures ###
+
+
+@pytest.fixture
+def fake_op(monkeypatch: pytest.MonkeyPatch) -> FakeOpaquePrompts:
+    import langchain.utilities.opaqueprompts as op
+
+    fake = FakeOpaquePrompts()
+    monkeypatch.setattr(op, "sanitize", fake.sanitize)
+    monkeypatch.setattr(op, "desanitize", fake.desanitize)
+    return fake
+
+
+@pytest.fixture
+def fake_llm() -> FakeLLM:
+    return FakeLLM()
+
+
+@pytest.fixture
+def fake_server(
+    fake_op: FakeOpaquePrompts,
+    fake_llm: FakeLLM,
+    monkeypatch: pytest.MonkeyPatch,
+) -> None:
+    from opchatserver import server
+    from opchatserver.authorization import JWKSKeyStore, VerifyToken
+
+    monkeypatch.setattr(server, "_create_llm", lambda model_name: fake_llm)
+    monkeypatch.setattr(
+        VerifyToken,
+        "verify",
+        lambda self, required_scopes=None: {"sub": "user|1"},
+    )
+    # Prefetched by the warm-up of the server
+    monkeypatch.setattr(JWKSKeyStore, "refresh", lambda self: None)
+
+
+@pytest.fixture(autouse=True)
+def reset_stage_policies(monkeypatch: pytest.MonkeyPatch) -> None:
+    """
+    Give each test fresh upstream policies, read from its environment, so
+    that circuit breakers opened by a test do not affect the next ones
+    """
+    from opchatserver import resilience
+
+    monkeypatch.setattr(resilience, "_policies", {})
@@ -0,0 +1,227 @@
+"""
+Unit tests for admission.py and the admission of the chat endpoints
+"""
+import asyncio
+from typing import List
+
+import pytest
+from conftest import FakeLLM, post_requests
+from opchatserver.admission import AdmissionController, AdmissionRejected
+
+
+async def run_chats(
+    controller: AdmissionController,
+    subjects: List[str],
+    duration: float,
+    started: List[str],
+) -> None:
+    """Run a chat of each subject, holding its admission for `duration`"""
+
+    async def chat(subject: str) -> None:
+        async with controller.admit(subject):
+            started.append(subject)
+            await asyncio.sleep(duration)
+
+    await asyncio.gather(*[chat(subject) for subject in subjects])
+
+
+### Tests ###
+
+
+def test_global_limit_is_enforced() -> None:
+    """
+    Validates that no more than `max_in_flight` requests are admitted at
+    once
+    """
+    ########## ARRANGE ##########
+    controller = AdmissionController(max_in_flight=2)
+    peak = 0
+
+    async def chat(subject: str) -> None:
+        nonlocal peak
+        async with controller.admit(subject):
+            peak = max(peak, controller.in_flight)
+            await asyncio.sleep(0.01)
+
+    async def run() -> None:
+        await asyncio.gather(*[chat(f"user {i}") for i in range(6)])
+
+    ########## ACT ##########
+    asyncio.run(run())
+
+    ########## ASSERT ##########
+    assert peak == 2
+    assert controller.in_flight == 0
+    assert controller.queue_depth == 0
+
+
+def test_subject_limit_does_not_block_others() -> None:
+    """
+    Validates that requests of a subject at its limit wait without holding
+    up the requests of other subjects queued behind them
+    """
+    ########## ARRANGE ##########
+    controller = AdmissionController(
+        max_in_flight=3, max_in_flight_per_subject=1
+    )
+    started: List[str] = []
+
+    async def run() -> None:
+        # "a" fills the global limit with "b", and its second request waits
+        await run_chats(controller, ["a", "b", "a", "c"], 0.05, started)
+
+    ########## ACT ##########
+    asyncio.run(run())
+
+    ########## ASSERT ##########
+    assert started == ["a", "b", "c", "a"]
+
+
+def test_try_acquire_does_not_wait() -> None:
+    """
+    Validates that try_acquire only admits a request which can be admitted
+    right away, within the limits
+    """
+    ########## ARRANGE ##########
+    controller = AdmissionController(
+        max_in_flight=2, max_in_flight_per_subject=1
+    )
+
+    ########## ACT ##########
+    admitted = [
+        controller.try_acquire("a"),
+        controller.try_acquire("a"),
+        controller.try_acquire("b"),
+        controller.try_acquire("c"),
+    ]
+
+    ########## ASSERT ##########
+    assert admitted == [True, False, True, False]
+    assert controller.in_flight == 2
+
+
+def test_full_queue_is_shed() -> None:
+    """
+    Validates that requests are rejected right away when the queue is full
+    """
+    ########## ARRANGE ##########
+    controller = AdmissionController(max_in_flight=1, max_queue=1)
+
+    async def run() -> None:
+        await controller.acquire("a")
+        waiting = asyncio.create_task(controller.acquire("b"))
+        await asyncio.sleep(0)
+        try:
+            await controller.acquire("c")
+        finally:
+            controller.release("a")
+            await waiting
+            controller.release("b")
+
+    ########## ACT ##########
+    with pytest.raises(AdmissionRejected) as exc_info:
+        asyncio.run(run())
+
+    ########## ASSERT ##########
+    assert exc_info.value.reason == "queue_full"
+    assert controller.in_flight == 0
+
+
+def test_waiting_past_deadline_is_shed() -> None:
+    """
+    Validates that a request is rejected once it has waited `max_wait`
+    seconds, and leaves the queue
+    """
+    ########## ARRANGE ##########
+    controller = AdmissionController(max_in_flight=1, max_wait=0.05)
+
+    async def run() -> None:
+        await controller.acquire("a")
+        try:
+            await controller.acquire("b")
+        finally:
+            controller.release("a")
+
+    ########## ACT ##########
+    with pytest.raises(AdmissionRejected) as exc_info:
+        asyncio.run(run())
+
+    ########## ASSERT ##########
+    assert exc_info.value.reason == "timeout"
+    assert exc_info.value.retry_after >= 1
+    assert controller.queue_depth == 0
+    assert controller.in_flight == 0
+
+
+def test_cancelled_waiter_leaves_queue() -> None:
+    """
+    Validates that a request cancelled while waiting leaves the queue
+    without being admitted
+    """
+    ########## ARRANGE ##########
+    controller = AdmissionController(max_in_flight=1)
+
+    async def run() -> None:
+        await controller.acquire("a")
+        waiting = asyncio.create_task(controller.acquire("b"))
+        await asyncio.sleep(0)
+        waiting.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await waiting
+        controller.release("a")
+
+    ########## ACT ##########
+    asyncio.run(run())
+
+    ########## ASSERT ##########
+    assert controller.queue_depth == 0
+    assert controller.in_flight == 0
+
+
+@pytest.mark.usefixtures("fake_server")
+def test_chat_is_shed_with_retry_after(
+    fake_llm: FakeLLM, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    """
+    Validates that /chat answers 503 with a Retry-After header when the
+    server is overloaded
+    """
+    ########## ARRANGE ##########
+    monkeypatch.setenv("ADMISSION_MAX_IN_FLIGHT", "1")
+    monkeypatch.setenv("ADMISSION_MAX_QUEUE", "0")
+    fake_llm.latency = 0.2
+    bodies = [
+        {"history": [], "prompt": "Hi"},
+        {"history": [], "prompt": "Hello"},
+    ]
+
+    ########## ACT ##########
+    responses = asyncio.run(post_requests("/chat", bodies))
+
+    ########## ASSERT ##########
+    assert sorted(response.status_code for response in responses) == [
+        200,
+        503,
+    ]
+    (shed,) = [r for r in responses if r.status_code == 503]
+    assert shed.headers["Retry-After"] == "5"
+
+
+@pytest.mark.usefixtures("fake_server")
+def test_stream_releases_admission_when_done(
+    monkeypatch: pytest.MonkeyPatch,
+) -> None:
+    """
+    Validates that a stream holds its admission until it ends, and then
+    releases it for the queued requests
+    """
+    ########## ARRANGE ##########
+    monkeypatch.setenv("ADMISSION_MAX_IN_FLIGHT", "1")
+    body = {"history": [], "prompt": "Hi"}
+
+    ########## ACT ##########
+    responses = asyncio.run(post_requests("/chat/stream", [body] * 3))
+
+    ########## ASSERT ##########
+    assert [response.status_code for response in responses] == [200] * 3
+    assert all("event: done" in response.text for response in responses)
@@ -0,0 +1,169 @@
+"""
+Unit tests for backends.py and the routing of the chats to the LLM backends
+"""
+import asyncio
+import json
+from pathlib import Path
+from typing import Any, Dict, List
+
+import httpx
+import pytest
+from conftest import AUTH_HEADERS, FakeOpaquePrompts
+from opchatserver.backends import (
+    Backend,
+    BackendRegistry,
+    Route,
+    load_backend_registry,
+)
+
+CONFIG: Dict[str, Any] = {
+    "backends": {
+        "large": {"type": "fake", "model": "gpt-4"},
+        "small": {"type": "fake", "model": "gpt-3.5-turbo"},
+        "premium": {"type": "fake", "model": "gpt-4"},
+    },
+    "default": "large",
+    "routes": [
+        {"backends": ["premium"], "scopes": ["tier:premium"]},
+        {"backends": ["small"], "max_prompt_tokens": 50},
+    ],
+}
+
+
+async def post_chats(bodies: List[Dict[str, Any]]) -> List[httpx.Response]:
+    """Post chats to the server, in order, within its lifespan"""
+    from opchatserver import server
+
+    async with server.app.router.lifespan_context(server.app):
+        transport = httpx.ASGITransport(app=server.app)
+        async with httpx.AsyncClient(
+            transport=transport, base_url="http://test"
+        ) as client:
+            return [
+                await client.post("/chat", json=body, headers=AUTH_HEADERS)
+                for body in bodies
+            ]
+
+
+### Fixtures ###
+
+
+@pytest.fixture
+def configured_server(
+    fake_op: FakeOpaquePrompts,
+    monkeypatch: pytest.MonkeyPatch,
+    tmp_path: Path,
+) -> None:
+    from opchatserver.authorization import JWKSKeyStore, VerifyToken
+
+    path = tmp_path / "backends.json"
+    path.write_text(json.dumps(CONFIG))
+    monkeypatch.setenv("LLM_BACKENDS_CONFIG", str(path))
+    monkeypatch.setattr(
+        VerifyToken,
+        "verify",
+        lambda self, required_scopes=None: {"sub": "user|1"},
+    )
+    monkeypatch.setattr(JWKSKeyStore, "refresh", lambda self: None)
+
+
+### Tests ###
+
+
+def test_select_routes_by_scope_and_prompt_tokens() -> None:
+    """
+    Validates that the first route which matches the scopes of the user and
+    the size of the prompt selects the backend, and that the default
+    backend completes the other chats
+    """
+    ########## ARRANGE ##########
+    registry = load_backend_registry(CONFIG)
+    user: Dict[str, Any] = {"sub": "user|1"}
+    premium_user = {"sub": "user|2", "scope": "openid tier:premium"}
+    long_prompt = "Tell me a story. " * 50
+
+    ########## ACT ##########
+    selected = [
+        registry.select("Hi", ["Hello", "Hi there"], user).name,
+        registry.select(long_prompt, [], user).name,
+        registry.select(long_prompt, [], premium_user).name,
+        registry.select("Hi", [], {"permissions": ["tier:premium"]}).name,
+    ]
+
+    ########## ASSERT ##########
+    assert selected == ["small", "large", "premium", "premium"]
+
+
+def test_select_prefers_the_fastest_backend() -> None:
+    """
+    Validates that a route selects its backend with the lowest recent
+    latency, and falls back to the default backend when all of its backends
+    are slower than its max latency
+    """
+    ########## ARRANGE ##########
+    registry = BackendRegistry(
+        [Backend("a", "fake"), Backend("b", "fake"), Backend("c", "fake")],
+        "c",
+        [Route(("a", "b"), max_latency=1.0)],
+    )
+
+    ########## ACT ##########
+    no_calls = registry.select("Hi", [], {}).name
+    registry._latencies["a"].record(0.5)
+    one_call = registry.select("Hi", [], {}).name
+    registry._latencies["b"].record(0.2)
+    fastest = registry.select("Hi", [], {}).name
+    registry._latencies["a"].record(2.0)
+    registry._latencies["a"].record(3.0)
+    registry._latencies["b"].record(2.0)
+    registry._latencies["b"].record(3.0)
+    saturated = registry.select("Hi", [], {}).name
+
+    ########## ASSERT ##########
+    assert no_calls == "a"
+    assert one_call == "b"
+    assert fastest == "b"
+    assert saturated == "c"
+    assert registry.latency("a") == 2.0
+
+
+def test_unknown_backends_are_rejected() -> None:
+    """
+    Validates that a configuration which refers to unknown backends or
+    backend types is rejected
+    """
+    ########## ARRANGE ##########
+    unknown_route = {**CONFIG, "routes": [{"backends": ["medium"]}]}
+    unknown_type = {"backends": {"a": {"type": "llama"}}}
+
+    ########## ACT & ASSERT ##########
+    with pytest.raises(ValueError, match="medium"):
+        load_backend_registry(unknown_route)
+    with pytest.raises(ValueError, match="llama"):
+        load_backend_registry(unknown_type)
+
+
+@pytest.mark.usefixtures("configured_server")
+def test_chat_reports_the_selected_backend() -> None:
+    """
+    Validates that the chats are completed by the backend of their route,
+    recording its latency, and that the response names it
+    """
+    ########## ARRANGE ##########
+    bodies = [
+        {"history": [], "prompt": "Hi, I am Alice."},
+        {"history": [], "prompt": "Hi, I am Bob. " + "Tell me more. " * 50},
+    ]
+
+    ########## ACT ##########
+    small, large = asyncio.run(post_chats(bodies))
+
+    ########## ASSERT ##########
+    assert small.status_code == large.status_code == 200
+    assert small.json()["model"] == "small"
+    assert large.json()["model"] == "large"
+    assert "Hi, I am Alice." in small.json()["desanitizedResponse"]
+    from opchatserver import server
+
+    assert server.app.state.backends.latency("small") is not None
+    assert server.app.state.backends.latency("premium") is None
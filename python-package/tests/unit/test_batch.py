@@ -0,0 +1,151 @@
+"""
+Unit tests for the /chat/batch endpoint
+"""
+import asyncio
+import time
+from typing import Any, Dict, List
+
+import pytest
+from conftest import FakeLLM, FakeOpaquePrompts, post_requests
+
+pytestmark = pytest.mark.usefixtures("fake_server")
+
+
+def post_batch(requests: List[Dict[str, Any]]) -> Any:
+    (response,) = asyncio.run(
+        post_requests("/chat/batch", [{"requests": requests}])
+    )
+    return response
+
+
+### Tests ###
+
+
+def test_batch_sanitizes_once_and_keeps_order(
+    fake_op: FakeOpaquePrompts,
+) -> None:
+    """
+    Validates that a batch is sanitized in a single call and that the
+    responses are returned in the order of the requests
+    """
+    ########## ARRANGE ##########
+    requests: List[Dict[str, Any]] = [
+        {"history": ["I am Bob", "Hi PERSON_2"], "prompt": "Hi Alice"},
+        {
+            "history": [],
+            "prompt": "Hi Carol",
+            "with_intermediate_outputs": False,
+        },
+    ]
+
+    ########## ACT ##########
+    response = post_batch(requests)
+
+    ########## ASSERT ##########
+    assert response.status_code == 200
+    assert response.json() == {
+        "responses": [
+            {
+                "statusCode": 200,
+                "response": {
+                    "desanitizedResponse": "Echo: Hi Alice",
+                    "sanitizedPrompt": "Hi PERSON_1",
+                    "rawResponse": "Echo: Hi PERSON_1",
+                    "preScreen": None,
+                    "model": "gpt-3.5-turbo",
+                    "timings": None,
+                },
+                "detail": None,
+            },
+            {
+                "statusCode": 200,
+                "response": {
+                    "desanitizedResponse": "Echo: Hi Carol",
+                    "sanitizedPrompt": None,
+                    "rawResponse": None,
+                    "preScreen": None,
+                    "model": "gpt-3.5-turbo",
+                    "timings": None,
+                },
+                "detail": None,
+            },
+        ]
+    }
+    assert fake_op.sanitize_calls == [
+        {
+            "0 prompt": "Hi Alice",
+            "0 Human 1": "I am Bob",
+            "0 Ai 1": "Hi PERSON_2",
+            "1 prompt": "Hi Carol",
+        }
+    ]
+
+
+def test_batch_reports_errors_per_request(
+    fake_llm: FakeLLM, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    """
+    Validates that invalid requests and failed completions are reported in
+    their result without failing the other requests
+    """
+    ########## ARRANGE ##########
+    respond = FakeLLM._respond
+
+    def respond_or_fail(self: FakeLLM, prompt: str) -> str:
+        if "fail" in prompt:
+            raise RuntimeError("llm failed")
+        return respond(self, prompt)
+
+    monkeypatch.setattr(FakeLLM, "_respond", respond_or_fail)
+    requests = [
+        {"history": ["odd"], "prompt": "Hi"},
+        {"history": [], "prompt": "please fail"},
+        {"history": [], "prompt": "Hi"},
+    ]
+
+    ########## ACT ##########
+    response = post_batch(requests)
+
+    ########## ASSERT ##########
+    assert response.status_code == 200
+    results = response.json()["responses"]
+    assert [result["statusCode"] for result in results] == [400, 500, 200]
+    assert results[1]["detail"] == "llm failed"
+    assert results[2]["response"]["desanitizedResponse"] == "Echo: Hi"
+
+
+def test_batch_bounds_llm_concurrency(
+    fake_llm: FakeLLM, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    """
+    Validates that the llm calls of a batch run concurrently, at most
+    CHAT_BATCH_MAX_CONCURRENCY at a time
+    """
+    ########## ARRANGE ##########
+    monkeypatch.setenv("CHAT_BATCH_MAX_CONCURRENCY", "4")
+    fake_llm.latency = 0.2
+    requests = [{"history": [], "prompt": f"Hi {i}"} for i in range(8)]
+
+    ########## ACT ##########
+    start = time.perf_counter()
+    response = post_batch(requests)
+    elapsed = time.perf_counter() - start
+
+    ########## ASSERT ##########
+    assert response.status_code == 200
+    assert 0.4 <= elapsed < 1.2
+
+
+def test_batch_size_is_limited(monkeypatch: pytest.MonkeyPatch) -> None:
+    """
+    Validates that batches larger than CHAT_BATCH_MAX_SIZE are rejected
+    """
+    ########## ARRANGE ##########
+    monkeypatch.setenv("CHAT_BATCH_MAX_SIZE", "2")
+    requests = [{"history": [], "prompt": "Hi"}] * 3
+
+    ########## ACT ##########
+    response = post_batch(requests)
+
+    ########## ASSERT ##########
+    assert response.status_code == 400
@@ -0,0 +1,83 @@
+"""
+Unit tests for chains.py
+"""
+from typing import List
+
+from conftest import FakeLLM, FakeOpaquePrompts
+from langchain.llms.base import BaseLLM
+from langchain.prompts import PromptTemplate
+from opchatserver.chains import ChainRegistry
+from opchatserver.intermediate_outputs import get_response
+from opchatserver.memory import build_memory
+from opchatserver.prompt_template import OPAQUEPROMPTS_TEMPLATE
+
+### Tests ###
+
+
+def test_registry_builds_chains_once_per_model() -> None:
+    """
+    Validates that the registry creates the llm and the chains of a model
+    once and reuses them
+    """
+    ########## ARRANGE ##########
+    created: List[str] = []
+
+    def llm_factory(model_name: str) -> BaseLLM:
+        created.append(model_name)
+        return FakeLLM()
+
+    registry = ChainRegistry(llm_factory)
+
+    ########## ACT ##########
+    first = registry.get("model-a", OPAQUEPROMPTS_TEMPLATE)
+    second = registry.get("model-a", OPAQUEPROMPTS_TEMPLATE)
+    other = registry.get("model-b", OPAQUEPROMPTS_TEMPLATE)
+
+    ########## ASSERT ##########
+    assert first is second
+    assert other is not first
+    assert created == ["model-a", "model-b"]
+
+
+def test_registry_chains_are_reusable(fake_op: FakeOpaquePrompts) -> None:
+    """
+    Validates that a shared chain keeps no state between invocations
+    """
+    ########## ARRANGE ##########
+    chains = ChainRegistry(lambda model_name: FakeLLM()).get(
+        "model-a", OPAQUEPROMPTS_TEMPLATE
+    )
+
+    ########## ACT ##########
+    outputs = [
+        chains.intermediate_output_chain.invoke(
+            {"prompt": prompt, "history": []}
+        )
+        for prompt in ["Hi Alice", "Hi Bob"]
+    ]
+
+    ########## ASSERT ##########
+    assert [output["desanitizedResponse"] for output in outputs] == [
+        "Echo: Hi Alice",
+        "Echo: Hi Bob",
+    ]
+
+
+def test_get_response_runs_the_asynchronous_pipeline(
+    fake_op: FakeOpaquePrompts,
+) -> None:
+    """
+    Validates that the synchronous get_response returns the response of
+    the asynchronous pipeline, with its intermediate outputs
+    """
+    ########## ARRANGE ##########
+    prompt = PromptTemplate.from_template(OPAQUEPROMPTS_TEMPLATE)
+    memory = build_memory(["I am Bob", "Hi!"])
+
+    ########## ACT ##########
+    response = get_response(prompt, memory, "Say hi to Alice", FakeLLM())
+
+    ########## ASSERT ##########
+    assert response.sanitized_prompt == "Say hi to PERSON_1"
+    assert response.raw_response == "Echo: Say hi to PERSON_1"
+    assert response.desanitized_response == "Echo: Say hi to Alice"
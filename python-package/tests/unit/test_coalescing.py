@@ -0,0 +1,159 @@
+"""
+Unit tests for coalescing.py and the coalescing of identical chats
+"""
+import asyncio
+from typing import Awaitable, Callable, List
+
+import pytest
+from conftest import FakeLLM, FakeOpaquePrompts, post_requests
+from opchatserver.coalescing import SingleFlight
+from prometheus_client import REGISTRY
+
+
+def coalesced(role: str) -> float:
+    return (
+        REGISTRY.get_sample_value(
+            "chat_coalesced_requests_total", {"role": role}
+        )
+        or 0.0
+    )
+
+
+### Tests ###
+
+
+def test_single_flight_shares_one_execution() -> None:
+    """
+    Validates that concurrent calls with the same key share one execution,
+    and its exception, while other keys and later calls run on their own
+    """
+    ########## ARRANGE ##########
+    single_flight: SingleFlight[str] = SingleFlight()
+    calls: List[str] = []
+
+    async def work(key: str) -> str:
+        calls.append(key)
+        await asyncio.sleep(0.05)
+        if key == "fail":
+            raise ValueError(key)
+        return key.upper()
+
+    def call(key: str) -> Callable[[], Awaitable[str]]:
+        async def function() -> str:
+            return await work(key)
+
+        return function
+
+    async def run() -> List[object]:
+        concurrent = await asyncio.gather(
+            *[
+                single_flight.run(key, call(key))
+                for key in ["a", "a", "b", "a", "fail", "fail"]
+            ],
+            return_exceptions=True,
+        )
+        later = await single_flight.run("a", lambda: work("a"))
+        return [*concurrent, later]
+
+    ########## ACT ##########
+    results = asyncio.run(run())
+
+    ########## ASSERT ##########
+    assert results[:4] == ["A", "A", "B", "A"]
+    assert all(isinstance(result, ValueError) for result in results[4:6])
+    assert results[4] is results[5]
+    assert results[6] == "A"
+    assert calls == ["a", "b", "fail", "a"]
+    assert len(single_flight) == 0
+
+
+def test_single_flight_survives_cancelled_callers() -> None:
+    """
+    Validates that the execution goes on when one of its callers is
+    cancelled, and is cancelled when all of them are
+    """
+    ########## ARRANGE ##########
+    single_flight: SingleFlight[str] = SingleFlight()
+    finished: List[str] = []
+
+    async def work(key: str) -> str:
+        await asyncio.sleep(0.05)
+        finished.append(key)
+        return key
+
+    async def run() -> str:
+        first = asyncio.ensure_future(
+            single_flight.run("a", lambda: work("a"))
+        )
+        second = asyncio.ensure_future(
+            single_flight.run("a", lambda: work("a"))
+        )
+        alone = asyncio.ensure_future(
+            single_flight.run("b", lambda: work("b"))
+        )
+        await asyncio.sleep(0.01)
+        first.cancel()
+        alone.cancel()
+        result = await second
+        await asyncio.sleep(0.1)
+        return result
+
+    ########## ACT ##########
+    result = asyncio.run(run())
+
+    ########## ASSERT ##########
+    assert result == "a"
+    assert finished == ["a"]
+    assert len(single_flight) == 0
+
+
+@pytest.mark.usefixtures("fake_server")
+def test_identical_chats_are_coalesced(
+    fake_op: FakeOpaquePrompts, fake_llm: FakeLLM
+) -> None:
+    """
+    Validates that identical chats in flight at the same time share one
+    sanitize, LLM and desanitize call and their response, while a different
+    chat is completed on its own
+    """
+    ########## ARRANGE ##########
+    fake_llm.latency = 0.2
+    body = {"history": ["Hi, I am Bob", "Hello PERSON_2"], "prompt": "Hi"}
+    other = {**body, "prompt": "Say hi to Alice"}
+    followers_before = coalesced("follower")
+
+    ########## ACT ##########
+    responses = asyncio.run(post_requests("/chat", [body] * 10 + [other]))
+
+    ########## ASSERT ##########
+    assert all(response.status_code == 200 for response in responses)
+    assert len({response.content for response in responses[:10]}) == 1
+    assert responses[10].json()["desanitizedResponse"] != (
+        responses[0].json()["desanitizedResponse"]
+    )
+    assert len(fake_op.sanitize_calls) == 2
+    assert len(fake_op.desanitize_calls) == 2
+    assert coalesced("follower") == followers_before + 9
+
+
+@pytest.mark.usefixtures("fake_server")
+def test_coalescing_can_be_disabled(
+    fake_op: FakeOpaquePrompts,
+    fake_llm: FakeLLM,
+    monkeypatch: pytest.MonkeyPatch,
+) -> None:
+    """
+    Validates that identical chats are each completed when coalescing is
+    disabled
+    """
+    ########## ARRANGE ##########
+    monkeypatch.setenv("CHAT_COALESCING_ENABLED", "false")
+    fake_llm.latency = 0.1
+    body = {"history": [], "prompt": "Hi"}
+
+    ########## ACT ##########
+    responses = asyncio.run(post_requests("/chat", [body] * 3))
+
+    ########## ASSERT ##########
+    assert all(response.status_code == 200 for response in responses)
+    assert len(fake_op.sanitize_calls) == 3
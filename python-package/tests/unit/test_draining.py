@@ -0,0 +1,147 @@
+"""
+Unit tests for draining.py and the draining of the server before it stops
+"""
+import asyncio
+import os
+import signal
+from typing import Dict, List, Tuple
+
+import httpx
+import pytest
+from conftest import AUTH_HEADERS, FakeLLM
+from opchatserver import draining
+from opchatserver.draining import Drain, install_drain_signal_handler
+
+CHAT = {"history": [], "prompt": "Hi, I am Alice."}
+
+### Tests ###
+
+
+def test_drain_waits_for_the_chats_in_flight() -> None:
+    """
+    Validates that waiting for the drain returns once no chat is in flight,
+    or after the timeout
+    """
+    ########## ARRANGE ##########
+    drain = Drain()
+
+    async def chat(seconds: float) -> None:
+        with drain.track():
+            await asyncio.sleep(seconds)
+
+    async def run() -> Tuple[bool, bool, bool]:
+        idle = await drain.wait(0.01)
+        asyncio.ensure_future(chat(0.05))
+        await asyncio.sleep(0)
+        drained = await drain.wait(1)
+        asyncio.ensure_future(chat(1))
+        await asyncio.sleep(0)
+        timed_out = await drain.wait(0.05)
+        return idle, drained, timed_out
+
+    ########## ACT ##########
+    idle, drained, timed_out = asyncio.run(run())
+
+    ########## ASSERT ##########
+    assert idle is True
+    assert drained is True
+    assert timed_out is False
+
+
+@pytest.mark.usefixtures("fake_server")
+def test_draining_server_finishes_chats_and_rejects_new_ones(
+    fake_llm: FakeLLM,
+) -> None:
+    """
+    Validates that once the server drains, /ready and new chats answer 503,
+    while the chats in flight are answered before the server stops
+    """
+    from opchatserver import server
+
+    ########## ARRANGE ##########
+    fake_llm.latency = 0.2
+
+    async def drain_during_chat() -> Dict[str, httpx.Response]:
+        async with server.app.router.lifespan_context(server.app):
+            await server.app.state.warm_up.load_pipeline()
+            transport = httpx.ASGITransport(app=server.app)
+            async with httpx.AsyncClient(
+                transport=transport, base_url="http://test"
+            ) as client:
+                ########## ACT ##########
+                in_flight = asyncio.ensure_future(
+                    client.post("/chat", json=CHAT, headers=AUTH_HEADERS)
+                )
+                await asyncio.sleep(0.05)
+                server.app.state.drain.start()
+                ready = await client.get("/ready")
+                rejected = await client.post(
+                    "/chat", json=CHAT, headers=AUTH_HEADERS
+                )
+        # The shutdown of the server waited for the chat in flight
+        assert in_flight.done()
+        return {
+            "in_flight": in_flight.result(),
+            "ready": ready,
+            "rejected": rejected,
+        }
+
+    responses = asyncio.run(drain_during_chat())
+
+    ########## ASSERT ##########
+    assert responses["in_flight"].status_code == 200
+    assert responses["ready"].status_code == 503
+    assert responses["ready"].json()["draining"] is True
+    assert responses["rejected"].status_code == 503
+    assert responses["rejected"].headers["Retry-After"] == "1"
+
+
+def test_sigterm_drains_before_handing_over(
+    monkeypatch: pytest.MonkeyPatch,
+) -> None:
+    """
+    Validates that with SHUTDOWN_DRAIN_DELAY set, SIGTERM starts draining
+    and SIGINT is only raised, once, when the chats in flight are done
+    """
+    ########## ARRANGE ##########
+    monkeypatch.setenv("SHUTDOWN_DRAIN_DELAY", "5")
+    raised: List[int] = []
+    monkeypatch.setattr(draining.signal, "raise_signal", raised.append)
+    drain = Drain()
+
+    async def run() -> Tuple[bool, List[int]]:
+        assert install_drain_signal_handler(drain)
+        with drain.track():
+            os.kill(os.getpid(), signal.SIGTERM)
+            await asyncio.sleep(0.05)
+            raised_during_chat = list(raised)
+        await asyncio.sleep(0.05)
+        os.kill(os.getpid(), signal.SIGTERM)
+        await asyncio.sleep(0.05)
+        return drain.draining, raised_during_chat
+
+    ########## ACT ##########
+    is_draining, raised_during_chat = asyncio.run(run())
+
+    ########## ASSERT ##########
+    assert is_draining is True
+    assert raised_during_chat == []
+    assert raised == [signal.SIGINT]
+
+
+def test_signal_handler_is_not_installed_by_default() -> None:
+    """
+    Validates that SIGTERM is left to the server unless SHUTDOWN_DRAIN_DELAY
+    is set
+    """
+    ########## ARRANGE ##########
+    drain = Drain()
+
+    async def run() -> bool:
+        return install_drain_signal_handler(drain)
+
+    ########## ACT ##########
+    installed = asyncio.run(run())
+
+    ########## ASSERT ##########
+    assert installed is False
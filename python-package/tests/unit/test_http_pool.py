@@ -0,0 +1,190 @@
+"""
+Unit tests for http_pool.py
+"""
+import asyncio
+import sys
+import threading
+import types
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Dict, Iterator, List, Set
+
+import openai
+import pytest
+from opchatserver.http_pool import (
+    UpstreamPools,
+    UpstreamPoolsMiddleware,
+    close_upstream_pools,
+    start_upstream_pools,
+)
+from prometheus_client import REGISTRY
+
+
+class KeepAliveServer:
+    """A local HTTP/1.1 server which records the client connections"""
+
+    def __init__(self) -> None:
+        self.client_ports: Set[int] = set()
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def do_GET(self) -> None:
+                server.client_ports.add(self.client_address[1])
+                self.send_response(200)
+                self.send_header("Content-Length", "2")
+                self.end_headers()
+                self.wfile.write(b"ok")
+
+            def log_message(self, *args: Any) -> None:
+                pass
+
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.url = f"http://127.0.0.1:{self.httpd.server_port}/"
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+
+
+### Fixtures ###
+
+
+@pytest.fixture
+def keep_alive_server() -> Iterator[KeepAliveServer]:
+    server = KeepAliveServer()
+    yield server
+    server.httpd.shutdown()
+
+
+### Tests ###
+
+
+def test_aiohttp_pool_reuses_connections(
+    keep_alive_server: KeepAliveServer,
+) -> None:
+    """
+    Validates that sequential asynchronous calls reuse one connection
+    """
+
+    ########## ARRANGE ##########
+    async def send_requests() -> None:
+        pools = UpstreamPools()
+        await pools.start()
+        try:
+            assert pools.aiohttp_session is not None
+            for _ in range(5):
+                async with pools.aiohttp_session.get(
+                    keep_alive_server.url
+                ) as response:
+                    await response.read()
+            assert pools.usage()["aiohttp"]["idle"] == 1
+        finally:
+            await pools.close()
+
+    ########## ACT ##########
+    asyncio.run(send_requests())
+
+    ########## ASSERT ##########
+    assert len(keep_alive_server.client_ports) == 1
+
+
+def test_pools_are_installed_in_openai() -> None:
+    """
+    Validates that the OpenAI client uses the pooled requests session while
+    the pools are started
+    """
+
+    ########## ARRANGE ##########
+    async def start_and_close() -> None:
+        pools = await start_upstream_pools()
+        assert openai.requestssession is pools.requests_session
+        await close_upstream_pools()
+
+    ########## ACT ##########
+    asyncio.run(start_and_close())
+
+    ########## ASSERT ##########
+    assert openai.requestssession is None
+
+
+def test_middleware_sets_aiohttp_session() -> None:
+    """
+    Validates that the middleware makes asynchronous OpenAI calls use the
+    shared session during a request and records the pool usage
+    """
+    ########## ARRANGE ##########
+    sessions: List[Any] = []
+
+    async def app(scope: Any, receive: Any, send: Any) -> None:
+        sessions.append(openai.aiosession.get())
+
+    async def handle_request() -> Any:
+        pools = await start_upstream_pools()
+        try:
+            await UpstreamPoolsMiddleware(app)({"type": "http"}, None, None)
+            return pools.aiohttp_session
+        finally:
+            await close_upstream_pools()
+
+    ########## ACT ##########
+    session = asyncio.run(handle_request())
+
+    ########## ASSERT ##########
+    assert sessions == [session]
+    assert openai.aiosession.get() is None
+    assert (
+        REGISTRY.get_sample_value(
+            "upstream_pool_connections",
+            {"pool": "aiohttp", "state": "limit"},
+        )
+        == 100
+    )
+
+
+def test_unsupported_opaqueprompts_client_keeps_its_session(
+    monkeypatch: pytest.MonkeyPatch,
+) -> None:
+    """
+    Validates that the pools start, and leave the OpaquePrompts client its
+    own session, when the internals of the client are not found
+    """
+    ########## ARRANGE ##########
+    opaqueprompts_service = types.ModuleType("opaqueprompts_service")
+    opaqueprompts = types.ModuleType("opaqueprompts")
+    setattr(opaqueprompts, "opaqueprompts_service", opaqueprompts_service)
+    monkeypatch.setitem(sys.modules, "opaqueprompts", opaqueprompts)
+
+    async def start_and_close() -> Any:
+        pools = await start_upstream_pools()
+        try:
+            return pools.opaqueprompts_session
+        finally:
+            await close_upstream_pools()
+
+    ########## ACT ##########
+    session = asyncio.run(start_and_close())
+
+    ########## ASSERT ##########
+    assert session is None
+    assert not hasattr(opaqueprompts_service, "_session")
+
+
+def test_usage_leaves_out_missing_aiohttp_counts() -> None:
+    """
+    Validates that the usage of the aiohttp pool only has its limit when
+    its connector does not have the expected internals
+    """
+
+    ########## ARRANGE ##########
+    class Connector:
+        limit = 10
+
+    class Session:
+        connector = Connector()
+
+    pools = UpstreamPools()
+    setattr(pools, "aiohttp_session", Session())
+
+    ########## ACT ##########
+    usage: Dict[str, Dict[str, int]] = pools.usage()
+
+    ########## ASSERT ##########
+    assert usage == {"aiohttp": {"limit": 10}}
@@ -0,0 +1,239 @@
+"""
+Unit tests for memory.py
+"""
+from typing import Any, Dict, List
+
+import pytest
+from conftest import FakeOpaquePrompts
+from langchain.schema import SystemMessage
+from opchatserver import memory
+from opchatserver.intermediate_outputs import _sanitize, _sanitize_batch
+from opchatserver.memory import (
+    build_memory,
+    count_tokens,
+    create_history_window,
+    summarize_turns,
+)
+
+
+def make_history(turns: int, words: int = 1) -> List[str]:
+    return [
+        " ".join([f"{role}{i}"] * words)
+        for i in range(turns)
+        for role in ("question", "answer")
+    ]
+
+
+### Tests ###
+
+
+def test_history_is_limited_by_turns() -> None:
+    """
+    Validates that at most `k` of the most recent turns are kept
+    """
+    ########## ARRANGE ##########
+    history = make_history(8)
+
+    ########## ACT ##########
+    messages = build_memory(history, k=5).buffer_as_messages
+
+    ########## ASSERT ##########
+    assert [m.content for m in messages] == history[-10:]
+
+
+def test_history_is_limited_by_tokens() -> None:
+    """
+    Validates that the oldest turns are dropped first to fit the token
+    budget, so that long turns keep fewer turns than short ones
+    """
+    ########## ARRANGE ##########
+    long_history = make_history(8, words=50)
+    short_history = make_history(8, words=1)
+    budget = 2 * sum(count_tokens(m, "gpt-4") for m in long_history[-4:])
+
+    ########## ACT ##########
+    long_messages = build_memory(
+        long_history, k=20, max_tokens=budget, model="gpt-4"
+    ).buffer_as_messages
+    short_messages = build_memory(
+        short_history, k=20, max_tokens=budget, model="gpt-4"
+    ).buffer_as_messages
+
+    ########## ASSERT ##########
+    assert 4 <= len(long_messages) < len(long_history)
+    assert [m.content for m in long_messages] == long_history[
+        -len(long_messages) :
+    ]
+    assert len(short_messages) == len(short_history)
+
+
+def test_turn_larger_than_budget_is_dropped() -> None:
+    """
+    Validates that a history whose last turn is over the budget is dropped
+    """
+    ########## ARRANGE ##########
+    history = make_history(2, words=200)
+
+    ########## ACT ##########
+    messages = build_memory(history, max_tokens=50).buffer_as_messages
+
+    ########## ASSERT ##########
+    assert messages == []
+
+
+def test_truncated_turns_are_summarized() -> None:
+    """
+    Validates that the dropped turns are summarized into a system message
+    at the start of the history
+    """
+    ########## ARRANGE ##########
+    history = [
+        "My name is Alice. I like tea.",
+        "Nice to meet you.",
+        "What is the capital of France? Thanks.",
+        "Paris.",
+    ] + make_history(4, words=20)
+
+    ########## ACT ##########
+    messages = build_memory(
+        history, k=4, max_tokens=2000, summarize=summarize_turns
+    ).buffer_as_messages
+
+    ########## ASSERT ##########
+    assert isinstance(messages[0], SystemMessage)
+    assert messages[0].content == (
+        "Earlier, the user said: My name is Alice. / "
+        "What is the capital of France?"
+    )
+    assert [m.content for m in messages[1:]] == history[-8:]
+
+
+def test_summary_is_sanitized_with_history(fake_op: FakeOpaquePrompts) -> None:
+    """
+    Validates that the summary is sanitized and comes first in the
+    sanitized history
+    """
+    ########## ARRANGE ##########
+    history = ["I am Alice.", "Hi.", "I am Bob.", "Hello."]
+    messages = build_memory(
+        history, k=1, summarize=summarize_turns
+    ).buffer_as_messages
+
+    ########## ACT ##########
+    sanitized = _sanitize({"prompt": "Hi", "history": messages})
+
+    ########## ASSERT ##########
+    assert sanitized["sanitized_input"]["history"] == (
+        "System: Earlier, the user said: I am PERSON_1.\n"
+        "Human: I am PERSON_2.AI: Hello."
+    )
+
+
+def test_sanitize_does_not_modify_its_input(
+    fake_op: FakeOpaquePrompts,
+) -> None:
+    """
+    Validates that the history is flattened into one text per message
+    without modifying the input, and joined back in order
+    """
+    ########## ARRANGE ##########
+    history = ["I am Alice.", "Hi.", "I am Bob.", "Hello.", "Bye.", "Bye."]
+    messages = build_memory(history, k=3).buffer_as_messages
+    unsanitized_input = {
+        "prompt": "Hi",
+        "history": messages,
+        "conversation_key": "subject:conversation",
+    }
+    original = dict(unsanitized_input)
+
+    ########## ACT ##########
+    sanitized = _sanitize(unsanitized_input)
+
+    ########## ASSERT ##########
+    assert unsanitized_input == original
+    assert fake_op.sanitize_calls == [
+        {
+            "prompt": "Hi",
+            "Human 1": "I am Alice.",
+            "Ai 1": "Hi.",
+            "Human 2": "I am Bob.",
+            "Ai 2": "Hello.",
+            "Human 3": "Bye.",
+            "Ai 3": "Bye.",
+        }
+    ]
+    assert sanitized["sanitized_input"] == {
+        "prompt": "Hi",
+        "history": "Human: I am PERSON_1.AI: Hi."
+        "Human: I am PERSON_2.AI: Hello.Human: Bye.AI: Bye.",
+    }
+
+
+def test_batch_sanitize_matches_sanitize(fake_op: FakeOpaquePrompts) -> None:
+    """
+    Validates that the inputs sanitized in one call are sanitized like they
+    are on their own, including the inputs without a history
+    """
+    ########## ARRANGE ##########
+    messages = build_memory(["I am Alice.", "Hi."]).buffer_as_messages
+    inputs: List[Dict[str, Any]] = [
+        {"prompt": "I am Bob."},
+        {"prompt": "Hi", "history": messages},
+    ]
+
+    ########## ACT ##########
+    batched = _sanitize_batch(inputs)
+    alone = [_sanitize(unsanitized_input) for unsanitized_input in inputs]
+
+    ########## ASSERT ##########
+    assert len(fake_op.sanitize_calls) == 3
+    assert [response["sanitized_input"] for response in batched] == [
+        response["sanitized_input"] for response in alone
+    ]
+    assert "history" not in batched[0]["sanitized_input"]
+
+
+def test_token_counts_are_cached(monkeypatch: pytest.MonkeyPatch) -> None:
+    """
+    Validates that each message is only tokenized once
+    """
+    ########## ARRANGE ##########
+    calls: List[str] = []
+    count = memory._count_tokens
+
+    def counting(text: str, model: str) -> int:
+        calls.append(text)
+        return count(text, model)
+
+    monkeypatch.setattr(memory, "_count_tokens", counting)
+    monkeypatch.setattr(
+        memory, "_token_counts", memory.TTLCache(maxsize=16, ttl=60)
+    )
+    history = make_history(3)
+
+    ########## ACT ##########
+    for _ in range(3):
+        build_memory(history, max_tokens=1000)
+
+    ########## ASSERT ##########
+    assert sorted(calls) == sorted(history)
+
+
+def test_history_window_from_environment(
+    monkeypatch: pytest.MonkeyPatch,
+) -> None:
+    """
+    Validates that the token budget defaults to a quarter of the context
+    window of the model, and can be configured
+    """
+    ########## ACT ##########
+    default = create_history_window("gpt-4-0613")
+    monkeypatch.setenv("HISTORY_MAX_TOKENS", "0")
+    monkeypatch.setenv("HISTORY_SUMMARY", "extractive")
+    configured = create_history_window("gpt-4-0613")
+
+    ########## ASSERT ##########
+    assert default.max_tokens == 2048
+    assert default.summarize is None
+    assert configured.max_tokens is None
+    assert configured.summarize is summarize_turns
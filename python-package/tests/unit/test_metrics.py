@@ -0,0 +1,126 @@
+"""
+Unit tests for metrics.py
+"""
+import asyncio
+import os
+import subprocess
+import sys
+from pathlib import Path
+from typing import Any, Dict, List
+
+import pytest
+from conftest import post_requests
+from opchatserver.metrics import make_metrics_app, track_stage
+from prometheus_client import REGISTRY
+
+
+def sample(name: str, labels: Dict[str, str]) -> float:
+    """Get the value of a sample of the default registry, or 0"""
+    return REGISTRY.get_sample_value(name, labels) or 0.0
+
+
+async def get_metrics(app: Any) -> str:
+    """Call a metrics ASGI application and return the body"""
+    messages: List[Dict[str, Any]] = []
+
+    async def receive() -> Dict[str, Any]:
+        return {"type": "http.request", "body": b"", "more_body": False}
+
+    async def send(message: Dict[str, Any]) -> None:
+        messages.append(message)
+
+    scope = {
+        "type": "http",
+        "method": "GET",
+        "path": "/",
+        "query_string": b"",
+        "headers": [],
+    }
+    await app(scope, receive, send)
+    return b"".join(m.get("body", b"") for m in messages).decode()
+
+
+### Tests ###
+
+
+def test_track_stage_records_errors() -> None:
+    """
+    Validates that a stage is measured and its errors counted by type, and
+    that it is no longer in flight afterwards
+    """
+    ########## ARRANGE ##########
+    labels = {"stage": "test-errors"}
+    error_labels = {"stage": "test-errors", "error": "ValueError"}
+
+    ########## ACT ##########
+    with pytest.raises(ValueError):
+        with track_stage("test-errors"):
+            assert sample("chat_stage_in_flight", labels) == 1
+            raise ValueError()
+
+    ########## ASSERT ##########
+    assert sample("chat_stage_duration_seconds_count", labels) == 1
+    assert sample("chat_stage_errors_total", error_labels) == 1
+    assert sample("chat_stage_in_flight", labels) == 0
+
+
+@pytest.mark.usefixtures("fake_server")
+def test_chat_records_stages() -> None:
+    """
+    Validates that a /chat request records the latency of each stage and a
+    positive total latency
+    """
+    ########## ARRANGE ##########
+    stages = ["auth", "memory", "sanitize", "llm", "desanitize"]
+    before = {
+        stage: sample("chat_stage_duration_seconds_count", {"stage": stage})
+        for stage in stages
+    }
+    endpoint = {"endpoint": "/chat"}
+    requests_before = sample("http_request_duration_seconds_count", endpoint)
+    body = {"history": [], "prompt": "Hi Alice"}
+
+    ########## ACT ##########
+    (response,) = asyncio.run(post_requests("/chat", [body]))
+
+    ########## ASSERT ##########
+    assert response.status_code == 200
+    for stage in stages:
+        labels = {"stage": stage}
+        count = sample("chat_stage_duration_seconds_count", labels)
+        assert count == before[stage] + 1, stage
+    assert (
+        sample("http_request_duration_seconds_count", endpoint)
+        == requests_before + 1
+    )
+    assert sample("http_request_duration_seconds_sum", endpoint) > 0
+    assert sample("http_responses_total", {**endpoint, "status": "200"}) >= 1
+
+
+def test_metrics_are_aggregated_across_workers(
+    tmp_path: Path, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    """
+    Validates that /metrics reports the sum of the metrics of the worker
+    processes when PROMETHEUS_MULTIPROC_DIR is set
+    """
+    ########## ARRANGE ##########
+    env: Dict[str, str] = {
+        **os.environ,
+        "PROMETHEUS_MULTIPROC_DIR": str(tmp_path),
+        "PYTHONPATH": os.pathsep.join(sys.path),
+    }
+    worker = (
+        "from opchatserver.metrics import track_stage\n"
+        "with track_stage('sanitize'):\n"
+        "    pass\n"
+    )
+    for _ in range(2):
+        subprocess.run([sys.executable, "-c", worker], env=env, check=True)
+    monkeypatch.setenv("PROMETHEUS_MULTIPROC_DIR", str(tmp_path))
+
+    ########## ACT ##########
+    metrics = asyncio.run(get_metrics(make_metrics_app()))
+
+    ########## ASSERT ##########
+    assert 'chat_stage_duration_seconds_count{stage="sanitize"} 2.0' in metrics
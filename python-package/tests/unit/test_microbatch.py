@@ -0,0 +1,189 @@
+"""
+Unit tests for microbatch.py and the batching of the OpaquePrompts calls
+"""
+import asyncio
+import time
+from typing import List
+
+import pytest
+from conftest import FakeLLM, FakeOpaquePrompts, post_requests
+from opchatserver.microbatch import MicroBatcher
+
+### Fixtures ###
+
+
+@pytest.fixture
+def batches() -> List[List[str]]:
+    return []
+
+
+@pytest.fixture
+def batcher(batches: List[List[str]]) -> MicroBatcher[str, str]:
+    async def run_batch(items: List[str]) -> List[str]:
+        batches.append(items)
+        await asyncio.sleep(0.01)
+        if "fail" in items:
+            raise ValueError("fail")
+        if "slow" in items:
+            await asyncio.sleep(10)
+        if "short" in items:
+            return []
+        return [item.upper() for item in items]
+
+    return MicroBatcher("test", run_batch, max_size=3, window=0.05)
+
+
+### Tests ###
+
+
+def test_inputs_are_batched_within_the_window(
+    batcher: MicroBatcher[str, str], batches: List[List[str]]
+) -> None:
+    """
+    Validates that the inputs submitted within the window with the same key
+    are run as one batch, at most `max_size` at a time, and that each caller
+    gets the result of its own input
+    """
+
+    ########## ARRANGE ##########
+    async def run() -> List[str]:
+        return await asyncio.gather(
+            *[
+                batcher.submit(key, item)
+                for key, item in [
+                    ("bob", "a"),
+                    ("bob", "b"),
+                    ("alice", "c"),
+                    ("bob", "d"),
+                    ("bob", "e"),
+                ]
+            ]
+        )
+
+    ########## ACT ##########
+    results = asyncio.run(run())
+
+    ########## ASSERT ##########
+    assert results == ["A", "B", "C", "D", "E"]
+    assert sorted(batches) == [["a", "b", "d"], ["c"], ["e"]]
+
+
+def test_batch_errors_are_raised_to_every_caller(
+    batcher: MicroBatcher[str, str]
+) -> None:
+    """
+    Validates that the error of a batch is raised to each of its callers,
+    and that later inputs are batched again
+    """
+
+    ########## ARRANGE ##########
+    async def run() -> List[object]:
+        failed = await asyncio.gather(
+            batcher.submit("bob", "a"),
+            batcher.submit("bob", "fail"),
+            return_exceptions=True,
+        )
+        return [*failed, await batcher.submit("bob", "b")]
+
+    ########## ACT ##########
+    results = asyncio.run(run())
+
+    ########## ASSERT ##########
+    assert all(isinstance(result, ValueError) for result in results[:2])
+    assert results[2] == "B"
+
+
+def test_incomplete_batches_fail_every_caller(
+    batcher: MicroBatcher[str, str]
+) -> None:
+    """
+    Validates that the callers of a batch which returns too few results, or
+    which is cancelled, get an error instead of waiting forever
+    """
+
+    ########## ARRANGE ##########
+    async def run() -> List[object]:
+        short = await asyncio.gather(
+            batcher.submit("bob", "a"),
+            batcher.submit("bob", "short"),
+            return_exceptions=True,
+        )
+        slow = asyncio.gather(
+            batcher.submit("alice", "a"),
+            batcher.submit("alice", "slow"),
+            return_exceptions=True,
+        )
+        await asyncio.sleep(0.1)
+        for task in list(batcher._running):
+            task.cancel()
+        return [*short, *await asyncio.wait_for(slow, 1)]
+
+    ########## ACT ##########
+    results = asyncio.run(run())
+
+    ########## ASSERT ##########
+    assert len(results) == 4
+    assert all(isinstance(result, RuntimeError) for result in results)
+
+
+@pytest.mark.usefixtures("fake_server")
+def test_concurrent_chats_of_a_user_share_opaqueprompts_calls(
+    fake_op: FakeOpaquePrompts,
+    fake_llm: FakeLLM,
+    monkeypatch: pytest.MonkeyPatch,
+) -> None:
+    """
+    Validates that the concurrent chats of a user are sanitized and
+    desanitized in batched calls, and that each of them gets the response
+    to its own prompt
+    """
+    ########## ARRANGE ##########
+    for stage in ["SANITIZE", "DESANITIZE"]:
+        monkeypatch.setenv(f"{stage}_BATCH_MAX_SIZE", "8")
+        monkeypatch.setenv(f"{stage}_BATCH_WINDOW", "0.05")
+    fake_llm.latency = 0.1
+    bodies = [
+        {
+            "history": ["Hi, I am Bob", "Hello PERSON_2"],
+            "prompt": f"Say hi to Alice #{i}",
+        }
+        for i in range(4)
+    ]
+
+    ########## ACT ##########
+    responses = asyncio.run(post_requests("/chat", bodies))
+
+    ########## ASSERT ##########
+    assert all(response.status_code == 200 for response in responses)
+    for i, response in enumerate(responses):
+        assert f"Say hi to Alice #{i}" in (
+            response.json()["desanitizedResponse"]
+        )
+    assert len(fake_op.sanitize_calls) == 1
+    assert len(fake_op.desanitize_calls) == 1
+
+
+@pytest.mark.usefixtures("fake_server")
+def test_unbatched_chat_does_not_wait_for_the_desanitize_window(
+    fake_op: FakeOpaquePrompts, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    """
+    Validates that the response to a chat which was sanitized on its own,
+    and so cannot share its desanitize call, is not kept waiting for the
+    window of the desanitize batches
+    """
+    ########## ARRANGE ##########
+    monkeypatch.setenv("DESANITIZE_BATCH_MAX_SIZE", "8")
+    monkeypatch.setenv("DESANITIZE_BATCH_WINDOW", "5")
+    body = {"history": [], "prompt": "Say hi to Alice"}
+
+    ########## ACT ##########
+    start = time.perf_counter()
+    (response,) = asyncio.run(post_requests("/chat", [body]))
+    elapsed = time.perf_counter() - start
+
+    ########## ASSERT ##########
+    assert response.status_code == 200
+    assert response.json()["desanitizedResponse"] == "Echo: Say hi to Alice"
+    assert len(fake_op.desanitize_calls) == 1
+    assert elapsed < 2
@@ -0,0 +1,238 @@
+"""
+Unit tests for prescreen.py and the pre-screen of the chat endpoints
+"""
+import asyncio
+import json
+from typing import Optional
+
+import pytest
+from conftest import FakeOpaquePrompts, post_requests
+from opchatserver.prescreen import ENTITY_PATTERNS, PreScreen, get_prescreen
+from prometheus_client import REGISTRY
+
+
+def decisions(decision: str, entity: str) -> float:
+    return (
+        REGISTRY.get_sample_value(
+            "prescreen_decisions_total",
+            {"decision": decision, "entity": entity},
+        )
+        or 0.0
+    )
+
+
+### Fixtures ###
+
+
+@pytest.fixture
+def conservative(monkeypatch: pytest.MonkeyPatch) -> None:
+    monkeypatch.setenv("PRESCREEN_MODE", "conservative")
+
+
+### Tests ###
+
+
+@pytest.mark.parametrize(
+    "text, entity",
+    [
+        ("hello, how are you?", None),
+        ("I'm fine, thanks. What can you do?", None),
+        ("Please write me a poem about the sea.", None),
+        ("Hi, I am Alice", "PROPER_NOUN"),
+        ("Will you help me?", "PROPER_NOUN"),
+        ("mail me at bob@example.com", "EMAIL_ADDRESS"),
+        ("call +1 (415) 555-0100 now", "PHONE_NUMBER"),
+        ("my card is 4111 1111 1111 1111", "CREDIT_CARD"),
+        ("ssn 078-05-1120", "US_SSN"),
+        ("see https://example.com/me", "URL"),
+        ("connect to 10.0.0.12", "IP_ADDRESS"),
+        ("born on 12/03/1990", "DATE"),
+        ("i turned 42", "NUMBER"),
+        ("merci josé", "NON_ASCII"),
+    ],
+)
+def test_conservative_pre_screen_finds_entities(
+    text: str, entity: Optional[str]
+) -> None:
+    """
+    Validates that the conservative pre-screen finds the first sensitive
+    data of a text, and lets plain text through
+    """
+    ########## ARRANGE ##########
+    prescreen = PreScreen(ENTITY_PATTERNS)
+
+    ########## ACT ##########
+    found = prescreen.find_entity(text)
+
+    ########## ASSERT ##########
+    assert found == entity
+
+
+def test_tunable_pre_screen_is_configured_by_the_environment(
+    monkeypatch: pytest.MonkeyPatch,
+) -> None:
+    """
+    Validates that the tunable pre-screen only looks for the configured
+    entities, and allows the configured words
+    """
+    ########## ARRANGE ##########
+    texts = ["How do I sort a list in Python 3?", "Use sorted(my_list)."]
+    monkeypatch.setenv("PRESCREEN_MODE", "tunable")
+    monkeypatch.setenv("PRESCREEN_ENTITIES", "EMAIL_ADDRESS, PROPER_NOUN")
+    monkeypatch.setenv("PRESCREEN_ALLOWED_WORDS", "Python,Use")
+
+    ########## ACT ##########
+    tunable = get_prescreen()
+    monkeypatch.setenv("PRESCREEN_MODE", "conservative")
+    conservative = get_prescreen()
+
+    ########## ASSERT ##########
+    assert tunable is not None and conservative is not None
+    assert tunable.entities == ("EMAIL_ADDRESS", "PROPER_NOUN")
+    assert tunable.is_clean(texts)
+    assert not tunable.is_clean(texts + ["Ask Bob"])
+    assert tunable.find_entity("write to bob42@example.com") == (
+        "EMAIL_ADDRESS"
+    )
+    assert not conservative.is_clean(texts)
+
+
+def test_pre_screen_rejects_unknown_configuration(
+    monkeypatch: pytest.MonkeyPatch,
+) -> None:
+    """
+    Validates that an unknown mode or entity is an error, and that the
+    pre-screen is disabled by default
+    """
+    ########## ARRANGE ##########
+    monkeypatch.delenv("PRESCREEN_MODE", raising=False)
+
+    ########## ACT ##########
+    default = get_prescreen()
+
+    ########## ASSERT ##########
+    assert default is None
+    monkeypatch.setenv("PRESCREEN_MODE", "aggressive")
+    with pytest.raises(ValueError):
+        get_prescreen()
+    monkeypatch.setenv("PRESCREEN_MODE", "tunable")
+    monkeypatch.setenv("PRESCREEN_ENTITIES", "PASSPORT")
+    with pytest.raises(ValueError):
+        get_prescreen()
+
+
+def test_pre_screen_caps_the_screened_length() -> None:
+    """
+    Validates that inputs longer than max_chars are flagged without being
+    scanned
+    """
+    ########## ARRANGE ##########
+    prescreen = PreScreen(["EMAIL_ADDRESS"], max_chars=10)
+    flagged_before = decisions("flagged", "TOO_LONG")
+
+    ########## ACT ##########
+    clean = prescreen.is_clean(["hello", "there, how are you"])
+
+    ########## ASSERT ##########
+    assert not clean
+    assert decisions("flagged", "TOO_LONG") == flagged_before + 1
+
+
+@pytest.mark.usefixtures("fake_server", "conservative")
+def test_clean_chat_skips_the_sanitizer(fake_op: FakeOpaquePrompts) -> None:
+    """
+    Validates that a clean chat is completed without calling OpaquePrompts,
+    and that a chat with sensitive data is still sanitized
+    """
+    ########## ARRANGE ##########
+    bodies = [
+        {
+            "history": ["hi", "hello, how can I help?"],
+            "prompt": "how are you?",
+        },
+        {"history": [], "prompt": "Say hi to Alice"},
+    ]
+    clean_before = decisions("clean", "")
+
+    ########## ACT ##########
+    clean, flagged = asyncio.run(post_requests("/chat", bodies))
+
+    ########## ASSERT ##########
+    assert clean.json() == {
+        "desanitizedResponse": "Echo: how are you?",
+        "sanitizedPrompt": "how are you?",
+        "rawResponse": "Echo: how are you?",
+        "preScreen": "clean",
+        "model": "gpt-3.5-turbo",
+        "timings": None,
+    }
+    assert flagged.json() == {
+        "desanitizedResponse": "Echo: Say hi to Alice",
+        "sanitizedPrompt": "Say hi to PERSON_1",
+        "rawResponse": "Echo: Say hi to PERSON_1",
+        "preScreen": "flagged",
+        "model": "gpt-3.5-turbo",
+        "timings": None,
+    }
+    assert fake_op.sanitize_calls == [{"prompt": "Say hi to Alice"}]
+    assert fake_op.desanitize_calls == ["Echo: Say hi to PERSON_1"]
+    assert decisions("clean", "") == clean_before + 1
+
+
+@pytest.mark.usefixtures("fake_server", "conservative")
+def test_clean_stream_skips_the_sanitizer(
+    fake_op: FakeOpaquePrompts,
+) -> None:
+    """
+    Validates that a clean stream is not sanitized, and reports the decision
+    with its sanitized prompt
+    """
+    ########## ARRANGE ##########
+    body = {"history": [], "prompt": "tell me a joke"}
+
+    ########## ACT ##########
+    (response,) = asyncio.run(post_requests("/chat/stream", [body]))
+
+    ########## ASSERT ##########
+    events = [
+        (event[len("event: ") :], json.loads(data[len("data: ") :]))
+        for event, data in (
+            block.split("\n") for block in response.text.strip().split("\n\n")
+        )
+    ]
+    assert events[0] == (
+        "sanitizedPrompt",
+        {"text": "tell me a joke", "preScreen": "clean"},
+    )
+    tokens = [data["text"] for event, data in events if event == "token"]
+    assert "".join(tokens) == "Echo: tell me a joke"
+    assert fake_op.sanitize_calls == []
+    assert fake_op.desanitize_calls == []
+
+
+@pytest.mark.usefixtures("fake_server", "conservative")
+def test_batch_only_sanitizes_flagged_requests(
+    fake_op: FakeOpaquePrompts,
+) -> None:
+    """
+    Validates that the clean requests of a batch are left out of its
+    sanitize call
+    """
+    ########## ARRANGE ##########
+    body = {
+        "requests": [
+            {"history": [], "prompt": "hello"},
+            {"history": [], "prompt": "Hi Carol"},
+        ]
+    }
+
+    ########## ACT ##########
+    (response,) = asyncio.run(post_requests("/chat/batch", [body]))
+
+    ########## ASSERT ##########
+    clean, flagged = response.json()["responses"]
+    assert clean["response"]["preScreen"] == "clean"
+    assert clean["response"]["desanitizedResponse"] == "Echo: hello"
+    assert flagged["response"]["preScreen"] == "flagged"
+    assert flagged["response"]["desanitizedResponse"] == "Echo: Hi Carol"
+    assert fake_op.sanitize_calls == [{"0 prompt": "Hi Carol"}]
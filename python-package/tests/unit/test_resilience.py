@@ -0,0 +1,325 @@
+"""
+Unit tests for resilience.py
+"""
+import asyncio
+import time
+from typing import Any, AsyncIterator, Dict, List
+
+import pytest
+import requests
+from conftest import FakeLLM, FakeOpaquePrompts, post_requests
+from opchatserver.resilience import (
+    CircuitBreaker,
+    CircuitOpenError,
+    StagePolicy,
+    UpstreamTimeoutError,
+    is_transient,
+)
+from prometheus_client import REGISTRY
+
+
+class FakeUpstream:
+    """
+    A local upstream service which answers each call after the latency at
+    the same index of `latencies` (or the last one), failing the calls
+    whose index is in `failures`.
+    """
+
+    def __init__(self, latencies: List[float], failures: List[int] = []):
+        self.latencies = latencies
+        self.failures = failures
+        self.calls = 0
+
+    async def call(self) -> int:
+        index = self.calls
+        self.calls += 1
+        await asyncio.sleep(
+            self.latencies[min(index, len(self.latencies) - 1)]
+        )
+        if index in self.failures:
+            raise ConnectionError(f"call {index} failed")
+        return index
+
+
+def sample(name: str, labels: Dict[str, str]) -> float:
+    return REGISTRY.get_sample_value(name, labels) or 0.0
+
+
+### Tests ###
+
+
+def test_slow_call_times_out() -> None:
+    """
+    Validates that a call slower than the timeout fails with
+    UpstreamTimeoutError without waiting for the call
+    """
+    ########## ARRANGE ##########
+    policy = StagePolicy("sanitize", timeout=0.05)
+    upstream = FakeUpstream([1.0])
+    timeouts_before = sample("upstream_timeouts_total", {"stage": "sanitize"})
+
+    ########## ACT ##########
+    start = time.perf_counter()
+    with pytest.raises(UpstreamTimeoutError):
+        asyncio.run(policy.call(upstream.call))
+    elapsed = time.perf_counter() - start
+
+    ########## ASSERT ##########
+    assert elapsed < 0.5
+    assert (
+        sample("upstream_timeouts_total", {"stage": "sanitize"})
+        == timeouts_before + 1
+    )
+
+
+def test_failed_calls_are_retried() -> None:
+    """
+    Validates that failed and timed out calls are retried until one
+    succeeds
+    """
+    ########## ARRANGE ##########
+    policy = StagePolicy(
+        "desanitize", timeout=0.05, retries=2, retry_base_delay=0.001
+    )
+    upstream = FakeUpstream([0.0, 1.0, 0.0], failures=[0])
+
+    ########## ACT ##########
+    result = asyncio.run(policy.call(upstream.call))
+
+    ########## ASSERT ##########
+    assert result == 2
+    assert upstream.calls == 3
+
+
+def test_retries_are_bounded() -> None:
+    """
+    Validates that the last error is raised once the retries are used up
+    """
+    ########## ARRANGE ##########
+    policy = StagePolicy("sanitize", retries=1, retry_base_delay=0.001)
+    upstream = FakeUpstream([0.0], failures=[0, 1, 2])
+
+    ########## ACT ##########
+    with pytest.raises(ConnectionError, match="call 1 failed"):
+        asyncio.run(policy.call(upstream.call))
+
+    ########## ASSERT ##########
+    assert upstream.calls == 2
+
+
+def http_error(status_code: int) -> requests.HTTPError:
+    response = requests.Response()
+    response.status_code = status_code
+    return requests.HTTPError(f"{status_code} error", response=response)
+
+
+@pytest.mark.parametrize(
+    "error, transient",
+    [
+        (ConnectionError("reset"), True),
+        (UpstreamTimeoutError("llm", "timed out"), True),
+        (requests.ConnectionError("refused"), True),
+        (http_error(503), True),
+        (http_error(429), True),
+        (http_error(400), False),
+        (ValueError("invalid input"), False),
+    ],
+)
+def test_transient_errors_are_recognized(
+    error: Exception, transient: bool
+) -> None:
+    """
+    Validates that timeouts, connection errors and 5xx or 429 responses are
+    transient, unlike the rejections of an invalid input
+    """
+    ########## ACT ##########
+    result = is_transient(error)
+
+    ########## ASSERT ##########
+    assert result == transient
+
+
+def test_non_transient_errors_neither_retry_nor_trip_the_breaker() -> None:
+    """
+    Validates that a call or a stream which fails because of its input is
+    not retried, and does not count towards opening the circuit
+    """
+    ########## ARRANGE ##########
+    breaker = CircuitBreaker("sanitize", failure_threshold=1)
+    policy = StagePolicy(
+        "sanitize", retries=2, retry_base_delay=0.001, breaker=breaker
+    )
+    calls = []
+
+    async def call() -> int:
+        calls.append("call")
+        raise http_error(400)
+
+    async def stream() -> AsyncIterator[int]:
+        calls.append("stream")
+        # Raises a ValueError
+        yield int("invalid input")
+
+    async def consume() -> List[int]:
+        return [item async for item in policy.stream(stream)]
+
+    ########## ACT ##########
+    with pytest.raises(requests.HTTPError):
+        asyncio.run(policy.call(call))
+    with pytest.raises(ValueError):
+        asyncio.run(consume())
+
+    ########## ASSERT ##########
+    assert calls == ["call", "stream"]
+    assert breaker.state == CircuitBreaker.CLOSED
+
+
+def test_circuit_opens_and_recovers() -> None:
+    """
+    Validates that the circuit opens after consecutive failures, fails fast
+    while open, and closes after a successful trial call
+    """
+    ########## ARRANGE ##########
+    now = [0.0]
+    breaker = CircuitBreaker(
+        "llm", failure_threshold=2, reset_timeout=10, timer=lambda: now[0]
+    )
+    policy = StagePolicy("llm", breaker=breaker)
+    upstream = FakeUpstream([0.0], failures=[0, 1])
+
+    async def call_twice() -> None:
+        for _ in range(2):
+            with pytest.raises(ConnectionError):
+                await policy.call(upstream.call)
+
+    ########## ACT ##########
+    asyncio.run(call_twice())
+    with pytest.raises(CircuitOpenError) as e:
+        asyncio.run(policy.call(upstream.call))
+    now[0] = 11
+    result = asyncio.run(policy.call(upstream.call))
+
+    ########## ASSERT ##########
+    assert e.value.retry_after == 10
+    assert upstream.calls == 3
+    assert result == 2
+    assert breaker.state == CircuitBreaker.CLOSED
+
+
+def test_half_open_circuit_lets_one_trial_through() -> None:
+    """
+    Validates that a half-open circuit rejects calls while its trial call is
+    in flight, and opens again if the trial call fails
+    """
+    ########## ARRANGE ##########
+    now = [0.0]
+    breaker = CircuitBreaker(
+        "llm", failure_threshold=1, reset_timeout=10, timer=lambda: now[0]
+    )
+    breaker.record_failure()
+    now[0] = 11
+
+    ########## ACT ##########
+    breaker.before_call()
+    with pytest.raises(CircuitOpenError):
+        breaker.before_call()
+    breaker.record_failure()
+
+    ########## ASSERT ##########
+    assert breaker.state == CircuitBreaker.OPEN
+    with pytest.raises(CircuitOpenError):
+        breaker.before_call()
+
+
+def test_hedged_call_returns_first_response() -> None:
+    """
+    Validates that a call slower than the hedging delay is hedged, and that
+    the faster response is used
+    """
+    ########## ARRANGE ##########
+    policy = StagePolicy("llm", hedge=True, hedge_after=0.05)
+    upstream = FakeUpstream([1.0, 0.0])
+    hedges_before = sample(
+        "upstream_hedges_total", {"stage": "llm", "winner": "hedge"}
+    )
+
+    ########## ACT ##########
+    start = time.perf_counter()
+    result = asyncio.run(policy.call(upstream.call))
+    elapsed = time.perf_counter() - start
+
+    ########## ASSERT ##########
+    assert result == 1
+    assert elapsed < 0.5
+    assert (
+        sample("upstream_hedges_total", {"stage": "llm", "winner": "hedge"})
+        == hedges_before + 1
+    )
+
+
+def test_fast_call_is_not_hedged() -> None:
+    """
+    Validates that a call faster than the hedging delay is made once
+    """
+    ########## ARRANGE ##########
+    policy = StagePolicy("llm", hedge=True, hedge_after=0.5)
+    upstream = FakeUpstream([0.0])
+
+    ########## ACT ##########
+    result = asyncio.run(policy.call(upstream.call))
+
+    ########## ASSERT ##########
+    assert result == 0
+    assert upstream.calls == 1
+
+
+@pytest.mark.usefixtures("fake_server")
+def test_chat_returns_504_when_llm_times_out(
+    fake_llm: FakeLLM, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    """
+    Validates that /chat responds with 504 when the llm is slower than its
+    timeout
+    """
+    ########## ARRANGE ##########
+    monkeypatch.setenv("LLM_TIMEOUT", "0.05")
+    fake_llm.latency = 1.0
+    body: Dict[str, Any] = {"history": [], "prompt": "Hi Alice"}
+
+    ########## ACT ##########
+    (response,) = asyncio.run(post_requests("/chat", [body]))
+
+    ########## ASSERT ##########
+    assert response.status_code == 504
+
+
+@pytest.mark.usefixtures("fake_server")
+def test_chat_returns_503_when_circuit_is_open(
+    fake_op: FakeOpaquePrompts, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    """
+    Validates that /chat fails fast with 503 and a Retry-After header once
+    the circuit of a failing upstream is open
+    """
+    ########## ARRANGE ##########
+    monkeypatch.setenv("SANITIZE_RETRIES", "0")
+    monkeypatch.setenv("CIRCUIT_FAILURE_THRESHOLD", "2")
+
+    def failing_sanitize(input: Any) -> Any:
+        fake_op.sanitize_calls.append(input)
+        raise ConnectionError("OpaquePrompts is down")
+
+    import langchain.utilities.opaqueprompts as op
+
+    monkeypatch.setattr(op, "sanitize", failing_sanitize)
+    body: Dict[str, Any] = {"history": [], "prompt": "Hi Alice"}
+
+    ########## ACT ##########
+    responses = [
+        asyncio.run(post_requests("/chat", [body]))[0] for _ in range(3)
+    ]
+
+    ########## ASSERT ##########
+    assert [r.status_code for r in responses] == [500, 500, 503]
+    assert responses[2].headers["Retry-After"] == "30"
+    assert len(fake_op.sanitize_calls) == 2
@@ -0,0 +1,181 @@
+"""
+Unit tests for response_cache.py and completion.py
+"""
+import asyncio
+from typing import Any, Dict, Iterator, List
+
+import pytest
+from conftest import FakeLLM, FakeOpaquePrompts, post_requests
+from langchain.prompts import PromptTemplate
+from opchatserver import response_cache
+from opchatserver.completion import LLMCompletion
+from prometheus_client import REGISTRY
+
+TEMPLATE = "Prompt: ```{prompt}```"
+
+
+def hits() -> float:
+    return (
+        REGISTRY.get_sample_value(
+            "response_cache_requests_total", {"result": "hit"}
+        )
+        or 0.0
+    )
+
+
+### Fixtures ###
+
+
+@pytest.fixture
+def enable_cache(monkeypatch: pytest.MonkeyPatch) -> Iterator[None]:
+    monkeypatch.setenv("RESPONSE_CACHE_ENABLED", "true")
+    monkeypatch.setattr(response_cache, "_cache", None)
+    yield
+
+
+### Tests ###
+
+
+@pytest.mark.usefixtures("enable_cache")
+def test_identical_prompts_call_llm_once(fake_llm: FakeLLM) -> None:
+    """
+    Validates that the llm is called once for identical prompts, while
+    other prompts and templates miss the cache
+    """
+    ########## ARRANGE ##########
+    completion = LLMCompletion(
+        PromptTemplate.from_template(TEMPLATE), fake_llm
+    )
+    other_template = LLMCompletion(
+        PromptTemplate.from_template("Other " + TEMPLATE), fake_llm
+    )
+    hits_before = hits()
+
+    ########## ACT ##########
+    responses = [
+        asyncio.run(completion.ainvoke({"prompt": "Hi PERSON_1"})),
+        completion.invoke({"prompt": "Hi PERSON_1"}),
+        asyncio.run(completion.ainvoke({"prompt": "Bye PERSON_1"})),
+        other_template.invoke({"prompt": "Hi PERSON_1"}),
+    ]
+
+    ########## ASSERT ##########
+    assert responses == [
+        "Echo: Hi PERSON_1",
+        "Echo: Hi PERSON_1",
+        "Echo: Bye PERSON_1",
+        "Echo: Hi PERSON_1",
+    ]
+    assert fake_llm.calls == 3
+    assert hits() == hits_before + 1
+
+
+@pytest.mark.usefixtures("enable_cache")
+def test_streamed_response_is_cached(fake_llm: FakeLLM) -> None:
+    """
+    Validates that a complete streamed response is cached and then streamed
+    as a single chunk
+    """
+    ########## ARRANGE ##########
+    completion = LLMCompletion(
+        PromptTemplate.from_template(TEMPLATE), fake_llm
+    )
+
+    async def stream() -> List[str]:
+        return [
+            chunk
+            async for chunk in completion.astream({"prompt": "Hi PERSON_1"})
+        ]
+
+    ########## ACT ##########
+    first = asyncio.run(stream())
+    second = asyncio.run(stream())
+
+    ########## ASSERT ##########
+    assert len(first) > 1
+    assert second == ["".join(first)]
+    assert fake_llm.calls == 1
+
+
+def test_cache_is_disabled_by_default(fake_llm: FakeLLM) -> None:
+    """
+    Validates that responses are not cached unless the cache is enabled
+    """
+    ########## ARRANGE ##########
+    completion = LLMCompletion(
+        PromptTemplate.from_template(TEMPLATE), fake_llm
+    )
+
+    ########## ACT ##########
+    for _ in range(2):
+        completion.invoke({"prompt": "Hi PERSON_1"})
+
+    ########## ASSERT ##########
+    assert fake_llm.calls == 2
+
+
+def test_cache_expires_responses(monkeypatch: pytest.MonkeyPatch) -> None:
+    """
+    Validates that cached responses expire after the time-to-live
+    """
+    ########## ARRANGE ##########
+    now = [0.0]
+    cache = response_cache.ResponseCache(maxsize=2, ttl=10)
+    monkeypatch.setattr(cache._responses, "_timer", lambda: now[0])
+    cache.set("key", "response")
+
+    ########## ACT ##########
+    now[0] = 11
+
+    ########## ASSERT ##########
+    assert cache.get("key") is None
+
+
+@pytest.mark.usefixtures("fake_server", "enable_cache")
+def test_chat_desanitizes_cached_response(
+    fake_op: FakeOpaquePrompts, fake_llm: FakeLLM
+) -> None:
+    """
+    Validates that a cached response is desanitized with the secure context
+    of the current request
+    """
+    ########## ARRANGE ##########
+    body: Dict[str, Any] = {"history": [], "prompt": "Hi Alice"}
+    asyncio.run(post_requests("/chat", [body]))
+
+    ########## ACT ##########
+    (response,) = asyncio.run(post_requests("/chat", [body]))
+
+    ########## ASSERT ##########
+    assert response.status_code == 200
+    assert response.json()["desanitizedResponse"] == "Echo: Hi Alice"
+    assert response.json()["rawResponse"] == "Echo: Hi PERSON_1"
+    assert fake_llm.calls == 1
+    assert len(fake_op.desanitize_calls) == 2
+
+
+@pytest.mark.usefixtures("fake_server", "enable_cache")
+def test_clean_pre_screened_chats_are_not_cached(
+    fake_op: FakeOpaquePrompts,
+    fake_llm: FakeLLM,
+    monkeypatch: pytest.MonkeyPatch,
+) -> None:
+    """
+    Validates that the chats which the pre-screen finds clean, which are
+    sent to the llm without being sanitized, leave the response cache empty
+    """
+    ########## ARRANGE ##########
+    monkeypatch.setenv("PRESCREEN_MODE", "conservative")
+    body: Dict[str, Any] = {"history": [], "prompt": "tell me a joke"}
+
+    ########## ACT ##########
+    for endpoint in ["/chat", "/chat", "/chat/stream"]:
+        (response,) = asyncio.run(post_requests(endpoint, [body]))
+        assert response.status_code == 200
+
+    ########## ASSERT ##########
+    cache = response_cache.get_response_cache()
+    assert cache is not None
+    assert len(cache._responses) == 0
+    assert fake_llm.calls == 3
+    assert fake_op.sanitize_calls == []
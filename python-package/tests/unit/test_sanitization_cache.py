@@ -0,0 +1,205 @@
+"""
+Unit tests for sanitization_cache.py
+"""
+import asyncio
+from typing import Any, Dict
+
+import pytest
+from conftest import FakeOpaquePrompts, post_requests
+from opchatserver import sanitization_cache
+from opchatserver.sanitization_cache import (
+    CompositeSecureContext,
+    SanitizationCache,
+    desanitize,
+)
+
+### Fixtures ###
+
+
+@pytest.fixture
+def cache() -> SanitizationCache:
+    return SanitizationCache(max_texts_per_conversation=8)
+
+
+### Tests ###
+
+
+def test_only_new_turns_are_sanitized(
+    cache: SanitizationCache, fake_op: FakeOpaquePrompts
+) -> None:
+    """
+    Validates that the turns of a conversation are only sent to the
+    sanitizer the first time they are seen
+    """
+
+    ########## ARRANGE ##########
+    first_turn = {"Human 1": "Hi", "prompt": "I am Alice"}
+    second_turn = {
+        "Human 1": "Hi",
+        "Ai 1": "Hello",
+        "Human 2": "I am Alice",
+        "Ai 2": "Hello PERSON_1",
+        "prompt": "Bob is my friend",
+    }
+
+    ########## ACT ##########
+    cache.sanitize("conversation", first_turn)
+    sanitized, _ = cache.sanitize("conversation", second_turn)
+
+    ########## ASSERT ##########
+    assert fake_op.sanitize_calls[1] == {
+        "Ai 1": "Hello",
+        "Ai 2": "Hello PERSON_1",
+        "prompt": "Bob is my friend",
+    }
+    assert sanitized["Human 2"] == "I am PERSON_1"
+    assert sanitized["prompt"] == "PERSON_2 is my friend"
+
+
+def test_cached_input_is_not_sanitized(
+    cache: SanitizationCache, fake_op: FakeOpaquePrompts
+) -> None:
+    """
+    Validates that an input whose texts are all cached is sanitized without
+    calling the sanitizer, with the secure context of the original call
+    """
+
+    ########## ARRANGE ##########
+    texts = {"Human 1": "I am Alice", "prompt": "Hi"}
+    _, first_context = cache.sanitize("conversation", texts)
+
+    ########## ACT ##########
+    sanitized, secure_context = cache.sanitize("conversation", texts)
+
+    ########## ASSERT ##########
+    assert len(fake_op.sanitize_calls) == 1
+    assert sanitized == {"Human 1": "I am PERSON_1", "prompt": "Hi"}
+    assert secure_context == first_context
+
+
+def test_conversations_are_isolated(
+    cache: SanitizationCache, fake_op: FakeOpaquePrompts
+) -> None:
+    """
+    Validates that texts cached for one conversation are not reused by
+    another conversation
+    """
+
+    ########## ARRANGE ##########
+    texts = {"prompt": "I am Alice"}
+    cache.sanitize("conversation 1", texts)
+
+    ########## ACT ##########
+    cache.sanitize("conversation 2", texts)
+
+    ########## ASSERT ##########
+    assert len(fake_op.sanitize_calls) == 2
+
+
+def test_colliding_placeholders_sanitize_whole_input(
+    cache: SanitizationCache, fake_op: FakeOpaquePrompts
+) -> None:
+    """
+    Validates that the whole input is sanitized again in a single call if a
+    new placeholder is already used by a cached text
+    """
+
+    ########## ARRANGE ##########
+    cache.sanitize("conversation", {"prompt": "I am Bob"})
+    texts = {"Human 1": "I am Bob", "prompt": "Is Bob here?"}
+
+    ########## ACT ##########
+    sanitized, secure_context = cache.sanitize("conversation", texts)
+
+    ########## ASSERT ##########
+    assert fake_op.sanitize_calls[-1] == texts
+    assert isinstance(secure_context, str)
+    assert sanitized == {
+        "Human 1": "I am PERSON_2",
+        "prompt": "Is PERSON_2 here?",
+    }
+
+
+def test_composite_context_desanitizes_each_call(
+    cache: SanitizationCache, fake_op: FakeOpaquePrompts
+) -> None:
+    """
+    Validates that a response is desanitized with the secure contexts of all
+    the calls that sanitized the input
+    """
+
+    ########## ARRANGE ##########
+    cache.sanitize("conversation", {"prompt": "I am Alice"})
+    _, secure_context = cache.sanitize(
+        "conversation",
+        {"Human 1": "I am Alice", "Ai 1": "Hi", "prompt": "Meet Carol"},
+    )
+
+    ########## ACT ##########
+    response = desanitize("PERSON_1, meet PERSON_3. Hi!", secure_context)
+
+    ########## ASSERT ##########
+    assert isinstance(secure_context, CompositeSecureContext)
+    assert response == "Alice, meet Carol. Hi!"
+    assert fake_op.desanitize_calls == [
+        "PERSON_1, meet PERSON_3. Hi!",
+        "Alice, meet PERSON_3. Hi!",
+    ]
+
+
+def test_texts_per_conversation_are_bounded(
+    fake_op: FakeOpaquePrompts,
+) -> None:
+    """
+    Validates that the least recently used texts of a conversation are
+    evicted beyond the limit
+    """
+
+    ########## ARRANGE ##########
+    cache = SanitizationCache(max_texts_per_conversation=2)
+    for prompt in ["one", "two", "three"]:
+        cache.sanitize("conversation", {"prompt": prompt})
+
+    ########## ACT ##########
+    cache.sanitize("conversation", {"prompt": "one"})
+    cache.sanitize("conversation", {"prompt": "three"})
+
+    ########## ASSERT ##########
+    assert fake_op.sanitize_calls == [
+        {"prompt": "one"},
+        {"prompt": "two"},
+        {"prompt": "three"},
+        {"prompt": "one"},
+    ]
+
+
+def test_chat_uses_cache_when_enabled(
+    fake_server: None,
+    fake_op: FakeOpaquePrompts,
+    monkeypatch: pytest.MonkeyPatch,
+) -> None:
+    """
+    Validates that consecutive turns of a conversation only sanitize the new
+    turns and are desanitized correctly
+    """
+
+    ########## ARRANGE ##########
+    monkeypatch.setenv("SANITIZE_CACHE_ENABLED", "true")
+    monkeypatch.setattr(sanitization_cache, "_cache", None)
+    first: Dict[str, Any] = {"prompt": "I am Alice", "history": []}
+    second: Dict[str, Any] = {
+        "prompt": "Carol is here",
+        "history": ["I am Alice", "Echo: I am Alice"],
+    }
+
+    ########## ACT ##########
+    asyncio.run(post_requests("/chat", [first]))
+    (response,) = asyncio.run(post_requests("/chat", [second]))
+
+    ########## ASSERT ##########
+    assert response.status_code == 200
+    assert response.json()["desanitizedResponse"] == "Echo: Carol is here"
+    assert fake_op.sanitize_calls[1] == {
+        "Ai 1": "Echo: I am Alice",
+        "prompt": "Carol is here",
+    }
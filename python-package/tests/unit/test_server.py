@@ -0,0 +1,218 @@
+"""
+Unit tests for server.py, using local fakes for Auth0, the OpaquePrompts
+service and the LLM
+"""
+import asyncio
+import time
+from typing import Any, Dict, List
+
+import httpx
+import pytest
+from conftest import FakeLLM, FakeOpaquePrompts, post_requests
+
+pytestmark = pytest.mark.usefixtures("fake_server")
+
+
+async def post_chats(bodies: List[Dict[str, Any]]) -> List[httpx.Response]:
+    return await post_requests("/chat", bodies)
+
+
+### Tests ###
+
+
+def test_chat_with_intermediate_outputs(fake_op: FakeOpaquePrompts) -> None:
+    """
+    Validates that /chat returns the sanitized prompt, the raw response and
+    the desanitized response
+    """
+    ########## ARRANGE ##########
+    body = {
+        "history": ["Hi, I am Bob", "Hello PERSON_2"],
+        "prompt": "Say hi to Alice",
+    }
+
+    ########## ACT ##########
+    (response,) = asyncio.run(post_chats([body]))
+
+    ########## ASSERT ##########
+    assert response.status_code == 200
+    assert response.json() == {
+        "desanitizedResponse": "Echo: Say hi to Alice",
+        "sanitizedPrompt": "Say hi to PERSON_1",
+        "rawResponse": "Echo: Say hi to PERSON_1",
+        "preScreen": None,
+        "model": "gpt-3.5-turbo",
+        "timings": None,
+    }
+    assert len(fake_op.sanitize_calls) == 1
+
+
+def test_chat_rejects_odd_history() -> None:
+    """
+    Validates that /chat rejects a history with an odd number of messages
+    """
+    ########## ACT ##########
+    (response,) = asyncio.run(post_chats([{"history": ["hi"], "prompt": "?"}]))
+
+    ########## ASSERT ##########
+    assert response.status_code == 400
+
+
+def test_chat_rejects_oversized_requests() -> None:
+    """
+    Validates that /chat rejects histories with too many messages and
+    messages that are too long, before they are sanitized
+    """
+    ########## ARRANGE ##########
+    from opchatserver.models import MAX_HISTORY_MESSAGES, MAX_MESSAGE_LENGTH
+
+    bodies = [
+        {"history": ["hi"] * (MAX_HISTORY_MESSAGES + 2), "prompt": "?"},
+        {"history": [], "prompt": "x" * (MAX_MESSAGE_LENGTH + 1)},
+        {"history": ["x" * (MAX_MESSAGE_LENGTH + 1), "hi"], "prompt": "?"},
+    ]
+
+    ########## ACT ##########
+    responses = asyncio.run(post_chats(bodies))
+
+    ########## ASSERT ##########
+    assert [response.status_code for response in responses] == [422] * 3
+
+
+def test_chat_response_is_serialized_by_alias() -> None:
+    """
+    Validates that the response body is compact UTF-8 JSON keyed by the
+    aliases of ChatResponse
+    """
+    ########## ARRANGE ##########
+    body = {"history": [], "prompt": "Hi Alice \u00e9"}
+
+    ########## ACT ##########
+    (response,) = asyncio.run(post_chats([body]))
+
+    ########## ASSERT ##########
+    assert response.headers["content-type"] == "application/json"
+    assert (
+        response.content
+        == (
+            '{"desanitizedResponse":"Echo: Hi Alice \u00e9",'
+            '"sanitizedPrompt":"Hi PERSON_1 \u00e9",'
+            '"rawResponse":"Echo: Hi PERSON_1 \u00e9",'
+            '"preScreen":null,"model":"gpt-3.5-turbo",'
+            '"timings":null}'
+        ).encode()
+    )
+
+
+def test_chat_does_not_block_event_loop(
+    fake_op: FakeOpaquePrompts, fake_llm: FakeLLM
+) -> None:
+    """
+    Validates that concurrent chats overlap their blocking sanitize and
+    desanitize calls and their LLM calls, instead of running one at a time
+    """
+    ########## ARRANGE ##########
+    fake_op.latency = 0.1
+    fake_llm.latency = 0.2
+    requests = 8
+    # Distinct prompts, which are not coalesced
+    bodies = [
+        {"history": [], "prompt": f"Say hi to Alice #{i}"}
+        for i in range(requests)
+    ]
+
+    ########## ACT ##########
+    start = time.perf_counter()
+    responses = asyncio.run(post_chats(bodies))
+    elapsed = time.perf_counter() - start
+
+    ########## ASSERT ##########
+    assert all(response.status_code == 200 for response in responses)
+    # One request takes 0.4s, so running them one at a time takes 3.2s
+    assert elapsed < 0.4 * requests / 2
+
+
+def test_token_is_verified_while_the_input_is_sanitized(
+    fake_op: FakeOpaquePrompts, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    """
+    Validates that the verification of the token overlaps the preparation
+    and the speculative sanitization of the chat
+    """
+    ########## ARRANGE ##########
+    from opchatserver.authorization import VerifyToken
+
+    def verify(self: VerifyToken, required_scopes: Any = None) -> Any:
+        time.sleep(0.2)
+        return {"sub": "user|1"}
+
+    monkeypatch.setattr(VerifyToken, "verify", verify)
+    monkeypatch.setenv("CHAT_SPECULATIVE_SANITIZE", "true")
+    fake_op.latency = 0.2
+    body = {"history": [], "prompt": "Say hi to Alice", "with_timings": True}
+
+    ########## ACT ##########
+    (response,) = asyncio.run(post_chats([body]))
+
+    ########## ASSERT ##########
+    assert response.status_code == 200
+    assert response.json()["desanitizedResponse"] == "Echo: Say hi to Alice"
+    timings = response.json()["timings"]
+    # Run one after the other, the stages take 600ms
+    sequential = timings["auth"] + timings["sanitize"] + timings["desanitize"]
+    assert timings["total"] < sequential - 100
+
+
+def test_rejected_token_cancels_the_chat(
+    fake_op: FakeOpaquePrompts,
+    fake_llm: FakeLLM,
+    monkeypatch: pytest.MonkeyPatch,
+) -> None:
+    """
+    Validates that a chat whose token is rejected stops before the LLM is
+    called, and gets the error of its token even if its body is invalid
+    """
+    ########## ARRANGE ##########
+    from fastapi import HTTPException
+    from opchatserver.authorization import VerifyToken
+
+    def verify(self: VerifyToken, required_scopes: Any = None) -> Any:
+        time.sleep(0.1)
+        raise HTTPException(status_code=401, detail="invalid token")
+
+    monkeypatch.setattr(VerifyToken, "verify", verify)
+    monkeypatch.setenv("CHAT_SPECULATIVE_SANITIZE", "true")
+    fake_op.latency = 0.2
+    bodies = [
+        {"history": [], "prompt": "Say hi to Alice"},
+        {"history": ["Hi"], "prompt": "Say hi to Bob"},
+    ]
+
+    ########## ACT ##########
+    responses = asyncio.run(post_chats(bodies))
+
+    ########## ASSERT ##########
+    assert [response.status_code for response in responses] == [401, 401]
+    assert fake_llm.calls == 0
+    assert fake_op.desanitize_calls == []
+
+
+def test_speculative_sanitize_is_admitted(
+    fake_op: FakeOpaquePrompts, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    """
+    Validates that the input of a chat is not sanitized speculatively when
+    the chat cannot be admitted right away
+    """
+    ########## ARRANGE ##########
+    monkeypatch.setenv("CHAT_SPECULATIVE_SANITIZE", "true")
+    monkeypatch.setenv("ADMISSION_MAX_IN_FLIGHT", "0")
+    monkeypatch.setenv("ADMISSION_MAX_QUEUE", "0")
+    body = {"history": [], "prompt": "Say hi to Alice"}
+
+    ########## ACT ##########
+    (response,) = asyncio.run(post_chats([body]))
+
+    ########## ASSERT ##########
+    assert response.status_code == 503
+    assert fake_op.sanitize_calls == []
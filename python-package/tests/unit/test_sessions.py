@@ -0,0 +1,245 @@
+"""
+Unit tests for sessions.py and the conversation_id of the chat endpoints
+"""
+import asyncio
+from pathlib import Path
+from typing import Any, Dict, List
+
+import httpx
+import pytest
+from conftest import AUTH_HEADERS, FakeOpaquePrompts, post_requests
+from opchatserver import sessions
+from opchatserver.sessions import (
+    InMemorySessionStore,
+    SessionStore,
+    SQLiteSessionStore,
+)
+
+
+async def post_sequentially(
+    path: str, bodies: List[Dict[str, Any]]
+) -> List[httpx.Response]:
+    """Post the bodies one after the other within a single lifespan"""
+    from opchatserver import server
+
+    async with server.app.router.lifespan_context(server.app):
+        transport = httpx.ASGITransport(app=server.app)
+        async with httpx.AsyncClient(
+            transport=transport, base_url="http://test"
+        ) as client:
+            return [
+                await client.post(path, json=body, headers=AUTH_HEADERS)
+                for body in bodies
+            ]
+
+
+### Tests ###
+
+
+def test_in_memory_store_keeps_last_turns() -> None:
+    """
+    Validates that a session only keeps its last `max_turns` turns
+    """
+    ########## ARRANGE ##########
+    store = InMemorySessionStore(max_turns=2)
+
+    ########## ACT ##########
+    for i in range(3):
+        store.append("session", f"prompt {i}", f"response {i}")
+
+    ########## ASSERT ##########
+    assert store.get("session") == [
+        "prompt 1",
+        "response 1",
+        "prompt 2",
+        "response 2",
+    ]
+    assert store.get("other session") == []
+
+
+def test_in_memory_store_evicts_sessions() -> None:
+    """
+    Validates that the least recently used sessions are evicted beyond the
+    limit
+    """
+    ########## ARRANGE ##########
+    store = InMemorySessionStore(max_sessions=2)
+
+    ########## ACT ##########
+    for key in ["a", "b", "c"]:
+        store.append(key, "prompt", "response")
+
+    ########## ASSERT ##########
+    assert store.get("a") == []
+    assert store.get("c") == ["prompt", "response"]
+
+
+def test_sessions_keep_the_turns_of_the_history_window(
+    monkeypatch: pytest.MonkeyPatch,
+) -> None:
+    """
+    Validates that the sessions keep as many turns as the history window
+    uses, unless SESSION_MAX_TURNS is set
+    """
+    ########## ARRANGE ##########
+    monkeypatch.setenv("HISTORY_MAX_TURNS", "12")
+    monkeypatch.delenv("SESSION_MAX_TURNS", raising=False)
+
+    ########## ACT ##########
+    store = sessions.create_session_store()
+    monkeypatch.setenv("SESSION_MAX_TURNS", "3")
+    overridden = sessions.create_session_store()
+
+    ########## ASSERT ##########
+    assert store is not None and store.max_turns == 12
+    assert overridden is not None and overridden.max_turns == 3
+
+
+def test_incomplete_store_cannot_be_created() -> None:
+    """
+    Validates that a session store missing a method fails when it is
+    created rather than when it is used
+    """
+
+    ########## ARRANGE ##########
+    class ReadOnlyStore(SessionStore):
+        def get(self, session_key: str) -> List[str]:
+            return []
+
+    ########## ACT & ASSERT ##########
+    with pytest.raises(TypeError):
+        ReadOnlyStore()  # type: ignore[abstract]
+
+
+def test_sqlite_store_persists_sessions(tmp_path: Path) -> None:
+    """
+    Validates that the sessions of the SQLite store survive the store and
+    only keep their last turns
+    """
+    ########## ARRANGE ##########
+    path = str(tmp_path / "sessions.db")
+    store = SQLiteSessionStore(path, max_turns=2)
+    for i in range(3):
+        store.append("session", f"prompt {i}", f"response {i}")
+    store.close()
+
+    ########## ACT ##########
+    store = SQLiteSessionStore(path, max_turns=2)
+    history = store.get("session")
+    store.close()
+
+    ########## ASSERT ##########
+    assert history == ["prompt 1", "response 1", "prompt 2", "response 2"]
+
+
+def test_sqlite_store_expires_sessions(
+    tmp_path: Path, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    """
+    Validates that a session expires `ttl` seconds after its last turn,
+    including its older turns
+    """
+    ########## ARRANGE ##########
+    now = [1000.0]
+    monkeypatch.setattr(sessions.time, "time", lambda: now[0])
+    store = SQLiteSessionStore(str(tmp_path / "sessions.db"), ttl=60)
+    store.append("session", "prompt 0", "response 0")
+    store.append("expired", "prompt", "response")
+    now[0] += 50
+    store.append("session", "prompt 1", "response 1")
+
+    ########## ACT ##########
+    now[0] += 50
+    history = store.get("session")
+    expired = store.get("expired")
+    store.close()
+
+    ########## ASSERT ##########
+    assert history == ["prompt 0", "response 0", "prompt 1", "response 1"]
+    assert expired == []
+
+
+@pytest.mark.usefixtures("fake_server")
+def test_chat_with_conversation_id(fake_op: FakeOpaquePrompts) -> None:
+    """
+    Validates that /chat uses and extends the history of the session of the
+    conversation_id
+    """
+    ########## ARRANGE ##########
+    bodies = [
+        {"conversation_id": "c1", "prompt": "I am Alice"},
+        {"conversation_id": "c1", "prompt": "Who am I?"},
+    ]
+
+    ########## ACT ##########
+    responses = asyncio.run(post_sequentially("/chat", bodies))
+
+    ########## ASSERT ##########
+    assert [response.status_code for response in responses] == [200, 200]
+    assert fake_op.sanitize_calls[1] == {
+        "prompt": "Who am I?",
+        "Human 1": "I am Alice",
+        "Ai 1": "Echo: I am Alice",
+    }
+
+
+@pytest.mark.usefixtures("fake_server")
+def test_chat_stream_saves_turn(
+    fake_op: FakeOpaquePrompts,
+    monkeypatch: pytest.MonkeyPatch,
+    tmp_path: Path,
+) -> None:
+    """
+    Validates that /chat/stream saves the desanitized response in the
+    session once it is complete, with a store shared across restarts
+    """
+    ########## ARRANGE ##########
+    monkeypatch.setenv("SESSION_STORE", "sqlite")
+    monkeypatch.setenv("SESSION_STORE_PATH", str(tmp_path / "sessions.db"))
+    asyncio.run(
+        post_requests(
+            "/chat/stream", [{"conversation_id": "c1", "prompt": "I am Bob"}]
+        )
+    )
+
+    ########## ACT ##########
+    (response,) = asyncio.run(
+        post_requests("/chat", [{"conversation_id": "c1", "prompt": "Hi"}])
+    )
+
+    ########## ASSERT ##########
+    assert response.status_code == 200
+    assert fake_op.sanitize_calls[1] == {
+        "prompt": "Hi",
+        "Human 1": "I am Bob",
+        "Ai 1": "Echo: I am Bob",
+    }
+
+
+@pytest.mark.usefixtures("fake_server")
+@pytest.mark.parametrize(
+    "session_store, body",
+    [
+        ("memory", {"conversation_id": "c1", "history": ["a", "b"]}),
+        ("none", {"conversation_id": "c1"}),
+    ],
+)
+def test_chat_with_invalid_conversation_id(
+    session_store: str,
+    body: Dict[str, Any],
+    monkeypatch: pytest.MonkeyPatch,
+) -> None:
+    """
+    Validates that a conversation_id is rejected along with a history, or if
+    sessions are disabled
+    """
+    ########## ARRANGE ##########
+    monkeypatch.setenv("SESSION_STORE", session_store)
+
+    ########## ACT ##########
+    (response,) = asyncio.run(
+        post_requests("/chat", [{"prompt": "Hi", **body}])
+    )
+
+    ########## ASSERT ##########
+    assert response.status_code == 400
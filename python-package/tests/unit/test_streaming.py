@@ -0,0 +1,138 @@
+"""
+Unit tests for streaming.py and the /chat/stream endpoint
+"""
+import asyncio
+import json
+from typing import Any, Dict, List, Tuple
+
+import pytest
+from conftest import FakeLLM, FakeOpaquePrompts, post_requests
+from opchatserver.streaming import PlaceholderSafeBuffer
+
+
+def stream_chat(body: Dict[str, Any]) -> List[Tuple[str, Dict[str, Any]]]:
+    """Post to /chat/stream and return the parsed events"""
+    (response,) = asyncio.run(post_requests("/chat/stream", [body]))
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("text/event-stream")
+    events = []
+    for block in response.text.strip().split("\n\n"):
+        event, data = block.split("\n")
+        events.append(
+            (event[len("event: ") :], json.loads(data[len("data: ") :]))
+        )
+    return events
+
+
+### Tests ###
+
+
+def test_buffer_holds_back_split_placeholder() -> None:
+    """
+    Validates that a placeholder split across chunks is released whole
+    """
+    ########## ARRANGE ##########
+    buffer = PlaceholderSafeBuffer()
+
+    ########## ACT ##########
+    released = [
+        buffer.push("Hello PERS"),
+        buffer.push("ON_"),
+        buffer.push("12, how"),
+        buffer.push(" are you"),
+        buffer.flush(),
+    ]
+
+    ########## ASSERT ##########
+    assert released == ["Hello ", "", "PERSON_12, how", " are you", ""]
+
+
+def test_buffer_releases_text_without_spaces() -> None:
+    """
+    Validates that text without spaces, e.g. in Chinese, is released as it
+    arrives rather than held back until the end of the stream
+    """
+    ########## ARRANGE ##########
+    buffer = PlaceholderSafeBuffer()
+    chunks = ["你好，", "我是一个", "乐于助人的", "助手。很高兴", "认识你"]
+
+    ########## ACT ##########
+    released = [buffer.push(chunk) for chunk in chunks]
+
+    ########## ASSERT ##########
+    assert released == chunks
+    assert buffer.flush() == ""
+
+
+@pytest.mark.usefixtures("fake_server")
+@pytest.mark.parametrize("chunk_size", [1, 3, 4, 100])
+def test_chat_stream_restores_split_placeholders(
+    chunk_size: int, fake_llm: FakeLLM
+) -> None:
+    """
+    Validates that the streamed tokens add up to the desanitized response,
+    whatever the chunk boundaries of the llm stream
+    """
+    ########## ARRANGE ##########
+    fake_llm.chunk_size = chunk_size
+    body = {"history": ["I am Bob", "Hi PERSON_2"], "prompt": "Hi to Alice!"}
+
+    ########## ACT ##########
+    events = stream_chat(body)
+
+    ########## ASSERT ##########
+    names = [event for event, _ in events]
+    assert names[0] == "sanitizedPrompt"
+    assert names[-2:] == ["rawResponse", "done"]
+    assert set(names[1:-2]) == {"token"}
+    assert events[0][1] == {"text": "Hi to PERSON_1!"}
+    assert events[-2][1] == {"text": "Echo: Hi to PERSON_1!"}
+    tokens = "".join(
+        data["text"] for event, data in events if event == "token"
+    )
+    assert tokens == "Echo: Hi to Alice!"
+
+
+@pytest.mark.usefixtures("fake_server")
+def test_chat_stream_without_intermediate_outputs(
+    fake_op: FakeOpaquePrompts,
+) -> None:
+    """
+    Validates that only tokens are streamed without intermediate outputs,
+    and that segments without placeholders are not sent to desanitize
+    """
+    ########## ARRANGE ##########
+    body = {
+        "history": [],
+        "prompt": "no names here",
+        "with_intermediate_outputs": False,
+    }
+
+    ########## ACT ##########
+    events = stream_chat(body)
+
+    ########## ASSERT ##########
+    assert {event for event, _ in events} == {"token", "done"}
+    assert fake_op.desanitize_calls == []
+
+
+@pytest.mark.usefixtures("fake_server")
+def test_chat_stream_reports_errors_in_band(
+    fake_llm: FakeLLM, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    """
+    Validates that a failure during generation ends the stream with an
+    error event
+    """
+
+    ########## ARRANGE ##########
+    def fail(prompt: str) -> str:
+        raise RuntimeError("llm failed")
+
+    monkeypatch.setattr(FakeLLM, "_respond", lambda self, prompt: fail(prompt))
+
+    ########## ACT ##########
+    events = stream_chat({"history": [], "prompt": "Hi"})
+
+    ########## ASSERT ##########
+    assert events[-1] == ("error", {"detail": "llm failed"})
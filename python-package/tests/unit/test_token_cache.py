@@ -0,0 +1,304 @@
+"""
+Unit tests for the JWKS key store and the verified token cache in
+authorization.py. These tests use a local JWKS server instead of Auth0.
+"""
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Dict, Iterator, List
+
+import jwt
+import pytest
+from cryptography.hazmat.primitives.asymmetric import rsa
+from fastapi.exceptions import HTTPException
+from opchatserver import authorization
+from opchatserver.authorization import JWKSKeyStore, VerifyToken
+from opchatserver.cache import TTLCache
+
+DOMAIN = "test-domain.local"
+AUDIENCE = "https://test-audience.local"
+SCOPE = "use:opaque-prompts-chat-bot"
+
+
+class JWKSServer:
+    """A local JWKS endpoint which counts the number of fetches"""
+
+    def __init__(self) -> None:
+        self.keys: List[Dict[str, Any]] = []
+        self.fetches = 0
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self) -> None:
+                server.fetches += 1
+                body = json.dumps({"keys": server.keys}).encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args: Any) -> None:
+                pass
+
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.url = (
+            f"http://127.0.0.1:{self.httpd.server_port}/.well-known/jwks.json"
+        )
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+
+    def add_key(self, kid: str) -> rsa.RSAPrivateKey:
+        private_key = rsa.generate_private_key(
+            public_exponent=65537, key_size=2048
+        )
+        jwk = json.loads(
+            jwt.algorithms.RSAAlgorithm.to_jwk(private_key.public_key())
+        )
+        jwk.update({"kid": kid, "use": "sig", "alg": "RS256"})
+        self.keys.append(jwk)
+        return private_key
+
+
+def make_token(
+    private_key: rsa.RSAPrivateKey,
+    kid: str,
+    expires_in: float = 3600,
+    scope: str = SCOPE,
+) -> str:
+    return jwt.encode(
+        {
+            "sub": "user|1",
+            "aud": AUDIENCE,
+            "iss": f"https://{DOMAIN}/",
+            "exp": int(time.time() + expires_in),
+            "scope": scope,
+        },
+        private_key,
+        algorithm="RS256",
+        headers={"kid": kid},
+    )
+
+
+### Fixtures ###
+
+
+@pytest.fixture
+def jwks_server() -> Iterator[JWKSServer]:
+    server = JWKSServer()
+    yield server
+    server.httpd.shutdown()
+
+
+@pytest.fixture
+def key_store(
+    jwks_server: JWKSServer, monkeypatch: pytest.MonkeyPatch
+) -> JWKSKeyStore:
+    key_store = JWKSKeyStore(jwks_server.url, min_refetch_interval=0)
+    monkeypatch.setattr(authorization, "_key_stores", {DOMAIN: key_store})
+    monkeypatch.setattr(
+        authorization, "_verified_tokens", TTLCache(maxsize=16, ttl=300)
+    )
+    monkeypatch.setattr(VerifyToken, "domain", DOMAIN)
+    monkeypatch.setattr(VerifyToken, "audience", AUDIENCE)
+    return key_store
+
+
+### Tests ###
+
+
+def test_ttl_cache_evicts_least_recently_used() -> None:
+    """
+    Validates that TTLCache evicts the least recently used entry when full
+    """
+    ########## ARRANGE ##########
+    cache: TTLCache[int] = TTLCache(maxsize=2, ttl=60)
+    cache.set("a", 1)
+    cache.set("b", 2)
+
+    ########## ACT ##########
+    cache.get("a")
+    cache.set("c", 3)
+
+    ########## ASSERT ##########
+    assert cache.get("a") == 1
+    assert cache.get("b") is None
+    assert cache.get("c") == 3
+
+
+def test_ttl_cache_expires_entries() -> None:
+    """
+    Validates that TTLCache drops entries once their time-to-live elapses,
+    including entries with their own shorter time-to-live
+    """
+    ########## ARRANGE ##########
+    now = [0.0]
+    cache: TTLCache[int] = TTLCache(maxsize=4, ttl=10, timer=lambda: now[0])
+    cache.set("default", 1)
+    cache.set("short", 2, ttl=1)
+    cache.set("expired", 3, ttl=-1)
+
+    ########## ACT ##########
+    now[0] = 5
+
+    ########## ASSERT ##########
+    assert cache.get("default") == 1
+    assert cache.get("short") is None
+    assert cache.get("expired") is None
+    now[0] = 11
+    assert cache.get("default") is None
+
+
+def test_key_store_fetches_once(
+    jwks_server: JWKSServer, key_store: JWKSKeyStore
+) -> None:
+    """
+    Validates that the JWKS is fetched once for many tokens signed with a
+    known key
+    """
+    ########## ARRANGE ##########
+    private_key = jwks_server.add_key("key-1")
+
+    ########## ACT ##########
+    for i in range(5):
+        VerifyToken(make_token(private_key, "key-1", 3600 + i)).verify()
+
+    ########## ASSERT ##########
+    assert jwks_server.fetches == 1
+
+
+def test_key_store_refetches_unknown_kid(
+    jwks_server: JWKSServer, key_store: JWKSKeyStore
+) -> None:
+    """
+    Validates that a token signed with a rotated-in key triggers a refetch
+    """
+    ########## ARRANGE ##########
+    first_key = jwks_server.add_key("key-1")
+    VerifyToken(make_token(first_key, "key-1")).verify()
+    second_key = jwks_server.add_key("key-2")
+
+    ########## ACT ##########
+    VerifyToken(make_token(second_key, "key-2")).verify()
+
+    ########## ASSERT ##########
+    assert jwks_server.fetches == 2
+
+
+def test_key_store_rate_limits_unknown_kid(jwks_server: JWKSServer) -> None:
+    """
+    Validates that unknown key ids do not trigger a refetch within the
+    minimum refetch interval
+    """
+    ########## ARRANGE ##########
+    jwks_server.add_key("key-1")
+    key_store = JWKSKeyStore(jwks_server.url, min_refetch_interval=60)
+    key_store.get_signing_key("key-1")
+
+    ########## ACT & ASSERT ##########
+    for _ in range(3):
+        with pytest.raises(jwt.PyJWKClientError):
+            key_store.get_signing_key("unknown")
+    assert jwks_server.fetches == 1
+
+
+def test_key_store_fetches_once_for_unknown_kid_after_ttl(
+    jwks_server: JWKSServer,
+) -> None:
+    """
+    Validates that an unknown key id after the keys expired costs a single
+    fetch, rather than a refresh followed by a rotation refetch
+    """
+    ########## ARRANGE ##########
+    jwks_server.add_key("key-1")
+    key_store = JWKSKeyStore(jwks_server.url, ttl=0.05, min_refetch_interval=0)
+    key_store.get_signing_key("key-1")
+    time.sleep(0.1)
+
+    ########## ACT ##########
+    with pytest.raises(jwt.PyJWKClientError):
+        key_store.get_signing_key("unknown")
+
+    ########## ASSERT ##########
+    assert jwks_server.fetches == 2
+
+
+def test_key_store_refreshes_in_background(jwks_server: JWKSServer) -> None:
+    """
+    Validates that keys close to expiry are served while they are refreshed
+    in the background
+    """
+    ########## ARRANGE ##########
+    jwks_server.add_key("key-1")
+    key_store = JWKSKeyStore(jwks_server.url, ttl=60, refresh_margin=60)
+    key_store.get_signing_key("key-1")
+
+    ########## ACT ##########
+    key_store.get_signing_key("key-1")
+
+    ########## ASSERT ##########
+    deadline = time.monotonic() + 5
+    while jwks_server.fetches < 2 and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert jwks_server.fetches == 2
+
+
+def test_verified_token_cache_skips_decode(
+    jwks_server: JWKSServer,
+    key_store: JWKSKeyStore,
+    monkeypatch: pytest.MonkeyPatch,
+) -> None:
+    """
+    Validates that a verified token is not decoded again, while scopes are
+    still checked on every call
+    """
+    ########## ARRANGE ##########
+    token = make_token(jwks_server.add_key("key-1"), "key-1")
+    VerifyToken(token).verify([SCOPE])
+
+    def fail(*args: Any, **kwargs: Any) -> None:
+        raise AssertionError("token decoded again")
+
+    monkeypatch.setattr(jwt, "decode", fail)
+
+    ########## ACT & ASSERT ##########
+    assert VerifyToken(token).verify([SCOPE])["sub"] == "user|1"
+    with pytest.raises(HTTPException):
+        VerifyToken(token).verify(["missing-scope"])
+
+
+def test_verified_token_cache_respects_audience(
+    jwks_server: JWKSServer, key_store: JWKSKeyStore
+) -> None:
+    """
+    Validates that a token verified for one audience is not accepted from
+    the cache for another audience
+    """
+    ########## ARRANGE ##########
+    token = make_token(jwks_server.add_key("key-1"), "key-1")
+    VerifyToken(token).verify()
+    token_verifier = VerifyToken(token)
+    token_verifier.audience = "https://different-audience.com"
+
+    ########## ACT & ASSERT ##########
+    with pytest.raises(HTTPException):
+        token_verifier.verify()
+
+
+def test_verified_token_cache_bounded_by_exp(
+    jwks_server: JWKSServer, key_store: JWKSKeyStore
+) -> None:
+    """
+    Validates that a cached token is rejected once it expires
+    """
+    ########## ARRANGE ##########
+    # exp is rounded down, so the token is valid for at least one second
+    token = make_token(jwks_server.add_key("key-1"), "key-1", expires_in=2)
+    VerifyToken(token).verify()
+
+    ########## ACT ##########
+    time.sleep(2.5)
+
+    ########## ASSERT ##########
+    with pytest.raises(HTTPException):
+        VerifyToken(token).verify()
@@ -0,0 +1,143 @@
+"""
+Unit tests for tracing.py and the tracing of the chat endpoints
+"""
+import asyncio
+import json
+from pathlib import Path
+from typing import Any, Dict, List
+
+import httpx
+import pytest
+from conftest import AUTH_HEADERS
+from opchatserver.metrics import track_stage
+from opchatserver.tracing import Span, Trace, _current_span, start_span
+
+TRACE_ID = "0af7651916cd43dd8448eb211c80319c"
+CLIENT_SPAN_ID = "b7ad6b7169203331"
+
+
+async def post_chat(
+    body: Dict[str, Any], headers: Dict[str, str]
+) -> httpx.Response:
+    """Post a chat to the server within its lifespan"""
+    from opchatserver import server
+
+    async with server.app.router.lifespan_context(server.app):
+        transport = httpx.ASGITransport(app=server.app)
+        async with httpx.AsyncClient(
+            transport=transport, base_url="http://test"
+        ) as client:
+            return await client.post(
+                "/chat", json=body, headers={**AUTH_HEADERS, **headers}
+            )
+
+
+### Tests ###
+
+
+def test_stages_are_not_recorded_by_default() -> None:
+    """
+    Validates that stages only record spans in requests which are recorded
+    """
+    ########## ARRANGE ##########
+    trace = Trace("request", TRACE_ID)
+    token = _current_span.set(Span(trace, None, "POST /chat"))
+
+    ########## ACT ##########
+    try:
+        with track_stage("sanitize"):
+            pass
+        trace.recording = True
+        with track_stage("llm"):
+            with track_stage("desanitize"):
+                pass
+    finally:
+        _current_span.reset(token)
+
+    ########## ASSERT ##########
+    assert [span.name for span in trace.spans] == ["desanitize", "llm"]
+    desanitize, llm = trace.spans
+    assert desanitize.parent is llm
+    assert set(trace.timings()) == {"llm", "desanitize", "total"}
+    assert start_span("outside of a request") is None
+
+
+@pytest.mark.usefixtures("fake_server")
+def test_chat_returns_timings_and_request_id(
+    monkeypatch: pytest.MonkeyPatch,
+) -> None:
+    """
+    Validates that a chat returns the time taken by each stage when asked
+    to, and its request ID, without tracing being enabled
+    """
+    ########## ARRANGE ##########
+    monkeypatch.delenv("TRACING_EXPORTER", raising=False)
+    body = {"history": [], "prompt": "Hi, I am Alice.", "with_timings": True}
+
+    ########## ACT ##########
+    response = asyncio.run(post_chat(body, {"X-Request-ID": "req-42"}))
+
+    ########## ASSERT ##########
+    assert response.headers["X-Request-ID"] == "req-42"
+    timings = response.json()["timings"]
+    assert set(timings) == {
+        "auth",
+        "memory",
+        "admission",
+        "sanitize",
+        "llm",
+        "desanitize",
+        "total",
+    }
+    assert all(ms >= 0 for ms in timings.values())
+    assert timings["total"] >= timings["llm"]
+
+
+@pytest.mark.usefixtures("fake_server")
+def test_traces_are_exported_to_a_file(
+    monkeypatch: pytest.MonkeyPatch, tmp_path: Path
+) -> None:
+    """
+    Validates that the spans of a chat are exported as OTLP/JSON, in the
+    trace of the client, when the file exporter is enabled
+    """
+    ########## ARRANGE ##########
+    path = tmp_path / "traces.jsonl"
+    monkeypatch.setenv("TRACING_EXPORTER", "file")
+    monkeypatch.setenv("TRACING_FILE", str(path))
+    headers = {"traceparent": f"00-{TRACE_ID}-{CLIENT_SPAN_ID}-01"}
+
+    ########## ACT ##########
+    response = asyncio.run(
+        post_chat({"history": [], "prompt": "Hi, I am Bob."}, headers)
+    )
+
+    ########## ASSERT ##########
+    assert response.status_code == 200
+    assert response.json()["timings"] is None
+    assert response.headers["X-Request-ID"] == TRACE_ID
+    spans: List[Dict[str, Any]] = [
+        span
+        for line in path.read_text().splitlines()
+        for resource_spans in json.loads(line)["resourceSpans"]
+        for scope_spans in resource_spans["scopeSpans"]
+        for span in scope_spans["spans"]
+    ]
+    root = next(span for span in spans if span["name"] == "POST /chat")
+    assert root["parentSpanId"] == CLIENT_SPAN_ID
+    assert {"key": "request.id", "value": {"stringValue": TRACE_ID}} in (
+        root["attributes"]
+    )
+    stages = {span["name"]: span for span in spans if span is not root}
+    assert set(stages) == {
+        "auth",
+        "memory",
+        "admission",
+        "sanitize",
+        "llm",
+        "desanitize",
+    }
+    for span in stages.values():
+        assert span["traceId"] == TRACE_ID
+        assert span["parentSpanId"] == root["spanId"]
+        assert int(span["endTimeUnixNano"]) >= int(span["startTimeUnixNano"])
@@ -0,0 +1,172 @@
+"""
+Unit tests for warmup.py and the /ready endpoint of the server
+"""
+import asyncio
+import os
+import subprocess
+import sys
+import threading
+from typing import List
+
+import httpx
+import pytest
+from conftest import AUTH_HEADERS, FakeLLM
+from opchatserver.warmup import WarmUp
+
+SRC_DIR = os.path.join(os.path.dirname(__file__), "..", "..", "src")
+
+
+### Fixtures ###
+
+
+@pytest.fixture
+def jwks_gate(monkeypatch: pytest.MonkeyPatch) -> threading.Event:
+    """
+    Holds the JWKS prefetch of the warm-up until the returned event is set
+    """
+    from opchatserver.authorization import JWKSKeyStore
+
+    gate = threading.Event()
+    monkeypatch.setattr(
+        JWKSKeyStore, "refresh", lambda self: gate.wait(timeout=10)
+    )
+    return gate
+
+
+### Tests ###
+
+
+def test_importing_the_server_does_not_import_langchain() -> None:
+    """
+    Validates that the server module is imported without LangChain, which
+    is loaded by the warm-up instead
+    """
+    ########## ARRANGE ##########
+    code = (
+        "import sys, opchatserver.server; "
+        "print(sorted(m for m in sys.modules if m.startswith('langchain')))"
+    )
+    env = dict(os.environ, PYTHONPATH=SRC_DIR)
+
+    ########## ACT ##########
+    result = subprocess.run(
+        [sys.executable, "-c", code],
+        capture_output=True,
+        text=True,
+        env=env,
+        check=True,
+    )
+
+    ########## ASSERT ##########
+    assert result.stdout.strip() == "[]"
+
+
+def test_server_is_ready_after_warm_up(
+    fake_server: None, jwks_gate: threading.Event
+) -> None:
+    """
+    Validates that /ready answers 503 until the pipeline is loaded and the
+    JWKS are prefetched, and 200 afterwards
+    """
+    from opchatserver import server
+
+    async def check_readiness() -> List[httpx.Response]:
+        async with server.app.router.lifespan_context(server.app):
+            transport = httpx.ASGITransport(app=server.app)
+            async with httpx.AsyncClient(
+                transport=transport, base_url="http://test"
+            ) as client:
+                ########## ACT ##########
+                before = await client.get("/ready")
+                jwks_gate.set()
+                while not server.app.state.warm_up.ready:
+                    await asyncio.sleep(0.01)
+                after = await client.get("/ready")
+        return [before, after]
+
+    ########## ARRANGE ##########
+    # See check_readiness
+
+    before, after = asyncio.run(check_readiness())
+
+    ########## ASSERT ##########
+    assert before.status_code == 503
+    assert before.json()["ready"] is False
+    assert before.json()["steps"]["jwks"] is False
+    assert after.status_code == 200
+    assert after.json() == {
+        "ready": True,
+        "steps": {"pipeline": True, "jwks": True},
+        "draining": False,
+    }
+
+
+def test_chat_is_served_during_warm_up(
+    fake_server: None, fake_llm: FakeLLM, jwks_gate: threading.Event
+) -> None:
+    """
+    Validates that a chat sent before the warm-up is done is answered,
+    loading the pipeline itself if needed
+    """
+    from opchatserver import server
+
+    async def chat() -> httpx.Response:
+        async with server.app.router.lifespan_context(server.app):
+            transport = httpx.ASGITransport(app=server.app)
+            async with httpx.AsyncClient(
+                transport=transport, base_url="http://test"
+            ) as client:
+                ########## ACT ##########
+                response = await client.post(
+                    "/chat",
+                    json={"history": [], "prompt": "Hi, I am Alice."},
+                    headers=AUTH_HEADERS,
+                )
+                assert not server.app.state.warm_up.ready
+                jwks_gate.set()
+        return response
+
+    ########## ARRANGE ##########
+    # See chat
+
+    response = asyncio.run(chat())
+
+    ########## ASSERT ##########
+    assert response.status_code == 200
+    assert response.json()["desanitizedResponse"] == "Echo: Hi, I am Alice."
+    assert fake_llm.calls == 1
+
+
+def test_failed_steps_are_retried() -> None:
+    """
+    Validates that a failed step of the warm-up is retried until it
+    succeeds, and that the pipeline is loaded once
+    """
+    ########## ARRANGE ##########
+    pipeline_loads: List[int] = []
+    jwks_attempts: List[int] = []
+
+    def load_pipeline() -> None:
+        pipeline_loads.append(1)
+
+    def prefetch_jwks() -> None:
+        jwks_attempts.append(1)
+        if len(jwks_attempts) < 3:
+            raise ConnectionError("JWKS unavailable")
+
+    warm_up = WarmUp(load_pipeline, prefetch_jwks, retry_delay=0.001)
+
+    async def run() -> None:
+        warm_up.start()
+        while not warm_up.ready:
+            await asyncio.sleep(0.001)
+        await warm_up.load_pipeline()
+        await warm_up.stop()
+
+    ########## ACT ##########
+    asyncio.run(run())
+
+    ########## ASSERT ##########
+    assert warm_up.ready
+    assert len(pipeline_loads) == 1
+    assert len(jwks_attempts) == 3